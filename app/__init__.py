@@ -3,14 +3,16 @@ Flask application factory for experimental chat interface.
 """
 
 import os
+import time
+import typing
+from datetime import datetime
 from functools import lru_cache
 from pathlib import Path
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 import dotenv
-import openai
+
+import response_cache
 
 # Load environment variables
 dotenv.load_dotenv()
@@ -18,11 +20,35 @@ dotenv.load_dotenv()
 # Initialize extensions
 db = SQLAlchemy()
 
-#limiter = Limiter(
-#    key_func=get_remote_address,
-#    default_limits=["200 per day", "50 per hour"],
-#    storage_uri="memory://",
-#)
+# Startup warm-up state, reported by /ready (see warm_up())
+warm_status: typing.Dict[str, typing.Any] = {
+    'conditions': False,
+    'client': False,
+    'state': False,
+    'pages': 0,
+    'warmed_at': None,
+    'duration_ms': None,
+    'pid': None,
+}
+
+
+def configure_sqlite(dbapi_connection, connection_record) -> None:
+    """
+    Set up each new SQLite connection for several workers sharing the file.
+
+    In WAL mode readers (history loads, exports) no longer block a writer or
+    the other way round, and commits append to the log with one sync per
+    checkpoint rather than per transaction. A write still waits for the
+    other workers' writes (up to sqlite3's 5 second default timeout):
+    SQLite commits one at a time, so with many workers or hosts use
+    PostgreSQL (DATABASE_URL=postgresql://...).
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    finally:
+        cursor.close()
 
 
 @lru_cache(maxsize=1)
@@ -36,6 +62,10 @@ def get_azure_client():
     Returns:
         Cached AzureOpenAI client instance
     """
+    # Deferred: openai is the heaviest import and not needed until the first
+    # model call (or warm_up), so db_utils and other tools start faster
+    import openai
+    
     return openai.AzureOpenAI(
         api_version=os.environ["MODEL_API_VERSION"],
         azure_endpoint=os.environ["MODEL_ENDPOINT"],
@@ -43,9 +73,89 @@ def get_azure_client():
     )
 
 
+def warm_up(app: Flask, config_file: typing.Optional[str] = None) -> typing.Dict[str, typing.Any]:
+    """
+    Load conditions of every study, render their chat pages and build the Azure client ahead of the first request.
+    
+    Intended for the WSGI entry point: with gunicorn --preload it runs once in
+    the master process, and forked workers inherit the parsed conditions, the
+    imported openai package and the client instead of building them lazily on
+    their first request. This is fork-safe because:
+    
+    - Conditions and rendered chat pages are plain immutable data
+    - The client opens no connections until its first request
+    - Database connections opened during startup are disposed here, so
+      workers never share a pooled SQLite/Postgres connection
+    
+    Failures are logged and leave the corresponding flag False; the lazy
+    paths still work on first use.
+    
+    Args:
+        app: Flask application
+        config_file: Only preload this conditions file (default: all studies, see app.studies)
+    
+    Returns:
+        The updated warm_status dictionary
+    """
+    from bot import load_experiment_config, _load_conditions_file
+    from app.studies import list_studies
+    
+    start = time.perf_counter()
+    
+    try:
+        # Parse every condition once - also surfaces config errors at startup
+        config_files = [config_file] if config_file else list(list_studies().values())
+        for path in config_files:
+            conditions = _load_conditions_file(path)["conditions"]
+            for condition_index in range(len(conditions)):
+                load_experiment_config(condition_index, path)
+        warm_status['conditions'] = bool(config_files)
+    except Exception as e:
+        print(f"⚠️  Warm-up: could not preload conditions: {e}")
+    
+    try:
+        get_azure_client()
+        warm_status['client'] = True
+    except Exception as e:
+        print(f"⚠️  Warm-up: could not create model client: {e}")
+    
+    try:
+        # Fork-safe: the redis client opens fresh connections in each forked worker
+        from app.state import get_state
+        warm_status['state'] = get_state().ping()
+    except Exception as e:
+        print(f"⚠️  Warm-up: shared state backend unavailable: {e}")
+    
+    if not config_file:
+        try:
+            # Each condition's chat page shell (see app.pages)
+            from app.pages import prerender_all
+            from app.routes import HISTORY_PAGE_SIZE
+            with app.app_context():
+                warm_status['pages'] = prerender_all(HISTORY_PAGE_SIZE)
+        except Exception as e:
+            print(f"⚠️  Warm-up: could not render chat pages: {e}")
+    
+    with app.app_context():
+        db.engine.dispose()
+    
+    warm_status['warmed_at'] = datetime.utcnow().isoformat()
+    warm_status['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    warm_status['pid'] = os.getpid()
+    print(f"🔥 Warm-up finished in {warm_status['duration_ms']}ms "
+          f"(conditions: {warm_status['conditions']}, client: {warm_status['client']}, "
+          f"state: {warm_status['state']}, pages: {warm_status['pages']})")
+    
+    return warm_status
+
+
 def create_app(config_name=None):
     """Application factory pattern."""
-    app = Flask(__name__)
+    # Static files are served by app.assets (fingerprinted, pre-compressed, cached)
+    app = Flask(__name__, static_folder=None)
+    
+    # Development response cache must never serve live participants
+    response_cache.forbid_in_live_server()
     
     # Validate required environment variables on startup
     # Note: Model parameters (temperature, max_completion_tokens) are now configured
@@ -87,8 +197,10 @@ def create_app(config_name=None):
     
     # Initialize extensions with app
     db.init_app(app)
-
-    #limiter.init_app(app)
+    if db_path.startswith('sqlite:') and 'mode=ro' not in db_path:
+        from sqlalchemy import event
+        with app.app_context():
+            event.listen(db.engine, 'connect', configure_sqlite)
     
     # Security headers for iframe embedding control
     @app.after_request
@@ -138,9 +250,27 @@ def create_app(config_name=None):
         
         return response
     
+    # Static assets, and compression of pages and API responses
+    from app import assets, pages
+    assets.init_app(app)
+    
+    # Compiled templates cached on disk (rendered chat pages are cached per condition)
+    pages.init_app(app)
+    
+    # Workers join profiling sessions started from the admin dashboard
+    from app import profiling
+    profiling.init_app(app)
+    
     # Register blueprints
     from app.routes import main_bp
+    from app.admin import admin_bp
     app.register_blueprint(main_bp)
+    app.register_blueprint(admin_bp)
+    
+    # One trace per participant request, with its queries and model attempts
+    import tracing
+    from app.routes import TRACED_ENDPOINTS
+    tracing.init_app(app, TRACED_ENDPOINTS)
     
     # Create database tables (safe for multi-worker environments)
     with app.app_context():
@@ -148,6 +278,9 @@ def create_app(config_name=None):
         if db_path.startswith('sqlite:///'):
             # Handle both sqlite:/// (relative) and sqlite://// (absolute)
             path_part = db_path.replace('sqlite:///', '')
+            # URI filenames, e.g. a read-only snapshot: sqlite:///file:/path/x.db?mode=ro&uri=true
+            if path_part.startswith('file:'):
+                path_part = path_part[len('file:'):].split('?')[0]
             db_dir = Path(path_part).parent
             db_dir.mkdir(parents=True, exist_ok=True)
         
@@ -156,5 +289,20 @@ def create_app(config_name=None):
         except Exception as e:
             # Tables may already exist from another worker - this is fine
             app.logger.debug(f"Database initialization: {e}")
+        
+        # Add columns/indexes introduced since the database was created
+        from app.migrations import upgrade_schema
+        try:
+            upgrade_schema()
+        except Exception as e:
+            # Another worker may be applying the same upgrade
+            app.logger.warning(f"Schema upgrade: {e}")
+        
+        # Full-text index over messages, kept in sync by triggers (see app/search.py)
+        from app.search import ensure_search_index
+        try:
+            ensure_search_index()
+        except Exception as e:
+            app.logger.warning(f"Search index: {e}")
     
     return app
\ No newline at end of file
@@ -0,0 +1,287 @@
+"""
+Admin dashboard for monitoring a running study.
+
+Disabled unless ADMIN_TOKEN is set. The API only accepts the token as a
+Bearer Authorization header, never in a URL, where access logs and browser
+history would keep it. The dashboard page holds no data: it is opened as
+/admin#token=..., its script reads the token from the URL fragment (which
+browsers do not send), and exchanges it for a stream token. EventSource
+cannot send headers, so the metrics stream alone takes ?stream_token=: an
+HMAC of ADMIN_TOKEN that expires after STREAM_TOKEN_TTL_SECONDS.
+
+Metrics come from the incrementally maintained counters in app.metrics, so
+refreshing the dashboard never scans the messages table. Each view shows
+one study, chosen with ?study= (default: the default study).
+
+/admin/api/profile turns on profiling of the chat routes for a few seconds
+(stage histograms and sampled stacks, see app.profiling).
+/admin/api/traces lists the worker's recent request traces (see tracing).
+"""
+
+import os
+import hmac
+import time
+import json
+import hashlib
+import secrets
+import functools
+
+from flask import Blueprint, render_template, jsonify, request, abort, Response, stream_with_context
+
+import tracing
+from app import db, metrics, profiling
+from app.studies import DEFAULT_STUDY, list_studies
+from app.validation import STUDY_ID_PATTERN
+
+admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
+
+DEFAULT_WINDOW_MINUTES = 15
+MAX_WINDOW_MINUTES = 24 * 60
+STREAM_INTERVAL_SECONDS = 5
+# Streams end after this long and the browser reconnects, so a dashboard
+# left open never ties up a worker indefinitely
+STREAM_MAX_SECONDS = 300
+DEFAULT_PROFILE_SECONDS = 30
+DEFAULT_TRACE_LIMIT = 50
+MAX_SAMPLE_INTERVAL_MS = 1000
+# Stream tokens only need to be valid when a stream connects; the page gets
+# a new one for each reconnection
+STREAM_TOKEN_TTL_SECONDS = 60
+
+
+def _admin_token():
+    """Return ADMIN_TOKEN (404 when unset: the dashboard is disabled)."""
+    admin_token = os.environ.get('ADMIN_TOKEN', '')
+    if not admin_token:
+        abort(404)
+    return admin_token
+
+
+def _bearer_token():
+    """Return the Bearer token of the current request, if any."""
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        return auth_header[len('Bearer '):]
+    return ''
+
+
+def _is_admin(admin_token):
+    """Check the Bearer token of the current request against ADMIN_TOKEN."""
+    return secrets.compare_digest(_bearer_token().encode('utf-8'), admin_token.encode('utf-8'))
+
+
+def _sign(admin_token, expires):
+    """HMAC of a stream token's expiry under ADMIN_TOKEN."""
+    return hmac.new(admin_token.encode('utf-8'), f"admin-stream:{expires}".encode('ascii'),
+                    hashlib.sha256).hexdigest()
+
+
+def issue_stream_token(admin_token, now=None):
+    """Create a stream token: its expiry (Unix time) and the HMAC of it under ADMIN_TOKEN."""
+    expires = int((time.time() if now is None else now) + STREAM_TOKEN_TTL_SECONDS)
+    return f"{expires}.{_sign(admin_token, expires)}"
+
+
+def check_stream_token(admin_token, stream_token, now=None):
+    """Check that a stream token was issued with this ADMIN_TOKEN and has not expired."""
+    expires, _, signature = stream_token.partition('.')
+    if not expires.isdigit() or int(expires) < (time.time() if now is None else now):
+        return False
+    return secrets.compare_digest(signature.encode('utf-8'), _sign(admin_token, int(expires)).encode('utf-8'))
+
+
+def require_admin(view):
+    """Decorator that rejects requests without ADMIN_TOKEN as a Bearer header."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _is_admin(_admin_token()):
+            return jsonify({'error': 'Invalid admin token'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _window_minutes():
+    """Read the aggregation window from the request (minutes, clamped)."""
+    window = request.args.get('window', DEFAULT_WINDOW_MINUTES, type=int)
+    return max(1, min(window, MAX_WINDOW_MINUTES))
+
+
+def _profile_session():
+    """Read the profiling session to report from the request (default: the latest)."""
+    session_id = request.args.get('session')
+    if session_id is not None and not (len(session_id) <= 32 and session_id.isalnum()):
+        abort(404)
+    return session_id
+
+
+def _study_id():
+    """Read the study to show from the request (404 for a malformed ID)."""
+    study_id = request.args.get('study') or DEFAULT_STUDY
+    if STUDY_ID_PATTERN.fullmatch(study_id) is None:
+        abort(404)
+    return study_id
+
+
+@admin_bp.route('')
+def dashboard():
+    """
+    Live dashboard page, opened as /admin#token=... (metrics are pushed via
+    /admin/api/metrics/stream). The page itself contains no study data.
+    """
+    _admin_token()
+    return render_template('admin.html',
+                           window=_window_minutes(),
+                           study=_study_id(),
+                           interval=STREAM_INTERVAL_SECONDS)
+
+
+@admin_bp.route('/api/stream-token', methods=['POST'])
+@require_admin
+def stream_token():
+    """A short-lived token for one connection to the metrics stream, and the studies to link to."""
+    return jsonify({
+        'stream_token': issue_stream_token(_admin_token()),
+        'expires_in': STREAM_TOKEN_TTL_SECONDS,
+        'studies': list(list_studies()),
+    })
+
+
+@admin_bp.route('/api/metrics')
+@require_admin
+def metrics_snapshot():
+    """Current metrics as JSON (for polling or scripts)."""
+    return jsonify(metrics.summarize(_window_minutes(), _study_id()))
+
+
+@admin_bp.route('/api/metrics/stream')
+def metrics_stream():
+    """
+    Server-sent events: a metrics snapshot every STREAM_INTERVAL_SECONDS.
+
+    Takes a Bearer header, or a ?stream_token= from /admin/api/stream-token
+    (checked when the stream connects).
+    """
+    admin_token = _admin_token()
+    if not (_is_admin(admin_token) or check_stream_token(admin_token, request.args.get('stream_token', ''))):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    window = _window_minutes()
+    study_id = _study_id()
+    
+    def generate():
+        # Reconnect delay for the browser once this stream ends
+        yield f"retry: {STREAM_INTERVAL_SECONDS * 1000}\n\n"
+        
+        deadline = time.time() + STREAM_MAX_SECONDS
+        while time.time() < deadline:
+            try:
+                snapshot = metrics.summarize(window, study_id)
+                yield f"data: {json.dumps(snapshot)}\n\n"
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            finally:
+                # Don't hold a connection (or a SQLite read snapshot) while sleeping
+                db.session.remove()
+            time.sleep(STREAM_INTERVAL_SECONDS)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+
+@admin_bp.route('/api/profile', methods=['POST'])
+@require_admin
+def start_profile():
+    """
+    Profile every serving worker for ?seconds= (default 30).
+
+    ?interval_ms= sets the stack sampling interval (default 10);
+    ?sample=0 records the stage histograms only.
+    """
+    seconds = max(1, min(request.args.get('seconds', DEFAULT_PROFILE_SECONDS, type=int),
+                         profiling.MAX_SESSION_SECONDS))
+    interval_ms = max(1, min(request.args.get('interval_ms', profiling.DEFAULT_SAMPLE_INTERVAL_MS, type=int),
+                             MAX_SAMPLE_INTERVAL_MS))
+    sample = request.args.get('sample', '1') != '0'
+    try:
+        session = profiling.start(seconds, interval_ms, sample)
+    except profiling.SessionActiveError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({
+        'session': session.session_id,
+        'until': session.until,
+        'interval_ms': session.interval_ms,
+        'sample': session.sample,
+    }), 202
+
+
+@admin_bp.route('/api/profile')
+@require_admin
+def profile_results():
+    """Per-stage timing histograms of a profiling session, merged across workers."""
+    results = profiling.results(_profile_session())
+    if results is None:
+        return jsonify({'error': 'No profiling results'}), 404
+    return jsonify(results)
+
+
+@admin_bp.route('/api/profile/stacks')
+@require_admin
+def profile_stacks():
+    """Sampled stacks of a profiling session in collapsed form (for flamegraph.pl or speedscope)."""
+    session_id = _profile_session()
+    stacks = profiling.collapsed_stacks(session_id)
+    if stacks is None:
+        return jsonify({'error': 'No profiling results'}), 404
+    return Response(stacks, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="profile-{session_id or "latest"}.folded"',
+    })
+
+
+def _trace_summary(trace):
+    """One line of the trace list: what the request was, how long it took and where the time went."""
+    spans = trace['spans'][1:]
+    return {
+        'trace_id': trace['trace_id'],
+        'name': trace['name'],
+        'start': trace['start'],
+        'duration_ms': trace['duration_ms'],
+        'status': trace['attributes'].get('status'),
+        'participant_id': trace['attributes'].get('participant_id'),
+        'error': trace['error'],
+        'db_queries': sum(1 for span in spans if span['name'] == 'db.query'),
+        'db_ms': round(sum(span['duration_ms'] for span in spans if span['name'] == 'db.query'), 3),
+        'llm_attempts': sum(1 for span in spans if span['name'] == 'llm.attempt'),
+    }
+
+
+@admin_bp.route('/api/traces')
+@require_admin
+def recent_traces():
+    """This worker's most recent request traces, newest first (?min_ms= for slow ones only, ?limit=)."""
+    exporter = tracing.get_exporter()
+    if exporter is None:
+        return jsonify({'error': 'Tracing is off (TRACE_EXPORTER=off)'}), 404
+    limit = max(1, min(request.args.get('limit', DEFAULT_TRACE_LIMIT, type=int), tracing.DEFAULT_BUFFER_SIZE))
+    min_ms = request.args.get('min_ms', 0, type=float)
+    return jsonify({
+        'pid': os.getpid(),
+        'traces': [_trace_summary(trace) for trace in exporter.recent(limit, min_ms)],
+    })
+
+
+@admin_bp.route('/api/traces/<trace_id>')
+@require_admin
+def trace_detail(trace_id):
+    """One trace with all its spans (from this worker's buffer, else from the trace file)."""
+    exporter = tracing.get_exporter()
+    trace = exporter.find(trace_id) if exporter is not None else None
+    if trace is None and isinstance(exporter, tracing.FileExporter):
+        trace = tracing.read_trace_file(trace_id, exporter.path)
+    if trace is None:
+        return jsonify({'error': 'Trace not found'}), 404
+    return jsonify(trace)
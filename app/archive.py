@@ -0,0 +1,381 @@
+"""
+Archival and retention: keep the live database small.
+
+Finished participants are moved into one archive database per study:
+
+    data/archive/<study_id>.db.gz    (ARCHIVE_DIR)
+
+An archive is an ordinary SQLite database with the live schema, gzip
+compressed. Unzip a copy and point DATABASE_URL at it to use the usual
+db_utils.py exports and reports. Archiving the same study again adds to
+its archive. Rows are only deleted from the live database once they are
+safely in the compressed archive, and a repeated run after an interruption
+does not duplicate them. Only the rows that were copied are deleted: a
+participant who writes anything while their study is archived stays in the
+live database (with all their rows) for the next run.
+
+Deletes run in short transactions (delete_in_chunks): chunk sizes adapt so
+each transaction holds SQLite's write lock for about DELETE_TARGET_MS, and
+the chat keeps saving messages while a study is archived or cleared.
+
+maintain() refreshes planner statistics (ANALYZE), merges the full-text
+index and reclaims free pages (VACUUM). Run it from cron at a quiet time.
+
+Prompts stay in the live database (archives get a copy): they are shared
+between participants, one row per distinct prompt, and running workers
+remember which ones are stored.
+"""
+
+import os
+import gzip
+import time
+import shutil
+import typing
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+
+from app import db
+from app.models import Participant, Message, Prompt, TaskStateEvent, ContentFilterEvent, WarmStart
+
+DEFAULT_ARCHIVE_DIR = 'data/archive'
+DELETE_TARGET_MS = 5           # Longest a delete transaction should hold the write lock
+DELETE_PAUSE_SECONDS = 0.005   # Gap between chunks, so waiting writers get the lock
+MIN_CHUNK_SIZE = 10
+MAX_CHUNK_SIZE = 5000
+COPY_BATCH_SIZE = 200          # Participants copied (and deleted) per batch
+COPY_PAGE_SIZE = 500           # Rows read from the live database per read transaction
+VACUUM_FREE_RATIO = 0.2        # maintain() vacuums when this share of the file is free pages
+
+# Tables with rows per participant, deleted before the participants themselves
+PARTICIPANT_TABLES = (TaskStateEvent.__table__, ContentFilterEvent.__table__, WarmStart.__table__, Message.__table__)
+# Of those, the tables copied to the archive (warm starts are transient)
+ARCHIVED_TABLES = (Message.__table__, TaskStateEvent.__table__, ContentFilterEvent.__table__)
+
+
+def archive_dir() -> str:
+    """Directory holding the per-study archives."""
+    return os.environ.get('ARCHIVE_DIR', DEFAULT_ARCHIVE_DIR)
+
+
+def archive_path(study_id: str) -> str:
+    """Path of a study's compressed archive."""
+    return os.path.join(archive_dir(), f"{study_id}.db.gz")
+
+
+def delete_in_chunks(table: db.Table, condition: typing.Any, target_ms: float = DELETE_TARGET_MS) -> int:
+    """
+    Delete matching rows in many short transactions.
+
+    Each transaction deletes one chunk by primary key. The chunk size
+    doubles while transactions finish well under target_ms and halves when
+    one takes longer, so the write lock is never held for long whatever the
+    per-row cost (indexes, search-index triggers, disk speed).
+
+    Must be called inside an application context, with no open transaction
+    in the session.
+
+    Args:
+        table: Table to delete from
+        condition: SQLAlchemy WHERE clause selecting the rows (db.true() for all)
+        target_ms: Aim for transactions of about this duration
+
+    Returns:
+        Number of rows deleted
+    """
+    key = list(table.primary_key.columns)[0]
+    chunk_size = MIN_CHUNK_SIZE * 10
+    deleted = 0
+
+    while True:
+        with db.engine.begin() as connection:
+            if connection.dialect.name == 'sqlite':
+                # Take the write lock first, so waiting for other writers is not
+                # mistaken for a slow chunk
+                connection.exec_driver_sql('BEGIN IMMEDIATE')
+            start = time.perf_counter()
+            chunk = db.select(key).where(condition).limit(chunk_size).scalar_subquery()
+            removed = connection.execute(table.delete().where(key.in_(chunk))).rowcount
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        deleted += removed
+
+        if removed < chunk_size:
+            return deleted
+        if elapsed_ms > target_ms:
+            chunk_size = max(MIN_CHUNK_SIZE, chunk_size // 2)
+        elif elapsed_ms < target_ms / 2:
+            chunk_size = min(MAX_CHUNK_SIZE, chunk_size * 2)
+        time.sleep(DELETE_PAUSE_SECONDS)
+
+
+def _with_new_rows(batch: typing.List[str], high_water: typing.Dict[str, typing.Optional[int]]) -> typing.Set[str]:
+    """Participants of a batch with archived-table rows above the highest keys copied from it."""
+    active = set()
+    with db.engine.connect() as connection:
+        for table in ARCHIVED_TABLES:
+            key = list(table.primary_key.columns)[0]
+            active.update(participant_id for (participant_id,) in connection.execute(
+                db.select(table.c.participant_id).distinct()
+                .where(table.c.participant_id.in_(batch), key > (high_water.get(table.name) or 0))
+            ))
+    return active
+
+
+def delete_participants(
+        participant_ids: typing.List[str],
+        high_water: typing.Optional[typing.List[typing.Dict[str, typing.Optional[int]]]] = None
+    ) -> int:
+    """
+    Delete participants and their rows in short transactions (see delete_in_chunks).
+
+    Args:
+        participant_ids: Participants to delete
+        high_water: From copy_to_archive(): per batch of COPY_BATCH_SIZE
+            participants, the highest key copied from each archived table.
+            Only rows up to those keys are deleted, and participants with
+            newer rows are kept whole. None deletes every row.
+
+    Returns:
+        Number of messages deleted
+    """
+    participants = Participant.__table__
+    messages = 0
+    for index, i in enumerate(range(0, len(participant_ids), COPY_BATCH_SIZE)):
+        batch = participant_ids[i:i + COPY_BATCH_SIZE]
+        copied = high_water[index] if high_water is not None else None
+        if copied is not None:
+            # Written to since the copy: keep them live, the next run archives the rest
+            active = _with_new_rows(batch, copied)
+            batch = [participant_id for participant_id in batch if participant_id not in active]
+            if not batch:
+                continue
+
+        for table in PARTICIPANT_TABLES:
+            condition = table.c.participant_id.in_(batch)
+            if copied is not None and table.name in copied:
+                key = list(table.primary_key.columns)[0]
+                condition = db.and_(condition, key <= copied[table.name]) if copied[table.name] else db.false()
+            removed = delete_in_chunks(table, condition)
+            if table is Message.__table__:
+                messages += removed
+
+        # A participant with rows left (written during the delete) is kept
+        delete_in_chunks(participants, db.and_(participants.c.participant_id.in_(batch), *[
+            ~db.exists().where(table.c.participant_id == participants.c.participant_id)
+            for table in PARTICIPANT_TABLES
+        ]))
+    return messages
+
+
+def select_participants(
+        study_id: str,
+        before: typing.Optional[datetime] = None,
+        condition_index: typing.Optional[int] = None
+    ) -> typing.List[str]:
+    """
+    Find the participants of a study to archive.
+
+    Args:
+        study_id: Study to archive from
+        before: Only participants who joined, and last sent or received a message, before this time (UTC)
+        condition_index: Only participants in this (finished) condition
+
+    Returns:
+        Participant IDs
+    """
+    query = db.session.query(Participant.participant_id).filter(Participant.study_id == study_id)
+    if condition_index is not None:
+        query = query.filter(Participant.condition_index == condition_index)
+    if before is not None:
+        # One index lookup per participant (ix_messages_participant_timestamp)
+        last_message = db.select(db.func.max(Message.timestamp)).where(
+            Message.participant_id == Participant.participant_id
+        ).scalar_subquery()
+        query = query.filter(
+            Participant.created_at < before,
+            db.or_(last_message.is_(None), last_message < before)
+        )
+    return [participant_id for (participant_id,) in query.order_by(Participant.participant_id)]
+
+
+def _copy_rows(archive, table: db.Table, condition: typing.Any) -> typing.Tuple[int, typing.Any]:
+    """
+    Copy matching rows into the archive, skipping rows it already has.
+
+    Rows are read in pages of COPY_PAGE_SIZE, each in its own short read
+    transaction: on SQLite an open read keeps writers from committing.
+
+    Returns:
+        (rows copied, highest key copied - None if none)
+    """
+    key = list(table.primary_key.columns)[0]
+    copied = 0
+    last = None
+    while True:
+        query = table.select().where(condition).order_by(key).limit(COPY_PAGE_SIZE)
+        if last is not None:
+            query = query.where(key > last)
+        with db.engine.connect() as live:
+            rows = [dict(row) for row in live.execute(query).mappings()]
+        if not rows:
+            return copied, last
+        archive.execute(sqlite.insert(table).on_conflict_do_nothing(), rows)
+        copied += len(rows)
+        last = rows[-1][key.name]
+
+
+def copy_to_archive(
+        study_id: str,
+        participant_ids: typing.List[str]
+    ) -> typing.Tuple[typing.Dict[str, int], typing.List[typing.Dict[str, typing.Optional[int]]]]:
+    """
+    Copy participants and their rows into the study's compressed archive.
+
+    The archive is unpacked to a temporary file, extended, checked and
+    compressed again, then atomically replaces the previous archive.
+
+    Must be called inside an application context.
+
+    Returns:
+        (row counts copied per table, and per batch of COPY_BATCH_SIZE
+        participants the highest key copied from each archived table - see
+        delete_participants)
+
+    Raises:
+        RuntimeError: If the archive does not contain every copied message
+    """
+    target = archive_path(study_id)
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    working_copy = target[:-len('.gz')] + '.tmp'
+
+    if os.path.exists(target):
+        with gzip.open(target, 'rb') as source, open(working_copy, 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+    elif os.path.exists(working_copy):
+        os.remove(working_copy)   # Left over from an interrupted run
+
+    from app.migrations import upgrade_schema
+    engine = create_engine(f"sqlite:///{os.path.abspath(working_copy)}")
+    copied = {'participants': 0, 'messages': 0, 'task_state_events': 0, 'content_filter_events': 0, 'prompts': 0}
+    high_water = []
+    try:
+        db.metadata.create_all(engine)
+        upgrade_schema(engine)   # Archives written by earlier versions
+
+        participants = Participant.__table__
+        messages = Message.__table__
+        for i in range(0, len(participant_ids), COPY_BATCH_SIZE):
+            batch = participant_ids[i:i + COPY_BATCH_SIZE]
+            with engine.begin() as archive:
+                with db.engine.connect() as live:
+                    hashes = {h for (h,) in live.execute(
+                        db.select(participants.c.system_prompt_hash).where(participants.c.participant_id.in_(batch))
+                        .union(db.select(messages.c.prompt_hash).where(messages.c.participant_id.in_(batch)))
+                    ) if h}
+                copied['prompts'] += _copy_rows(archive, Prompt.__table__, Prompt.__table__.c.prompt_hash.in_(hashes))[0]
+                copied['participants'] += _copy_rows(archive, participants, participants.c.participant_id.in_(batch))[0]
+                batch_high_water = {}
+                for name, table in (('messages', messages), ('task_state_events', TaskStateEvent.__table__),
+                                    ('content_filter_events', ContentFilterEvent.__table__)):
+                    count, batch_high_water[table.name] = _copy_rows(archive, table, table.c.participant_id.in_(batch))
+                    copied[name] += count
+                high_water.append(batch_high_water)
+
+        with engine.connect() as archive:
+            archived = sum(
+                archive.execute(db.select(db.func.count()).select_from(messages)
+                                .where(messages.c.participant_id.in_(participant_ids[i:i + COPY_BATCH_SIZE]))).scalar()
+                for i in range(0, len(participant_ids), COPY_BATCH_SIZE)
+            )
+        # More is fine: a repeated run only finds the messages not yet deleted
+        if archived < copied['messages']:
+            raise RuntimeError(f"Archive check failed: copied {copied['messages']} messages, archive has {archived}")
+    finally:
+        engine.dispose()
+
+    with open(working_copy, 'rb') as source, gzip.open(target + '.part', 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+    os.replace(target + '.part', target)
+    os.remove(working_copy)
+    return copied, high_water
+
+
+def archive_participants(
+        study_id: str,
+        before: typing.Optional[datetime] = None,
+        condition_index: typing.Optional[int] = None
+    ) -> typing.Dict[str, typing.Any]:
+    """
+    Move finished participants of a study from the live database into its archive.
+
+    Must be called inside an application context.
+
+    Args:
+        study_id: Study to archive from
+        before: Only participants inactive since before this time (UTC)
+        condition_index: Only participants in this condition
+
+    Returns:
+        Dictionary with participants, messages, task_state_events,
+        content_filter_events, prompts (rows copied), deleted_messages and
+        archive (path)
+
+    Raises:
+        ValueError: If neither before nor condition_index is given
+        RuntimeError: If the archive could not be verified (nothing is deleted)
+    """
+    if before is None and condition_index is None:
+        raise ValueError("Give a cutoff date, a condition, or both")
+
+    participant_ids = select_participants(study_id, before, condition_index)
+    db.session.commit()   # End the read transaction before the long copy
+    if not participant_ids:
+        return {'participants': 0, 'messages': 0, 'task_state_events': 0, 'content_filter_events': 0,
+                'prompts': 0, 'deleted_messages': 0, 'archive': archive_path(study_id)}
+
+    copied, high_water = copy_to_archive(study_id, participant_ids)
+    summary: typing.Dict[str, typing.Any] = dict(copied)
+    summary['deleted_messages'] = delete_participants(participant_ids, high_water)
+    summary['archive'] = archive_path(study_id)
+    return summary
+
+
+def maintain(vacuum: typing.Optional[bool] = None) -> typing.List[str]:
+    """
+    Routine database maintenance: planner statistics, search index merge and free space.
+
+    Must be called inside an application context, with no open transaction.
+
+    Args:
+        vacuum: Always (True) or never (False) VACUUM; by default only when at
+            least VACUUM_FREE_RATIO of a SQLite file is free pages
+
+    Returns:
+        Descriptions of the steps performed
+    """
+    from app.search import SEARCH_TABLE
+
+    done = []
+    dialect = db.engine.dialect.name
+    # VACUUM cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if dialect == 'sqlite':
+            connection.execute(db.text('ANALYZE'))
+            done.append('ANALYZE')
+
+            if connection.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': SEARCH_TABLE}
+            ).first():
+                connection.execute(db.text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')"))
+                done.append('merged search index')
+
+            page_count = connection.execute(db.text('PRAGMA page_count')).scalar()
+            free_pages = connection.execute(db.text('PRAGMA freelist_count')).scalar()
+            if vacuum or (vacuum is None and page_count and free_pages / page_count >= VACUUM_FREE_RATIO):
+                connection.execute(db.text('VACUUM'))
+                done.append(f'VACUUM ({free_pages} free pages reclaimed)')
+        elif dialect == 'postgresql':
+            connection.execute(db.text('VACUUM (ANALYZE)' if vacuum is not False else 'ANALYZE'))
+            done.append('VACUUM ANALYZE' if vacuum is not False else 'ANALYZE')
+    return done
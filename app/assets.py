@@ -0,0 +1,224 @@
+"""
+Static asset delivery: fingerprinted URLs, pre-compression, long-lived caching.
+
+Every file in app/static is read once at startup (with gunicorn --preload,
+once in the master process) and served from memory:
+
+    /static/css/chat.3f2a1b9c0d4e.css   fingerprinted URL (content hash); cached by
+                                        browsers for a year without revalidation,
+                                        since a changed file gets a new URL
+    /static/css/chat.css                plain URL, still served (e.g. bot icons in
+                                        condition files); revalidated on each use
+
+Templates link assets with asset_url('css/chat.css'). Text assets are
+pre-compressed with gzip, and with brotli if the optional brotli package is
+installed (pip install brotli), and sent in the best encoding the browser
+accepts. Conditional requests (If-None-Match) are answered with 304.
+
+Pages and API responses are compressed per response instead: gzip for
+HTML and JSON over MIN_COMPRESS_BYTES (never the streamed chat responses),
+and HTML pages get an ETag so an unchanged page is answered with 304.
+
+Files added to app/static after startup are served from disk as usual.
+"""
+
+import os
+import gzip
+import hashlib
+import mimetypes
+import typing
+
+from flask import Flask, Response, request, send_from_directory
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_URL_PATH = '/static'
+
+FINGERPRINT_LENGTH = 12                   # Hex digits of the content hash in asset URLs
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'     # Plain URLs: cached, but checked on each use
+PAGE_CACHE_CONTROL = 'private, no-cache'  # Pages carry the participant's session token
+COMPRESSIBLE_MIMETYPES = frozenset({
+    'text/css', 'text/javascript', 'application/javascript', 'application/json',
+    'image/svg+xml', 'text/plain', 'text/html',
+})
+MIN_COMPRESS_BYTES = 1024                 # Smaller responses are not worth compressing
+GZIP_LEVEL_STATIC = 9                     # Once per asset at startup
+GZIP_LEVEL_DYNAMIC = 6                    # Per response
+
+
+class Asset(typing.NamedTuple):
+    """A static file held in memory in each encoding it is served in."""
+    path: str                              # Relative to the static folder, e.g. 'css/chat.css'
+    url: str                               # Fingerprinted URL
+    mimetype: str
+    etag: str
+    bodies: typing.Dict[str, bytes]        # Encoding ('identity', 'gzip', 'br') -> content
+
+
+# Relative path -> Asset, and fingerprinted path -> Asset (built by load_assets)
+_assets: typing.Dict[str, Asset] = {}
+_fingerprinted: typing.Dict[str, Asset] = {}
+
+
+def _brotli():
+    """Import brotli if installed (optional dependency), else None."""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def fingerprinted_path(path: str, digest: str) -> str:
+    """Insert a content hash before the extension: css/chat.css -> css/chat.<hash>.css."""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest[:FINGERPRINT_LENGTH]}{ext}"
+
+
+def _compressed(content: bytes, mimetype: str) -> typing.Dict[str, bytes]:
+    """Encode a file in every supported encoding that makes it smaller."""
+    bodies = {'identity': content}
+    if mimetype not in COMPRESSIBLE_MIMETYPES or len(content) < MIN_COMPRESS_BYTES:
+        return bodies
+
+    # mtime=0 keeps the output identical across restarts and workers
+    bodies['gzip'] = gzip.compress(content, compresslevel=GZIP_LEVEL_STATIC, mtime=0)
+    brotli = _brotli()
+    if brotli is not None:
+        bodies['br'] = brotli.compress(content, quality=11)
+    return {encoding: body for encoding, body in bodies.items()
+            if encoding == 'identity' or len(body) < len(content)}
+
+
+def load_assets(static_dir: str = STATIC_DIR) -> typing.Dict[str, Asset]:
+    """
+    Read, fingerprint and compress every file in the static folder.
+
+    Args:
+        static_dir: Folder to load (default: app/static)
+
+    Returns:
+        Relative path -> Asset for every file loaded
+    """
+    assets = {}
+    for root, _dirs, files in os.walk(static_dir):
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            path = os.path.relpath(full_path, static_dir).replace(os.sep, '/')
+            with open(full_path, 'rb') as f:
+                content = f.read()
+
+            digest = hashlib.sha256(content).hexdigest()
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            assets[path] = Asset(
+                path=path,
+                url=f"{STATIC_URL_PATH}/{fingerprinted_path(path, digest)}",
+                mimetype=mimetype,
+                etag=digest[:FINGERPRINT_LENGTH * 2],
+                bodies=_compressed(content, mimetype),
+            )
+
+    _assets.clear()
+    _assets.update(assets)
+    _fingerprinted.clear()
+    _fingerprinted.update({asset.url[len(STATIC_URL_PATH) + 1:]: asset for asset in assets.values()})
+    return assets
+
+
+def asset_url(path: str) -> str:
+    """
+    Fingerprinted URL of a static file (template global).
+
+    Args:
+        path: Path relative to the static folder ('css/chat.css'), or a
+            /static/... URL (e.g. a bot icon from the conditions file)
+
+    Returns:
+        The fingerprinted URL, or the plain URL for a file that was not loaded
+        at startup. Anything that is not a static path is returned unchanged.
+    """
+    if path.startswith(STATIC_URL_PATH + '/'):
+        relative = path[len(STATIC_URL_PATH) + 1:]
+    elif '://' in path or path.startswith('/'):
+        return path
+    else:
+        relative = path
+    asset = _assets.get(relative)
+    return asset.url if asset else f"{STATIC_URL_PATH}/{relative}"
+
+
+def _accepted_encoding(available: typing.Iterable[str]) -> str:
+    """Pick the best encoding the client accepts among the available ones."""
+    for encoding in ('br', 'gzip'):
+        if encoding in available and request.accept_encodings[encoding] > 0:
+            return encoding
+    return 'identity'
+
+
+def serve_static(filename: str) -> Response:
+    """Serve a static file from memory with caching headers (the 'static' endpoint)."""
+    asset = _fingerprinted.get(filename)
+    immutable = asset is not None
+    if asset is None:
+        asset = _assets.get(filename)
+    if asset is None:
+        # Not loaded at startup: from disk, revalidated on each use (404 if missing)
+        return send_from_directory(STATIC_DIR, filename)
+
+    encoding = _accepted_encoding(asset.bodies)
+    response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    if len(asset.bodies) > 1:
+        response.vary.add('Accept-Encoding')
+
+    # Weak: the same validator covers every encoding of the file
+    response.set_etag(asset.etag, weak=True)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+    return response.make_conditional(request)
+
+
+def compress_response(response: Response) -> Response:
+    """
+    Validate and gzip a page or API response (after_request hook).
+
+    HTML pages get a weak ETag and are answered with 304 if unchanged; HTML
+    and JSON over MIN_COMPRESS_BYTES are gzipped if the client accepts it.
+    Streamed responses (the chat's server-sent events) are left alone, as
+    are responses that are already encoded, e.g. static files.
+    """
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in ('text/html', 'application/json')):
+        return response
+
+    if response.mimetype == 'text/html' and request.method == 'GET':
+        response.headers.setdefault('Cache-Control', PAGE_CACHE_CONTROL)
+        response.add_etag(weak=True)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings['gzip'] <= 0:
+        return response
+
+    response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL_DYNAMIC))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def init_app(app: Flask) -> None:
+    """
+    Serve app/static through this module and compress pages and API responses.
+
+    The app must be created with static_folder=None, so this module's view
+    takes the 'static' endpoint (url_for('static', filename=...) still works).
+    """
+    load_assets()
+    app.add_url_rule(f"{STATIC_URL_PATH}/<path:filename>", endpoint='static', view_func=serve_static)
+    app.add_template_global(asset_url)
+    app.after_request(compress_response)
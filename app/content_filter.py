@@ -0,0 +1,180 @@
+"""
+Fast-fail cache for messages rejected by the provider's content filter.
+
+When Azure's content filter rejects a request, the participant usually
+sends the same text again, and each attempt costs a full round trip to be
+rejected again. Rejected requests are remembered by fingerprint in the
+shared state backend (app.state), so a repeat is refused right away with
+the condition's content_filter message:
+
+    participant cache   the normalized message (case, spacing and surrounding
+                        punctuation ignored), for that participant only
+    global cache        the normalized message plus a hash of the conversation
+                        before it (system prompt and answered turns) and the
+                        deployment, for everyone: it only matches requests the
+                        filter would see identically, e.g. the same opening
+                        message in the same condition
+
+Only rejected requests (stage 'prompt') are cached. A response stopped
+mid-way (stage 'completion') depends on what the model generated, so it is
+logged but not cached.
+
+Settings, for the whole study in study_metadata and overridable per condition:
+
+    "content_filter": {"message": "...", "participant_ttl_seconds": 600, "global_ttl_seconds": 3600}
+
+Every filtered or fast-failed message is logged as a ContentFilterEvent
+and counted in the live metrics. If the state backend is unreachable the
+cache is skipped with a warning and the model is called as usual.
+"""
+
+import re
+import hashlib
+import typing
+
+from app import db, metrics
+from app.models import ContentFilterEvent
+from app.state import get_state
+
+_SPACES = re.compile(r'\s+')
+_SURROUNDING_PUNCTUATION = re.compile(r'^[\W_]+|[\W_]+$')
+
+
+class Fingerprint(typing.NamedTuple):
+    """Keys of a request in the participant and global caches."""
+    message: str
+    context: str
+
+
+def normalize_message(text: str) -> str:
+    """Fold case and spacing and strip surrounding punctuation, so near-identical resends match."""
+    return _SURROUNDING_PUNCTUATION.sub('', _SPACES.sub(' ', text.casefold()))
+
+
+def fingerprint(conversation: typing.List[typing.Dict[str, str]], deployment: str) -> Fingerprint:
+    """
+    Fingerprint the request for a conversation ending in the participant's message.
+
+    Unanswered messages before the last one (e.g. earlier attempts that were
+    filtered) are left out of the context, so a resend has the same context
+    as the attempt it repeats.
+    """
+    message = hashlib.sha256(normalize_message(conversation[-1]['content']).encode('utf-8')).hexdigest()
+
+    answered = len(conversation) - 1
+    while answered > 0 and conversation[answered - 1]['role'] == 'user':
+        answered -= 1
+    context = hashlib.sha256(f"{deployment}\0{message}".encode('utf-8'))
+    for entry in conversation[:answered]:
+        context.update(f"\0{entry['role']}\0{entry['content']}".encode('utf-8'))
+    return Fingerprint(message, context.hexdigest())
+
+
+def _keys(study_id: str, participant_id: str, fp: Fingerprint) -> typing.Tuple[str, str]:
+    return (f"content_filter:{study_id}:participant:{participant_id}:{fp.message}",
+            f"content_filter:{study_id}:global:{fp.context}")
+
+
+def cached(
+        study_id: str,
+        participant_id: str,
+        fp: Fingerprint,
+        settings: typing.Dict[str, typing.Any]
+    ) -> typing.Optional[str]:
+    """
+    Look a request up in the fast-fail caches (one state backend round trip).
+
+    Returns:
+        'participant' or 'global' if the request was recently rejected, else None
+    """
+    if not settings.get('participant_ttl_seconds') and not settings.get('global_ttl_seconds'):
+        return None
+    try:
+        participant_hit, global_hit = get_state().get_many(list(_keys(study_id, participant_id, fp)))
+    except Exception as e:
+        print(f"⚠️  Content filter cache unavailable: {type(e).__name__}: {e}")
+        return None
+    if participant_hit and settings.get('participant_ttl_seconds'):
+        return 'participant'
+    if global_hit and settings.get('global_ttl_seconds'):
+        return 'global'
+    return None
+
+
+def _record(
+        study_id: str,
+        participant_id: str,
+        condition_index: int,
+        event: ContentFilterEvent
+    ) -> None:
+    """Log an event and count it in the live metrics, in its own transaction. Never raises."""
+    try:
+        db.session.add(event)
+        metrics.record_content_filter(condition_index, event.event_type, study_id=study_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️  Could not record content filter event for {participant_id}: {type(e).__name__}: {e}")
+
+
+def record_filtered(
+        study_id: str,
+        participant_id: str,
+        condition_index: int,
+        message_id: typing.Optional[int],
+        fp: Fingerprint,
+        result: typing.Dict[str, typing.Any],
+        settings: typing.Dict[str, typing.Any]
+    ) -> None:
+    """
+    Log a message the provider's filter stopped, and cache it if the request was rejected.
+
+    Runs in its own transaction and never raises, so the caller can still
+    return its error response.
+
+    Args:
+        study_id: Participant's study
+        participant_id: Participant who sent the message
+        condition_index: Participant's condition
+        message_id: ID of the stored message
+        fp: The request's fingerprint
+        result: response_info['content_filter'] from bot.get_chat_response(_stream)
+        settings: The condition's content_filter settings
+    """
+    rejected = result.get('stage') == 'prompt'
+    _record(study_id, participant_id, condition_index, ContentFilterEvent(
+        participant_id=participant_id,
+        message_id=message_id,
+        event_type=ContentFilterEvent.PROMPT_FILTERED if rejected else ContentFilterEvent.COMPLETION_FILTERED,
+        detail=','.join(result.get('categories', []))[:255],
+        fingerprint=fp.context,
+    ))
+    if not rejected:
+        return
+
+    try:
+        state = get_state()
+        for key, ttl in zip(_keys(study_id, participant_id, fp),
+                            (settings.get('participant_ttl_seconds'), settings.get('global_ttl_seconds'))):
+            if ttl:
+                state.set(key, '1', ttl)
+    except Exception as e:
+        print(f"⚠️  Could not cache content filter result: {type(e).__name__}: {e}")
+
+
+def record_fast_fail(
+        study_id: str,
+        participant_id: str,
+        condition_index: int,
+        message_id: typing.Optional[int],
+        fp: Fingerprint,
+        cache: str
+    ) -> None:
+    """Log a message refused from the cache ('participant' or 'global'). Never raises."""
+    _record(study_id, participant_id, condition_index, ContentFilterEvent(
+        participant_id=participant_id,
+        message_id=message_id,
+        event_type=ContentFilterEvent.FAST_FAILED,
+        detail=cache,
+        fingerprint=fp.context,
+    ))
@@ -0,0 +1,390 @@
+"""
+Cost ledger and spending caps.
+
+Every model response with reported usage appends a row to the cost ledger
+(cost_ledger: study, participant, condition, deployment, tokens, cost) in
+the turn's own transaction, and adds to running totals in cost_rollups:
+
+    study         per UTC day
+    condition     per UTC day
+    participant   total
+
+Study and condition totals are the sums of their day rows, so a turn writes
+three rollup rows, and spend reports and budget checks read one row per day
+the study has run instead of summing messages or the ledger. The ledger is
+never updated or pruned (archiving or deleting participants leaves it
+alone); rebuild_rollups() recomputes the totals from it.
+
+Prices are set per deployment in study_metadata, per million tokens:
+
+    "pricing": {"gpt-5-mini": {"prompt": 0.25, "completion": 2.0}}
+
+Usage of a deployment without a price is recorded with cost 0 and
+priced = false (with a warning if the study has prices for others), so
+tokens are never lost from the ledger.
+
+Budgets are set in study_metadata and overridable per condition:
+
+    "cost_budgets": {
+        "participant": {"soft": 0.50, "hard": 1.00},
+        "condition":   {"hard": 50},
+        "study":       {"soft": 150, "hard": 200},
+        "study_daily": {"soft": 20, "hard": 30}
+    }
+
+Soft: a warning is logged once per worker when the amount is reached.
+Hard: new turns are refused (the participant's, or the whole condition's or
+study's) until the budget is raised. Spend is only known once a turn has
+finished, so turns already in progress may take spend slightly past a hard
+budget. If the database cannot be read, budgets are skipped with a warning
+instead of blocking the study.
+
+A stream the participant abandoned is cancelled before the model reports
+its usage, so its tokens are estimated (source 'abandoned_estimate'): the
+prompt from the conversation's length, the completion from the chunks
+streamed. Hidden reasoning and tokens generated after the last chunk are
+missed, so the estimate errs low.
+"""
+
+import math
+import typing
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import CostEntry, CostRollup
+from app.upserts import increment_counters
+
+COUNTER_COLUMNS = ('turns', 'prompt_tokens', 'completion_tokens', 'cost_micros')
+ESTIMATED_SOURCE = 'abandoned_estimate'
+CHARS_PER_TOKEN_ESTIMATE = 4          # Rough size of a token in English text
+
+# Ledger sources that are not participant turns (prefetches; 'warm_start_discarded' in older rows)
+NON_TURN_SOURCES = ('warm_start', 'warm_start_discarded')
+ROLLUP_KEY = ['study_id', 'scope', 'subject', 'period']
+TOTAL = 'total'
+REBUILD_BATCH_SIZE = 5000
+
+# Budget name -> refusal message and HTTP status
+_REFUSALS = {
+    'participant': ("You have reached the usage limit for this study.", 429),
+    'condition': ("This study has reached its usage limit. Please contact the researchers.", 503),
+    'study': ("This study has reached its usage limit. Please contact the researchers.", 503),
+    'study_daily': ("This study has reached its usage limit for today. Please try again tomorrow.", 503),
+}
+
+# Soft budgets and unpriced deployments already warned about by this worker
+_warned: typing.Set[typing.Tuple[str, ...]] = set()
+
+
+class BudgetExceededError(Exception):
+    """Raised when a turn would start while a hard cost budget is used up."""
+
+    def __init__(self, message: str, budget: str, status: int, retry_after: typing.Optional[int] = None):
+        super().__init__(message)
+        self.budget = budget
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _day(now: datetime) -> str:
+    return now.strftime('%Y-%m-%d')
+
+
+def _budget_subjects(
+        condition_index: int,
+        participant_id: str
+    ) -> typing.Dict[str, typing.Tuple[str, str]]:
+    """Rollup rows (scope, subject) behind each budget."""
+    return {
+        'participant': ('participant', participant_id),
+        'condition': ('condition', str(condition_index)),
+        'study': ('study', ''),
+        'study_daily': ('study', ''),
+    }
+
+
+def price_usage(
+        pricing: typing.Dict[str, typing.Dict[str, float]],
+        deployment: typing.Optional[str],
+        prompt_tokens: int,
+        completion_tokens: int
+    ) -> typing.Tuple[int, bool]:
+    """
+    Price a response's usage.
+
+    Returns:
+        (cost in millionths of the pricing currency, whether the deployment has a price)
+    """
+    prices = pricing.get(deployment) if deployment else None
+    if prices is None:
+        return 0, False
+    # Prices are per million tokens, so the price is also the cost per token in millionths
+    cost = prompt_tokens * prices.get('prompt', 0) + completion_tokens * prices.get('completion', 0)
+    return round(cost), True
+
+
+def estimate_abandoned_usage(
+        conversation: typing.List[typing.Dict[str, str]],
+        streamed_chunks: int,
+        response_info: typing.Dict[str, typing.Any]
+    ) -> typing.Dict[str, typing.Any]:
+    """
+    Estimate the usage of a stream cancelled before its final usage chunk.
+
+    Args:
+        conversation: Messages sent to the model
+        streamed_chunks: Content chunks received (about one token each)
+        response_info: The stream's response_info (usage reported by earlier
+            attempts is kept, and usage_recorded passed on)
+
+    Returns:
+        response_info with the estimated tokens added, for record_usage
+        (with source=ESTIMATED_SOURCE)
+    """
+    prompt_chars = sum(len(message.get("content") or '') for message in conversation)
+    estimate = dict(response_info)
+    estimate['prompt_tokens'] = (response_info.get('prompt_tokens') or 0) + math.ceil(prompt_chars / CHARS_PER_TOKEN_ESTIMATE)
+    estimate['completion_tokens'] = (response_info.get('completion_tokens') or 0) + streamed_chunks
+    return estimate
+
+
+def record_usage(
+        config: typing.Dict[str, typing.Any],
+        study_id: str,
+        participant_id: str,
+        response_info: typing.Optional[typing.Dict[str, typing.Any]],
+        source: str = 'turn',
+        now: typing.Optional[datetime] = None
+    ) -> int:
+    """
+    Append a response's usage to the cost ledger and its rollups.
+
+    Runs in a savepoint of the current transaction and never raises, like
+    the live metrics; the caller commits (together with the turn itself).
+
+    Args:
+        config: The condition's configuration (from load_study_config)
+        study_id: Participant's study
+        participant_id: Participant the tokens were spent on
+        response_info: Usage details filled in by the model call. Usage marked
+            usage_recorded (a served warm start, recorded when it was generated)
+            is skipped
+        source: 'turn', 'failed_turn', 'warm_start' or ESTIMATED_SOURCE
+        now: Current UTC time (for testing)
+
+    Returns:
+        Cost recorded, in millionths of the pricing currency
+    """
+    info = response_info or {}
+    if info.get('usage_recorded'):
+        return 0
+    prompt_tokens = info.get('prompt_tokens') or 0
+    completion_tokens = info.get('completion_tokens') or 0
+    if not prompt_tokens and not completion_tokens:
+        return 0
+
+    now = now or datetime.utcnow()
+    deployment = info.get('deployment') or config.get('deployment')
+    cost, priced = price_usage(config.get('pricing', {}), deployment, prompt_tokens, completion_tokens)
+    if not priced and config.get('pricing') and ('pricing', deployment) not in _warned:
+        _warned.add(('pricing', deployment))
+        print(f"⚠️  No price for deployment '{deployment}' in study_metadata.pricing - its usage is recorded at cost 0")
+
+    condition_index = config['condition_index']
+    counters = {
+        'turns': 0 if source in NON_TURN_SOURCES else 1,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cost_micros': cost,
+    }
+    day = _day(now)
+    rollups = [('study', '', day), ('condition', str(condition_index), day), ('participant', participant_id, TOTAL)]
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(CostEntry), dict(
+                timestamp=now, study_id=study_id, participant_id=participant_id,
+                condition_index=condition_index, deployment=deployment, source=source,
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                cost_micros=cost, priced=priced,
+            ))
+            increment_counters(CostRollup, [
+                {'study_id': study_id, 'scope': scope, 'subject': subject, 'period': period, **counters}
+                for scope, subject, period in rollups
+            ], index_elements=ROLLUP_KEY, value_column=COUNTER_COLUMNS)
+    except Exception as e:
+        print(f"⚠️  Could not record cost for {participant_id}: {type(e).__name__}: {e}")
+    return cost
+
+
+def check_budget(
+        config: typing.Dict[str, typing.Any],
+        study_id: str,
+        participant_id: str,
+        now: typing.Optional[datetime] = None
+    ) -> None:
+    """
+    Check a participant's, condition's and study's spend against the hard and soft budgets.
+
+    Costs one indexed query when the condition has budgets, nothing otherwise
+    (it sums the study's and condition's day rows).
+
+    Args:
+        config: The condition's configuration (from load_study_config)
+        study_id: Participant's study
+        participant_id: Authenticated participant
+        now: Current UTC time (for testing)
+
+    Raises:
+        BudgetExceededError: If a hard budget is used up
+    """
+    budgets = config.get('cost_budgets')
+    if not budgets:
+        return
+
+    now = now or datetime.utcnow()
+    today = _day(now)
+    keys = _budget_subjects(config['condition_index'], participant_id)
+    wanted = {keys[name] for name in budgets}
+    try:
+        rows = db.session.execute(db.select(
+            CostRollup.scope, CostRollup.subject,
+            db.func.sum(CostRollup.cost_micros).label('total'),
+            db.func.sum(db.case((CostRollup.period == today, CostRollup.cost_micros), else_=0)).label('today'),
+        ).where(
+            # study_id in every branch, so each is a primary key range (SQLite would
+            # otherwise scan the study's rows in ix_cost_rollups_ranking)
+            db.or_(*[db.and_(CostRollup.study_id == study_id, CostRollup.scope == scope,
+                             CostRollup.subject == subject)
+                     for scope, subject in wanted]),
+            # skip study and condition 'total' rows left by older versions (rebuild_rollups drops them)
+            db.or_(CostRollup.scope == 'participant', CostRollup.period != TOTAL)
+        ).group_by(CostRollup.scope, CostRollup.subject)).all()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️  Cost budgets not checked for {participant_id}: {type(e).__name__}: {e}")
+        return
+    spent = {(row.scope, row.subject): (row.total / 1e6, row.today / 1e6) for row in rows}
+
+    for name, budget in budgets.items():
+        total, spent_today = spent.get(keys[name], (0.0, 0.0))
+        amount = spent_today if name == 'study_daily' else total
+        if 'hard' in budget and amount >= budget['hard']:
+            message, status = _REFUSALS[name]
+            retry_after = None
+            if name == 'study_daily':
+                midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+                retry_after = max(1, int((midnight - now).total_seconds()))
+            raise BudgetExceededError(message, name, status, retry_after)
+        warning = (study_id, name) + keys[name] + ((today,) if name == 'study_daily' else ())
+        if 'soft' in budget and amount >= budget['soft'] and warning not in _warned:
+            _warned.add(warning)
+            subject = f" {keys[name][1]}" if keys[name][1] else ''
+            print(f"⚠️  Cost budget: {name}{subject} of study {study_id} has spent {amount:.4f} "
+                  f"(soft budget {budget['soft']}, hard {budget.get('hard', 'none')})")
+
+
+def spend_summary(
+        study_id: str,
+        days: int = 14,
+        top: int = 10,
+        now: typing.Optional[datetime] = None
+    ) -> typing.Dict[str, typing.Any]:
+    """
+    Spend of a study from the rollups: reads one row per day and per
+    condition and day, plus one per listed participant, however large the
+    ledger.
+
+    Must be called inside an application context.
+
+    Returns:
+        Dictionary with total, conditions (by condition index), daily (last
+        `days` UTC days, oldest first) and top_participants (highest spend
+        first); each entry has turns, prompt_tokens, completion_tokens and cost
+    """
+    now = now or datetime.utcnow()
+
+    def entry(row) -> typing.Dict[str, typing.Any]:
+        return {
+            'turns': row.turns if row else 0,
+            'prompt_tokens': row.prompt_tokens if row else 0,
+            'completion_tokens': row.completion_tokens if row else 0,
+            'cost': row.cost_micros / 1e6 if row else 0.0,
+        }
+
+    def sums(scope: str):
+        return db.session.query(
+            CostRollup.subject,
+            *[db.func.sum(getattr(CostRollup, name)).label(name) for name in COUNTER_COLUMNS]
+        ).filter(CostRollup.study_id == study_id, CostRollup.scope == scope,
+                 CostRollup.period != TOTAL).group_by(CostRollup.subject)
+
+    rollups = CostRollup.query.filter_by(study_id=study_id)
+    total = sums('study').first()
+    conditions = {int(row.subject): entry(row) for row in sums('condition')}
+    first_day = _day(now - timedelta(days=days - 1))
+    daily = {
+        row.period: entry(row)
+        for row in rollups.filter(CostRollup.scope == 'study', CostRollup.subject == '',
+                                  CostRollup.period != TOTAL, CostRollup.period >= first_day)
+    }
+    top_participants = [
+        dict(entry(row), participant_id=row.subject)
+        for row in rollups.filter_by(scope='participant', period=TOTAL)
+        .order_by(CostRollup.cost_micros.desc()).limit(top)
+    ]
+    return {
+        'study_id': study_id,
+        'total': entry(total),
+        'conditions': dict(sorted(conditions.items())),
+        'daily': {day: daily.get(day, entry(None))
+                  for day in (_day(now - timedelta(days=offset)) for offset in range(days - 1, -1, -1))},
+        'top_participants': top_participants,
+    }
+
+
+def rebuild_rollups(study_id: typing.Optional[str] = None) -> int:
+    """
+    Recompute cost rollups from the ledger (e.g. after restoring a backup of one table).
+
+    Must be called inside an application context. Commits.
+
+    Args:
+        study_id: Only this study (default: all)
+
+    Returns:
+        Number of ledger entries summed
+    """
+    day = db.func.date(CostEntry.timestamp)
+    query = db.session.query(
+        CostEntry.study_id, CostEntry.condition_index, CostEntry.participant_id, day.label('day'),
+        db.func.sum(db.case((CostEntry.source.in_(NON_TURN_SOURCES), 0), else_=1)).label('turns'),
+        db.func.sum(CostEntry.prompt_tokens).label('prompt_tokens'),
+        db.func.sum(CostEntry.completion_tokens).label('completion_tokens'),
+        db.func.sum(CostEntry.cost_micros).label('cost_micros'),
+        db.func.count().label('entries'),
+    ).group_by(CostEntry.study_id, CostEntry.condition_index, CostEntry.participant_id, day)
+    stale = CostRollup.query
+    if study_id:
+        query = query.filter(CostEntry.study_id == study_id)
+        stale = stale.filter_by(study_id=study_id)
+
+    # Sum in memory: one row per rollup, however many ledger groups add to it
+    totals: typing.Dict[typing.Tuple[str, str, str, str], typing.List[int]] = {}
+    entries = 0
+    for group in query.all():
+        period = str(group.day)[:10]
+        condition = str(group.condition_index)
+        for key in ((group.study_id, 'study', '', period), (group.study_id, 'condition', condition, period),
+                    (group.study_id, 'participant', group.participant_id, TOTAL)):
+            counters = totals.setdefault(key, [0] * len(COUNTER_COLUMNS))
+            for i, name in enumerate(COUNTER_COLUMNS):
+                counters[i] += int(getattr(group, name) or 0)
+        entries += group.entries
+
+    stale.delete(synchronize_session=False)
+    rows = [dict(zip(ROLLUP_KEY, key), **dict(zip(COUNTER_COLUMNS, counters))) for key, counters in totals.items()]
+    for i in range(0, len(rows), REBUILD_BATCH_SIZE):
+        db.session.execute(db.insert(CostRollup), rows[i:i + REBUILD_BATCH_SIZE])
+    db.session.commit()
+    return entries
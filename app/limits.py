@@ -0,0 +1,212 @@
+"""
+Per-participant rate limits and token caps.
+
+Limits are set in experimental_conditions.json, for the whole study in
+study_metadata and overridable per condition:
+
+    "rate_limits": {"turns_per_minute": 30, "turns_per_day": 500, "tokens_per_day": 200000}
+
+Unset limits fall back to bot.DEFAULT_RATE_LIMITS (30 turns per minute, 500
+per day, no token cap); null removes a limit.
+
+Counters are keyed by study and authenticated participant rather than by IP
+address: behind a survey platform and a reverse proxy, many participants
+share one address. They live in the shared state backend (app.state), so a
+limit holds across all workers and hosts using the same STATE_BACKEND_URL.
+
+Each limit is a sliding window counter: the current fixed window's count
+plus the previous window's count, weighted by how much of the previous
+window the sliding window still covers. That is two small counters per
+limit (no per-request timestamps) and no double burst at window edges.
+
+tokens_per_day caps prompt plus completion tokens. Usage is only known once
+a turn has finished, so turns are refused after the cap has been reached
+(the turn that crosses it completes).
+
+If the state backend is unreachable, limits are skipped with a warning
+instead of blocking the study.
+"""
+
+import math
+import time
+import typing
+
+from app.state import get_state
+
+# Limit name -> (counter, window in seconds)
+LIMITS: typing.Dict[str, typing.Tuple[str, int]] = {
+    'turns_per_minute': ('turns', 60),
+    'turns_per_day': ('turns', 24 * 60 * 60),
+    'tokens_per_day': ('tokens', 24 * 60 * 60),
+}
+
+_MESSAGES = {
+    'turns_per_minute': "You are sending messages too quickly. Please wait a moment and try again.",
+    'turns_per_day': "You have reached the daily message limit for this study.",
+    'tokens_per_day': "You have reached the daily usage limit for this study.",
+}
+
+
+class RateLimitExceededError(Exception):
+    """Raised when a participant has reached one of their limits."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _windows(name: str, subject: str, now: float) -> typing.Tuple[str, str, float]:
+    """
+    Locate a limit's sliding window.
+
+    Returns:
+        (current window key, previous window key, seconds into the current window)
+    """
+    counter, window = LIMITS[name]
+    index, offset = divmod(now, window)
+    key = f"rate:{counter}:{window}:{subject}"
+    return f"{key}:{int(index)}", f"{key}:{int(index) - 1}", offset
+
+
+def _estimate(previous: int, current: int, window: int, offset: float) -> float:
+    """Sliding-window count: current window plus the still-covered share of the previous one."""
+    return previous * (1 - offset / window) + current
+
+
+def _exceeded(name: str, previous: int, room: int, offset: float) -> RateLimitExceededError:
+    """
+    Build the error for a limit, with the seconds until it allows another turn.
+
+    room is how far the current window alone is below the limit; when
+    positive, the limit frees up as the previous window's share decays.
+    """
+    window = LIMITS[name][1]
+    if room > 0 and previous:
+        wait = (1 - room / previous) * window - offset
+    else:
+        wait = window - offset
+    return RateLimitExceededError(_MESSAGES[name], max(1, math.ceil(wait)))
+
+
+def check_turn(
+        study_id: str,
+        participant_id: str,
+        limits: typing.Dict[str, int],
+        now: typing.Optional[float] = None
+    ) -> typing.List[typing.Tuple[str, int]]:
+    """
+    Count a new turn against a participant's limits.
+
+    Costs one read round trip plus one increment per turn limit. A refused
+    turn is not counted; a turn refused later (e.g. by the content filter
+    cache) is given back with refund_turn().
+
+    Args:
+        study_id: Participant's study
+        participant_id: Authenticated participant
+        limits: The condition's rate_limits (from load_study_config)
+        now: Current Unix time (for testing)
+
+    Returns:
+        The counters the turn was counted in, as (key, ttl) pairs for refund_turn()
+
+    Raises:
+        RateLimitExceededError: If the turn would exceed a limit
+    """
+    if not limits:
+        return []
+
+    now = time.time() if now is None else now
+    subject = f"{study_id}:{participant_id}"
+    names = [name for name in LIMITS if name in limits]
+    windows = {name: _windows(name, subject, now) for name in names}
+    token_names = [name for name in names if LIMITS[name][0] == 'tokens']
+
+    try:
+        state = get_state()
+        values = [int(value or 0) for value in state.get_many(
+            [windows[name][1] for name in names] + [windows[name][0] for name in token_names]
+        )]
+        previous = dict(zip(names, values))
+        used_tokens = dict(zip(token_names, values[len(names):]))
+
+        for name in token_names:
+            current_key, _, offset = windows[name]
+            if _estimate(previous[name], used_tokens[name], LIMITS[name][1], offset) >= limits[name]:
+                raise _exceeded(name, previous[name], limits[name] - used_tokens[name], offset)
+
+        counted: typing.List[typing.Tuple[str, int]] = []
+        try:
+            for name in names:
+                counter, window = LIMITS[name]
+                if counter != 'turns':
+                    continue
+                current_key, _, offset = windows[name]
+                count = state.incr(current_key, 1, ttl=2 * window)
+                counted.append((current_key, 2 * window))
+                if _estimate(previous[name], count, window, offset) > limits[name]:
+                    raise _exceeded(name, previous[name], limits[name] - count, offset)
+        except RateLimitExceededError:
+            _uncount(state, counted)
+            raise
+        return counted
+
+    except RateLimitExceededError:
+        raise
+    except Exception as e:
+        print(f"⚠️  Rate limits not checked for {participant_id}: {type(e).__name__}: {e}")
+        return []
+
+
+def _uncount(state, counted: typing.List[typing.Tuple[str, int]]) -> None:
+    """
+    Take a turn back out of its counters.
+
+    The decrement carries the counter's TTL: a counter that expired in the
+    meantime is recreated at -1, and must not outlive its window.
+    """
+    for key, ttl in counted:
+        state.incr(key, -1, ttl=ttl)
+
+
+def refund_turn(counted: typing.List[typing.Tuple[str, int]]) -> None:
+    """
+    Give back a turn counted by check_turn() that was refused before calling the model.
+
+    Never raises.
+    """
+    try:
+        _uncount(get_state(), counted)
+    except Exception as e:
+        print(f"⚠️  Could not refund refused turn: {type(e).__name__}: {e}")
+
+
+def record_tokens(
+        study_id: str,
+        participant_id: str,
+        limits: typing.Dict[str, int],
+        response_info: typing.Dict[str, typing.Any]
+    ) -> None:
+    """
+    Add a turn's token usage to the participant's token counters.
+
+    Never raises - the turn has already been answered.
+
+    Args:
+        study_id: Participant's study
+        participant_id: Authenticated participant
+        limits: The condition's rate_limits (only tokens_per_day is affected)
+        response_info: Usage details filled in by the model call (skipped if
+            marked usage_recorded - a served warm start)
+    """
+    if response_info.get('usage_recorded'):
+        return
+    tokens = (response_info.get('prompt_tokens') or 0) + (response_info.get('completion_tokens') or 0)
+    if not tokens or 'tokens_per_day' not in limits:
+        return
+
+    try:
+        current_key, _, _ = _windows('tokens_per_day', f"{study_id}:{participant_id}", time.time())
+        get_state().incr(current_key, tokens, ttl=2 * LIMITS['tokens_per_day'][1])
+    except Exception as e:
+        print(f"⚠️  Could not record token usage for {participant_id}: {type(e).__name__}: {e}")
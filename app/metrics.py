@@ -0,0 +1,276 @@
+"""
+Live study metrics maintained incrementally as chat turns complete.
+
+Each turn adds to a handful of per-minute, per-condition counters in the
+metric_counters table (one upsert in the turn's own transaction), so the
+admin dashboard can summarize the last few minutes by reading a few hundred
+counter rows instead of scanning the messages table. Counters live in the
+database rather than in process memory so every gunicorn worker contributes
+to the same totals. Counters are kept per study (see app.studies), so
+condition indexes of different studies never mix.
+"""
+
+import typing
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import MetricCounter, Message, Participant
+from app.studies import DEFAULT_STUDY
+from app.upserts import increment_counters
+
+# Time-to-first-token histogram bucket upper bounds (milliseconds); p95 is
+# reported as the upper bound of the bucket containing the 95th percentile
+TTFT_BUCKETS_MS = (250, 500, 1000, 2000, 3000, 5000, 8000, 13000, 20000, 30000)
+
+# A participant counts as active if they sent a message this recently
+ACTIVE_SESSION_MINUTES = 5
+
+
+def _ttft_bucket_name(ttft_ms: float) -> str:
+    """Return the histogram counter name for a time to first token."""
+    for upper_bound in TTFT_BUCKETS_MS:
+        if ttft_ms <= upper_bound:
+            return f'ttft_le_{upper_bound}'
+    return 'ttft_le_inf'
+
+
+def _add_to_counters(condition_index: int, increments: typing.Dict[str, int], study_id: str) -> None:
+    """
+    Add to this minute's counters for a condition of a study.
+    
+    Runs in a savepoint of the current transaction so that a metrics failure
+    never loses the caller's own writes; the caller commits.
+    """
+    minute = datetime.utcnow().replace(second=0, microsecond=0)
+    rows = [
+        {'minute': minute, 'study_id': study_id, 'condition_index': condition_index, 'name': name, 'value': value}
+        for name, value in increments.items()
+    ]
+    
+    try:
+        with db.session.begin_nested():
+            increment_counters(MetricCounter, rows, index_elements=['minute', 'study_id', 'condition_index', 'name'])
+    except Exception as e:
+        print(f"⚠️  Could not record metrics: {type(e).__name__}: {e}")
+
+
+def record_turn(
+        condition_index: int,
+        response_info: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        error: bool = False,
+        study_id: str = DEFAULT_STUDY
+    ) -> None:
+    """
+    Add a completed (or failed) chat turn to the live metrics.
+    
+    The caller commits (together with the turn itself).
+    
+    Args:
+        condition_index: Condition the turn was answered under
+        response_info: Usage and timing filled in by bot.get_chat_response(_stream)
+        error: True if no response could be delivered
+        study_id: Study the condition belongs to
+    """
+    info = response_info or {}
+    increments = {'turns': 1}
+    if error:
+        increments['errors'] = 1
+    if info.get('prompt_tokens'):
+        increments['prompt_tokens'] = info['prompt_tokens']
+    if info.get('completion_tokens'):
+        increments['completion_tokens'] = info['completion_tokens']
+    if info.get('ttft_timeouts'):
+        increments['ttft_timeouts'] = info['ttft_timeouts']
+    if info.get('fallback'):
+        increments['fallbacks'] = 1
+    if info.get('ttft_ms') is not None:
+        ttft_ms = int(info['ttft_ms'])
+        increments['ttft_count'] = 1
+        increments['ttft_total_ms'] = ttft_ms
+        increments[_ttft_bucket_name(ttft_ms)] = 1
+    
+    _add_to_counters(condition_index, increments, study_id)
+
+
+def record_abandoned_stream(
+        condition_index: int,
+        streamed_chunks: int,
+        max_completion_tokens: int,
+        study_id: str = DEFAULT_STUDY
+    ) -> None:
+    """
+    Record a streamed response cancelled because the participant disconnected.
+    
+    Usage is not reported for cancelled streams, so the tokens saved are an
+    upper bound: the completion budget the request could still have used.
+    The caller commits.
+    
+    Args:
+        condition_index: Condition the turn was answered under
+        streamed_chunks: Content chunks received before the disconnect
+        max_completion_tokens: Completion budget of the cancelled request
+        study_id: Study the condition belongs to
+    """
+    _add_to_counters(condition_index, {
+        'abandoned_streams': 1,
+        'abandoned_tokens_saved_max': max(0, max_completion_tokens - streamed_chunks),
+    }, study_id)
+
+
+def record_warm_start(
+        condition_index: int,
+        outcome: str,
+        response_info: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        study_id: str = DEFAULT_STUDY
+    ) -> None:
+    """
+    Count a speculative first turn (see app.warm_start) as 'hit' or 'discarded'.
+    
+    Discarded prefetches add their tokens to the spend here, since no turn
+    will report them. The caller commits.
+    """
+    info = response_info or {}
+    increments = {f'warm_start_{outcome}': 1}
+    if info.get('prompt_tokens'):
+        increments['prompt_tokens'] = info['prompt_tokens']
+    if info.get('completion_tokens'):
+        increments['completion_tokens'] = info['completion_tokens']
+    _add_to_counters(condition_index, increments, study_id)
+
+
+def record_content_filter(
+        condition_index: int,
+        event_type: str,
+        study_id: str = DEFAULT_STUDY
+    ) -> None:
+    """
+    Count a content filter event (see app.content_filter): 'fast_failed'
+    messages were refused from the cache, the others by the provider.
+    The caller commits.
+    """
+    name = 'content_filter_hits' if event_type == 'fast_failed' else 'content_filtered'
+    _add_to_counters(condition_index, {name: 1}, study_id)
+
+
+def record_failed_turn(
+        condition_index: int,
+        response_info: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        study_id: str = DEFAULT_STUDY
+    ) -> None:
+    """
+    Record a turn that delivered no response, in its own transaction.
+    
+    For error paths: discards whatever the session had pending, and never
+    raises, so the caller can still return its error response.
+    """
+    try:
+        db.session.rollback()
+        record_turn(condition_index, response_info, error=True, study_id=study_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️  Could not record metrics: {type(e).__name__}: {e}")
+
+
+def _p95_from_histogram(histogram: typing.Dict[str, int]) -> typing.Optional[int]:
+    """Approximate the 95th percentile from TTFT bucket counts (None if empty)."""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    
+    threshold = 0.95 * total
+    cumulative = 0
+    for upper_bound in TTFT_BUCKETS_MS:
+        cumulative += histogram.get(f'ttft_le_{upper_bound}', 0)
+        if cumulative >= threshold:
+            return upper_bound
+    return None   # Above the largest bucket (reported as > ttft_max_bucket_ms)
+
+
+def summarize(window_minutes: int = 15, study_id: str = DEFAULT_STUDY) -> typing.Dict[str, typing.Any]:
+    """
+    Summarize live metrics per condition of a study.
+    
+    Reads only counter rows inside the window plus an indexed range of recent
+    messages for the active session count.
+    
+    Args:
+        window_minutes: How many recent minutes to aggregate
+        study_id: Study to summarize
+    
+    Returns:
+        Dictionary with per-condition metrics and overall totals
+    """
+    now = datetime.utcnow()
+    since = now.replace(second=0, microsecond=0) - timedelta(minutes=window_minutes - 1)
+    
+    rows = db.session.query(
+        MetricCounter.condition_index, MetricCounter.name, db.func.sum(MetricCounter.value)
+    ).filter(
+        MetricCounter.minute >= since,
+        MetricCounter.study_id == study_id
+    ).group_by(MetricCounter.condition_index, MetricCounter.name).all()
+    
+    counters: typing.Dict[int, typing.Dict[str, int]] = {}
+    for condition_index, name, value in rows:
+        counters.setdefault(condition_index, {})[name] = int(value or 0)
+    
+    # Active sessions: participants with a message in the last few minutes
+    # (range scan on the messages.timestamp index)
+    active_since = now - timedelta(minutes=ACTIVE_SESSION_MINUTES)
+    active_rows = db.session.query(
+        Participant.condition_index, db.func.count(db.distinct(Message.participant_id))
+    ).join(
+        Participant, Participant.participant_id == Message.participant_id
+    ).filter(
+        Message.timestamp >= active_since,
+        Participant.study_id == study_id
+    ).group_by(Participant.condition_index).all()
+    active_sessions = {condition_index: count for condition_index, count in active_rows}
+    
+    conditions = {}
+    for condition_index in sorted(set(counters) | set(active_sessions)):
+        values = counters.get(condition_index, {})
+        turns = values.get('turns', 0)
+        errors = values.get('errors', 0)
+        ttft_count = values.get('ttft_count', 0)
+        histogram = {name: value for name, value in values.items() if name.startswith('ttft_le_')}
+        
+        conditions[condition_index] = {
+            'active_sessions': active_sessions.get(condition_index, 0),
+            'turns': turns,
+            'turns_per_minute': round(turns / window_minutes, 2),
+            'errors': errors,
+            'error_rate': round(errors / turns, 4) if turns else 0.0,
+            'prompt_tokens': values.get('prompt_tokens', 0),
+            'completion_tokens': values.get('completion_tokens', 0),
+            'mean_ttft_ms': round(values.get('ttft_total_ms', 0) / ttft_count) if ttft_count else None,
+            'p95_ttft_ms': _p95_from_histogram(histogram),
+            'ttft_timeouts': values.get('ttft_timeouts', 0),
+            'fallbacks': values.get('fallbacks', 0),
+            'abandoned_streams': values.get('abandoned_streams', 0),
+            'abandoned_tokens_saved_max': values.get('abandoned_tokens_saved_max', 0),
+            'warm_start_hits': values.get('warm_start_hit', 0),
+            'warm_start_discarded': values.get('warm_start_discarded', 0),
+            'content_filtered': values.get('content_filtered', 0),
+            'content_filter_hits': values.get('content_filter_hits', 0),
+        }
+    
+    totals = {
+        name: sum(condition[name] for condition in conditions.values())
+        for name in ('active_sessions', 'turns', 'errors', 'prompt_tokens', 'completion_tokens',
+                     'ttft_timeouts', 'fallbacks', 'abandoned_streams', 'abandoned_tokens_saved_max',
+                     'warm_start_hits', 'warm_start_discarded', 'content_filtered', 'content_filter_hits')
+    }
+    totals['turns_per_minute'] = round(totals['turns'] / window_minutes, 2)
+    totals['error_rate'] = round(totals['errors'] / totals['turns'], 4) if totals['turns'] else 0.0
+    
+    return {
+        'generated_at': now.isoformat(),
+        'study_id': study_id,
+        'window_minutes': window_minutes,
+        'active_session_minutes': ACTIVE_SESSION_MINUTES,
+        'ttft_max_bucket_ms': TTFT_BUCKETS_MS[-1],
+        'conditions': conditions,
+        'totals': totals,
+    }
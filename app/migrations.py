@@ -0,0 +1,70 @@
+"""
+Lightweight schema upgrades for existing databases.
+
+db.create_all() only creates missing tables. When a model gains a column or
+an index, upgrade_schema() adds it to databases created by earlier versions,
+so deployments keep working without a separate migration tool.
+
+Tables listed in RECREATE_ON_KEY_CHANGE hold only short-lived data and are
+dropped and recreated instead when their primary key changes (SQLite cannot
+alter a primary key).
+"""
+
+import typing
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+
+from app import db
+
+# Live dashboard counters: only the last few minutes are ever read
+RECREATE_ON_KEY_CHANGE = {'metric_counters'}
+
+
+def upgrade_schema(engine: typing.Optional[Engine] = None) -> None:
+    """
+    Add columns and indexes that exist in the models but not in the database.
+    
+    Only additive changes are handled (plus recreating the tables in
+    RECREATE_ON_KEY_CHANGE). Added columns must be nullable or have a server
+    default, since existing rows get no value.
+    
+    Must be called inside an application context, after db.create_all().
+    
+    Args:
+        engine: Database to upgrade (default: the app's database; e.g. an archive)
+    """
+    engine = engine or db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    
+    with engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            
+            if table.name in RECREATE_ON_KEY_CHANGE:
+                existing_key = set(inspector.get_pk_constraint(table.name)['constrained_columns'])
+                if existing_key != {column.name for column in table.primary_key.columns}:
+                    table.drop(connection)
+                    table.create(connection)
+                    print(f"🔧 Schema upgrade: recreated {table.name} (primary key changed)")
+                    continue
+            
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {column.server_default.arg}'
+                connection.execute(db.text(ddl))
+                print(f"🔧 Schema upgrade: added column {table.name}.{column.name}")
+            
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection, checkfirst=True)
+                    print(f"🔧 Schema upgrade: added index {index.name}")
@@ -2,8 +2,35 @@
 Database models for experimental chat application.
 """
 
+import hashlib
 from datetime import datetime
 from app import db
+from tracing import current_trace_id
+
+
+def hash_prompt(content: str) -> str:
+    """Return the content address (SHA-256 hex digest) of a prompt."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class Prompt(db.Model):
+    """Store each distinct system prompt once, addressed by its content hash."""
+    __tablename__ = 'prompts'
+    
+    prompt_hash = db.Column(db.String(64), primary_key=True)
+    content = db.Column(db.Text, nullable=False)           # Empty when compressed
+    content_blob = db.Column(db.LargeBinary, nullable=True)  # Compressed text (see app.prompts)
+    encoding = db.Column(db.String(10), nullable=True)       # None, 'zlib' or 'zstd'
+    size_bytes = db.Column(db.Integer, nullable=True)        # Uncompressed size
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @property
+    def text(self):
+        """Prompt text, decompressed if needed."""
+        if self.encoding:
+            from app.prompts import decompress_text
+            return decompress_text(self.encoding, self.content_blob)
+        return self.content
 
 
 class Participant(db.Model):
@@ -12,21 +39,42 @@ class Participant(db.Model):
     
     participant_id = db.Column(db.String(255), primary_key=True)
     session_token = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    # Study the participant joined (see app.studies); 'default' is experimental_conditions.json
+    study_id = db.Column(db.String(64), nullable=False, default='default', server_default=db.text("'default'"), index=True)
     condition_index = db.Column(db.Integer, nullable=False)
     condition_id = db.Column(db.String(100), nullable=False)
     condition_name = db.Column(db.String(255), nullable=False)
+    # System prompt in effect when the participant joined (NULL for participants
+    # created before prompts were deduplicated - their prompt is a system message)
+    system_prompt_hash = db.Column(db.String(64), db.ForeignKey('prompts.prompt_hash'), nullable=True)
+    # Current task state (task_active URL/request flag); changes are logged as TaskStateEvents
+    task_active = db.Column(db.Boolean, nullable=False, default=True, server_default=db.text('true'), index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship to messages
     messages = db.relationship('Message', backref='participant', lazy=True, cascade='all, delete-orphan')
+    system_prompt_ref = db.relationship('Prompt', lazy=True)
+    task_state_events = db.relationship('TaskStateEvent', backref='participant', lazy=True,
+                                        cascade='all, delete-orphan', order_by='TaskStateEvent.timestamp')
+    warm_start = db.relationship('WarmStart', lazy=True, uselist=False, cascade='all, delete-orphan')
+    content_filter_events = db.relationship('ContentFilterEvent', backref='participant', lazy=True,
+                                            cascade='all, delete-orphan', order_by='ContentFilterEvent.timestamp')
+    
+    @property
+    def system_prompt(self):
+        """System prompt text from the prompts table (None for legacy participants)."""
+        return self.system_prompt_ref.text if self.system_prompt_ref else None
     
     def to_dict(self):
         return {
             'participant_id': self.participant_id,
+            'study_id': self.study_id,
             'condition_index': self.condition_index,
             'condition_id': self.condition_id,
             'condition_name': self.condition_name,
+            'system_prompt_hash': self.system_prompt_hash,
+            'task_active': self.task_active,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
             # Note: session_token intentionally excluded from export for security
@@ -41,18 +89,158 @@ class Message(db.Model):
     participant_id = db.Column(db.String(255), db.ForeignKey('participants.participant_id'), nullable=False, index=True)
     role = db.Column(db.String(20), nullable=False)
     content = db.Column(db.Text, nullable=False)
+    # Repeated system text is stored once in the prompts table; content is then empty
+    prompt_hash = db.Column(db.String(64), db.ForeignKey('prompts.prompt_hash'), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # True if the participant disconnected before the response finished streaming
+    truncated = db.Column(db.Boolean, nullable=False, default=False, server_default=db.text('false'))
+    # Trace of the request that stored the message (see tracing); NULL outside traced requests
+    trace_id = db.Column(db.String(32), nullable=True, default=current_trace_id)
+    
+    prompt = db.relationship('Prompt', lazy=True)
     
     # Composite index for the most common query pattern (filter by participant_id, order by timestamp)
     __table_args__ = (
         db.Index('ix_messages_participant_timestamp', 'participant_id', 'timestamp'),
     )
     
+    @property
+    def text(self):
+        """Message text, resolved from the prompts table if deduplicated."""
+        return self.prompt.text if self.prompt_hash else self.content
+    
     def to_dict(self):
         return {
             'id': self.id,
             'participant_id': self.participant_id,
             'role': self.role,
-            'content': self.content,
+            'content': self.text,
+            'timestamp': self.timestamp.isoformat(),
+            'truncated': self.truncated
+        }
+
+
+class TaskStateEvent(db.Model):
+    """Log each change of a participant's task state (for PI review)."""
+    __tablename__ = 'task_state_events'
+    
+    # Event types
+    TASK_ACTIVE = 'task_active'
+    TASK_INACTIVE = 'task_inactive'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    participant_id = db.Column(db.String(255), db.ForeignKey('participants.participant_id'), nullable=False, index=True)
+    event_type = db.Column(db.String(20), nullable=False)
+    source = db.Column(db.String(30), nullable=False)      # 'gui', 'send_message' or 'legacy_marker'
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    @classmethod
+    def for_state(cls, participant_id: str, task_active: bool, source: str) -> 'TaskStateEvent':
+        """Create the event recording a change to the given task state."""
+        return cls(
+            participant_id=participant_id,
+            event_type=cls.TASK_ACTIVE if task_active else cls.TASK_INACTIVE,
+            source=source
+        )
+    
+    def to_dict(self):
+        return {
+            'event_type': self.event_type,
+            'source': self.source,
             'timestamp': self.timestamp.isoformat()
-        }
\ No newline at end of file
+        }
+
+
+class MetricCounter(db.Model):
+    """Per-minute, per-condition counters behind the admin dashboard (see app.metrics)."""
+    __tablename__ = 'metric_counters'
+    
+    minute = db.Column(db.DateTime, primary_key=True)          # UTC, truncated to the minute
+    study_id = db.Column(db.String(64), primary_key=True, server_default=db.text("'default'"))
+    condition_index = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(40), primary_key=True)          # e.g. 'turns', 'errors', 'ttft_le_1000'
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class ContentFilterEvent(db.Model):
+    """A message stopped by the provider's content filter, or refused from the filter cache (for PI review)."""
+    __tablename__ = 'content_filter_events'
+    
+    # Event types
+    PROMPT_FILTERED = 'prompt_filtered'           # The provider rejected the request
+    COMPLETION_FILTERED = 'completion_filtered'   # The provider stopped the response
+    FAST_FAILED = 'fast_failed'                   # Refused from the cache without calling the model
+    
+    id = db.Column(db.Integer, primary_key=True)
+    participant_id = db.Column(db.String(255), db.ForeignKey('participants.participant_id'), nullable=False, index=True)
+    # The participant's message that was filtered
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id'), nullable=True)
+    event_type = db.Column(db.String(20), nullable=False)
+    # Flagged categories (comma-separated, e.g. 'jailbreak,violence'); for fast_failed,
+    # the cache that matched ('participant' or 'global')
+    detail = db.Column(db.String(255), nullable=False, default='')
+    fingerprint = db.Column(db.String(64), nullable=True)   # See app.content_filter
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'event_type': self.event_type,
+            'detail': self.detail,
+            'message_id': self.message_id,
+            'timestamp': self.timestamp.isoformat(),
+        }
+
+
+class WarmStart(db.Model):
+    """Speculatively generated first assistant turn (see app.warm_start)."""
+    __tablename__ = 'warm_starts'
+    
+    participant_id = db.Column(db.String(255), db.ForeignKey('participants.participant_id'), primary_key=True)
+    study_id = db.Column(db.String(64), nullable=False, default='default', server_default=db.text("'default'"))
+    condition_index = db.Column(db.Integer, nullable=False)
+    mode = db.Column(db.String(20), nullable=False)               # 'bot_first' or 'predicted_user'
+    opening_message = db.Column(db.Text, nullable=True)           # Predicted first user message
+    status = db.Column(db.String(20), nullable=False)             # pending, ready, failed, used, discarded
+    response = db.Column(db.Text, nullable=True)
+    prompt_tokens = db.Column(db.Integer, nullable=True)
+    completion_tokens = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class CostEntry(db.Model):
+    """Append-only ledger of model usage and its cost (see app.costs)."""
+    __tablename__ = 'cost_ledger'
+    
+    # Deliberately no foreign key to participants: spend stays on record after
+    # participants are archived or deleted
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    study_id = db.Column(db.String(64), nullable=False, default='default', server_default=db.text("'default'"))
+    participant_id = db.Column(db.String(255), nullable=False, index=True)
+    condition_index = db.Column(db.Integer, nullable=False)
+    deployment = db.Column(db.String(100), nullable=True)
+    source = db.Column(db.String(30), nullable=False)              # 'turn', 'failed_turn', 'warm_start', 'abandoned_estimate'
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cost_micros = db.Column(db.BigInteger, nullable=False, default=0)   # Millionths of the pricing currency
+    priced = db.Column(db.Boolean, nullable=False, default=True)      # False if the deployment had no price
+
+
+class CostRollup(db.Model):
+    """Running totals of the cost ledger per study, condition and participant (see app.costs)."""
+    __tablename__ = 'cost_rollups'
+    
+    study_id = db.Column(db.String(64), primary_key=True)
+    scope = db.Column(db.String(20), primary_key=True)                # 'study', 'condition' or 'participant'
+    subject = db.Column(db.String(255), primary_key=True)             # '', condition index or participant ID
+    period = db.Column(db.String(10), primary_key=True)               # UTC day (YYYY-MM-DD); 'total' for participants
+    turns = db.Column(db.BigInteger, nullable=False, default=0)
+    prompt_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    completion_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    cost_micros = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    # Top spenders of a study without scanning every participant
+    __table_args__ = (
+        db.Index('ix_cost_rollups_ranking', 'study_id', 'scope', 'period', 'cost_micros'),
+    )
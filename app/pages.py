@@ -0,0 +1,128 @@
+"""
+Pre-rendered chat pages: one shell per condition, participant values injected.
+
+Everything chat.html shows except the participant's own settings (session
+token, task state and embedded history) depends only on the condition, so
+each condition's page is rendered once, with a marker where those settings
+go, and kept as two strings. /gui then joins them around the participant's
+settings, serialized as HTML-safe JSON:
+
+    <head ... condition styles ...> const chatConfig = {..., ...<participant JSON>}; <... rest>
+
+Shells live as long as the worker, like the parsed conditions files they
+are rendered from (bot._load_conditions_file): restart the app after
+editing a conditions file or chat.html. warm_up() renders all shells before
+gunicorn forks its workers.
+
+Compiled templates are also cached on disk (Jinja bytecode cache), so a
+restarted worker does not compile them again:
+
+    TEMPLATE_CACHE_DIR    Directory for compiled templates (default: the system
+                          temp directory; 'off' disables the cache)
+"""
+
+import os
+import typing
+
+import jinja2
+from flask import Flask, render_template
+from markupsafe import Markup
+
+from app.studies import list_studies, load_study_config
+from bot import _load_conditions_file
+
+# Stands in for the participant's settings while a shell is rendered
+PARTICIPANT_MARKER = '\x00participant-settings\x00'
+
+
+class Shell(typing.NamedTuple):
+    """A condition's rendered chat page, split where the participant's settings go."""
+    head: str
+    tail: str
+
+
+# (study_id, condition_index) -> Shell (per worker)
+_shells: typing.Dict[typing.Tuple[str, int], Shell] = {}
+
+
+def _render_shell(config: typing.Dict[str, typing.Any], history_page_size: int) -> typing.Optional[Shell]:
+    """Render a condition's page with the marker (None if it cannot be split on it)."""
+    html = render_template('chat.html', config=config, history_page_size=history_page_size,
+                           participant_settings=Markup(PARTICIPANT_MARKER))
+    parts = html.split(PARTICIPANT_MARKER)
+    if len(parts) != 2:
+        return None
+    return Shell(*parts)
+
+
+def get_shell(config: typing.Dict[str, typing.Any], history_page_size: int) -> typing.Optional[Shell]:
+    """
+    Return the condition's shell, rendering it on first use.
+
+    Args:
+        config: Condition configuration from app.studies.load_study_config()
+        history_page_size: Page size of older messages fetched by the page
+
+    Returns:
+        The shell, or None if the page cannot be pre-rendered
+    """
+    key = (config['study_id'], config['condition_index'])
+    shell = _shells.get(key)
+    if shell is not None:
+        return shell
+
+    shell = _render_shell(config, history_page_size)
+    if shell is not None:
+        _shells[key] = shell
+    return shell
+
+
+def render_chat_page(
+        config: typing.Dict[str, typing.Any],
+        history_page_size: int,
+        participant_settings: typing.Dict[str, typing.Any]
+    ) -> str:
+    """
+    Render chat.html for a participant from the condition's shell.
+
+    Args:
+        config: Condition configuration from app.studies.load_study_config()
+        history_page_size: Page size of older messages fetched by the page
+        participant_settings: The participant's chatConfig values (sessionToken,
+            taskActive, initialHistory)
+
+    Returns:
+        The page HTML
+    """
+    settings = jinja2.utils.htmlsafe_json_dumps(participant_settings)
+    shell = get_shell(config, history_page_size)
+    if shell is None:
+        # Fall back to a full render
+        return render_template('chat.html', config=config, history_page_size=history_page_size,
+                               participant_settings=settings)
+    return f"{shell.head}{settings}{shell.tail}"
+
+
+def prerender_all(history_page_size: int) -> int:
+    """
+    Render the shell of every condition of every study (app context required).
+
+    Returns:
+        Number of shells rendered
+    """
+    rendered = 0
+    for study_id, config_file in list_studies().items():
+        for condition_index in range(len(_load_conditions_file(config_file)["conditions"])):
+            if get_shell(load_study_config(study_id, condition_index), history_page_size) is not None:
+                rendered += 1
+    return rendered
+
+
+def init_app(app: Flask) -> None:
+    """Cache compiled templates on disk (TEMPLATE_CACHE_DIR)."""
+    directory = os.environ.get('TEMPLATE_CACHE_DIR', '').strip()
+    if directory.lower() == 'off':
+        return
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory or None)
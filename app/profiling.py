@@ -0,0 +1,362 @@
+"""
+On-demand profiling of a running study: stage timings and a sampling profiler.
+
+Off by default. While off, the stage markers in the chat routes (span() and
+record()) only check a flag, and add the stage to the request's trace (see
+tracing). An admin turns profiling on for N seconds with
+POST /admin/api/profile; the session is announced in the shared state
+backend (app.state), and each worker joins it on its next request (checked
+at most every POLL_SECONDS). Until the session ends, each worker collects:
+
+    stage histograms    time spent in each stage of each chat turn it serves
+                        (validate, auth, config, turn_lock, persist_user_message,
+                        load_history, llm_ttft and stream - or llm_response
+                        when not streamed - and persist_assistant_message),
+                        in STAGE_BUCKETS_MS buckets
+    sampled stacks      every thread's stack every interval_ms, counted in
+                        collapsed form ("outer;inner;leaf count"), the input
+                        format of flamegraph.pl, speedscope and inferno
+
+At the end of the session each worker publishes its results to the state
+backend. GET /admin/api/profile merges the histograms of every worker, and
+GET /admin/api/profile/stacks the stacks. With the in-process state backend
+(memory://) only the worker that serves the admin request takes part; with
+several workers, use a shared backend (e.g. Redis). Workers that receive no
+requests during the session do not join it.
+"""
+
+import os
+import sys
+import json
+import time
+import typing
+import secrets
+import threading
+import collections
+
+from flask import Flask
+
+import tracing
+from app.state import get_state
+
+# Stage time histogram bucket upper bounds (milliseconds); percentiles are
+# reported as the upper bound of the bucket containing them
+STAGE_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+POLL_SECONDS = 2.0                  # How often a serving worker checks for a new session
+DEFAULT_SAMPLE_INTERVAL_MS = 10     # 100 stack samples per second
+MAX_SESSION_SECONDS = 600
+RESULT_TTL_SECONDS = 24 * 60 * 60   # How long published results can be fetched
+MAX_STACK_DEPTH = 128               # Frames kept per sample (innermost)
+
+SESSION_KEY = 'profiling:session'
+LAST_SESSION_KEY = 'profiling:last'
+
+
+class SessionActiveError(Exception):
+    """A profiling session is already running."""
+
+
+class Session(typing.NamedTuple):
+    """A profiling session as announced in the state backend."""
+    session_id: str
+    until: float          # End (Unix time)
+    interval_ms: int      # Stack sampling interval
+    sample: bool          # False: stage histograms only
+
+
+# This worker's state: stage histograms of the running session (name ->
+# {'count', 'total_ms', 'max_ms', 'buckets'}), and the sessions it joined
+_enabled = False
+_lock = threading.Lock()
+_stages: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+_joined: typing.Set[str] = set()
+_running = False
+_next_poll = 0.0
+
+
+def _add(name: str, elapsed_ms: float) -> None:
+    """Add one timing to a stage's histogram."""
+    bucket = len(STAGE_BUCKETS_MS)
+    for index, upper_bound in enumerate(STAGE_BUCKETS_MS):
+        if elapsed_ms <= upper_bound:
+            bucket = index
+            break
+    with _lock:
+        stage = _stages.get(name)
+        if stage is None:
+            stage = _stages[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                     'buckets': [0] * (len(STAGE_BUCKETS_MS) + 1)}
+        stage['count'] += 1
+        stage['total_ms'] += elapsed_ms
+        stage['max_ms'] = max(stage['max_ms'], elapsed_ms)
+        stage['buckets'][bucket] += 1
+
+
+class _Span:
+    """Times the block it wraps into a stage's histogram (and the request's trace)."""
+    __slots__ = ('name', 'started', 'traced')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.traced = tracing.span(self.name)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _add(self.name, (time.perf_counter() - self.started) * 1000)
+        self.traced.__exit__(*exc_info)
+        return False
+
+
+def span(name: str) -> typing.ContextManager:
+    """
+    Time a stage of a request while profiling is on, and trace it in a traced request.
+
+    Usage:
+        with profiling.span('load_history'):
+            conversation = get_conversation_history(...)
+    """
+    if not _enabled:
+        return tracing.span(name)
+    return _Span(name)
+
+
+def now() -> float:
+    """Start time for record(), for stages that do not fit a with block (e.g. in generators)."""
+    return time.perf_counter()
+
+
+def record(name: str, started: float) -> None:
+    """Record the time since `started` (from now()) as a stage, while profiling is on, and trace it."""
+    tracing.record(name, started)
+    if _enabled:
+        _add(name, (time.perf_counter() - started) * 1000)
+
+
+def enabled() -> bool:
+    """True while this worker takes part in a profiling session."""
+    return _enabled
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample(stacks: typing.Counter[str], names: typing.Dict[typing.Any, str], own_thread: int) -> None:
+    """Add the current stack of every other thread to the collapsed stack counts."""
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id == own_thread:
+            continue
+        frames = []
+        while frame is not None and len(frames) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            name = names.get(code)
+            if name is None:
+                name = names[code] = _frame_name(code)
+            frames.append(name)
+            frame = frame.f_back
+        stacks[';'.join(reversed(frames))] += 1
+
+
+def _run(session: Session) -> None:
+    """Take part in a session (profiler thread): sample until it ends, then publish."""
+    global _enabled, _running
+    stacks: typing.Counter[str] = collections.Counter()
+    names: typing.Dict[typing.Any, str] = {}
+    samples = 0
+    own_thread = threading.get_ident()
+    interval = session.interval_ms / 1000
+
+    with _lock:
+        _stages.clear()
+    _enabled = True
+    print(f"🔧 Profiling session {session.session_id} started in worker {os.getpid()}")
+    try:
+        while True:
+            remaining = session.until - time.time()
+            if remaining <= 0:
+                break
+            if session.sample:
+                _sample(stacks, names, own_thread)
+                samples += 1
+                time.sleep(min(interval, remaining))
+            else:
+                time.sleep(remaining)
+    except Exception as e:
+        print(f"⚠️  Profiling session {session.session_id} stopped early: {type(e).__name__}: {e}")
+    finally:
+        _enabled = False
+        with _lock:
+            stages = {name: dict(stage, buckets=list(stage['buckets'])) for name, stage in _stages.items()}
+        _publish(session, {'pid': os.getpid(), 'samples': samples, 'stages': stages, 'stacks': dict(stacks)})
+        _running = False
+
+
+def _publish(session: Session, result: typing.Dict[str, typing.Any]) -> None:
+    """Store a worker's results of a session in the state backend. Never raises."""
+    try:
+        state = get_state()
+        slot = state.incr(f"profiling:{session.session_id}:workers", ttl=RESULT_TTL_SECONDS)
+        state.set_json(f"profiling:{session.session_id}:worker:{slot}", result, ttl=RESULT_TTL_SECONDS)
+        print(f"✅ Profiling session {session.session_id} finished in worker {result['pid']} "
+              f"({result['samples']} samples)")
+    except Exception as e:
+        print(f"⚠️  Could not publish profiling results: {type(e).__name__}: {e}")
+
+
+def _join(session: Session) -> bool:
+    """Start this worker's profiler thread for a session, unless it already joined it."""
+    global _running
+    with _lock:
+        if _running or session.session_id in _joined or time.time() >= session.until:
+            return False
+        _joined.add(session.session_id)
+        _running = True
+    threading.Thread(target=_run, args=(session,), name='profiler', daemon=True).start()
+    return True
+
+
+def poll() -> None:
+    """Join a newly announced profiling session (before_request hook). Never raises."""
+    global _next_poll
+    current = time.monotonic()
+    if current < _next_poll:
+        return
+    _next_poll = current + POLL_SECONDS
+    try:
+        announced = get_state().get_json(SESSION_KEY)
+    except Exception as e:
+        print(f"⚠️  Could not check for a profiling session: {type(e).__name__}: {e}")
+        return
+    if announced:
+        _join(Session(**announced))
+
+
+def start(seconds: float, interval_ms: int = DEFAULT_SAMPLE_INTERVAL_MS, sample: bool = True) -> Session:
+    """
+    Announce a profiling session to every worker and join it in this one.
+
+    Args:
+        seconds: Session length (at most MAX_SESSION_SECONDS)
+        interval_ms: Stack sampling interval
+        sample: Sample stacks (False: stage histograms only)
+
+    Returns:
+        The session
+
+    Raises:
+        SessionActiveError: If a session is already running
+    """
+    state = get_state()
+    announced = state.get_json(SESSION_KEY)
+    if announced and announced['until'] > time.time():
+        raise SessionActiveError(f"Profiling session {announced['session_id']} is still running")
+
+    session = Session(secrets.token_hex(4), time.time() + seconds, interval_ms, sample)
+    state.set_json(SESSION_KEY, session._asdict(), ttl=seconds)
+    state.set(LAST_SESSION_KEY, session.session_id, ttl=RESULT_TTL_SECONDS)
+    _join(session)
+    return session
+
+
+def _percentile(buckets: typing.List[int], fraction: float) -> typing.Optional[int]:
+    """Approximate a percentile from bucket counts (None if empty or above the largest bucket)."""
+    total = sum(buckets)
+    if not total:
+        return None
+    cumulative = 0
+    for upper_bound, count in zip(STAGE_BUCKETS_MS, buckets):
+        cumulative += count
+        if cumulative >= fraction * total:
+            return upper_bound
+    return None
+
+
+def _worker_results(session_id: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    state = get_state()
+    count = int(state.get(f"profiling:{session_id}:workers") or 0)
+    if not count:
+        return []
+    values = state.get_many([f"profiling:{session_id}:worker:{slot}" for slot in range(1, count + 1)])
+    return [json.loads(value) for value in values if value]
+
+
+def results(session_id: typing.Optional[str] = None) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Stage histograms of a session, merged across the workers that published results.
+
+    Args:
+        session_id: Session to report (default: the most recent one)
+
+    Returns:
+        Dictionary with the session, whether it is still running, the workers
+        and per-stage count, mean, max and approximate percentiles (ms), or
+        None if there is no such session
+    """
+    state = get_state()
+    session_id = session_id or state.get(LAST_SESSION_KEY)
+    if not session_id:
+        return None
+    announced = state.get_json(SESSION_KEY)
+    workers = _worker_results(session_id)
+    active = bool(announced and announced['session_id'] == session_id and announced['until'] > time.time())
+    if not workers and not active:
+        return None
+
+    merged: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+    for worker in workers:
+        for name, stage in worker['stages'].items():
+            total = merged.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                             'buckets': [0] * (len(STAGE_BUCKETS_MS) + 1)})
+            total['count'] += stage['count']
+            total['total_ms'] += stage['total_ms']
+            total['max_ms'] = max(total['max_ms'], stage['max_ms'])
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], stage['buckets'])]
+
+    stages = {}
+    for name, stage in sorted(merged.items()):
+        stages[name] = {
+            'count': stage['count'],
+            'mean_ms': round(stage['total_ms'] / stage['count'], 2) if stage['count'] else None,
+            'max_ms': round(stage['max_ms'], 2),
+            'p50_ms': _percentile(stage['buckets'], 0.50),
+            'p95_ms': _percentile(stage['buckets'], 0.95),
+            'p99_ms': _percentile(stage['buckets'], 0.99),
+            'buckets': {f'le_{upper_bound}': count for upper_bound, count
+                        in zip(STAGE_BUCKETS_MS + ('inf',), stage['buckets'])},
+        }
+
+    return {
+        'session': session_id,
+        'active': active,
+        'until': announced['until'] if active else None,
+        'workers': [{'pid': worker['pid'], 'samples': worker['samples']} for worker in workers],
+        'stages': stages,
+    }
+
+
+def collapsed_stacks(session_id: typing.Optional[str] = None) -> typing.Optional[str]:
+    """
+    Sampled stacks of a session, merged across workers, one "frame;frame;frame count" line each.
+
+    Returns:
+        The collapsed stacks (most frequent first), or None if no worker published results
+    """
+    session_id = session_id or get_state().get(LAST_SESSION_KEY)
+    if not session_id:
+        return None
+    workers = _worker_results(session_id)
+    if not workers:
+        return None
+    stacks: typing.Counter[str] = collections.Counter()
+    for worker in workers:
+        stacks.update(worker['stacks'])
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def init_app(app: Flask) -> None:
+    """Let workers join profiling sessions as they serve requests."""
+    app.before_request(poll)
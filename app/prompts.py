@@ -0,0 +1,151 @@
+"""
+Content-addressed storage for system prompts and other repeated system text.
+
+Each distinct text is stored once in the prompts table under its SHA-256
+hash; participants and messages reference it by hash instead of carrying a
+copy. Texts over a size threshold can optionally be compressed:
+
+    PROMPT_COMPRESSION            off | zlib | zstd (default: off; zstd needs the zstandard package)
+    PROMPT_COMPRESSION_MIN_BYTES  Only compress texts at least this large (default: 2048)
+
+Compressed rows are always readable, whatever the current setting.
+"""
+
+import os
+import zlib
+import typing
+import functools
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Prompt, hash_prompt
+from app.upserts import insert_or_ignore
+
+COMPRESSION_CODECS = ('off', 'zlib', 'zstd')
+DEFAULT_COMPRESSION_MIN_BYTES = 2048
+
+# Prompt hashes known to be committed to the database (prompts are never
+# modified). Hashes inserted by a session only join the set once that
+# session commits, so another request never skips the insert of a row that
+# is not yet visible to it (or that gets rolled back).
+_stored_prompt_hashes: typing.Set[str] = set()
+PENDING_HASHES_KEY = 'pending_prompt_hashes'    # Session.info key of uncommitted hashes
+
+
+def _zstd():
+    """Import zstandard on demand (optional dependency)."""
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "PROMPT_COMPRESSION=zstd requires the zstandard package: pip install zstandard"
+        )
+    return zstandard
+
+
+def compress_text(content: str) -> typing.Tuple[typing.Optional[str], typing.Optional[bytes]]:
+    """
+    Compress text according to PROMPT_COMPRESSION if it is over the size threshold.
+    
+    Args:
+        content: Text to store
+    
+    Returns:
+        (encoding, blob) - (None, None) if the text should be stored uncompressed
+    """
+    codec = os.environ.get('PROMPT_COMPRESSION', 'off').strip().lower() or 'off'
+    if codec not in COMPRESSION_CODECS:
+        raise ValueError(f"Invalid PROMPT_COMPRESSION '{codec}'. Use one of: {', '.join(COMPRESSION_CODECS)}")
+    
+    raw = content.encode('utf-8')
+    min_bytes = int(os.environ.get('PROMPT_COMPRESSION_MIN_BYTES', DEFAULT_COMPRESSION_MIN_BYTES))
+    if codec == 'off' or len(raw) < min_bytes:
+        return None, None
+    
+    if codec == 'zstd':
+        blob = _zstd().ZstdCompressor(level=10).compress(raw)
+    else:
+        blob = zlib.compress(raw, 9)
+    
+    # Not worth it if compression barely helps
+    if len(blob) >= len(raw) * 0.9:
+        return None, None
+    return codec, blob
+
+
+def decompress_text(encoding: str, blob: bytes) -> str:
+    """Decompress text stored by compress_text()."""
+    if encoding == 'zstd':
+        return _zstd().ZstdDecompressor().decompress(blob).decode('utf-8')
+    if encoding == 'zlib':
+        return zlib.decompress(blob).decode('utf-8')
+    raise ValueError(f"Unknown prompt encoding '{encoding}'")
+
+
+def store_prompt(content: str) -> str:
+    """
+    Store text in the deduplicated prompts table.
+    
+    Prompts are content-addressed, so identical prompts (every participant in
+    a condition) share one row. Hashes already stored by this process skip
+    the database entirely. Runs in the caller's transaction.
+    
+    Args:
+        content: Full prompt text
+    
+    Returns:
+        The prompt's content hash
+    """
+    prompt_hash = hash_prompt(content)
+    if prompt_hash not in _stored_prompt_hashes:
+        encoding, blob = compress_text(content)
+        insert_or_ignore(Prompt, {
+            'prompt_hash': prompt_hash,
+            'content': '' if encoding else content,
+            'content_blob': blob,
+            'encoding': encoding,
+            'size_bytes': len(content.encode('utf-8')),
+            'created_at': datetime.utcnow(),
+        }, index_elements=['prompt_hash'])
+        db.session.info.setdefault(PENDING_HASHES_KEY, set()).add(prompt_hash)
+    return prompt_hash
+
+
+@event.listens_for(Session, 'after_commit')
+def _remember_committed_prompts(session) -> None:
+    """Add the hashes a session inserted to the memo once they are committed."""
+    pending = session.info.pop(PENDING_HASHES_KEY, None)
+    if pending:
+        _stored_prompt_hashes.update(pending)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_rolled_back_prompts(session, previous_transaction) -> None:
+    """Drop the uncommitted hashes of a rolled back session (they are inserted again next time)."""
+    session.info.pop(PENDING_HASHES_KEY, None)
+
+
+def get_prompt_content(prompt_hash: str) -> typing.Optional[str]:
+    """
+    Get a stored prompt's text by hash.
+    
+    Found prompts are cached for the lifetime of the process because a hash
+    always refers to the same content; a missing prompt is looked up again
+    next time (it may not be committed yet).
+    """
+    try:
+        return _load_prompt_content(prompt_hash)
+    except LookupError:
+        return None
+
+
+@functools.lru_cache(maxsize=256)
+def _load_prompt_content(prompt_hash: str) -> str:
+    """Load a stored prompt's text (raises LookupError if missing - errors are not cached)."""
+    prompt = Prompt.query.get(prompt_hash)
+    if prompt is None:
+        raise LookupError(prompt_hash)
+    return prompt.text
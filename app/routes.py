@@ -2,138 +2,429 @@
 Routes and view functions for the chat application.
 """
 
+import os
 import typing
-import re
 import secrets
+from datetime import datetime
 
-from flask import Blueprint, render_template, request, jsonify, Response, stream_with_context
-from sqlalchemy.exc import IntegrityError
+from flask import Blueprint, render_template, jsonify, Response, stream_with_context
 
-#from app import db, get_azure_client, limiter
-from app import db, get_azure_client
-from app.models import Participant, Message
-from bot import get_chat_response, load_experiment_config
+from app import db, get_azure_client, warm_status
+from app import content_filter, costs, metrics, pages, profiling, warm_start
+from app.limits import check_turn, refund_turn, record_tokens, RateLimitExceededError
+from app.models import Participant, Message, TaskStateEvent
+from app.prompts import store_prompt, get_prompt_content
+from app.state import get_state, Lock
+from app.studies import (
+    load_study_config,
+    check_participant_quota,
+    check_turn_quota,
+    QuotaExceededError,
+    UnknownStudyError,
+)
+from app.upserts import insert_or_ignore
+from app.validation import (
+    SEND_MESSAGE_SCHEMA,
+    GET_HISTORY_SCHEMA,
+    CHAT_INTERFACE_SCHEMA,
+    ErrorCode,
+    RequestValidationError,
+    ValidatedRequest,
+    parse_request,
+    validate_request,
+)
+from bot import get_chat_response, model_params_from_config
 
 main_bp = Blueprint('main', __name__)
 
-# Constants for validation
-# TODO This should be dynamically determined not hard coded
-VALID_CONDITION_RANGE = (0, 6)   # Valid condition indices: 0-6 inclusive for the morality tests
-MAX_MESSAGE_LENGTH = 2000        # Maximum characters per message (~500 tokens)
+# Shared-state settings (see app.state)
+TURN_LOCK_TTL_SECONDS = 300              # Upper bound on one turn; frees the lock if a worker dies
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60   # How long a completed turn can be replayed
+CONVERSATION_CACHE_TTL_SECONDS = 30 * 60
 
+# History embedded in the /gui page, so it shows without a second request. Longer
+# histories are embedded up to these limits (newest messages) and the page fetches
+# older messages from /api/get_history, HISTORY_PAGE_SIZE at a time.
+INLINE_HISTORY_MAX_MESSAGES = 200
+INLINE_HISTORY_MAX_CHARS = 200_000
+HISTORY_PAGE_SIZE = 100
 
-def validate_participant_id(participant_id: str) -> bool:
+# Participant requests traced from the route down to each query and model attempt (see tracing)
+TRACED_ENDPOINTS = ('main.chat_interface', 'main.send_message', 'main.send_message_stream', 'main.get_history')
+
+# Injected after the system prompt while the task is inactive (never stored)
+TASK_COMPLETE_OVERRIDE = {
+    "role": "system",
+    "content": (
+        "CRITICAL OVERRIDE: The main task is now complete. "
+        "You must politely decline any requests to continue or restart the task. "
+        "Suggested responses:\n"
+        "- 'That activity is complete.'\n"
+        "- 'I've finished helping with that. Feel free to continue with the survey!'\n"
+        "You may still have friendly conversations about other topics."
+    )
+}
+
+
+def get_or_create_participant(participant_id: str, condition_index: int, config: typing.Dict[str, typing.Any]) -> Participant:
     """
-    Validate participant ID format.
+    Get existing participant or create new one.
+    
+    Creation is a single atomic INSERT ... ON CONFLICT DO NOTHING, so when
+    many participants (or duplicate page loads) arrive at once, the losing
+    requests simply read the winner's row - no retries or sleeps.
+    
+    Raises:
+        QuotaExceededError: If a new participant would exceed the study's max_participants
+    """
+    # Returning participants: one primary key lookup
+    participant = Participant.query.get(participant_id)
+    if participant is not None:
+        return participant
+    
+    check_participant_quota(config['study_id'])
+    
+    try:
+        prompt_hash = store_prompt(config['system_prompt'])
+        
+        now = datetime.utcnow()
+        insert_or_ignore(Participant, {
+            'participant_id': participant_id,
+            'study_id': config['study_id'],
+            # Generate cryptographically secure random token
+            'session_token': secrets.token_urlsafe(32),
+            'condition_index': condition_index,
+            'condition_id': config['condition_id'],
+            'condition_name': config['condition_name'],
+            'system_prompt_hash': prompt_hash,
+            'created_at': now,
+            'updated_at': now,
+        }, index_elements=['participant_id'])
+        
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
     
-    Accepts:
-    - Alphanumeric characters (A-Z, a-z, 0-9)
-    - Hyphens (-)
-    - Underscores (_)
-    - Length: 1-255 characters
+    # Either we inserted the row or a concurrent request did - read it back
+    participant = Participant.query.get(participant_id)
+    if participant is None:
+        raise RuntimeError(f"Failed to get or create participant {participant_id}")
+    return participant
+
+
+def get_conversation_history(
+        participant_id: str,
+        participant: typing.Optional[Participant] = None
+    ) -> typing.List[typing.Dict[str, str]]:
+    """
+    Retrieve conversation history for a participant.
     
-    Rejects:
-    - Special characters
-    - Path traversal attempts
-    - Whitespace-only IDs
-    - Empty strings
-    - Too long IDs
+    The system prompt comes first: from the prompts table for current
+    participants, or from the stored system message for legacy participants.
     
     Args:
-        participant_id: The participant ID to validate
+        participant_id: Participant whose history to load
+        participant: Already-loaded participant (saves a lookup), if available
+    """
+    if participant is None:
+        participant = Participant.query.get(participant_id)
+    history = _load_messages(participant_id)
+    
+    if participant is not None and participant.system_prompt_hash:
+        history.insert(0, {"role": "system", "content": get_prompt_content(participant.system_prompt_hash)})
+    
+    return history
+
+
+def _history_entry(msg: Message) -> typing.Dict[str, str]:
+    return {"role": msg.role, "content": get_prompt_content(msg.prompt_hash) if msg.prompt_hash else msg.content}
+
+
+def _load_messages(participant_id: str) -> typing.List[typing.Dict[str, str]]:
+    """
+    Load a participant's messages through the shared conversation cache.
+    
+    The cache holds the messages up to a known id. One aggregate query
+    (message count and newest id) tells whether it is still complete, so only
+    messages added since - usually the turn just saved - are read from the
+    database. Any other change (e.g. a deleted participant) reloads everything,
+    so a stale cache, or one written by another worker, is never served.
+    """
+    count, latest_id = db.session.query(
+        db.func.count(Message.id), db.func.max(Message.id)
+    ).filter(Message.participant_id == participant_id).one()
+    if not count:
+        return []
+    
+    cache_key = f"conversation:{participant_id}"
+    try:
+        cached = get_state().get_json(cache_key)
+    except Exception as e:
+        print(f"⚠️  Conversation cache unavailable: {type(e).__name__}: {e}")
+        cached = None
+    
+    if cached and cached['last_id'] == latest_id and len(cached['messages']) == count:
+        return cached['messages']
+    
+    history = None
+    if cached and cached['last_id'] < latest_id:
+        added = Message.query.filter(
+            Message.participant_id == participant_id, Message.id > cached['last_id']
+        ).order_by(Message.timestamp).all()
+        if len(cached['messages']) + len(added) == count:
+            history = cached['messages'] + [_history_entry(msg) for msg in added]
+    
+    if history is None:
+        messages = Message.query.filter_by(participant_id=participant_id).order_by(Message.timestamp).all()
+        history = [_history_entry(msg) for msg in messages]
+    
+    try:
+        get_state().set_json(cache_key, {'last_id': latest_id, 'messages': history}, CONVERSATION_CACHE_TTL_SECONDS)
+    except Exception as e:
+        print(f"⚠️  Conversation cache unavailable: {type(e).__name__}: {e}")
+    return history
+
+
+def load_history_page(
+        participant_id: str,
+        before_id: typing.Optional[int] = None,
+        limit: typing.Optional[int] = None,
+        max_chars: typing.Optional[int] = None
+    ) -> typing.Tuple[typing.List[Message], typing.Optional[int]]:
+    """
+    Load the messages a participant sees (no system messages), optionally one page at a time.
+    
+    Args:
+        participant_id: Participant whose history to load
+        before_id: Only messages older than this message ID
+        limit: At most this many messages (the newest); None for all of them
+        max_chars: Stop adding older messages once their text exceeds this
+            many characters (the newest message is always included)
     
     Returns:
-        True if valid, False otherwise
+        (messages oldest first, before_id of the next older page or None if there is none)
     """
-    if not participant_id or not participant_id.strip():
-        return False
+    query = Message.query.filter(Message.participant_id == participant_id, Message.role != 'system')
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    if limit is None:
+        return query.order_by(Message.timestamp).all(), None
+    
+    # Newest first; one extra row tells whether an older page exists
+    newest = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    page = newest[:limit]
+    if max_chars is not None:
+        chars = 0
+        for count, msg in enumerate(page):
+            chars += len(msg.text)
+            if chars > max_chars and count:
+                page = page[:count]
+                break
+    
+    more = len(newest) > len(page)
+    page.reverse()
+    return page, (page[0].id if more else None)
+
+
+def acquire_turn_lock(participant_id: str) -> typing.Optional[Lock]:
+    """
+    Take the participant's turn lock, shared by all workers (see app.state).
+    
+    One turn per participant at a time: a double submission, or a retry
+    while the first request is still answering, would otherwise interleave
+    two model calls in the same conversation.
     
-    # Allow alphanumeric, hyphens, underscores only, 1-255 characters
-    # Hyphen at start of character class to avoid range interpretation
-    return bool(re.match(r'^[-a-zA-Z0-9_]{1,255}$', participant_id))
+    Returns:
+        The held lock, or None if another turn is in progress
+    """
+    with profiling.span('turn_lock'):
+        lock = get_state().lock(f"turn:{participant_id}", TURN_LOCK_TTL_SECONDS)
+        return lock if lock.acquire() else None
+
+
+def turn_in_progress_response():
+    """Error response for a participant who already has a turn in progress."""
+    return RequestValidationError(
+        ErrorCode.TURN_IN_PROGRESS,
+        'A response to your previous message is still in progress',
+        status=409
+    ).to_response()
+
+
+def rate_limited_response(error: RateLimitExceededError):
+    """Error response for a participant who reached one of their rate limits."""
+    response, status = RequestValidationError(ErrorCode.RATE_LIMITED, str(error), status=429).to_response()
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, status
+
+
+def budget_exhausted_response(error: costs.BudgetExceededError):
+    """Error response for a turn refused because a hard cost budget is used up."""
+    response, status = RequestValidationError(ErrorCode.BUDGET_EXHAUSTED, str(error), status=error.status).to_response()
+    if error.retry_after:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response, status
+
 
+def content_filtered_response(config: typing.Dict[str, typing.Any]):
+    """Error response for a message stopped by the content filter (or refused from its cache)."""
+    return RequestValidationError(
+        ErrorCode.CONTENT_FILTERED, config["content_filter"]["message"], status=422
+    ).to_response()
 
-def validate_condition_index(condition_index: typing.Optional[int]) -> bool:
+
+def record_failed_turn(req: ValidatedRequest, config: typing.Dict[str, typing.Any],
+                       response_info: typing.Dict[str, typing.Any]) -> None:
+    """Record a turn that delivered no response: live metrics, and the cost of any tokens it used. Never raises."""
+    metrics.record_failed_turn(config["condition_index"], response_info, study_id=req.study_id)
+    try:
+        costs.record_usage(config, req.study_id, req.participant_id, response_info, source='failed_turn')
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️  Could not record cost of failed turn: {type(e).__name__}: {e}")
+
+
+def record_abandoned_usage(req: ValidatedRequest, config: typing.Dict[str, typing.Any],
+                           conversation: typing.List[typing.Dict[str, str]], streamed_chunks: int,
+                           response_info: typing.Dict[str, typing.Any]) -> None:
+    """
+    Book the estimated usage of a stream the participant abandoned (the model
+    never reported it) in the cost ledger and the token cap. Never raises.
     """
-    Validate condition index is within valid range.
+    estimate = costs.estimate_abandoned_usage(conversation, streamed_chunks, response_info)
+    try:
+        costs.record_usage(config, req.study_id, req.participant_id, estimate, source=costs.ESTIMATED_SOURCE)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️  Could not record cost of abandoned stream: {type(e).__name__}: {e}")
+    record_tokens(req.study_id, req.participant_id, config["rate_limits"], estimate)
+
+
+def get_completed_turn(req: ValidatedRequest) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Return the stored response of a request retried with the same Idempotency-Key, if any."""
+    if not req.idempotency_key:
+        return None
+    return get_state().get_json(f"idempotency:{req.participant_id}:{req.idempotency_key}")
+
+
+def remember_completed_turn(req: ValidatedRequest, payload: typing.Dict[str, typing.Any]) -> None:
+    """Store a turn's response under its Idempotency-Key. Never raises (the turn is already saved)."""
+    if not req.idempotency_key:
+        return
+    try:
+        get_state().set_json(f"idempotency:{req.participant_id}:{req.idempotency_key}", payload,
+                             IDEMPOTENCY_TTL_SECONDS)
+    except Exception as e:
+        print(f"⚠️  Could not store idempotent response: {type(e).__name__}: {e}")
+
+
+def set_task_state(participant: Participant, task_active: bool, source: str) -> bool:
+    """
+    Update a participant's task state, logging a TaskStateEvent if it changed.
+    
+    Compares against the participant's task_active column, so no messages are
+    read. The caller commits.
     
     Args:
-        condition_index: The condition index to validate
+        participant: Participant to update
+        task_active: New task state
+        source: Where the change came from ('gui' or 'send_message')
     
     Returns:
-        True if valid, False otherwise
+        True if the state changed
     """
-    if condition_index is None:
+    if participant.task_active == task_active:
         return False
     
-    min_condition, max_condition = VALID_CONDITION_RANGE
-    return min_condition <= condition_index <= max_condition
+    participant.task_active = task_active
+    db.session.add(TaskStateEvent.for_state(participant.participant_id, task_active, source))
+    return True
 
 
-def get_or_create_participant(participant_id: str, condition_index: int, config: typing.Dict[str, typing.Any]) -> Participant:
-    """
-    Get existing participant or create new one.
-    Thread-safe with retry logic to handle race conditions.
+def save_truncated_response(
+        participant_id: str,
+        condition_index: int,
+        partial_response: str,
+        streamed_chunks: int,
+        max_completion_tokens: int,
+        study_id: str
+    ) -> None:
     """
-   
-    # Try to get existing participant first
-    participant = Participant.query.get(participant_id)
-    if participant is not None:
-        return participant
+    Persist a partially streamed response after the participant disconnected.
     
-    # Participant doesn't exist - try to create
-    # Use retry logic to handle race condition where two requests
-    # try to create the same participant simultaneously
-    max_attempts = 3
-    for attempt in range(max_attempts):
-        try:
-            # Generate cryptographically secure random token
-            session_token = secrets.token_urlsafe(32)
-            
-            participant = Participant(
-                participant_id=participant_id,
-                session_token=session_token,
-                condition_index=condition_index,
-                condition_id=config['condition_id'],
-                condition_name=config['condition_name']
-            )
-            db.session.add(participant)
-            
-            system_message = Message(
+    The partial text (if any) is saved with truncated=True so analyses can tell
+    it apart from complete responses, and the abandoned stream is counted in
+    the live metrics. Never raises - it runs while the response is closing.
+    """
+    try:
+        if partial_response:
+            db.session.add(Message(
                 participant_id=participant_id,
-                role='system',
-                content=config['system_prompt']
-            )
-            db.session.add(system_message)
-            
-            db.session.commit()
-            
-            # Successfully created
-            return participant
-            
-        except IntegrityError as e:
-            # Another request created this participant first
-            db.session.rollback()
-            print(f"Race condition on participant creation (attempt {attempt + 1}/{max_attempts}): {e}")
-            
-            # Query again - the other request should have created it
-            participant = Participant.query.get(participant_id)
-            if participant is not None:
-                return participant
-            
-            # If still None and not last attempt, try again
-            if attempt < max_attempts - 1:
-                import time
-                time.sleep(0.1)  # Brief delay before retry
+                role='assistant',
+                content=partial_response,
+                truncated=True
+            ))
+        metrics.record_abandoned_stream(condition_index, streamed_chunks, max_completion_tokens, study_id=study_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️  Could not save truncated response: {type(e).__name__}: {e}")
+
+
+def claim_warm_first_turn(
+        participant_id: str,
+        conversation: typing.List[typing.Dict[str, str]],
+        config: typing.Dict[str, typing.Any],
+        task_active: bool
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Take the prefetched reply to a predicted first message, if there is one.
+    
+    Only applies to a condition with a predicted_user warm start, on the
+    participant's first message while the task is active.
+    
+    Returns:
+        Dict from warm_start.claim(), or None to call the model as usual
+    """
+    settings = config.get("warm_start")
+    if not settings or settings["mode"] != 'predicted_user' or not task_active:
+        return None
     
-    # Should never get here, but handle gracefully
-    raise RuntimeError(f"Failed to get or create participant {participant_id} after {max_attempts} attempts")
+    # First turn: system prompt plus the message just saved
+    roles = [m["role"] for m in conversation]
+    if roles.count('user') != 1 or 'assistant' in roles:
+        return None
+    
+    return warm_start.claim(participant_id, 'predicted_user', conversation[-1]["content"],
+                            max_wait=config.get("ttft_timeout"))
+
 
+def warm_response_info(warm: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """
+    Build the response_info recorded for a turn served from a warm start.
 
-def get_conversation_history(participant_id: str) -> typing.List[typing.Dict[str, str]]:
-    """Retrieve conversation history for a participant."""
-    messages = Message.query.filter_by(participant_id=participant_id).order_by(Message.timestamp).all()
-    return [{"role": msg.role, "content": msg.content} for msg in messages]
+    Its tokens count in the live metrics; the cost ledger and token cap
+    already have them (usage_recorded - see app.warm_start).
+    """
+    return {
+        'prompt_tokens': warm['prompt_tokens'],
+        'completion_tokens': warm['completion_tokens'],
+        'ttft_ms': warm['wait_ms'],
+        'usage_recorded': True,
+    }
+
+
+def apply_task_state(
+        conversation: typing.List[typing.Dict[str, str]],
+        task_active: bool
+    ) -> typing.List[typing.Dict[str, str]]:
+    """Insert the task-complete override after the system prompt if the task is inactive."""
+    if not task_active:
+        conversation.insert(1, TASK_COMPLETE_OVERRIDE)
+    return conversation
 
 
 # ============================================================================
@@ -148,13 +439,21 @@ def health():
 
 @main_bp.route('/ready')
 def ready():
-    """Readiness check endpoint."""
+    """
+    Readiness check endpoint.
+    
+    Also reports whether conditions and the model client were warmed up at
+    startup (see app.warm_up) and which worker process answered.
+    """
+    warm = dict(warm_status, worker_pid=os.getpid())
     try:
         # Check database connection
         db.session.execute(db.text('SELECT 1'))
-        return jsonify({'status': 'ready'}), 200
+        # Check the shared state backend (locks, idempotency keys, caches)
+        get_state().ping()
+        return jsonify({'status': 'ready', 'warm': warm}), 200
     except Exception as e:
-        return jsonify({'status': 'not ready', 'error': str(e)}), 503
+        return jsonify({'status': 'not ready', 'error': str(e), 'warm': warm}), 503
 
 
 # ============================================================================
@@ -169,60 +468,64 @@ def index():
 
 @main_bp.route('/gui')
 def chat_interface():
-    """Chat interface - expects participant_id and condition as URL params."""
-    participant_id = request.args.get('participant_id')
-    condition_index = request.args.get('condition', type=int)
-    task_active = request.args.get('task_active', default='true').lower() != 'false'
-    
-    # Validate participant_id
-    if not participant_id:
-        return jsonify({'error': 'participant_id parameter is required'}), 400
-    
-    if not validate_participant_id(participant_id):
-        return jsonify({
-            'error': 'Invalid participant_id format. Use letters, numbers, hyphens, and underscores only (max 255 characters).'
-        }), 400
-    
-    # Validate condition_index
-    if condition_index is None:
-        return jsonify({'error': 'condition parameter is required'}), 400
+    """Chat interface - expects participant_id and condition (and optionally study) as URL params."""
+    try:
+        req = parse_request(CHAT_INTERFACE_SCHEMA)
+    except RequestValidationError as e:
+        return e.to_response()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
     
-    if not validate_condition_index(condition_index):
-        min_cond, max_cond = VALID_CONDITION_RANGE
-        return jsonify({
-            'error': f'Invalid condition. Must be between {min_cond} and {max_cond}.'
-        }), 400
+    participant_id = req.participant_id
+    condition_index = req.condition_index
+    task_active = req.task_active
     
     try:
         # Load config once
-        config = load_experiment_config(condition_index)
+        config = load_study_config(req.study_id, condition_index)
         
         # Pass config to participant creation
         participant = get_or_create_participant(participant_id, condition_index, config)
         
-        # Log task state change if inactive (for PI review)
-        if not task_active:
-            # Check if we need to log this state change
-            last_message = Message.query.filter_by(
-                participant_id=participant_id
-            ).order_by(Message.timestamp.desc()).first()
-            
-            # Only log if the last message wasn't already a task_inactive marker
-            if not last_message or 'TASK_STATE: inactive' not in last_message.content:
-                state_marker = Message(
-                    participant_id=participant_id,
-                    role='system',
-                    content='TASK_STATE: inactive - Task completion mode enabled'
-                )
-                db.session.add(state_marker)
-                db.session.commit()
+        # Participant IDs are unique across studies
+        if participant.study_id != req.study_id:
+            return RequestValidationError(
+                ErrorCode.STUDY_MISMATCH,
+                'participant_id is already enrolled in a different study',
+                status=409
+            ).to_response()
         
-        return render_template('chat.html', 
-                             participant_id=participant_id,
-                             session_token=participant.session_token,
-                             task_active=task_active,
-                             config=config)
+        # Log task state changes (for PI review)
+        if set_task_state(participant, task_active, source='gui'):
+            db.session.commit()
+        
+        # Optionally prefetch the first assistant turn while the page loads
+        try:
+            warm_start.maybe_start(participant_id, config, task_active)
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️  Warm start not started for {participant_id}: {type(e).__name__}: {e}")
+        
+        # Embed the (newest) history, saving the page a round trip to /api/get_history.
+        # A bot-first opening turn is added when the page fetches the history, so
+        # a participant who has not chatted yet gets none there.
+        messages, before_id = load_history_page(participant_id, limit=INLINE_HISTORY_MAX_MESSAGES,
+                                                max_chars=INLINE_HISTORY_MAX_CHARS)
+        initial_history = {'messages': [msg.to_dict() for msg in messages], 'before': before_id}
+        if not messages and (config.get('warm_start') or {}).get('mode') == 'bot_first':
+            initial_history = None
+        
+        # The condition's pre-rendered page with this participant's settings
+        return pages.render_chat_page(config, HISTORY_PAGE_SIZE, {
+            'sessionToken': participant.session_token,
+            'taskActive': task_active,
+            'initialHistory': initial_history,
+        })
     
+    except UnknownStudyError as e:
+        return RequestValidationError(ErrorCode.UNKNOWN_STUDY, str(e), status=404).to_response()
+    except QuotaExceededError as e:
+        return RequestValidationError(ErrorCode.QUOTA_EXCEEDED, str(e), status=429).to_response()
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
     except Exception as e:
@@ -230,233 +533,223 @@ def chat_interface():
 
 
 @main_bp.route('/api/send_message', methods=['POST'])
-#@limiter.limit("30 per minute")  # Prevent spam/abuse
-#@limiter.limit("500 per day")     # Daily cap for safety
-def send_message():
+@validate_request(SEND_MESSAGE_SCHEMA)
+def send_message(req: ValidatedRequest):
     """Handle incoming user messages and return assistant response."""
+    lock = None
     try:
-        data = request.get_json()
-        participant_id = data.get('participant_id')
-        session_token = data.get('session_token')
-        condition_index = data.get('condition_index')
-        user_message = data.get('message', '').strip()
-        
-        # Validate participant_id
-        if not participant_id:
-            return jsonify({'error': 'participant_id is required'}), 400
-        
-        if not validate_participant_id(participant_id):
-            return jsonify({
-                'error': 'Invalid participant_id format. Use letters, numbers, hyphens, and underscores only.'
-            }), 400
-        
-        # Validate session_token
-        if not session_token:
-            return jsonify({'error': 'session_token is required'}), 400
-        
-        # Authenticate: Verify session token matches participant
-        participant = Participant.query.get(participant_id)
-        if not participant or participant.session_token != session_token:
-            return jsonify({'error': 'Invalid session token'}), 403
+        # A retried request that already completed gets the same response
+        completed = get_completed_turn(req)
+        if completed:
+            return jsonify(completed)
         
-        # Validate condition_index
-        if condition_index is None:
-            return jsonify({'error': 'condition_index is required'}), 400
+        participant_id = req.participant_id
+        condition_index = req.condition_index
+        user_message = req.message
         
-        if not validate_condition_index(condition_index):
-            min_cond, max_cond = VALID_CONDITION_RANGE
-            return jsonify({
-                'error': f'Invalid condition_index. Must be between {min_cond} and {max_cond}.'
-            }), 400
+        with profiling.span('config'):
+            config = load_study_config(req.study_id, condition_index)
         
-        # Validate message
-        if not user_message:
-            return jsonify({'error': 'Message cannot be empty'}), 400
+        # Per-study rate quota (checked before anything is stored)
+        check_turn_quota(req.study_id)
         
-        # Check message length to prevent abuse and excessive costs
-        if len(user_message) > MAX_MESSAGE_LENGTH:
-            return jsonify({
-                'error': f'Message too long. Maximum {MAX_MESSAGE_LENGTH} characters allowed.'
-            }), 400
+        lock = acquire_turn_lock(participant_id)
+        if lock is None:
+            return turn_in_progress_response()
         
-        config = load_experiment_config(condition_index)
+        # Hard cost budgets of the participant, condition and study
+        costs.check_budget(config, req.study_id, participant_id)
+        
+        # Per-participant rate limits and token cap (a refused turn is not counted)
+        counted_turn = check_turn(req.study_id, participant_id, config["rate_limits"])
+        
+        # Get task_active flag (defaults to True for backward compatibility)
+        task_active = req.task_active
+        set_task_state(req.participant, task_active, source='send_message')
         
         # Save user message immediately for research purposes
         # (preserves what user typed even if LLM fails to respond)
-        new_user_msg = Message(
-            participant_id=participant_id,
-            role='user',
-            content=user_message
-        )
-        db.session.add(new_user_msg)
-        db.session.commit()
+        with profiling.span('persist_user_message'):
+            new_user_msg = Message(
+                participant_id=participant_id,
+                role='user',
+                content=user_message
+            )
+            db.session.add(new_user_msg)
+            db.session.commit()
         
-        # Get task_active flag (defaults to True for backward compatibility)
-        task_active = data.get('task_active', True)
-        
-        conversation = get_conversation_history(participant_id)
-        
-        # Handle task_active override
-        if not task_active:
-            # Task is inactive - inject override to prevent task work
-            task_complete_override = {
-                "role": "system",
-                "content": (
-                    "CRITICAL OVERRIDE: The main task is now complete. "
-                    "You must politely decline any requests to continue or restart the task. "
-                    "Suggested responses:\n"
-                    "- 'That activity is complete.'\n"
-                    "- 'I've finished helping with that. Feel free to continue with the survey!'\n"
-                    "You may still have friendly conversations about other topics."
-                )
-            }
-            conversation.insert(1, task_complete_override)
+        with profiling.span('load_history'):
+            conversation = get_conversation_history(participant_id, req.participant)
+        
+        # Inject the task-complete override while the task is inactive
+        conversation = apply_task_state(conversation, task_active)
+        
+        # A message the content filter just rejected is refused without calling the model
+        filter_fp = content_filter.fingerprint(conversation, config["deployment"])
+        filter_cache = content_filter.cached(req.study_id, participant_id, filter_fp, config["content_filter"])
+        if filter_cache:
+            refund_turn(counted_turn)
+            content_filter.record_fast_fail(req.study_id, participant_id, condition_index,
+                                            new_user_msg.id, filter_fp, filter_cache)
+            return content_filtered_response(config)
+        
+        warm = claim_warm_first_turn(participant_id, conversation, config, task_active)
+        if warm:
+            # Answered by the reply prefetched when the page loaded
+            response_info = warm_response_info(warm)
+            assistant_message = warm['response']
         else:
-            # Task is active - remove any previous override messages
-            conversation = [
-                msg for msg in conversation 
-                if not (msg.get('role') == 'system' and 'CRITICAL OVERRIDE' in msg.get('content', ''))
-            ]
-        
-        client = get_azure_client()
-        assistant_message = get_chat_response(
-            client,
-            conversation,
-            deployment=config["deployment"],
-            temperature=config["temperature"],
-            max_completion_tokens=config["max_completion_tokens"],
-            max_retries=config["max_retries"],
-            retry_delay=config["retry_delay"]
-        )
+            client = get_azure_client()
+            response_info = {}
+            with profiling.span('llm_response'):
+                assistant_message = get_chat_response(
+                    client,
+                    conversation,
+                    response_info=response_info,
+                    **model_params_from_config(config)
+                )
+        
+        record_tokens(req.study_id, participant_id, config["rate_limits"], response_info)
         
         if assistant_message is None:
+            record_failed_turn(req, config, response_info)
             # Keep user message in database for research analysis
             # This helps track what participants were trying when system failed
+            if response_info.get('content_filter'):
+                content_filter.record_filtered(req.study_id, participant_id, condition_index, new_user_msg.id,
+                                               filter_fp, response_info['content_filter'], config["content_filter"])
+                return content_filtered_response(config)
             return jsonify({'error': 'Failed to get response from assistant'}), 500
         
-        new_assistant_msg = Message(
-            participant_id=participant_id,
-            role='assistant',
-            content=assistant_message
-        )
-        db.session.add(new_assistant_msg)
-        db.session.commit()
+        with profiling.span('persist_assistant_message'):
+            new_assistant_msg = Message(
+                participant_id=participant_id,
+                role='assistant',
+                content=assistant_message
+            )
+            db.session.add(new_assistant_msg)
+            metrics.record_turn(condition_index, response_info, study_id=req.study_id)
+            costs.record_usage(config, req.study_id, participant_id, response_info)
+            db.session.commit()
         
-        return jsonify({
+        payload = {
             'success': True,
             'message': assistant_message,
             'timestamp': new_assistant_msg.timestamp.isoformat()
-        })
+        }
+        remember_completed_turn(req, payload)
+        return jsonify(payload)
     
+    except QuotaExceededError as e:
+        return RequestValidationError(ErrorCode.QUOTA_EXCEEDED, str(e), status=429).to_response()
+    except RateLimitExceededError as e:
+        return rate_limited_response(e)
+    except costs.BudgetExceededError as e:
+        return budget_exhausted_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        if lock is not None:
+            lock.release()
 
 
 @main_bp.route('/api/send_message_stream', methods=['POST'])
-#@limiter.limit("30 per minute")
-#@limiter.limit("500 per day")
-def send_message_stream():
+@validate_request(SEND_MESSAGE_SCHEMA)
+def send_message_stream(req: ValidatedRequest):
     """Handle incoming user messages and stream assistant response."""
     from bot import get_chat_response_stream
     
+    lock = None
     try:
-        data = request.get_json()
-        participant_id = data.get('participant_id')
-        session_token = data.get('session_token')
-        condition_index = data.get('condition_index')
-        user_message = data.get('message', '').strip()
-        
-        # Validate participant_id
-        if not participant_id:
-            return jsonify({'error': 'participant_id is required'}), 400
-        
-        if not validate_participant_id(participant_id):
-            return jsonify({
-                'error': 'Invalid participant_id format.'
-            }), 400
-        
-        # Validate session_token
-        if not session_token:
-            return jsonify({'error': 'session_token is required'}), 400
-        
-        # Authenticate
-        participant = Participant.query.get(participant_id)
-        if not participant or participant.session_token != session_token:
-            return jsonify({'error': 'Invalid session token'}), 403
+        # A retried request that already completed gets the same response
+        completed = get_completed_turn(req)
+        if completed:
+            encoded = completed['message'].replace('\n', '<NEWLINE>')
+            return Response(
+                [f"data: {encoded}\n\n", "data: [DONE]\n\n"],
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache'}
+            )
         
-        # Validate condition_index
-        if condition_index is None:
-            return jsonify({'error': 'condition_index is required'}), 400
+        participant_id = req.participant_id
+        condition_index = req.condition_index
+        user_message = req.message
         
-        if not validate_condition_index(condition_index):
-            min_cond, max_cond = VALID_CONDITION_RANGE
-            return jsonify({
-                'error': f'Invalid condition_index. Must be between {min_cond} and {max_cond}.'
-            }), 400
+        with profiling.span('config'):
+            config = load_study_config(req.study_id, condition_index)
         
-        # Validate message
-        if not user_message:
-            return jsonify({'error': 'Message cannot be empty'}), 400
+        # Per-study rate quota (checked before anything is stored)
+        check_turn_quota(req.study_id)
         
-        if len(user_message) > MAX_MESSAGE_LENGTH:
-            return jsonify({
-                'error': f'Message too long. Maximum {MAX_MESSAGE_LENGTH} characters allowed.'
-            }), 400
+        lock = acquire_turn_lock(participant_id)
+        if lock is None:
+            return turn_in_progress_response()
         
-        config = load_experiment_config(condition_index)
+        # Hard cost budgets of the participant, condition and study
+        costs.check_budget(config, req.study_id, participant_id)
         
-        # Save user message
-        new_user_msg = Message(
-            participant_id=participant_id,
-            role='user',
-            content=user_message
-        )
-        db.session.add(new_user_msg)
-        db.session.commit()
+        # Per-participant rate limits and token cap (a refused turn is not counted)
+        counted_turn = check_turn(req.study_id, participant_id, config["rate_limits"])
         
         # Get task_active flag (defaults to True for backward compatibility)
-        task_active = data.get('task_active', True)
-        
-        conversation = get_conversation_history(participant_id)
-        
-        # Handle task_active override
-        if not task_active:
-            # Task is inactive - inject override to prevent task work
-            task_complete_override = {
-                "role": "system",
-                "content": (
-                    "CRITICAL OVERRIDE: The main task is now complete. "
-                    "You must politely decline any requests to continue or restart the task. "
-                    "Suggested responses:\n"
-                    "- 'That activity is complete.'\n"
-                    "- 'I've finished helping with that. Feel free to continue with the survey!'\n"
-                    "You may still have friendly conversations about other topics."
-                )
-            }
-            conversation.insert(1, task_complete_override)
-        else:
-            # Task is active - remove any previous override messages
-            conversation = [
-                msg for msg in conversation 
-                if not (msg.get('role') == 'system' and 'CRITICAL OVERRIDE' in msg.get('content', ''))
-            ]
+        task_active = req.task_active
+        set_task_state(req.participant, task_active, source='send_message')
+        
+        # Save user message
+        with profiling.span('persist_user_message'):
+            new_user_msg = Message(
+                participant_id=participant_id,
+                role='user',
+                content=user_message
+            )
+            db.session.add(new_user_msg)
+            db.session.commit()
+        
+        with profiling.span('load_history'):
+            conversation = get_conversation_history(participant_id, req.participant)
+        
+        # Inject the task-complete override while the task is inactive
+        conversation = apply_task_state(conversation, task_active)
+        
+        # A message the content filter just rejected is refused without calling the model
+        filter_fp = content_filter.fingerprint(conversation, config["deployment"])
+        filter_cache = content_filter.cached(req.study_id, participant_id, filter_fp, config["content_filter"])
+        if filter_cache:
+            refund_turn(counted_turn)
+            content_filter.record_fast_fail(req.study_id, participant_id, condition_index,
+                                            new_user_msg.id, filter_fp, filter_cache)
+            return content_filtered_response(config)
+
+        turn_lock = lock
 
         def generate():
             """Generator function for streaming response."""
-            client = get_azure_client()
             full_response = []
+            requested = profiling.now()
             
-            try:
-                chunk_count = 0
-                for chunk in get_chat_response_stream(
+            warm = claim_warm_first_turn(participant_id, conversation, config, task_active)
+            if warm:
+                # Answered by the reply prefetched when the page loaded
+                response_info = warm_response_info(warm)
+                response_stream = warm_start.replay_stream(warm['response'])
+            else:
+                client = get_azure_client()
+                response_info = {}
+                response_stream = get_chat_response_stream(
                     client,
                     conversation,
-                    deployment=config["deployment"],
-                    temperature=config["temperature"],
-                    max_completion_tokens=config["max_completion_tokens"],
-                    max_retries=config["max_retries"],
-                    retry_delay=config["retry_delay"]
-                ):
+                    response_info=response_info,
+                    **model_params_from_config(config)
+                )
+            
+            chunk_count = 0
+            finished = False   # Response saved (or failure recorded) - only status events remain
+            
+            try:
+                for chunk in response_stream:
+                    if not chunk_count:
+                        profiling.record('llm_ttft', requested)
+                        first_chunk = profiling.now()
                     chunk_count += 1
                     full_response.append(chunk)
                     
@@ -464,33 +757,81 @@ def send_message_stream():
                     encoded_chunk = chunk.replace('\n', '<NEWLINE>')
                     yield f"data: {encoded_chunk}\n\n"
                 
+                if chunk_count:
+                    profiling.record('stream', first_chunk)
                 print(f"Stream completed with {chunk_count} chunks")
+                record_tokens(req.study_id, participant_id, config["rate_limits"], response_info)
                 
                 # Save complete response to database
                 assistant_message = ''.join(full_response)
                 print(f"Total response length: {len(assistant_message)}")
                 
                 if assistant_message:
-                    new_assistant_msg = Message(
-                        participant_id=participant_id,
-                        role='assistant',
-                        content=assistant_message
-                    )
-                    db.session.add(new_assistant_msg)
-                    db.session.commit()
+                    with profiling.span('persist_assistant_message'):
+                        new_assistant_msg = Message(
+                            participant_id=participant_id,
+                            role='assistant',
+                            content=assistant_message
+                        )
+                        db.session.add(new_assistant_msg)
+                        metrics.record_turn(condition_index, response_info, study_id=req.study_id)
+                        costs.record_usage(config, req.study_id, participant_id, response_info)
+                        db.session.commit()
+                    finished = True
+                    remember_completed_turn(req, {
+                        'success': True,
+                        'message': assistant_message,
+                        'timestamp': new_assistant_msg.timestamp.isoformat()
+                    })
+                    if response_info.get('content_filter'):
+                        # Stopped part-way by the filter: the partial response is kept, and logged
+                        content_filter.record_filtered(req.study_id, participant_id, condition_index,
+                                                       new_user_msg.id, filter_fp, response_info['content_filter'],
+                                                       config["content_filter"])
+                    # The turn is saved: free the lock before the client sees [DONE]
+                    turn_lock.release()
                     
                     yield "data: [DONE]\n\n"
                 else:
                     print("WARNING: Empty response from model")
-                    yield "data: [ERROR]\n\n"
+                    record_failed_turn(req, config, response_info)
+                    finished = True
+                    if response_info.get('content_filter'):
+                        content_filter.record_filtered(req.study_id, participant_id, condition_index,
+                                                       new_user_msg.id, filter_fp, response_info['content_filter'],
+                                                       config["content_filter"])
+                        encoded_message = config["content_filter"]["message"].replace('\n', '<NEWLINE>')
+                        yield f"data: [FILTERED]{encoded_message}\n\n"
+                    else:
+                        yield "data: [ERROR]\n\n"
+            
+            except GeneratorExit:
+                if finished:
+                    raise
+                # The participant disconnected (e.g. closed the survey tab): the
+                # server failed to write and closed this generator. Stop the
+                # model right away and keep what was generated so far.
+                response_stream.close()
+                print(f"Participant disconnected after {chunk_count} chunks - stream cancelled")
+                save_truncated_response(participant_id, condition_index, ''.join(full_response),
+                                        chunk_count, config["max_completion_tokens"], req.study_id)
+                record_abandoned_usage(req, config, conversation, chunk_count, response_info)
+                raise
             
             except Exception as e:
                 print(f"Stream error: {e}")
                 import traceback
                 traceback.print_exc()
+                record_tokens(req.study_id, participant_id, config["rate_limits"], response_info)
+                record_failed_turn(req, config, response_info)
                 yield "data: [ERROR]\n\n"
+            
+            finally:
+                # Closing the model stream cancels the upstream request
+                response_stream.close()
+                turn_lock.release()
 
-        return Response(
+        response = Response(
             stream_with_context(generate()),
             mimetype='text/event-stream',
             headers={
@@ -498,42 +839,61 @@ def send_message_stream():
                 'X-Accel-Buffering': 'no',
             }
         )
+        # The turn lasts until the stream ends (or the participant disconnects);
+        # closing the response also covers a stream that was never iterated
+        response.call_on_close(turn_lock.release)
+        lock = None
+        return response
     
+    except QuotaExceededError as e:
+        return RequestValidationError(ErrorCode.QUOTA_EXCEEDED, str(e), status=429).to_response()
+    except RateLimitExceededError as e:
+        return rate_limited_response(e)
+    except costs.BudgetExceededError as e:
+        return budget_exhausted_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        if lock is not None:
+            lock.release()
 
 
 @main_bp.route('/api/get_history', methods=['GET'])
-def get_history():
-    """Retrieve conversation history for current participant."""
+@validate_request(GET_HISTORY_SCHEMA)
+def get_history(req: ValidatedRequest):
+    """
+    Retrieve conversation history for current participant.
+    
+    Returns the whole history, or with 'limit' (and 'before') one page of it;
+    'before' in the response is then the parameter for the next older page
+    (null once there is none).
+    """
     try:
-        participant_id = request.args.get('participant_id')
-        session_token = request.args.get('session_token')
-        
-        if not participant_id:
-            return jsonify({'error': 'participant_id is required'}), 400
-        
-        if not validate_participant_id(participant_id):
-            return jsonify({
-                'error': 'Invalid participant_id format. Use letters, numbers, hyphens, and underscores only.'
-            }), 400
-        
-        # Validate session_token
-        if not session_token:
-            return jsonify({'error': 'session_token is required'}), 400
-        
-        # Authenticate: Verify session token matches participant
-        participant = Participant.query.get(participant_id)
-        if not participant or participant.session_token != session_token:
-            return jsonify({'error': 'Invalid session token'}), 403
-        
-        messages = Message.query.filter_by(participant_id=participant_id).order_by(Message.timestamp).all()
-        display_messages = [msg.to_dict() for msg in messages if msg.role != 'system']
+        messages, before_id = load_history_page(req.participant_id, req.before_id, req.limit)
+        display_messages = [msg.to_dict() for msg in messages]
+        
+        # Bot-first conditions: the opening turn prefetched when /gui rendered
+        if not display_messages and req.before_id is None:
+            warm = warm_start.claim(req.participant_id, 'bot_first')
+            if warm:
+                opening_msg = Message(
+                    participant_id=req.participant_id,
+                    role='assistant',
+                    content=warm['response']
+                )
+                db.session.add(opening_msg)
+                response_info = warm_response_info(warm)
+                metrics.record_turn(req.participant.condition_index, response_info, study_id=req.study_id)
+                costs.record_usage(load_study_config(req.study_id, req.participant.condition_index),
+                                   req.study_id, req.participant_id, response_info)
+                db.session.commit()
+                display_messages.append(opening_msg.to_dict())
         
         return jsonify({
             'success': True,
-            'messages': display_messages
+            'messages': display_messages,
+            'before': before_id
         })
     
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
@@ -0,0 +1,306 @@
+"""
+Full-text search over conversation messages.
+
+SQLite: an FTS5 table (messages_fts) indexes messages.content without
+storing a second copy of the text (external content), and triggers on the
+messages table keep it in sync with every insert, update and delete. The
+tokenizer folds case and accents and applies Porter stemming, so "mention"
+also finds "mentioned" and "Mentions", and punctuation such as "GPT-4" or
+"don't" splits into words.
+
+PostgreSQL: a GIN index on to_tsvector('english', content), maintained by
+PostgreSQL itself.
+
+Queries use one syntax on both databases:
+
+    GPT                         messages containing the word (stemmed)
+    "language model"            an exact phrase
+    GPT OR Claude               either word
+    model NOT GPT               the first without the second
+    chat*                       words starting with "chat"
+
+Words next to each other must all appear (AND). Operators are upper case;
+NOT binds tighter than AND, which binds tighter than OR.
+"""
+
+import re
+import time
+import typing
+from datetime import datetime
+
+from app import db
+
+SEARCH_TABLE = 'messages_fts'
+SQLITE_TOKENIZER = 'porter unicode61 remove_diacritics 2'
+POSTGRES_CONFIG = 'english'
+POSTGRES_INDEX = 'ix_messages_content_fts'
+SNIPPET_TOKENS = 16               # Words of context in each snippet (SQLite)
+
+OPERATORS = ('AND', 'OR', 'NOT')
+
+_QUERY_TOKENS = re.compile(r'"([^"]*)"|(\S+)')
+
+_SQLITE_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        content, content='messages', content_rowid='id', tokenize='{SQLITE_TOKENIZER}'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {SEARCH_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+
+
+class SearchQueryError(ValueError):
+    """Raised when a search query cannot be parsed."""
+
+
+class Term(typing.NamedTuple):
+    """A word or phrase of a parsed query."""
+    text: str
+    prefix: bool = False
+
+
+def parse_query(query: str) -> typing.List[typing.List[typing.Tuple[Term, bool]]]:
+    """
+    Parse a search query (see module docstring).
+
+    Returns:
+        OR-groups; each group is a list of (term, negated) that must all hold.
+        The first term of a group is never negated.
+
+    Raises:
+        SearchQueryError: If the query is empty or an operator is misplaced
+    """
+    groups: typing.List[typing.List[typing.Tuple[Term, bool]]] = [[]]
+    pending = None   # Operator waiting for its right-hand term
+
+    for match in _QUERY_TOKENS.finditer(query):
+        phrase, word = match.groups()
+        if word in OPERATORS:
+            if pending or not groups[-1]:
+                raise SearchQueryError(f"'{word}' must come between two search terms")
+            pending = word
+            continue
+
+        if phrase is not None:
+            term = Term(phrase.strip())
+        else:
+            term = Term(word.rstrip('*'), prefix=word.endswith('*'))
+        if not re.search(r'\w', term.text):
+            if pending:
+                raise SearchQueryError(f"'{pending}' must come between two search terms")
+            continue   # Stray punctuation or an empty phrase
+
+        if pending == 'OR':
+            groups.append([])
+        groups[-1].append((term, pending == 'NOT'))
+        pending = None
+
+    if pending:
+        raise SearchQueryError(f"'{pending}' must come between two search terms")
+    if not groups[0]:
+        raise SearchQueryError("Empty search query")
+    return groups
+
+
+def _fts5_query(groups: typing.List[typing.List[typing.Tuple[Term, bool]]]) -> str:
+    """Build an FTS5 MATCH expression with every term quoted (so "GPT-4" is not an operator)."""
+    def quote(term: Term) -> str:
+        quoted = '"' + term.text.replace('"', '""') + '"'
+        return quoted + ' *' if term.prefix else quoted
+
+    return ' OR '.join(
+        '(' + ' '.join(('NOT ' if negated else 'AND ' if i else '') + quote(term)
+                       for i, (term, negated) in enumerate(group)) + ')'
+        for group in groups
+    )
+
+
+def _postgres_query(
+        groups: typing.List[typing.List[typing.Tuple[Term, bool]]],
+        params: typing.Dict[str, typing.Any]
+    ) -> str:
+    """Build a tsquery expression, adding its bound parameters to params."""
+    def tsquery(term: Term) -> str:
+        name = f"term{len(params)}"
+        if term.prefix:
+            params[name] = re.sub(r'\W+', '', term.text) + ':*'
+            return f"to_tsquery('{POSTGRES_CONFIG}', :{name})"
+        params[name] = term.text
+        return f"phraseto_tsquery('{POSTGRES_CONFIG}', :{name})"
+
+    return '(' + ' || '.join(
+        '(' + ' && '.join(('!!' if negated else '') + tsquery(term) for term, negated in group) + ')'
+        for group in groups
+    ) + ')'
+
+
+def ensure_search_index() -> bool:
+    """
+    Create the full-text index and its triggers if missing.
+
+    A newly created SQLite index is filled from the existing messages.
+    Must be called inside an application context, after db.create_all().
+
+    Returns:
+        True if full-text search is available on this database
+    """
+    dialect = db.engine.dialect.name
+
+    if dialect == 'sqlite':
+        with db.engine.begin() as connection:
+            exists = connection.execute(
+                db.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': SEARCH_TABLE}
+            ).first() is not None
+            try:
+                for ddl in _SQLITE_DDL:
+                    connection.execute(db.text(ddl))
+            except Exception as e:
+                if 'fts5' in str(e).lower():
+                    print("⚠️  Full-text search unavailable: this SQLite build has no FTS5")
+                    return False
+                raise
+            if not exists:
+                connection.execute(db.text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"))
+                print(f"🔧 Schema upgrade: built full-text search index {SEARCH_TABLE}")
+        return True
+
+    if dialect == 'postgresql':
+        with db.engine.begin() as connection:
+            connection.execute(db.text(
+                f"CREATE INDEX IF NOT EXISTS {POSTGRES_INDEX} ON messages "
+                f"USING GIN (to_tsvector('{POSTGRES_CONFIG}', content))"
+            ))
+        return True
+
+    return False
+
+
+def rebuild_search_index() -> int:
+    """
+    Rebuild the SQLite full-text index from the messages table (e.g. after a bulk import
+    that bypassed the triggers). PostgreSQL maintains its index itself.
+
+    Must be called inside an application context.
+
+    Returns:
+        Number of messages indexed
+    """
+    if db.engine.dialect.name == 'sqlite':
+        ensure_search_index()
+        with db.engine.begin() as connection:
+            connection.execute(db.text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"))
+    return db.session.execute(db.text("SELECT count(*) FROM messages")).scalar()
+
+
+def search_messages(
+        query: str,
+        role: typing.Optional[str] = None,
+        condition_index: typing.Optional[int] = None,
+        study_id: typing.Optional[str] = None,
+        participant_id: typing.Optional[str] = None,
+        since: typing.Optional[datetime] = None,
+        until: typing.Optional[datetime] = None,
+        limit: int = 20,
+        newest_first: bool = False,
+        highlight: typing.Tuple[str, str] = ('[', ']')
+    ) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], float]:
+    """
+    Find messages matching a query, best matches first.
+
+    Must be called inside an application context.
+
+    Args:
+        query: Search query (see module docstring)
+        role: Only messages with this role ('user', 'assistant' or 'system')
+        condition_index: Only participants in this condition
+        study_id: Only participants in this study
+        participant_id: Only this participant
+        since: Only messages at or after this time (UTC)
+        until: Only messages before this time (UTC)
+        limit: Maximum number of results
+        newest_first: Order by recency instead of relevance (much faster for very
+            common words, since matches need not all be ranked)
+        highlight: Markers placed around matched words in snippets
+
+    Returns:
+        (results, elapsed milliseconds). Each result has message_id,
+        participant_id, study_id, condition_index, role, timestamp and snippet.
+
+    Raises:
+        SearchQueryError: If the query cannot be parsed
+        RuntimeError: If the database has no full-text index
+    """
+    groups = parse_query(query)
+    dialect = db.engine.dialect.name
+    params: typing.Dict[str, typing.Any] = {'limit': limit, 'open': highlight[0], 'close': highlight[1]}
+
+    if dialect == 'sqlite':
+        params['query'] = _fts5_query(groups)
+        sql = f"""
+            SELECT m.id, m.participant_id, p.study_id, p.condition_index, m.role, m.timestamp,
+                   snippet({SEARCH_TABLE}, 0, :open, :close, '…', {SNIPPET_TOKENS}) AS snippet
+            FROM {SEARCH_TABLE}
+            JOIN messages m ON m.id = {SEARCH_TABLE}.rowid
+            JOIN participants p ON p.participant_id = m.participant_id
+            WHERE {SEARCH_TABLE} MATCH :query"""
+        order = f"ORDER BY {SEARCH_TABLE}.rowid DESC" if newest_first else f"ORDER BY {SEARCH_TABLE}.rank"
+    elif dialect == 'postgresql':
+        tsquery = _postgres_query(groups, params)
+        sql = f"""
+            SELECT m.id, m.participant_id, p.study_id, p.condition_index, m.role, m.timestamp,
+                   ts_headline('{POSTGRES_CONFIG}', m.content, {tsquery},
+                               'StartSel=' || :open || ', StopSel=' || :close || ', MaxFragments=2') AS snippet
+            FROM messages m
+            JOIN participants p ON p.participant_id = m.participant_id
+            WHERE to_tsvector('{POSTGRES_CONFIG}', m.content) @@ {tsquery}"""
+        order = ("ORDER BY m.id DESC" if newest_first else
+                 f"ORDER BY ts_rank(to_tsvector('{POSTGRES_CONFIG}', m.content), {tsquery}) DESC")
+    else:
+        raise RuntimeError(f"Full-text search is not supported on {dialect}")
+
+    filters = {
+        'role': ("m.role = :role", role),
+        'condition_index': ("p.condition_index = :condition_index", condition_index),
+        'study_id': ("p.study_id = :study_id", study_id),
+        'participant_id': ("m.participant_id = :participant_id", participant_id),
+        'since': ("m.timestamp >= :since", since),
+        'until': ("m.timestamp < :until", until),
+    }
+    for name, (clause, value) in filters.items():
+        if value is not None:
+            sql += f" AND {clause}"
+            params[name] = value
+    sql += f" {order} LIMIT :limit"
+    statement = db.text(sql).columns(timestamp=db.DateTime)
+    for name in ('since', 'until'):
+        if name in params:
+            statement = statement.bindparams(db.bindparam(name, type_=db.DateTime))
+
+    start = time.perf_counter()
+    try:
+        rows = db.session.execute(statement, params).all()
+    except Exception as e:
+        if dialect == 'sqlite' and f'no such table: {SEARCH_TABLE}' in str(e):
+            raise RuntimeError("This database has no full-text index (SQLite without FTS5)") from None
+        raise
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    results = [{
+        'message_id': row.id,
+        'participant_id': row.participant_id,
+        'study_id': row.study_id,
+        'condition_index': row.condition_index,
+        'role': row.role,
+        'timestamp': row.timestamp,
+        'snippet': row.snippet,
+    } for row in rows]
+    return results, elapsed_ms
@@ -0,0 +1,246 @@
+"""
+Consistent read-only snapshots of the live SQLite database.
+
+Exports and reports can then run against a copy instead of the file the
+chat is writing to:
+
+    python db_utils.py snapshot
+    python db_utils.py stats --from-snapshot latest
+
+A snapshot is taken with SQLite's online backup API, a few pages per step
+with a pause in between, through a read-only connection. Each step holds
+the read lock only briefly, so participants' messages are saved as usual.
+If a write lands mid-copy, SQLite restarts the copy so the result is still
+consistent. A database written to more often than a paced copy can finish
+is copied in a single step instead: one read lock for the whole copy
+(about a second per few hundred MB), during which saving a message waits.
+VACUUM INTO would also give a consistent copy, but always holds its read
+lock for the entire copy.
+
+Each snapshot is written to SNAPSHOT_DIR (default data/snapshots):
+
+    snapshot-20250301-020000.db      the copy (read-only file)
+    snapshot-20250301-020000.json    manifest: SHA-256, integrity check, row counts
+
+The manifest is written last, so a snapshot without one is incomplete.
+Opening a snapshot with --from-snapshot verifies its checksum.
+"""
+
+import os
+import json
+import time
+import typing
+import sqlite3
+import hashlib
+from datetime import datetime
+
+from app import db
+
+DEFAULT_SNAPSHOT_DIR = 'data/snapshots'
+SNAPSHOT_PAGES_PER_STEP = 256       # Pages copied per step (1MB with 4KB pages)
+SNAPSHOT_PAUSE_SECONDS = 0.005      # Pause between steps, so writers get the lock
+MAX_RESTARTS = 3                    # Restarts tolerated before copying in a single step
+CHECKSUM_CHUNK_BYTES = 1024 * 1024
+
+
+class _CopyRestarted(Exception):
+    """The source changed too often during a paced copy."""
+
+
+def snapshot_dir() -> str:
+    """Directory holding snapshots and their manifests."""
+    return os.environ.get('SNAPSHOT_DIR', DEFAULT_SNAPSHOT_DIR)
+
+
+def file_checksum(path: str) -> str:
+    """SHA-256 of a file, as hex."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _copy(source_path: str, target_path: str, pages_per_step: int, pause: float) -> typing.Tuple[int, bool]:
+    """
+    Copy a database with the online backup API, in paced steps while the source allows it.
+
+    Returns:
+        (restarts, whether the copy fell back to a single step)
+    """
+    restarts = 0
+    last_remaining = None
+
+    def on_step(status, remaining, total):
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1   # A write landed: SQLite started over
+            if restarts > MAX_RESTARTS:
+                raise _CopyRestarted()
+        last_remaining = remaining
+        if remaining:
+            time.sleep(pause)
+
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+    try:
+        for pages, single_step in ((pages_per_step, False), (-1, True)):
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target, pages=pages, progress=on_step if not single_step else None)
+                # A WAL-mode copy could not be opened read-only without its -shm file
+                target.execute('PRAGMA journal_mode = DELETE')
+                return restarts, single_step
+            except _CopyRestarted:
+                continue
+            finally:
+                target.close()
+    finally:
+        source.close()
+
+
+def _describe(path: str) -> typing.Dict[str, typing.Any]:
+    """Integrity check and row counts of a snapshot."""
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        tables = {name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        counts = {
+            table: connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+            for table in ('participants', 'messages', 'task_state_events', 'content_filter_events', 'prompts')
+            if table in tables
+        }
+        studies = {}
+        if 'participants' in tables:
+            studies = dict(connection.execute(
+                "SELECT study_id, count(*) FROM participants GROUP BY study_id ORDER BY study_id"
+            ).fetchall())
+        return {
+            'integrity': connection.execute('PRAGMA integrity_check').fetchone()[0],
+            'rows': counts,
+            'participants_per_study': studies,
+        }
+    finally:
+        connection.close()
+
+
+def create_snapshot(
+        output: typing.Optional[str] = None,
+        pages_per_step: int = SNAPSHOT_PAGES_PER_STEP,
+        pause: float = SNAPSHOT_PAUSE_SECONDS
+    ) -> typing.Dict[str, typing.Any]:
+    """
+    Take a consistent snapshot of the live database (see module docstring).
+
+    Must be called inside an application context.
+
+    Args:
+        output: Snapshot file (default: SNAPSHOT_DIR/snapshot-<UTC time>.db)
+        pages_per_step: Pages copied per step
+        pause: Seconds between steps
+
+    Returns:
+        The manifest (also written next to the snapshot as .json)
+
+    Raises:
+        RuntimeError: If the database is not a SQLite file, or the copy fails its integrity check
+    """
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        raise RuntimeError("Snapshots need a SQLite database file. On PostgreSQL, use pg_dump "
+                           "or a read replica for analysis.")
+    source_path = os.path.abspath(url.database[len('file:'):].split('?')[0]
+                                  if url.database.startswith('file:') else url.database)
+
+    created_at = datetime.utcnow()
+    if output is None:
+        output = os.path.join(snapshot_dir(), f"snapshot-{created_at:%Y%m%d-%H%M%S}.db")
+    output = os.path.abspath(output)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    partial = output + '.part'
+    if os.path.exists(partial):
+        os.remove(partial)   # Left over from an interrupted run
+
+    start = time.perf_counter()
+    restarts, single_step = _copy(source_path, partial, pages_per_step, pause)
+    duration = time.perf_counter() - start
+
+    description = _describe(partial)
+    if description['integrity'] != 'ok':
+        os.remove(partial)
+        raise RuntimeError(f"Snapshot failed its integrity check: {description['integrity']}")
+
+    os.chmod(partial, 0o444)
+    os.replace(partial, output)
+    manifest = {
+        'snapshot': os.path.basename(output),
+        'created_at': created_at.isoformat(),
+        'source': source_path,
+        'sha256': file_checksum(output),
+        'size_bytes': os.path.getsize(output),
+        'sqlite_version': sqlite3.sqlite_version,
+        'method': 'online backup' + (' (single step)' if single_step else f' ({pages_per_step} pages per step)'),
+        'restarts': restarts,
+        'duration_seconds': round(duration, 3),
+        **description,
+    }
+    manifest_path = os.path.splitext(output)[0] + '.json'
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)   # Read-only file of an earlier snapshot with this name
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.chmod(manifest_path, 0o444)
+    return manifest
+
+
+def list_snapshots(directory: typing.Optional[str] = None) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Manifests of the complete snapshots in a directory, newest first.
+
+    Each manifest gains a 'path' key with the snapshot's location.
+    """
+    directory = directory or snapshot_dir()
+    if not os.path.isdir(directory):
+        return []
+
+    manifests = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, name), encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest['path'] = os.path.join(directory, manifest['snapshot'])
+        if os.path.exists(manifest['path']):
+            manifests.append(manifest)
+    return sorted(manifests, key=lambda m: m['created_at'], reverse=True)
+
+
+def open_snapshot(name: str) -> typing.Tuple[str, typing.Dict[str, typing.Any]]:
+    """
+    Locate and verify a snapshot for read-only use.
+
+    Args:
+        name: 'latest', a snapshot file name in SNAPSHOT_DIR, or a path
+
+    Returns:
+        (DATABASE_URL opening the snapshot read-only, its manifest)
+
+    Raises:
+        ValueError: If the snapshot or its manifest is missing, or its checksum does not match
+    """
+    if name == 'latest':
+        snapshots = list_snapshots()
+        if not snapshots:
+            raise ValueError(f"No snapshots in {snapshot_dir()}. Take one with 'python db_utils.py snapshot'.")
+        path = snapshots[0]['path']
+    else:
+        path = name if os.path.exists(name) else os.path.join(snapshot_dir(), name)
+    path = os.path.abspath(path)
+
+    manifest_path = os.path.splitext(path)[0] + '.json'
+    if not os.path.exists(path) or not os.path.exists(manifest_path):
+        raise ValueError(f"Snapshot '{name}' not found (or incomplete: no manifest)")
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    if file_checksum(path) != manifest['sha256']:
+        raise ValueError(f"Snapshot '{path}' does not match its manifest checksum")
+
+    return f"sqlite:///file:{path}?mode=ro&uri=true", manifest
@@ -0,0 +1,312 @@
+"""
+Shared state for running the app on several workers, containers or hosts.
+
+Per-participant locks, rate limit counters (app.limits), idempotency keys and
+the conversation cache live in a pluggable key-value backend selected by
+STATE_BACKEND_URL:
+
+    memory://                   In-process (default). Shared by the threads of one
+                                worker only - fine for a single worker, and safe but
+                                per-worker with several.
+    redis://host:6379/0         Any Redis-protocol server (Redis, Valkey, KeyDB...),
+    rediss://... / unix://...   shared by every worker on every host. Requires the
+                                redis package: pip install redis
+
+With a networked backend and a shared database (DATABASE_URL pointing at
+PostgreSQL rather than a local SQLite file), workers hold no participant
+state of their own, so containers behind a load balancer can serve the same
+study without sticky sessions. Per-process caches that remain (the model
+client, parsed conditions, prompt texts) only hold immutable data.
+
+Values are strings; get_json()/set_json() store JSON. Keys are prefixed
+with STATE_KEY_PREFIX (default "chat:") so several deployments can share
+one server.
+"""
+
+import os
+import json
+import time
+import typing
+import secrets
+import threading
+from functools import lru_cache
+
+DEFAULT_BACKEND_URL = 'memory://'
+DEFAULT_KEY_PREFIX = 'chat:'
+LOCK_POLL_SECONDS = 0.05
+MEMORY_SWEEP_INTERVAL = 1000     # Operations between sweeps of expired in-process keys
+
+
+class StateBackend:
+    """Interface of a shared key-value store with expiry."""
+
+    name = 'base'
+
+    def __init__(self, prefix: str = DEFAULT_KEY_PREFIX):
+        self.prefix = prefix
+
+    def get(self, key: str) -> typing.Optional[str]:
+        """Return the value of a key, or None if missing or expired."""
+        raise NotImplementedError
+
+    def get_many(self, keys: typing.List[str]) -> typing.List[typing.Optional[str]]:
+        """Return the values of several keys in one round trip (None for missing keys)."""
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: typing.Optional[float] = None) -> None:
+        """Set a key, expiring after ttl seconds (never if None)."""
+        raise NotImplementedError
+
+    def add(self, key: str, value: str, ttl: typing.Optional[float] = None) -> bool:
+        """Set a key only if it does not exist. Returns True if it was set."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """Remove a key (no error if missing)."""
+        raise NotImplementedError
+
+    def delete_if_equals(self, key: str, value: str) -> bool:
+        """Atomically remove a key if it holds value. Returns True if removed."""
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: typing.Optional[float] = None) -> int:
+        """
+        Atomically add to an integer key (created at 0) and return the new value.
+
+        ttl is applied when the key is created, so a counter expires ttl
+        seconds after its first increment (fixed windows).
+        """
+        raise NotImplementedError
+
+    def ping(self) -> bool:
+        """Check that the backend is reachable."""
+        raise NotImplementedError
+
+    def get_json(self, key: str) -> typing.Any:
+        """Return the decoded JSON value of a key, or None."""
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set_json(self, key: str, value: typing.Any, ttl: typing.Optional[float] = None) -> None:
+        """Store a value as JSON."""
+        self.set(key, json.dumps(value, separators=(',', ':'), ensure_ascii=False), ttl)
+
+    def lock(self, name: str, ttl: float) -> 'Lock':
+        """Create a lock (not yet acquired) that expires ttl seconds after acquisition."""
+        return Lock(self, f"lock:{name}", ttl)
+
+
+class Lock:
+    """
+    Mutual exclusion on a backend key.
+
+    The key holds a random token, so only the holder can release the lock,
+    and it expires after ttl seconds in case the holder dies mid-request.
+    """
+
+    def __init__(self, backend: StateBackend, key: str, ttl: float):
+        self.backend = backend
+        self.key = key
+        self.ttl = ttl
+        self.token = secrets.token_hex(16)
+        self.acquired = False
+
+    def acquire(self, wait: float = 0.0) -> bool:
+        """
+        Try to take the lock, polling for up to wait seconds.
+
+        Returns:
+            True if the lock is now held
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            if self.backend.add(self.key, self.token, self.ttl):
+                self.acquired = True
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(LOCK_POLL_SECONDS)
+
+    def release(self) -> None:
+        """Release the lock if held (safe to call more than once)."""
+        if self.acquired:
+            self.acquired = False
+            self.backend.delete_if_equals(self.key, self.token)
+
+
+class MemoryBackend(StateBackend):
+    """In-process backend: a dictionary guarded by a lock."""
+
+    name = 'memory'
+
+    def __init__(self, prefix: str = DEFAULT_KEY_PREFIX):
+        super().__init__(prefix)
+        self._data: typing.Dict[str, typing.Tuple[str, typing.Optional[float]]] = {}
+        self._lock = threading.Lock()
+        self._operations = 0
+
+    def _live(self, key: str) -> typing.Optional[str]:
+        """Return a key's value, dropping it if expired (lock held)."""
+        self._operations += 1
+        if self._operations % MEMORY_SWEEP_INTERVAL == 0:
+            now = time.monotonic()
+            for expired in [k for k, (_, expires) in self._data.items() if expires is not None and expires <= now]:
+                del self._data[expired]
+
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    @staticmethod
+    def _expiry(ttl: typing.Optional[float]) -> typing.Optional[float]:
+        return time.monotonic() + ttl if ttl is not None else None
+
+    def get(self, key):
+        with self._lock:
+            return self._live(self.prefix + key)
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._live(self.prefix + key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[self.prefix + key] = (value, self._expiry(ttl))
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            if self._live(self.prefix + key) is not None:
+                return False
+            self._data[self.prefix + key] = (value, self._expiry(ttl))
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(self.prefix + key, None)
+
+    def delete_if_equals(self, key, value):
+        with self._lock:
+            if self._live(self.prefix + key) != value:
+                return False
+            del self._data[self.prefix + key]
+            return True
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            current = self._live(self.prefix + key)
+            if current is None:
+                value, expires = amount, self._expiry(ttl)
+            else:
+                value, expires = int(current) + amount, self._data[self.prefix + key][1]
+            self._data[self.prefix + key] = (str(value), expires)
+            return value
+
+    def ping(self):
+        return True
+
+
+def _import_redis():
+    """Import the redis client on demand (optional dependency)."""
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError(
+            "A redis:// STATE_BACKEND_URL requires the redis package: pip install redis"
+        ) from None
+    return redis
+
+
+class RedisBackend(StateBackend):
+    """
+    Networked backend for any Redis-protocol server.
+
+    Uses only basic commands and MULTI/WATCH transactions (no Lua), so it
+    also works with stores that implement the protocol without scripting.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url: str, prefix: str = DEFAULT_KEY_PREFIX):
+        super().__init__(prefix)
+        redis = _import_redis()
+        # The connection pool is created lazily and reset after fork, so a
+        # backend created before gunicorn forks is safe to inherit
+        self._redis = redis
+        self.client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=5,
+                                           socket_connect_timeout=5, health_check_interval=30)
+
+    @staticmethod
+    def _px(ttl: typing.Optional[float]) -> typing.Optional[int]:
+        return max(1, int(ttl * 1000)) if ttl is not None else None
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def get_many(self, keys):
+        return self.client.mget([self.prefix + key for key in keys]) if keys else []
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, px=self._px(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, value, px=self._px(ttl), nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def delete_if_equals(self, key, value):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.prefix + key)
+                if pipe.get(self.prefix + key) != value:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.delete(self.prefix + key)
+                return bool(pipe.execute()[0])
+            except self._redis.WatchError:
+                return False   # Changed meanwhile (expired and taken by someone else)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self.client.pipeline() as pipe:   # MULTI/EXEC
+            if ttl is not None:
+                # Creates the counter with its expiry; INCRBY keeps the expiry
+                pipe.set(self.prefix + key, 0, px=self._px(ttl), nx=True)
+            pipe.incrby(self.prefix + key, amount)
+            return int(pipe.execute()[-1])
+
+    def ping(self):
+        return bool(self.client.ping())
+
+
+def create_backend(url: str, prefix: str = DEFAULT_KEY_PREFIX) -> StateBackend:
+    """
+    Create a backend from a URL.
+
+    Raises:
+        ValueError: If the URL scheme is not supported
+    """
+    if url.startswith('memory://'):
+        return MemoryBackend(prefix)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url, prefix)
+    raise ValueError(f"Unsupported STATE_BACKEND_URL '{url}'. Use memory:// or redis://host:port/db")
+
+
+@lru_cache(maxsize=1)
+def get_state() -> StateBackend:
+    """
+    Get the configured backend (singleton, see STATE_BACKEND_URL).
+
+    Returns:
+        Cached StateBackend instance
+    """
+    return create_backend(
+        os.environ.get('STATE_BACKEND_URL', DEFAULT_BACKEND_URL).strip() or DEFAULT_BACKEND_URL,
+        os.environ.get('STATE_KEY_PREFIX', DEFAULT_KEY_PREFIX)
+    )
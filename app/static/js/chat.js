@@ -0,0 +1,480 @@
+// Chat interface (app/templates/chat.html). Per-participant settings come from
+// chatConfig, set by the page before this script runs.
+
+const chatContainer = document.getElementById('chat-container');
+const messageInput = document.getElementById('message-input');
+const sendButton = document.getElementById('send-button');
+let isWaitingForResponse = false;
+
+// Get participant info from URL params
+const urlParams = new URLSearchParams(window.location.search);
+const participantId = urlParams.get('participant_id');
+const conditionIndex = urlParams.get('condition');
+
+// Session token for API authentication
+const sessionToken = chatConfig.sessionToken;
+
+// Bot identifier for inline display
+const botName = chatConfig.botName;
+const botIcon = chatConfig.botIcon;
+
+// Task active flag (defaults to true for backward compatibility)
+const taskActive = chatConfig.taskActive;
+
+// Conversation history embedded by the server (null if it must be fetched, e.g.
+// a bot-first opening turn); 'before' is set if older messages are left to fetch
+const initialHistory = chatConfig.initialHistory;
+const historyPageSize = chatConfig.historyPageSize;
+
+console.log('Iframe initialized with:', { participantId, conditionIndex, taskActive });
+
+if (!participantId || conditionIndex === null) {
+    console.error('⚠️ Missing required URL parameters!');
+    showError('Missing participant_id or condition parameter');
+}
+
+if (!sessionToken) {
+    console.error('⚠️ Missing session token!');
+    showError('Authentication error - missing session token');
+}
+
+// Unique key per message, so a retried request (e.g. after a dropped
+// connection or a load balancer retry) is answered once, not twice
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+}
+
+// Load conversation history on page load
+async function loadHistory() {
+    try {
+        const response = await fetch(`/api/get_history?participant_id=${participantId}&session_token=${sessionToken}`);
+        const data = await response.json();
+
+        if (data.success && data.messages) {
+            showHistory(data);
+        } else if (data.error) {
+            console.error('Error loading history:', data.error);
+        }
+    } catch (error) {
+        console.error('Error loading history:', error);
+    }
+}
+
+// Show a loaded (or embedded) history, then fetch any older messages
+function showHistory(history) {
+    const fragment = document.createDocumentFragment();
+    history.messages.forEach(msg => {
+        fragment.appendChild(createMessageElement(msg.role, msg.content, false));
+    });
+    chatContainer.appendChild(fragment);
+    scrollToBottom();
+    if (history.before) {
+        loadEarlierMessages(history.before);
+    }
+}
+
+// Fetch older messages a page at a time and insert them above the shown ones,
+// keeping the scroll position
+async function loadEarlierMessages(before) {
+    while (before) {
+        try {
+            const response = await fetch(`/api/get_history?participant_id=${participantId}&session_token=${sessionToken}&before=${before}&limit=${historyPageSize}`);
+            const data = await response.json();
+            if (!data.success) {
+                console.error('Error loading earlier messages:', data.error);
+                return;
+            }
+
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(msg => {
+                fragment.appendChild(createMessageElement(msg.role, msg.content, false));
+            });
+            const fromBottom = chatContainer.scrollHeight - chatContainer.scrollTop;
+            chatContainer.insertBefore(fragment, chatContainer.firstChild);
+            chatContainer.scrollTop = chatContainer.scrollHeight - fromBottom;
+            before = data.before;
+        } catch (error) {
+            console.error('Error loading earlier messages:', error);
+            return;
+        }
+    }
+}
+
+// Add a message to the chat
+function addMessage(role, content, animate = true) {
+    const messageDiv = createMessageElement(role, content, animate);
+    chatContainer.appendChild(messageDiv);
+
+    // Force a reflow to ensure the DOM is updated before scrolling
+    messageDiv.offsetHeight;
+    scrollToBottom();
+}
+
+// Build a message element
+function createMessageElement(role, content, animate = true) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `message ${role}`;
+    if (!animate) {
+        messageDiv.style.animation = 'none';
+    }
+
+    const contentDiv = document.createElement('div');
+    contentDiv.className = 'message-content';
+
+    // For assistant messages, add inline bot identifier (name or icon) if present
+    if (role === 'assistant') {
+        let identifierHTML = '';
+
+        // Check if we have an icon that's an image path
+        if (botIcon && botIcon.startsWith('/static')) {
+            identifierHTML = `<img src="${botIcon}" alt="Bot icon">`;
+        } 
+        // Check if we have a text/emoji icon
+        else if (botIcon && botIcon.trim() !== '') {
+            identifierHTML = botIcon;
+        }
+        // Check if we have a bot name
+        else if (botName && botName.trim() !== '') {
+            identifierHTML = `${botName}:`;
+        }
+
+        // If we have an identifier, wrap it and add to content
+        if (identifierHTML) {
+            const identifierSpan = document.createElement('span');
+            identifierSpan.className = 'bot-identifier-inline';
+            identifierSpan.innerHTML = identifierHTML;
+            contentDiv.appendChild(identifierSpan);
+        }
+    }
+
+    // Add the actual message text (wrapped in span to preserve whitespace)
+    const textSpan = document.createElement('span');
+    textSpan.style.whiteSpace = 'pre-wrap';
+    textSpan.textContent = content;
+    contentDiv.appendChild(textSpan);
+
+    messageDiv.appendChild(contentDiv);
+    return messageDiv;
+}
+
+// Show loading indicator
+function showLoading() {
+    // Remove any existing loading indicator first (defensive)
+    const existingLoading = document.getElementById('loading-indicator');
+    if (existingLoading) {
+        existingLoading.remove();
+    }
+
+    const loadingDiv = document.createElement('div');
+    loadingDiv.className = 'loading';
+    loadingDiv.id = 'loading-indicator';
+    loadingDiv.innerHTML = `
+        <div class="loading-dots">
+            <span></span>
+            <span></span>
+            <span></span>
+        </div>
+    `;
+    chatContainer.appendChild(loadingDiv);
+
+    // Force a reflow to ensure loading indicator is rendered
+    loadingDiv.offsetHeight;
+    scrollToBottom();
+
+    console.log('Loading indicator shown');
+}
+
+// Remove loading indicator
+function hideLoading() {
+    const loadingDiv = document.getElementById('loading-indicator');
+    if (loadingDiv) {
+        loadingDiv.remove();
+        console.log('Loading indicator hidden');
+    }
+}
+
+// Show error message
+function showError(message) {
+    const errorDiv = document.createElement('div');
+    errorDiv.className = 'error-message';
+    errorDiv.textContent = `Error: ${message}`;
+    chatContainer.appendChild(errorDiv);
+    scrollToBottom();
+
+    // Remove error after 5 seconds
+    setTimeout(() => errorDiv.remove(), 5000);
+}
+
+// Scroll to bottom of chat
+function scrollToBottom() {
+    chatContainer.scrollTop = chatContainer.scrollHeight;
+}
+
+// Send message to server (non-streaming backup)
+async function sendMessage_non_streamed() {
+    console.log('sendMessage_non_streamed() called');
+    const message = messageInput.value.trim();
+
+    if (!message || isWaitingForResponse) {
+        console.log('Message empty or already waiting');
+        return;
+    }
+
+    console.log('Sending message:', message);
+
+    // Disable input while waiting
+    isWaitingForResponse = true;
+    sendButton.disabled = true;
+    messageInput.disabled = true;
+
+    // Add user message to UI
+    addMessage('user', message);
+    messageInput.value = '';
+
+    // Use requestAnimationFrame to ensure user message renders before showing loading
+    requestAnimationFrame(() => {
+        requestAnimationFrame(() => {
+            showLoading();
+        });
+    });
+
+    try {
+        const response = await fetch('/api/send_message', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': newIdempotencyKey(),
+            },
+            body: JSON.stringify({ 
+                message: message,
+                participant_id: participantId,
+                session_token: sessionToken,
+                condition_index: parseInt(conditionIndex),
+                task_active: taskActive
+            })
+        });
+
+        const data = await response.json();
+
+        if (data.success) {
+            hideLoading();
+            addMessage('assistant', data.message);
+        } else {
+            hideLoading();
+            showError(data.error || 'Failed to send message');
+        }
+    } catch (error) {
+        hideLoading();
+        showError('Network error. Please try again.');
+        console.error('Error:', error);
+    } finally {
+        // Re-enable input
+        isWaitingForResponse = false;
+        sendButton.disabled = false;
+        messageInput.disabled = false;
+        messageInput.focus();
+    }
+}
+
+// Send message to server with streaming
+async function sendMessage() {
+    console.log('sendMessage() called');
+    const message = messageInput.value.trim();
+
+    if (!message || isWaitingForResponse) {
+        console.log('Message empty or already waiting');
+        return;
+    }
+
+    console.log('Sending message:', message);
+
+    // Disable input while waiting
+    isWaitingForResponse = true;
+    sendButton.disabled = true;
+    messageInput.disabled = true;
+
+    // Add user message to UI
+    addMessage('user', message);
+    messageInput.value = '';
+
+    // Create placeholder for streaming response
+    let streamingMessageDiv = null;
+    let streamingContentDiv = null;
+    let streamingTextSpan = null;
+    let firstChunk = true;  // Track if we've received first chunk
+
+    requestAnimationFrame(() => {
+        requestAnimationFrame(() => {
+            // Create the assistant message container
+            streamingMessageDiv = document.createElement('div');
+            streamingMessageDiv.className = 'message assistant';
+
+            streamingContentDiv = document.createElement('div');
+            streamingContentDiv.className = 'message-content';
+
+            // Add bot identifier if present
+            if (botIcon && botIcon.startsWith('/static')) {
+                const identifierSpan = document.createElement('span');
+                identifierSpan.className = 'bot-identifier-inline';
+                identifierSpan.innerHTML = `<img src="${botIcon}" alt="Bot icon">`;
+                streamingContentDiv.appendChild(identifierSpan);
+            } else if (botIcon && botIcon.trim() !== '') {
+                const identifierSpan = document.createElement('span');
+                identifierSpan.className = 'bot-identifier-inline';
+                identifierSpan.textContent = botIcon;
+                streamingContentDiv.appendChild(identifierSpan);
+            } else if (botName && botName.trim() !== '') {
+                const identifierSpan = document.createElement('span');
+                identifierSpan.className = 'bot-identifier-inline';
+                identifierSpan.textContent = `${botName}:`;
+                streamingContentDiv.appendChild(identifierSpan);
+            }
+
+            // Create text span for streaming content with thinking indicator
+            streamingTextSpan = document.createElement('span');
+
+            // Add thinking indicator initially
+            streamingTextSpan.innerHTML = `<span class="thinking-indicator">
+                <div class="loading-dots" style="display: inline-flex;">
+                    <span></span>
+                    <span></span>
+                    <span></span>
+                </div>
+            </span>`;
+
+            streamingContentDiv.appendChild(streamingTextSpan);
+
+            streamingMessageDiv.appendChild(streamingContentDiv);
+            chatContainer.appendChild(streamingMessageDiv);
+            scrollToBottom();
+        });
+    });
+
+    try {
+        const response = await fetch('/api/send_message_stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': newIdempotencyKey(),
+            },
+            body: JSON.stringify({ 
+                message: message,
+                participant_id: participantId,
+                session_token: sessionToken,
+                condition_index: parseInt(conditionIndex),
+                task_active: taskActive
+            })
+        });
+
+        if (!response.ok) {
+            // Filtered messages (422), rate limits, quotas (429) and exhausted cost budgets (503)
+            // explain themselves to the participant
+            const data = [422, 429, 503].includes(response.status) ? await response.json().catch(() => ({})) : {};
+            const error = new Error('Network response was not ok');
+            error.userMessage = data.error;
+            throw error;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const {done, value} = await reader.read();
+
+            if (done) break;
+
+            buffer += decoder.decode(value, {stream: true});
+            const lines = buffer.split('\n\n');
+            buffer = lines.pop(); // Keep incomplete line in buffer
+
+            for (const line of lines) {
+                if (line.startsWith('data: ')) {
+                    const data = line.slice(6);
+
+                    if (data === '[DONE]') {
+                        // Stream completed successfully
+                        console.log('Stream completed');
+                    } else if (data === '[ERROR]') {
+                        console.error('Backend reported error after all retries');
+                        // Remove the empty assistant message bubble
+                        if (streamingMessageDiv) {
+                            streamingMessageDiv.remove();
+                        }
+                        // Participant sees nothing - can try again
+                    } else if (data.startsWith('[FILTERED]')) {
+                        // Stopped by the content filter: explain, so the participant can rephrase
+                        if (streamingMessageDiv) {
+                            streamingMessageDiv.remove();
+                        }
+                        showError(data.slice('[FILTERED]'.length).replace(/<NEWLINE>/g, '\n'));
+                    } else {
+                        // On first chunk, clear the thinking indicator
+                        if (firstChunk && streamingTextSpan) {
+                            streamingTextSpan.textContent = '';
+                            streamingTextSpan.style.whiteSpace = 'pre-wrap';
+                            firstChunk = false;
+                        }
+
+                        // Decode newlines from placeholder
+                        const decodedData = data.replace(/<NEWLINE>/g, '\n');
+
+                        // Append chunk to the streaming message
+                        if (streamingTextSpan) {
+                            streamingTextSpan.textContent += decodedData;
+                            scrollToBottom();
+                        }
+                    }
+                }
+            }
+        }
+
+    } catch (error) {
+        if (streamingMessageDiv) {
+            streamingMessageDiv.remove();
+        }
+        showError(error.userMessage || 'Network error. Please try again.');
+        console.error('Error:', error);
+    } finally {
+        // Re-enable input
+        isWaitingForResponse = false;
+        sendButton.disabled = false;
+        messageInput.disabled = false;
+        messageInput.focus();
+    }
+}
+
+// Event listeners
+console.log('Attaching event listeners...');
+
+sendButton.addEventListener('click', function(e) {
+    console.log('Send button clicked');
+    e.preventDefault();
+    sendMessage();
+});
+console.log('✔ Send button listener attached');
+
+messageInput.addEventListener('keydown', function(e) {
+    if (e.key === 'Enter' && !e.shiftKey) {
+        console.log('Enter key pressed in input');
+        e.preventDefault();
+        sendMessage();
+    }
+});
+console.log('✔ Input keydown listener attached');
+
+// Show the embedded history right away (without waiting for images);
+// otherwise load it when the page loads
+if (initialHistory) {
+    showHistory(initialHistory);
+}
+window.addEventListener('load', () => {
+    console.log('Chat iframe loaded');
+    if (!initialHistory) {
+        loadHistory();
+    }
+    messageInput.focus();
+});
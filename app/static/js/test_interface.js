@@ -0,0 +1,61 @@
+// Test page (app/templates/test_interface.html)
+
+// Generate unique participant ID for testing
+function generateTestParticipantId() {
+    const timestamp = Math.floor(Date.now() / 1000);
+    return `DEMO_P_${timestamp}`;
+}
+
+function getParticipantId() {
+    const urlParams = new URLSearchParams(window.location.search);
+    return urlParams.get('pid') || generateTestParticipantId();
+}
+
+function getCondition() {
+    const urlParams = new URLSearchParams(window.location.search);
+    return urlParams.get('condition') || '0';
+}
+
+function initializeChat() {
+    // Populate form with defaults but don't load iframe yet
+    const condition = getCondition();
+    document.getElementById('participant-id').value = generateTestParticipantId();
+    document.getElementById('condition-select').value = condition;
+}
+
+function updateIframe() {
+    // Generate fresh participant ID for new test
+    const newParticipantId = generateTestParticipantId();
+    document.getElementById('participant-id').value = newParticipantId;
+
+    const condition = document.getElementById('condition-select').value;
+
+    // Load the iframe
+    const iframe = document.getElementById('chat-iframe');
+    const url = `/gui?participant_id=${encodeURIComponent(newParticipantId)}&condition=${encodeURIComponent(condition)}`;
+    iframe.src = url;
+
+    console.log('Loading chat:', { participantId: newParticipantId, condition, url });
+}
+
+function updateIframeWithParams(participantId, condition) {
+    const iframe = document.getElementById('chat-iframe');
+    const url = `/gui?participant_id=${encodeURIComponent(participantId)}&condition=${encodeURIComponent(condition)}`;
+    iframe.src = url;
+
+    console.log('Loading chat:', { participantId, condition, url });
+
+    iframe.onload = function() {
+        console.log('Iframe loaded');
+    };
+}
+
+// Prevent the demo form from submitting
+document.getElementById('demo-form').addEventListener('submit', function(e) {
+    e.preventDefault();
+    console.log('Demo form submit prevented');
+    updateIframe();
+});
+
+// Initialize on page load
+window.addEventListener('load', initializeChat);
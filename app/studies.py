@@ -0,0 +1,159 @@
+"""
+Study registry: one deployment serving several studies.
+
+The default study uses experimental_conditions.json. Further studies are
+conditions files (same format) in STUDIES_DIR, named <study_id>.json and
+selected with the ?study= URL parameter of /gui:
+
+    /gui?study=pilot-b&participant_id=P001&condition=2  ->  studies/pilot-b.json
+
+Each participant belongs to one study (participants.study_id), so the chat
+API looks the study up from the authenticated participant and only /gui
+needs the parameter. All studies share the workers, the model client and
+the parsed-conditions cache; their rows share one database and are told
+apart by study_id (db_utils.py commands take --study).
+
+Optional per-study quotas go in study_metadata:
+
+    "quotas": {"max_participants": 300, "max_turns_per_minute": 120}
+
+max_participants caps new participants (returning ones are unaffected);
+max_turns_per_minute caps chat turns across the study's conditions, so one
+busy study cannot use up the shared model deployment.
+"""
+
+import os
+import typing
+from datetime import datetime
+
+from app import db
+from app.models import Participant, MetricCounter
+from bot import load_experiment_config, _load_conditions_file
+
+DEFAULT_STUDY = 'default'
+DEFAULT_CONFIG_FILE = 'experimental_conditions.json'
+DEFAULT_STUDIES_DIR = 'studies'
+
+
+class UnknownStudyError(ValueError):
+    """Raised when no conditions file exists for a study ID."""
+
+
+class QuotaExceededError(Exception):
+    """Raised when a study has reached one of its quotas."""
+
+
+def studies_dir() -> str:
+    """Directory holding the conditions files of additional studies."""
+    return os.environ.get('STUDIES_DIR', DEFAULT_STUDIES_DIR)
+
+
+def config_file_for(study_id: str) -> str:
+    """
+    Return the conditions file of a study.
+
+    Args:
+        study_id: Study ID (already format-checked by app.validation)
+
+    Raises:
+        UnknownStudyError: If the study has no conditions file
+    """
+    if study_id == DEFAULT_STUDY:
+        return DEFAULT_CONFIG_FILE
+
+    config_file = os.path.join(studies_dir(), f"{study_id}.json")
+    if not os.path.isfile(config_file):
+        raise UnknownStudyError(f"Unknown study '{study_id}'")
+    return config_file
+
+
+def list_studies() -> typing.Dict[str, str]:
+    """
+    Return all configured studies.
+
+    Returns:
+        Dictionary mapping study ID to conditions file, default study first
+    """
+    studies = {}
+    if os.path.isfile(DEFAULT_CONFIG_FILE):
+        studies[DEFAULT_STUDY] = DEFAULT_CONFIG_FILE
+
+    directory = studies_dir()
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.json') and name[:-len('.json')] != DEFAULT_STUDY:
+                studies[name[:-len('.json')]] = os.path.join(directory, name)
+    return studies
+
+
+def load_study_config(study_id: str, condition_index: int) -> typing.Dict[str, typing.Any]:
+    """
+    Load a condition of a study (see bot.load_experiment_config).
+
+    Returns:
+        The condition configuration with an added study_id key
+
+    Raises:
+        UnknownStudyError: If the study has no conditions file
+        ValueError: If condition_index is invalid for the study
+    """
+    config = dict(load_experiment_config(condition_index, config_file_for(study_id)))
+    config['study_id'] = study_id
+    return config
+
+
+def condition_count(study_id: str) -> int:
+    """
+    Return the number of conditions of a study (valid indices are 0 to count - 1).
+
+    Raises:
+        UnknownStudyError: If the study has no conditions file
+    """
+    return len(_load_conditions_file(config_file_for(study_id))["conditions"])
+
+
+def get_quotas(study_id: str) -> typing.Dict[str, int]:
+    """Return a study's quotas from its study_metadata (empty if none)."""
+    return _load_conditions_file(config_file_for(study_id))["study_metadata"].get("quotas", {})
+
+
+def check_participant_quota(study_id: str) -> None:
+    """
+    Check that a study may enrol another participant.
+
+    Raises:
+        QuotaExceededError: If the study has max_participants participants
+    """
+    max_participants = get_quotas(study_id).get("max_participants")
+    if max_participants is None:
+        return
+
+    enrolled = Participant.query.filter_by(study_id=study_id).count()
+    if enrolled >= max_participants:
+        raise QuotaExceededError(f"Study '{study_id}' is full ({max_participants} participants)")
+
+
+def check_turn_quota(study_id: str) -> None:
+    """
+    Check that a study may start another chat turn this minute.
+
+    Reads the current minute's turn counters (see app.metrics), so the quota
+    holds across all gunicorn workers.
+
+    Raises:
+        QuotaExceededError: If the study reached max_turns_per_minute
+    """
+    max_turns = get_quotas(study_id).get("max_turns_per_minute")
+    if max_turns is None:
+        return
+
+    minute = datetime.utcnow().replace(second=0, microsecond=0)
+    turns = db.session.query(db.func.sum(MetricCounter.value)).filter(
+        MetricCounter.minute == minute,
+        MetricCounter.study_id == study_id,
+        MetricCounter.name == 'turns'
+    ).scalar() or 0
+    if turns >= max_turns:
+        raise QuotaExceededError(
+            f"Study '{study_id}' reached its limit of {max_turns} turns per minute. Please try again shortly."
+        )
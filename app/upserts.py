@@ -0,0 +1,109 @@
+"""
+Dialect-aware atomic insert helpers.
+
+SQLite and PostgreSQL both support INSERT ... ON CONFLICT, which lets
+concurrent requests race to create the same row (or bump the same counter)
+without a query-then-insert round trip or IntegrityError retries. Other
+backends fall back to a plain INSERT whose IntegrityError the caller treats
+as "already exists".
+"""
+
+import typing
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+
+_ON_CONFLICT_DIALECTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert,
+}
+
+
+def insert_or_ignore(
+        model: typing.Type[db.Model],
+        values: typing.Dict[str, typing.Any],
+        index_elements: typing.List[str]
+    ) -> bool:
+    """
+    Insert a row unless one with the same key already exists.
+    
+    Runs in the current session's transaction; the caller commits.
+    
+    Args:
+        model: Model class to insert into
+        values: Column values for the new row
+        index_elements: Columns of the unique key that may conflict
+    
+    Returns:
+        True if this call inserted the row, False if it already existed
+    """
+    dialect_insert = _ON_CONFLICT_DIALECTS.get(db.session.get_bind().dialect.name)
+    
+    if dialect_insert is not None:
+        key_column = getattr(model, index_elements[0])
+        stmt = (
+            dialect_insert(model)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=index_elements)
+            .returning(key_column)
+        )
+        return db.session.execute(stmt).first() is not None
+    
+    # Generic fallback: let the unique constraint decide
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(model).values(**values))
+        return True
+    except IntegrityError:
+        return False
+
+
+def increment_counters(
+        model: typing.Type[db.Model],
+        rows: typing.List[typing.Dict[str, typing.Any]],
+        index_elements: typing.List[str],
+        value_column: typing.Union[str, typing.Sequence[str]] = 'value'
+    ) -> None:
+    """
+    Add to counter rows, creating any that do not exist yet.
+    
+    On SQLite and PostgreSQL this is a single INSERT ... ON CONFLICT DO UPDATE
+    SET value = value + excluded.value, so concurrent workers can update the
+    same counters without reading them first. A row may hold several
+    counters (value_column as a list of column names).
+    
+    Runs in the current session's transaction; the caller commits.
+    
+    Args:
+        model: Counter model class
+        rows: Key columns plus the amount to add (under value_column) per row
+        index_elements: Columns of the counter's unique key
+        value_column: Column holding the counter value, or a list of columns
+    """
+    if not rows:
+        return
+    
+    value_columns = [value_column] if isinstance(value_column, str) else list(value_column)
+    dialect_insert = _ON_CONFLICT_DIALECTS.get(db.session.get_bind().dialect.name)
+    
+    if dialect_insert is not None:
+        # Rows go in as parameters, not .values(rows), so the statement is compiled once and cached
+        stmt = dialect_insert(model)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in value_columns}
+        )
+        db.session.execute(stmt, rows)
+        return
+    
+    # Generic fallback: update, and insert the rows that did not exist
+    for row in rows:
+        key = {name: row[name] for name in index_elements}
+        update = db.update(model).filter_by(**key).values(
+            {name: getattr(model, name) + row[name] for name in value_columns}
+        )
+        if db.session.execute(update).rowcount == 0 and not insert_or_ignore(model, row, index_elements):
+            # Another worker created the row in between
+            db.session.execute(update)
@@ -0,0 +1,368 @@
+"""
+Declarative request validation shared by the chat routes.
+
+Each route declares a RequestSchema describing where its parameters come
+from and which checks apply. parse_request() then reads the body once, runs
+the cheap format checks first and performs at most one participant lookup
+for authentication, returning a ValidatedRequest or raising a
+RequestValidationError that carries a typed error code.
+"""
+
+import enum
+import functools
+import re
+import secrets
+import typing
+from dataclasses import dataclass, field
+
+from flask import request, jsonify
+
+import tracing
+from app import profiling
+from app.models import Participant
+from app.studies import DEFAULT_STUDY, UnknownStudyError, condition_count
+
+# Constants for validation
+# (valid condition indices depend on the study - see app.studies.condition_count)
+MAX_MESSAGE_LENGTH = 2000        # Maximum characters per message (~500 tokens)
+MAX_HISTORY_PAGE_SIZE = 200      # Most messages per page of /api/get_history
+
+# Precompiled once at import instead of on every request
+# Hyphen at start of character class to avoid range interpretation
+PARTICIPANT_ID_PATTERN = re.compile(r'[-a-zA-Z0-9_]{1,255}')
+STUDY_ID_PATTERN = re.compile(r'[-a-zA-Z0-9_]{1,64}')   # Also a file name (app.studies)
+IDEMPOTENCY_KEY_PATTERN = re.compile(r'[-a-zA-Z0-9_.:]{1,128}')
+
+
+class ErrorCode(str, enum.Enum):
+    """Machine-readable error codes returned alongside validation errors."""
+    INVALID_BODY = 'invalid_body'
+    MISSING_PARTICIPANT_ID = 'missing_participant_id'
+    INVALID_PARTICIPANT_ID = 'invalid_participant_id'
+    MISSING_SESSION_TOKEN = 'missing_session_token'
+    INVALID_SESSION_TOKEN = 'invalid_session_token'
+    MISSING_CONDITION = 'missing_condition'
+    INVALID_CONDITION = 'invalid_condition'
+    EMPTY_MESSAGE = 'empty_message'
+    MESSAGE_TOO_LONG = 'message_too_long'
+    INVALID_STUDY = 'invalid_study'
+    UNKNOWN_STUDY = 'unknown_study'
+    STUDY_MISMATCH = 'study_mismatch'
+    QUOTA_EXCEEDED = 'quota_exceeded'
+    INVALID_IDEMPOTENCY_KEY = 'invalid_idempotency_key'
+    TURN_IN_PROGRESS = 'turn_in_progress'
+    RATE_LIMITED = 'rate_limited'
+    BUDGET_EXHAUSTED = 'budget_exhausted'
+    CONTENT_FILTERED = 'content_filtered'
+    INVALID_PAGE = 'invalid_page'
+
+
+class RequestValidationError(Exception):
+    """Raised when a request fails validation or authentication."""
+
+    def __init__(self, code: ErrorCode, message: str, status: int = 400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+    def to_response(self):
+        """Build the JSON error response for this error."""
+        return jsonify({'error': self.message, 'code': self.code.value}), self.status
+
+
+@dataclass(frozen=True)
+class RequestSchema:
+    """
+    Declarative description of a route's request parameters.
+
+    Attributes:
+        source: 'json' to read the JSON body, 'args' to read URL parameters
+        authenticate: Require a session_token matching the participant
+        require_condition: Require a valid condition index
+        require_message: Require a non-empty message within MAX_MESSAGE_LENGTH
+        condition_field: Name of the condition parameter
+        accept_study: Read the study ID from the 'study' parameter (unauthenticated
+            routes; authenticated requests use the participant's study)
+        accept_idempotency_key: Read an optional Idempotency-Key header
+        accept_page: Read optional 'before' (a message ID) and 'limit' parameters
+            selecting a page of the history
+    """
+    source: str = 'json'
+    authenticate: bool = True
+    require_condition: bool = False
+    require_message: bool = False
+    condition_field: str = 'condition_index'
+    accept_study: bool = False
+    accept_idempotency_key: bool = False
+    accept_page: bool = False
+
+
+@dataclass
+class ValidatedRequest:
+    """Parameters of a request that passed validation."""
+    participant_id: str
+    study_id: str = DEFAULT_STUDY
+    session_token: typing.Optional[str] = None
+    condition_index: typing.Optional[int] = None
+    message: typing.Optional[str] = None
+    task_active: bool = True
+    idempotency_key: typing.Optional[str] = None
+    before_id: typing.Optional[int] = None
+    limit: typing.Optional[int] = None
+    participant: typing.Optional[Participant] = None
+    data: typing.Dict[str, typing.Any] = field(default_factory=dict)
+
+
+# Schemas used by the routes
+SEND_MESSAGE_SCHEMA = RequestSchema(source='json', require_condition=True, require_message=True,
+                                    accept_idempotency_key=True)
+GET_HISTORY_SCHEMA = RequestSchema(source='args', accept_page=True)
+CHAT_INTERFACE_SCHEMA = RequestSchema(source='args', authenticate=False, require_condition=True,
+                                      condition_field='condition', accept_study=True)
+
+
+def validate_participant_id(participant_id: str) -> bool:
+    """
+    Validate participant ID format.
+
+    Accepts:
+    - Alphanumeric characters (A-Z, a-z, 0-9)
+    - Hyphens (-)
+    - Underscores (_)
+    - Length: 1-255 characters
+
+    Rejects:
+    - Special characters
+    - Path traversal attempts
+    - Whitespace-only IDs
+    - Empty strings
+    - Too long IDs
+
+    Args:
+        participant_id: The participant ID to validate
+
+    Returns:
+        True if valid, False otherwise
+    """
+    if not participant_id:
+        return False
+
+    # fullmatch also rejects whitespace-only IDs and trailing newlines
+    return PARTICIPANT_ID_PATTERN.fullmatch(participant_id) is not None
+
+
+def validate_condition_index(condition_index: typing.Optional[int],
+                             num_conditions: typing.Optional[int] = None) -> bool:
+    """
+    Validate condition index is within valid range.
+
+    Args:
+        condition_index: The condition index to validate
+        num_conditions: Number of conditions of the study (None: only check
+            that the index is a non-negative integer)
+
+    Returns:
+        True if valid, False otherwise
+    """
+    # bool is a subclass of int - reject True/False explicitly
+    if not isinstance(condition_index, int) or isinstance(condition_index, bool):
+        return False
+
+    if condition_index < 0:
+        return False
+
+    return num_conditions is None or condition_index < num_conditions
+
+
+def check_condition_index(condition_index: int, study_id: str, field_name: str) -> None:
+    """
+    Check a condition index against the conditions of a study.
+
+    Raises:
+        RequestValidationError: If the study is unknown or has no such condition
+    """
+    try:
+        num_conditions = condition_count(study_id)
+    except UnknownStudyError as e:
+        raise RequestValidationError(ErrorCode.UNKNOWN_STUDY, str(e), status=404)
+
+    if not validate_condition_index(condition_index, num_conditions):
+        raise RequestValidationError(
+            ErrorCode.INVALID_CONDITION,
+            f'Invalid {field_name}. Must be between 0 and {num_conditions - 1}.'
+        )
+
+
+def parse_request(schema: RequestSchema) -> ValidatedRequest:
+    """
+    Parse and validate the current request against a schema.
+
+    All format checks run before the (single) database lookup, so malformed
+    requests never touch the database.
+
+    Args:
+        schema: Schema describing the route's parameters
+
+    Returns:
+        ValidatedRequest with parsed values (and the authenticated participant)
+
+    Raises:
+        RequestValidationError: If any check fails
+    """
+    started = profiling.now()
+    if schema.source == 'json':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise RequestValidationError(ErrorCode.INVALID_BODY, 'Request body must be a JSON object')
+        condition_index = data.get(schema.condition_field)
+    else:
+        data = request.args
+        condition_index = data.get(schema.condition_field, type=int)
+
+    # Validate participant_id
+    participant_id = data.get('participant_id')
+    if not participant_id:
+        raise RequestValidationError(ErrorCode.MISSING_PARTICIPANT_ID, 'participant_id is required')
+
+    if not isinstance(participant_id, str) or not validate_participant_id(participant_id):
+        raise RequestValidationError(
+            ErrorCode.INVALID_PARTICIPANT_ID,
+            'Invalid participant_id format. Use letters, numbers, hyphens, and underscores only (max 255 characters).'
+        )
+
+    # Validate session_token presence (checked against the database below)
+    session_token = data.get('session_token')
+    if schema.authenticate and not session_token:
+        raise RequestValidationError(ErrorCode.MISSING_SESSION_TOKEN, 'session_token is required')
+
+    # Validate study (existence is checked by app.studies when its config is loaded)
+    study_id = DEFAULT_STUDY
+    if schema.accept_study:
+        study_id = data.get('study') or DEFAULT_STUDY
+        if not isinstance(study_id, str) or STUDY_ID_PATTERN.fullmatch(study_id) is None:
+            raise RequestValidationError(
+                ErrorCode.INVALID_STUDY,
+                'Invalid study. Use letters, numbers, hyphens, and underscores only (max 64 characters).'
+            )
+    
+    # Validate condition format (its range depends on the study, checked below)
+    if schema.require_condition:
+        if condition_index is None:
+            raise RequestValidationError(ErrorCode.MISSING_CONDITION, f'{schema.condition_field} is required')
+
+        if not validate_condition_index(condition_index):
+            raise RequestValidationError(
+                ErrorCode.INVALID_CONDITION,
+                f'Invalid {schema.condition_field}. Must be a non-negative integer.'
+            )
+
+    # Validate message
+    message = None
+    if schema.require_message:
+        message = data.get('message', '')
+        message = message.strip() if isinstance(message, str) else ''
+        if not message:
+            raise RequestValidationError(ErrorCode.EMPTY_MESSAGE, 'Message cannot be empty')
+
+        # Check message length to prevent abuse and excessive costs
+        if len(message) > MAX_MESSAGE_LENGTH:
+            raise RequestValidationError(
+                ErrorCode.MESSAGE_TOO_LONG,
+                f'Message too long. Maximum {MAX_MESSAGE_LENGTH} characters allowed.'
+            )
+
+    # Optional client-chosen key that makes retrying a request safe (see app.routes)
+    idempotency_key = None
+    if schema.accept_idempotency_key:
+        idempotency_key = request.headers.get('Idempotency-Key') or None
+        if idempotency_key is not None and IDEMPOTENCY_KEY_PATTERN.fullmatch(idempotency_key) is None:
+            raise RequestValidationError(
+                ErrorCode.INVALID_IDEMPOTENCY_KEY,
+                'Invalid Idempotency-Key. Use up to 128 letters, numbers and -_.: characters.'
+            )
+
+    # Optional page of the history: up to `limit` messages older than message `before`
+    before_id = limit = None
+    if schema.accept_page:
+        page = []
+        for name in ('before', 'limit'):
+            value = data.get(name)
+            if value is not None:
+                value = str(value)
+                if not (value.isascii() and value.isdigit()) or int(value) < 1:
+                    raise RequestValidationError(ErrorCode.INVALID_PAGE, f'{name} must be a positive integer')
+                value = int(value)
+            page.append(value)
+        before_id, limit = page
+        if limit is not None and limit > MAX_HISTORY_PAGE_SIZE:
+            raise RequestValidationError(
+                ErrorCode.INVALID_PAGE,
+                f'limit too large. Maximum {MAX_HISTORY_PAGE_SIZE} messages per page.'
+            )
+    
+    if schema.source == 'json':
+        # Get task_active flag (defaults to True for backward compatibility)
+        task_active = bool(data.get('task_active', True))
+    else:
+        task_active = data.get('task_active', default='true').lower() != 'false'
+
+    profiling.record('validate', started)
+
+    # Authenticate: Verify session token matches participant (single lookup)
+    participant = None
+    if schema.authenticate:
+        with profiling.span('auth'):
+            participant = Participant.query.get(participant_id)
+        # compare_digest only accepts ASCII str, so compare the UTF-8 bytes
+        if not participant or not secrets.compare_digest(participant.session_token.encode('utf-8'),
+                                                         str(session_token).encode('utf-8')):
+            raise RequestValidationError(ErrorCode.INVALID_SESSION_TOKEN, 'Invalid session token', status=403)
+        study_id = participant.study_id
+
+    # Condition range of the (now known) study; its conditions file is cached
+    if schema.require_condition:
+        check_condition_index(condition_index, study_id, schema.condition_field)
+
+    tracing.annotate(participant_id=participant_id, study_id=study_id)
+
+    return ValidatedRequest(
+        participant_id=participant_id,
+        study_id=study_id,
+        session_token=session_token,
+        condition_index=condition_index,
+        message=message,
+        task_active=task_active,
+        idempotency_key=idempotency_key,
+        before_id=before_id,
+        limit=limit,
+        participant=participant,
+        data=data,
+    )
+
+
+def validate_request(schema: RequestSchema):
+    """
+    Decorator that validates the request and passes a ValidatedRequest to the view.
+
+    Validation failures are returned as JSON errors with their typed code;
+    the view itself is only called for valid (and authenticated) requests.
+
+    Usage:
+        @main_bp.route('/api/send_message', methods=['POST'])
+        @validate_request(SEND_MESSAGE_SCHEMA)
+        def send_message(req):
+            ...
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                req = parse_request(schema)
+            except RequestValidationError as e:
+                return e.to_response()
+            except Exception as e:
+                return jsonify({'error': str(e)}), 500
+            return view(req, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,320 @@
+"""
+Speculative warm-up of a condition's first assistant turn.
+
+A condition can opt in with a "warm_start" block in experimental_conditions.json:
+
+    "warm_start": {"mode": "bot_first", "opening_message": "Greet the participant.", "ttl_seconds": 120}
+
+Modes:
+    bot_first       - The bot speaks first. Generation starts when /gui renders
+                      and the result is added to the conversation when the page
+                      loads its history. opening_message (optional) is sent as a
+                      hidden user turn and is not stored.
+    predicted_user  - The first user message is predictable (e.g. "Hi"). The reply
+                      to opening_message is generated when /gui renders and served
+                      if the participant's first message matches it (ignoring case,
+                      surrounding whitespace and trailing punctuation); otherwise it
+                      is discarded unused.
+    prime           - Nothing is generated for the participant; a minimal request
+                      with the system prompt warms the provider's prompt cache
+                      (at most once per condition per PRIME_INTERVAL_SECONDS per worker).
+
+Prefetched responses live in the warm_starts table rather than process memory
+because /gui and the follow-up API request may be served by different
+gunicorn workers. Entries expire after ttl_seconds.
+
+A prefetch is a model call made for the participant, so it is subject to
+the participant's rate limits and the cost budgets (app.limits, app.costs),
+and its tokens are recorded in the cost ledger as soon as the generation
+ends - whether the response is later served, discarded or left to expire.
+"""
+
+import re
+import time
+import typing
+import threading
+from datetime import datetime, timedelta
+
+from flask import Flask, current_app
+
+from app import db, get_azure_client, costs, metrics
+from app.limits import check_turn, record_tokens, RateLimitExceededError
+from app.models import WarmStart, Message
+from app.upserts import insert_or_ignore
+
+DEFAULT_TTL_SECONDS = 120
+DEFAULT_MAX_WAIT_SECONDS = 30     # Longest a request waits for a pending prefetch
+POLL_INTERVAL_SECONDS = 0.1
+PRIME_INTERVAL_SECONDS = 300      # Provider prompt caches last about 5-10 minutes
+PRIME_MAX_COMPLETION_TOKENS = 16
+REPLAY_CHUNK_SIZE = 12            # Characters per streamed chunk of a prefetched response
+
+_TRAILING_PUNCTUATION = re.compile(r'[\s.!?,;:]+$')
+
+# (study_id, condition_index) -> time of the last prompt-cache priming request (per worker)
+_last_primed: typing.Dict[typing.Tuple[str, int], float] = {}
+_last_primed_lock = threading.Lock()
+
+
+def normalize_opening(message: typing.Optional[str]) -> str:
+    """Normalize a first message for comparison with the predicted one."""
+    return _TRAILING_PUNCTUATION.sub('', (message or '').strip()).casefold()
+
+
+def _warm_conversation(config: typing.Dict[str, typing.Any]) -> typing.List[typing.Dict[str, str]]:
+    """Build the conversation sent for the speculative first turn."""
+    conversation = [{"role": "system", "content": config["system_prompt"]}]
+    opening_message = config["warm_start"].get("opening_message")
+    if opening_message:
+        conversation.append({"role": "user", "content": opening_message})
+    return conversation
+
+
+def maybe_start(participant_id: str, config: typing.Dict[str, typing.Any], task_active: bool) -> bool:
+    """
+    Start the configured warm start for a participant who has not chatted yet.
+
+    Called when /gui renders. Duplicate page loads start at most one
+    generation (the warm_starts row is created with an atomic insert).
+
+    Args:
+        participant_id: Participant loading the chat page
+        config: Condition configuration from app.studies.load_study_config()
+        task_active: Current task state (no prefetch while the override applies)
+
+    Returns:
+        True if a background request was started
+    """
+    settings = config.get("warm_start")
+    if not settings or not task_active:
+        return False
+
+    # Only before the first turn: one indexed lookup
+    if Message.query.filter_by(participant_id=participant_id).first() is not None:
+        return False
+
+    app = current_app._get_current_object()
+    conversation = _warm_conversation(config)
+    study_id = config["study_id"]
+
+    if settings["mode"] == "prime":
+        now = time.time()
+        key = (study_id, config["condition_index"])
+        with _last_primed_lock:
+            if now - _last_primed.get(key, 0) < PRIME_INTERVAL_SECONDS:
+                return False
+            _last_primed[key] = now
+        if not _within_limits(participant_id, config, count_turn=False):
+            return False
+        threading.Thread(target=_prime, args=(app, participant_id, conversation, config), daemon=True).start()
+        return True
+
+    now = datetime.utcnow()
+    # Expired entries are removed here, so a participant returning after the TTL can be warmed again
+    WarmStart.query.filter(WarmStart.expires_at < now).delete(synchronize_session=False)
+    db.session.commit()
+
+    # Reloads of the page while an entry is live start nothing (and count nothing)
+    if db.session.get(WarmStart, participant_id) is not None:
+        return False
+    if not _within_limits(participant_id, config, count_turn=True):
+        return False
+
+    created = insert_or_ignore(WarmStart, {
+        'participant_id': participant_id,
+        'study_id': config["study_id"],
+        'condition_index': config["condition_index"],
+        'mode': settings["mode"],
+        'opening_message': settings.get("opening_message"),
+        'status': 'pending',
+        'created_at': now,
+        'expires_at': now + timedelta(seconds=settings.get("ttl_seconds", DEFAULT_TTL_SECONDS)),
+    }, index_elements=['participant_id'])
+    db.session.commit()
+
+    if created:
+        threading.Thread(target=_generate, args=(app, participant_id, conversation, config), daemon=True).start()
+    return created
+
+
+def _within_limits(participant_id: str, config: typing.Dict[str, typing.Any], count_turn: bool) -> bool:
+    """
+    Check the cost budgets (and, with count_turn, count a turn against the
+    participant's rate limits) before a prefetch. False if either refuses.
+    """
+    try:
+        costs.check_budget(config, config["study_id"], participant_id)
+        if count_turn:
+            check_turn(config["study_id"], participant_id, config["rate_limits"])
+    except (costs.BudgetExceededError, RateLimitExceededError) as e:
+        print(f"⚠️  Warm start skipped for {participant_id}: {e}")
+        return False
+    return True
+
+
+def _record_spend(
+        participant_id: str,
+        config: typing.Dict[str, typing.Any],
+        response_info: typing.Dict[str, typing.Any]
+    ) -> None:
+    """Add a prefetch's tokens to the cost ledger and the participant's token cap (caller commits)."""
+    costs.record_usage(config, config["study_id"], participant_id, response_info, source='warm_start')
+    record_tokens(config["study_id"], participant_id, config["rate_limits"], response_info)
+
+
+def _prime(
+        app: Flask,
+        participant_id: str,
+        conversation: typing.List[typing.Dict[str, str]],
+        config: typing.Dict[str, typing.Any]
+    ) -> None:
+    """Send a minimal request so the provider caches the system prompt (billed to the participant who triggered it)."""
+    import bot
+
+    params = bot.model_params_from_config(config)
+    params.update(max_completion_tokens=PRIME_MAX_COMPLETION_TOKENS, max_retries=1)
+    response_info = {}
+    try:
+        bot.get_chat_response(get_azure_client(), conversation, response_info=response_info, **params)
+    except Exception as e:
+        print(f"⚠️  Prompt cache priming failed: {type(e).__name__}: {e}")
+
+    with app.app_context():
+        try:
+            _record_spend(participant_id, config, response_info)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️  Could not record cost of prompt cache priming: {type(e).__name__}: {e}")
+        finally:
+            db.session.remove()
+
+
+def _generate(
+        app: Flask,
+        participant_id: str,
+        conversation: typing.List[typing.Dict[str, str]],
+        config: typing.Dict[str, typing.Any]
+    ) -> None:
+    """
+    Generate the speculative first turn in a background thread and store it.
+
+    The tokens are recorded whatever happened to the entry meanwhile (it may
+    have been discarded, or deleted after expiring), as they were spent anyway.
+    """
+    import bot
+
+    response_info = {}
+    try:
+        response = bot.get_chat_response(
+            get_azure_client(), conversation,
+            response_info=response_info,
+            **bot.model_params_from_config(config)
+        )
+    except Exception as e:
+        print(f"⚠️  Warm start failed for {participant_id}: {type(e).__name__}: {e}")
+        response = None
+
+    with app.app_context():
+        try:
+            _record_spend(participant_id, config, response_info)
+            db.session.execute(
+                db.update(WarmStart)
+                .where(WarmStart.participant_id == participant_id, WarmStart.status == 'pending')
+                .values(
+                    status='ready' if response else 'failed',
+                    response=response,
+                    prompt_tokens=response_info.get('prompt_tokens'),
+                    completion_tokens=response_info.get('completion_tokens'),
+                )
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"⚠️  Could not store warm start for {participant_id}: {type(e).__name__}: {e}")
+        finally:
+            db.session.remove()
+
+
+def claim(
+        participant_id: str,
+        mode: str,
+        user_message: typing.Optional[str] = None,
+        max_wait: typing.Optional[float] = None
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Take a participant's prefetched first turn, waiting briefly if still pending.
+
+    Only one request can claim an entry (atomic status update). For
+    predicted_user, a first message that doesn't match the prediction
+    discards the entry.
+
+    Must be called with no uncommitted changes in the session.
+
+    Args:
+        participant_id: Participant whose first turn is being answered
+        mode: 'bot_first' (page load) or 'predicted_user' (first message)
+        user_message: The participant's first message (predicted_user)
+        max_wait: Seconds to wait for a pending generation (default DEFAULT_MAX_WAIT_SECONDS)
+
+    Returns:
+        Dict with response, prompt_tokens, completion_tokens and wait_ms, or
+        None if there is nothing to serve
+    """
+    entry = db.session.get(WarmStart, participant_id)
+    if entry is None or entry.mode != mode or entry.status not in ('pending', 'ready'):
+        return None
+
+    if entry.expires_at < datetime.utcnow():
+        return None
+
+    if mode == 'predicted_user' and normalize_opening(user_message) != normalize_opening(entry.opening_message):
+        _discard(entry)
+        return None
+
+    # Wait for a generation that is still running (it started at page load,
+    # so this is still sooner than starting a new request now)
+    start_time = time.time()
+    deadline = start_time + (DEFAULT_MAX_WAIT_SECONDS if max_wait is None else max_wait)
+    while entry.status == 'pending' and time.time() < deadline:
+        time.sleep(POLL_INTERVAL_SECONDS)
+        db.session.commit()   # End the read transaction so the next read sees the update
+        entry = db.session.get(WarmStart, participant_id)
+
+    if entry.status != 'ready':
+        return None
+
+    claimed = db.session.execute(
+        db.update(WarmStart)
+        .where(WarmStart.participant_id == participant_id, WarmStart.status == 'ready')
+        .values(status='used')
+    ).rowcount == 1
+    db.session.commit()
+    if not claimed:
+        return None
+
+    metrics.record_warm_start(entry.condition_index, 'hit', study_id=entry.study_id)
+    db.session.commit()
+
+    return {
+        'response': entry.response,
+        'prompt_tokens': entry.prompt_tokens,
+        'completion_tokens': entry.completion_tokens,
+        'wait_ms': (time.time() - start_time) * 1000,
+    }
+
+
+def replay_stream(text: str) -> typing.Generator[str, None, None]:
+    """Emit a prefetched response as streaming chunks for the SSE route."""
+    for i in range(0, len(text), REPLAY_CHUNK_SIZE):
+        yield text[i:i + REPLAY_CHUNK_SIZE]
+
+
+def _discard(entry: WarmStart) -> None:
+    """Drop an unused prefetch (its cost was recorded when it was generated)."""
+    entry.status = 'discarded'
+    metrics.record_warm_start(entry.condition_index, 'discarded', {
+        'prompt_tokens': entry.prompt_tokens,
+        'completion_tokens': entry.completion_tokens,
+    }, study_id=entry.study_id)
+    db.session.commit()
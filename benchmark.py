@@ -0,0 +1,1769 @@
+"""
+Micro-benchmarks for the application's own request-path overhead.
+
+Everything here runs against a throwaway SQLite database and a stubbed
+model, so the numbers measure only what the app does around each LLM call
+(validation, config loading, database work, history loading, SSE encoding).
+
+Usage:
+    python benchmark.py request-path                    # Run and print results
+    python benchmark.py request-path --save-baseline    # Store results as the new baseline
+    python benchmark.py request-path --compare          # Compare against the stored baseline
+    python benchmark.py validation                      # Request-validation layer only
+    python benchmark.py startup                         # Interpreter start + import profile, with budgets
+    python benchmark.py gui-burst                       # 500 concurrent first visits to /gui
+    python benchmark.py multi-node                      # 1, 2 and 4 app nodes without sticky sessions
+    python benchmark.py limiter                         # Per-participant rate limit checks, with p99 budgets
+    python benchmark.py search                          # Full-text search over a million messages
+    python benchmark.py archive                         # Chat writes while a study is archived or deleted
+    python benchmark.py snapshot                        # Chat writes during a snapshot vs. a live export
+    python benchmark.py costs                           # Cost ledger writes, budget checks and spend reports
+    python benchmark.py content-filter                  # Per-turn content filter cache lookup, with p99 budgets
+    python benchmark.py gui-history                     # Time to interactive of /gui with and without inline history
+    python benchmark.py delivery                        # Bytes and requests per chat page load, with budgets
+    python benchmark.py gui-render                      # CPU time to render /gui, full render vs. cached page
+    python benchmark.py profiling                       # Cost of the stage timers, off and on, and of a stack sample
+    python benchmark.py tracing                         # Cost of request tracing per turn, per exporter
+
+The command exits with status 1 if any benchmark exceeds its budget in
+BUDGETS, P99_BUDGETS or DELIVERY_BUDGETS, scales worse than SCALING_BUDGETS
+or, when comparing, if its median is slower than the baseline by more than
+--tolerance (default 25%).
+"""
+
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import shutil
+import subprocess
+import argparse
+import platform
+import statistics
+import tempfile
+import typing
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
+
+
+DEFAULT_BASELINE_FILE = 'data/benchmarks/baseline.json'
+DEFAULT_TOLERANCE = 0.25         # Flag medians more than 25% slower than baseline
+MIN_REGRESSION_SECONDS = 20e-6   # Ignore differences below 20µs (timer noise)
+HISTORY_LENGTHS = (1, 10, 100, 500)
+
+STUB_RESPONSE = (
+    "Thanks for your message! Here is a stubbed assistant reply used for benchmarking.\n"
+    "It has a couple of lines so that SSE newline encoding is exercised as well.\n"
+) * 4
+STUB_CHUNK_SIZE = 12             # Characters per streamed chunk (roughly one token group)
+STUB_RESPONSE_INFO = {'attempts': 1, 'prompt_tokens': 850, 'completion_tokens': 120, 'ttft_ms': 900.0}
+NODE_COUNTS = (1, 2, 4)
+NODE_MODEL_LATENCY = 0.05        # Simulated model time per turn in the multi-node suite (seconds)
+NODE_BASE_PORT = 18500
+NODE_STATE_PORT = 18499          # Port of the redis-server started for the multi-node suite, if any
+SEARCH_MESSAGES = 1_000_000
+SEARCH_MESSAGES_PER_PARTICIPANT = 100
+ARCHIVE_MESSAGES = 200_000
+ARCHIVE_WRITER_INTERVAL = 0.005  # Pause between the concurrent writer's inserts (seconds)
+COST_LEDGER_ENTRIES = 1_000_000
+COST_TURNS_PER_PARTICIPANT = 20
+GUI_HISTORY_LENGTHS = (1, 10, 100, 500, 2000)
+GUI_ROUND_TRIP = 0.15            # Network round trip assumed for time-to-interactive estimates (seconds)
+DELIVERY_ICON = '/static/images/heart.png'   # Bot icon of the condition loaded in the delivery suite
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Median budgets (seconds) checked after a suite runs; exceeding one fails the run
+BUDGETS: typing.Dict[str, typing.Dict[str, float]] = {
+    'startup': {
+        'import app': 1.0,
+        'import wsgi (create_app + warm_up)': 2.5,
+        'import db_utils': 1.0,
+    },
+}
+
+# Spend reports read rollups, so they should not slow down as the ledger grows
+BUDGETS['costs'] = {
+    f'costs.spend_summary ({COST_LEDGER_ENTRIES:,} ledger entries)': 0.010,
+}
+
+BUDGETS['search'] = {
+    'search: rare word': 0.010,
+    'search: phrase': 0.050,
+    'search: rare word + filters': 0.010,
+    'search: boolean (OR, NOT)': 0.050,
+    'search: common word, newest first': 0.010,
+}
+
+# Rendering /gui with its history embedded should stay well under one network round trip
+BUDGETS['gui-history'] = {
+    'GET /gui[500] (history inline)': 0.050,
+    'GET /gui[2000] (history inline)': 0.050,
+}
+
+# CPU per /gui request spent rendering the page, once it is cached for the condition
+BUDGETS['gui-render'] = {
+    'render_chat_page (CPU)': 100e-6,
+}
+
+# Stage timers run on every chat turn whether or not a profiling session is on
+BUDGETS['profiling'] = {
+    'profiling.span (off)': 2e-6,
+    'profiling.record (off)': 2e-6,
+}
+
+# Spans are created for every stage, query and model attempt of a traced request
+BUDGETS['tracing'] = {
+    'tracing.span (outside a trace)': 1e-6,
+    'tracing.span (in a trace)': 10e-6,
+}
+
+# Minimum scaling efficiency (throughput per node relative to one node), checked against
+# the 'efficiency' of a result. Only recorded when the nodes share a networked state backend.
+SCALING_BUDGETS: typing.Dict[str, typing.Dict[str, float]] = {
+    'multi-node': {
+        'POST /api/send_message, 2 node(s) (per turn)': 0.80,
+        'POST /api/send_message, 4 node(s) (per turn)': 0.60,
+    },
+}
+
+# Tail-latency budgets (seconds) for code on every chat turn, checked against p99
+P99_BUDGETS: typing.Dict[str, typing.Dict[str, float]] = {
+    'limiter': {
+        'limits.check_turn': 1e-3,
+        'limits.check_turn (refused)': 1e-3,
+        'limits.record_tokens': 1e-3,
+    },
+    # A chat turn's message insert while archiving or clearing runs alongside
+    'archive': {
+        'writer insert during chunked delete': 0.050,
+        'writer insert during archive': 0.050,
+    },
+    'snapshot': {
+        'writer insert during snapshot': 0.050,
+    },
+    # Added to every turn: the ledger entry and rollups (with their commit), and the budget check
+    'costs': {
+        'costs.record_usage + commit': 0.010,
+        'costs.check_budget': 5e-3,
+    },
+    # Added to every turn before the model is called
+    'content-filter': {
+        'content_filter.fingerprint (40 turns)': 1e-3,
+        'content_filter.cached (miss)': 1e-3,
+        'content_filter.cached (hit)': 1e-3,
+    },
+}
+
+# Transfer budgets for a chat page load (response bodies as sent, and requests made),
+# checked against the 'bytes' and 'requests' of a result
+DELIVERY_BUDGETS: typing.Dict[str, typing.Dict[str, typing.Dict[str, int]]] = {
+    'delivery': {
+        # Empty browser cache: the page, its stylesheet and script, and the bot icon
+        'first visit': {'requests': 4, 'bytes': 12_000},
+        # Later iframes of the same survey: assets come from the browser cache
+        'next survey page': {'requests': 1, 'bytes': 2_000},
+        'next survey page (page unchanged)': {'requests': 1, 'bytes': 0},
+    },
+}
+
+
+# ============================================================================
+# Measurement helpers
+# ============================================================================
+
+def measure(func: typing.Callable[[], typing.Any], rounds: int, warmup: int = 3,
+            setup: typing.Optional[typing.Callable[[], typing.Any]] = None,
+            clock: typing.Callable[[], float] = time.perf_counter) -> typing.Dict[str, float]:
+    """
+    Time a callable repeatedly and summarize the durations.
+
+    Args:
+        func: Zero-argument callable to time
+        rounds: Number of timed calls
+        warmup: Number of untimed calls made first
+        setup: Optional untimed callable run before every call (e.g. cleanup)
+        clock: Clock to time with (time.process_time for CPU time)
+
+    Returns:
+        Dictionary with min, median, mean, p95, p99 and stdev in seconds
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        func()
+
+    durations = []
+    for _ in range(rounds):
+        if setup:
+            setup()
+        start = clock()
+        func()
+        durations.append(clock() - start)
+
+    return summarize(durations)
+
+
+def summarize(durations: typing.List[float]) -> typing.Dict[str, float]:
+    """
+    Summarize a list of durations.
+
+    Returns:
+        Dictionary with rounds, min, median, mean, p95, p99 and stdev in seconds
+    """
+    durations = sorted(durations)
+    return {
+        'rounds': len(durations),
+        'min': durations[0],
+        'median': statistics.median(durations),
+        'mean': statistics.fmean(durations),
+        'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'p99': durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+        'stdev': statistics.stdev(durations) if len(durations) > 1 else 0.0,
+    }
+
+
+def format_seconds(value: float) -> str:
+    """Format a duration with a readable unit."""
+    if value < 1e-3:
+        return f"{value * 1e6:.1f}µs"
+    if value < 1:
+        return f"{value * 1e3:.2f}ms"
+    return f"{value:.2f}s"
+
+
+def print_results(suite: str, results: typing.Dict[str, typing.Dict[str, float]]) -> None:
+    """Print benchmark results as a table."""
+    print("\n" + "="*80)
+    print(f"BENCHMARK: {suite}")
+    print("="*80)
+    print(f"{'Name':<44} {'Median':>10} {'Mean':>10} {'P95':>10} {'Rounds':>6}")
+    print("-"*80)
+    for name, stats in results.items():
+        print(f"{name:<44} {format_seconds(stats['median']):>10} {format_seconds(stats['mean']):>10} "
+              f"{format_seconds(stats['p95']):>10} {stats['rounds']:>6}")
+    print("="*80 + "\n")
+
+
+# ============================================================================
+# Baselines
+# ============================================================================
+
+def load_baseline(baseline_file: str) -> typing.Dict[str, typing.Any]:
+    """Load stored baselines (empty structure if none exist yet)."""
+    if not os.path.exists(baseline_file):
+        return {'suites': {}}
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(baseline_file: str, suite: str, results: typing.Dict[str, typing.Dict[str, float]]) -> None:
+    """Store results for one suite as its new baseline (other suites are kept)."""
+    baseline = load_baseline(baseline_file)
+    baseline['suites'][suite] = {
+        'recorded_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(baseline_file)), exist_ok=True)
+    with open(baseline_file, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, indent=2)
+
+    print(f"✅ Saved baseline for '{suite}' to {baseline_file}")
+
+
+def compare_to_baseline(baseline_file: str, suite: str, results: typing.Dict[str, typing.Dict[str, float]],
+                        tolerance: float = DEFAULT_TOLERANCE) -> typing.List[str]:
+    """
+    Compare results against the stored baseline for a suite.
+
+    Args:
+        baseline_file: Path to the baseline JSON file
+        suite: Suite name
+        results: Fresh results from the same suite
+        tolerance: Allowed relative slowdown of the median (0.25 = 25%)
+
+    Returns:
+        List of benchmark names that regressed
+    """
+    stored = load_baseline(baseline_file)['suites'].get(suite)
+    if not stored:
+        print(f"⚠️  No baseline stored for '{suite}' in {baseline_file}. Run with --save-baseline first.")
+        return []
+
+    print(f"Comparing against baseline recorded {stored['recorded_at']} (tolerance {tolerance:.0%})")
+    print("-"*80)
+
+    regressions = []
+    for name, stats in results.items():
+        base = stored['results'].get(name)
+        if base is None:
+            print(f"  {name:<44} (new - no baseline)")
+            continue
+
+        change = (stats['median'] - base['median']) / base['median'] if base['median'] else 0.0
+        regressed = (
+            stats['median'] > base['median'] * (1 + tolerance)
+            and stats['median'] - base['median'] > MIN_REGRESSION_SECONDS
+        )
+        marker = "❌ REGRESSION" if regressed else "ok"
+        print(f"  {name:<44} {format_seconds(base['median']):>10} -> {format_seconds(stats['median']):>10} "
+              f"({change:+.0%}) {marker}")
+        if regressed:
+            regressions.append(name)
+
+    print("-"*80)
+    return regressions
+
+
+# ============================================================================
+# Benchmark environment
+# ============================================================================
+
+def check_budgets(suite: str, results: typing.Dict[str, typing.Dict[str, float]]) -> typing.List[str]:
+    """
+    Check results against the suite's median budgets in BUDGETS, p99 budgets in
+    P99_BUDGETS, transfer budgets in DELIVERY_BUDGETS and minimum scaling
+    efficiencies in SCALING_BUDGETS.
+
+    Returns:
+        List of benchmark names that exceeded a budget
+    """
+    over_budget = []
+    for statistic, budgets in (('median', BUDGETS), ('p99', P99_BUDGETS)):
+        for name, budget in budgets.get(suite, {}).items():
+            if name in results and results[name].get(statistic, 0) > budget:
+                print(f"❌ {name}: {statistic} {format_seconds(results[name][statistic])} "
+                      f"exceeds budget {format_seconds(budget)}")
+                over_budget.append(name)
+    for name, limits in DELIVERY_BUDGETS.get(suite, {}).items():
+        for statistic, budget in limits.items():
+            if name in results and results[name].get(statistic, 0) > budget:
+                print(f"❌ {name}: {results[name][statistic]:,} {statistic} exceeds budget {budget:,}")
+                over_budget.append(name)
+    for name, minimum in SCALING_BUDGETS.get(suite, {}).items():
+        if name in results and results[name].get('efficiency', minimum) < minimum:
+            print(f"❌ {name}: scaling efficiency {results[name]['efficiency']:.0%} is below {minimum:.0%}")
+            over_budget.append(name)
+    return over_budget
+
+
+@contextmanager
+def benchmark_environment():
+    """
+    Prepare a throwaway working directory and environment for the app.
+
+    Sets dummy model credentials (the model is never called), points
+    DATABASE_URL at a temporary SQLite file and copies the example
+    conditions file (with raised rate limits) into the working directory.
+
+    Yields:
+        Path of the temporary working directory (also the current directory)
+    """
+    workdir = tempfile.mkdtemp(prefix='chat-bench-')
+    original_cwd = os.getcwd()
+
+    # Dummy credentials - only used to construct the (never called) client
+    os.environ.setdefault('MODEL_ENDPOINT', 'https://benchmark.invalid/')
+    os.environ.setdefault('MODEL_DEPLOYMENT', 'benchmark-deployment')
+    os.environ.setdefault('MODEL_API_VERSION', '2024-02-15-preview')
+    os.environ.setdefault('MODEL_SUBSCRIPTION_KEY', 'benchmark-key')
+    os.environ.setdefault('MODEL_MAX_RETRIES', '1')
+    os.environ.setdefault('MODEL_RETRY_DELAY', '0')
+
+    # Never touch a real database
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+
+    # Benchmarks send turns far faster than a participant would: raise the
+    # rate limits (rather than removing them, so their checks are still timed)
+    with open(os.path.join(PROJECT_DIR, 'experimental_conditions.example.json'), encoding='utf-8') as f:
+        conditions = json.load(f)
+    conditions['study_metadata']['rate_limits'] = {'turns_per_minute': 10 ** 9, 'turns_per_day': 10 ** 9}
+    with open(os.path.join(workdir, 'experimental_conditions.json'), 'w', encoding='utf-8') as f:
+        json.dump(conditions, f, indent=2)
+
+    if PROJECT_DIR not in sys.path:
+        sys.path.insert(0, PROJECT_DIR)
+    os.chdir(workdir)
+    try:
+        yield workdir
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@contextmanager
+def benchmark_app():
+    """
+    Create an isolated app instance for benchmarking (see benchmark_environment).
+
+    Yields:
+        Flask app instance
+    """
+    with benchmark_environment():
+        from app import create_app
+        yield create_app()
+
+
+def stub_get_chat_response(client, conversation, response_info=None, **kwargs) -> str:
+    """Stand-in for bot.get_chat_response that returns immediately."""
+    if response_info is not None:
+        response_info.update(STUB_RESPONSE_INFO)
+    return STUB_RESPONSE
+
+
+def stub_get_chat_response_stream(client, conversation, response_info=None, **kwargs) -> typing.Generator[str, None, None]:
+    """Stand-in for bot.get_chat_response_stream that yields fixed-size chunks."""
+    if response_info is not None:
+        response_info.update(STUB_RESPONSE_INFO)
+    for i in range(0, len(STUB_RESPONSE), STUB_CHUNK_SIZE):
+        yield STUB_RESPONSE[i:i + STUB_CHUNK_SIZE]
+
+
+@contextmanager
+def stubbed_model(latency: float = 0.0):
+    """
+    Patch both model entry points used by the routes.
+
+    Args:
+        latency: Seconds each stubbed call waits before answering (simulated model time)
+    """
+    get_response, get_response_stream = stub_get_chat_response, stub_get_chat_response_stream
+    if latency:
+        def get_response(*args, **kwargs):
+            time.sleep(latency)
+            return stub_get_chat_response(*args, **kwargs)
+
+        def get_response_stream(*args, **kwargs):
+            time.sleep(latency)
+            yield from stub_get_chat_response_stream(*args, **kwargs)
+
+    with mock.patch('app.routes.get_chat_response', get_response), \
+         mock.patch('bot.get_chat_response_stream', get_response_stream):
+        yield
+
+
+def seed_participant(app, client, participant_id: str, history_length: int, condition_index: int = 0) -> str:
+    """
+    Create a participant through /gui and pad its history to a given length.
+
+    Args:
+        app: Flask app
+        client: Flask test client
+        participant_id: Participant ID to create
+        history_length: Total stored messages, including the system prompt
+        condition_index: Condition to assign
+
+    Returns:
+        The participant's session token
+    """
+    from app import db
+    from app.models import Participant, Message
+
+    response = client.get(f'/gui?participant_id={participant_id}&condition={condition_index}')
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+    with app.app_context():
+        participant = Participant.query.get(participant_id)
+        start = datetime.utcnow() - timedelta(days=1)
+        for i in range(history_length - 1):
+            db.session.add(Message(
+                participant_id=participant_id,
+                role='user' if i % 2 == 0 else 'assistant',
+                content=f"Seeded message {i}: " + "lorem ipsum dolor sit amet " * 8,
+                timestamp=start + timedelta(seconds=i)
+            ))
+        db.session.commit()
+        return participant.session_token
+
+
+def trim_history(app, participant_id: str, history_length: int) -> None:
+    """
+    Delete messages added by benchmark requests so history stays at a fixed length.
+
+    Seeded messages are timestamped a day in the past, so anything newer was
+    added by a benchmark request.
+    """
+    from app import db
+    from app.models import Message
+
+    with app.app_context():
+        Message.query.filter(
+            Message.participant_id == participant_id,
+            Message.timestamp > datetime.utcnow() - timedelta(hours=1)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+
+# ============================================================================
+# Suites
+# ============================================================================
+
+def bench_request_path(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark each stage of a chat turn plus both send endpoints end to end.
+
+    Stages mirror what send_message/send_message_stream do before and after
+    the model call: validation, config loading (including dotenv), the
+    participant lookup, the user and assistant message commits, history
+    loading, the task-state override, live metrics and SSE encoding.
+    """
+    import dotenv
+
+    results = {}
+
+    with benchmark_app() as app, stubbed_model():
+        from app import db
+        from app.models import Participant, Message
+        from app.routes import get_conversation_history, apply_task_state
+        from app.validation import validate_participant_id, validate_condition_index
+        from bot import load_experiment_config
+
+        client = app.test_client()
+        tokens = {
+            length: seed_participant(app, client, f"bench-{length}", length)
+            for length in HISTORY_LENGTHS
+        }
+        seed_participant(app, client, "bench-commit", 1)
+
+        # --- Individual stages -------------------------------------------------
+        results['validate_participant_id'] = measure(
+            lambda: validate_participant_id('bench-participant_0123456789'), rounds * 10
+        )
+        results['validate_condition_index'] = measure(lambda: validate_condition_index(3), rounds * 10)
+        results['dotenv.load_dotenv'] = measure(dotenv.load_dotenv, rounds)
+        results['load_experiment_config'] = measure(lambda: load_experiment_config(0), rounds)
+
+        with app.app_context():
+            def lookup():
+                participant = Participant.query.get('bench-10')
+                db.session.expire_all()  # Force a real query each round, like a fresh request
+                return participant
+            results['participant_lookup'] = measure(lookup, rounds)
+
+            def commit_message():
+                db.session.add(Message(participant_id='bench-commit', role='user', content='benchmark'))
+                db.session.commit()
+            results['message_commit'] = measure(commit_message, rounds)
+        trim_history(app, 'bench-commit', 1)
+
+        for length in HISTORY_LENGTHS:
+            with app.app_context():
+                # Routes pass the participant loaded during authentication
+                participant = Participant.query.get(f'bench-{length}')
+                results[f'get_conversation_history[{length}]'] = measure(
+                    lambda: get_conversation_history(f'bench-{length}', participant), rounds
+                )
+
+        # Task state is a column, so the override costs the same at any history length
+        with app.app_context():
+            history = get_conversation_history('bench-500')
+        for task_active in (True, False):
+            results[f'apply_task_state[500, task_active={task_active}]'] = measure(
+                lambda: apply_task_state(list(history), task_active), rounds * 10
+            )
+
+        # Live metrics: one counter upsert per turn, and the dashboard summary
+        from app import metrics
+        with app.app_context():
+            def record_turn():
+                metrics.record_turn(0, STUB_RESPONSE_INFO)
+                db.session.commit()
+            results['metrics.record_turn'] = measure(record_turn, rounds)
+            results['metrics.summarize'] = measure(lambda: metrics.summarize(15), rounds)
+
+        chunks = list(stub_get_chat_response_stream(None, []))
+        results['sse_encode_response'] = measure(
+            lambda: [f"data: {chunk.replace(chr(10), '<NEWLINE>')}\n\n" for chunk in chunks], rounds * 10
+        )
+
+        # --- End to end (stubbed model) ---------------------------------------
+        for length in HISTORY_LENGTHS:
+            participant_id = f"bench-{length}"
+            payload = {
+                'participant_id': participant_id,
+                'session_token': tokens[length],
+                'condition_index': 0,
+                'message': 'How long does this take without the model?',
+                'task_active': True,
+            }
+            reset = lambda pid=participant_id, n=length: trim_history(app, pid, n)
+
+            def send():
+                response = client.post('/api/send_message', json=payload)
+                assert response.status_code == 200, response.get_data(as_text=True)
+            results[f'POST /api/send_message[{length}]'] = measure(send, rounds, setup=reset)
+
+            def send_stream():
+                response = client.post('/api/send_message_stream', json=payload)
+                body = response.get_data(as_text=True)  # Consume the whole stream
+                assert body.endswith("data: [DONE]\n\n"), body[-200:]
+            results[f'POST /api/send_message_stream[{length}]'] = measure(send_stream, rounds, setup=reset)
+
+            history_url = f'/api/get_history?participant_id={participant_id}&session_token={tokens[length]}'
+            results[f'GET /api/get_history[{length}]'] = measure(
+                lambda: client.get(history_url).get_data(), rounds, setup=reset
+            )
+
+    return results
+
+
+def bench_validation(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark the shared request-validation layer.
+
+    Times the precompiled validators on their own and parse_request() for
+    each route schema (body parsing, format checks and the auth lookup),
+    plus a rejected request that must fail before touching the database.
+    """
+    import re
+
+    results = {}
+
+    with benchmark_app() as app:
+        from app.validation import (
+            SEND_MESSAGE_SCHEMA,
+            GET_HISTORY_SCHEMA,
+            CHAT_INTERFACE_SCHEMA,
+            RequestValidationError,
+            parse_request,
+            validate_participant_id,
+            validate_condition_index,
+        )
+
+        client = app.test_client()
+        token = seed_participant(app, client, 'bench-validation', 1)
+        participant_id = 'bench-participant_0123456789'
+
+        # Previous implementation, kept here as the reference point
+        def legacy_validate_participant_id():
+            return bool(participant_id.strip()) and bool(re.match(r'^[-a-zA-Z0-9_]{1,255}$', participant_id))
+
+        results['validate_participant_id (legacy re.match)'] = measure(legacy_validate_participant_id, rounds * 10)
+        results['validate_participant_id'] = measure(lambda: validate_participant_id(participant_id), rounds * 10)
+        results['validate_condition_index'] = measure(lambda: validate_condition_index(3), rounds * 10)
+
+        body = {
+            'participant_id': 'bench-validation',
+            'session_token': token,
+            'condition_index': 0,
+            'message': 'How long does validation take?',
+            'task_active': True,
+        }
+
+        def parse(schema, **request_kwargs):
+            with app.test_request_context(**request_kwargs):
+                return parse_request(schema)
+
+        results['parse_request[send_message]'] = measure(
+            lambda: parse(SEND_MESSAGE_SCHEMA, method='POST', json=body), rounds
+        )
+        results['parse_request[get_history]'] = measure(
+            lambda: parse(GET_HISTORY_SCHEMA, query_string={
+                'participant_id': 'bench-validation', 'session_token': token
+            }), rounds
+        )
+        results['parse_request[chat_interface]'] = measure(
+            lambda: parse(CHAT_INTERFACE_SCHEMA, query_string={
+                'participant_id': 'bench-validation', 'condition': '0'
+            }), rounds
+        )
+
+        def rejected():
+            try:
+                parse(SEND_MESSAGE_SCHEMA, method='POST', json=dict(body, message=''))
+            except RequestValidationError:
+                pass
+        results['parse_request[rejected, no db]'] = measure(rejected, rounds)
+
+        # Request context alone, to separate Flask overhead from validation
+        def empty_context():
+            with app.test_request_context(method='POST', json=body):
+                pass
+        results['test_request_context (overhead)'] = measure(empty_context, rounds)
+
+    return results
+
+
+def bench_startup(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark process startup: fresh interpreters importing the app entry points.
+
+    Each round starts a new Python process, so module caches are cold except
+    for compiled bytecode. Also prints an import-time profile of the WSGI
+    entry point and checks that heavy imports stay deferred.
+    """
+    rounds = min(rounds, 10)  # Each round is a whole interpreter start
+    results = {}
+
+    with benchmark_environment() as workdir:
+        env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+
+        def run(code: str, *flags: str) -> subprocess.CompletedProcess:
+            return subprocess.run(
+                [sys.executable, *flags, '-c', code],
+                cwd=workdir, env=env, capture_output=True, text=True, check=True
+            )
+
+        results['python -c pass (interpreter only)'] = measure(lambda: run('pass'), rounds, warmup=1)
+        results['import app'] = measure(lambda: run('import app'), rounds, warmup=1)
+        results['import wsgi (create_app + warm_up)'] = measure(lambda: run('import wsgi'), rounds, warmup=1)
+        results['import db_utils'] = measure(lambda: run('import db_utils'), rounds, warmup=1)
+
+        # Heavy imports must not be pulled in just by importing the package
+        deferred = run("import sys, app; print(','.join(m for m in ('openai',) if m in sys.modules))")
+        if deferred.stdout.strip():
+            print(f"⚠️  Deferred modules imported eagerly by 'import app': {deferred.stdout.strip()}")
+
+        # Import-time profile: top modules by cumulative import time
+        profile = run('import wsgi', '-X', 'importtime').stderr
+        cumulative = []
+        for line in profile.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative_us, module = line.split('|')
+                if cumulative_us.strip().isdigit():
+                    cumulative.append((int(cumulative_us), module.rstrip()))
+
+        print("\nImport-time profile for 'import wsgi' (top 10 by cumulative time):")
+        for cumulative_us, module in sorted(cumulative, reverse=True)[:10]:
+            print(f"  {format_seconds(cumulative_us / 1e6):>10}  {module}")
+
+    return results
+
+
+def bench_gui_burst(rounds: int, requests: int = 500, concurrency: int = 50,
+                    duplicate_share: float = 0.2) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark a burst of concurrent first visits to /gui (e.g. a Qualtrics panel launch).
+
+    Fires `requests` /gui hits from `concurrency` threads. A share of them
+    reuse participant IDs so concurrent creation of the same participant
+    (double page loads) is exercised too. Every request must succeed, and
+    each participant must end up with exactly one row.
+    """
+    import concurrent.futures
+
+    results = {}
+
+    with benchmark_app() as app:
+        from app.models import Participant
+
+        def hit(participant_id: str) -> float:
+            client = app.test_client()
+            start = time.perf_counter()
+            response = client.get(f'/gui?participant_id={participant_id}&condition=0')
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.get_data(as_text=True)[:200]
+            return elapsed
+
+        unique = int(requests * (1 - duplicate_share))
+        participant_ids = [f"burst-{i}" for i in range(unique)]
+        participant_ids += [f"burst-{i % max(1, unique // 10)}" for i in range(requests - unique)]
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(hit, participant_ids))
+        wall_time = time.perf_counter() - start
+
+        with app.app_context():
+            created = Participant.query.filter(Participant.participant_id.like('burst-%')).count()
+        assert created == unique, f"expected {unique} participants, found {created}"
+
+        results[f'GET /gui burst x{requests} (per request)'] = summarize(latencies)
+        results[f'GET /gui burst x{requests} (wall time)'] = summarize([wall_time])
+
+        # Returning participants: the fast path is a single primary key lookup
+        client = app.test_client()
+        results['GET /gui (returning participant)'] = measure(
+            lambda: client.get('/gui?participant_id=burst-0&condition=0'), rounds
+        )
+
+    print(f"Burst: {requests} requests, {concurrency} threads, {requests / wall_time:.0f} requests/s")
+    return results
+
+
+def serve_node(port: int, latency: float = NODE_MODEL_LATENCY) -> None:
+    """
+    Run one single-threaded app node for the multi-node suite (in its own process).
+
+    Uses the environment prepared by the parent (DATABASE_URL, STATE_BACKEND_URL),
+    so all nodes share one database and one state backend. Starts like
+    wsgi.py (create_app + warm_up), so no node imports the model client
+    during the timed turns.
+    """
+    from werkzeug.serving import make_server
+    from app import create_app, warm_up
+
+    app = create_app()
+    warm_up(app)
+    with stubbed_model(latency):
+        make_server('127.0.0.1', port, app, threaded=False).serve_forever()
+
+
+@contextmanager
+def shared_state_backend():
+    """
+    Provide a state backend every node of the multi-node suite can share.
+
+    Uses STATE_BACKEND_URL if it names a networked backend, otherwise starts
+    a throwaway redis-server (without persistence) if one is installed.
+
+    Yields:
+        Backend URL, or None if only memory:// is available
+    """
+    url = os.environ.get('STATE_BACKEND_URL', 'memory://').strip() or 'memory://'
+    if not url.startswith('memory://'):
+        yield url
+        return
+
+    server_binary = shutil.which('redis-server')
+    if server_binary is None:
+        yield None
+        return
+
+    server = subprocess.Popen(
+        [server_binary, '--port', str(NODE_STATE_PORT), '--bind', '127.0.0.1', '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        url = f"redis://127.0.0.1:{NODE_STATE_PORT}/0"
+        from app.state import create_backend
+        deadline = time.time() + 10
+        while True:
+            try:
+                create_backend(url).ping()
+                break
+            except Exception:
+                if time.time() > deadline:
+                    raise RuntimeError(f"redis-server did not start on port {NODE_STATE_PORT}")
+                time.sleep(0.1)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_multi_node(rounds: int, clients: int = 8, history_length: int = 10) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark horizontal scaling: 1, 2 and 4 app nodes behind round-robin routing.
+
+    Each node is a separate single-threaded process, like a container with
+    one worker, and the stubbed model takes NODE_MODEL_LATENCY per turn.
+    Closed-loop clients (one participant each) send every turn to the next
+    node in turn, with no session stickiness, so consecutive turns of a
+    conversation are always served by different nodes. Afterwards every
+    conversation must hold exactly its seeded messages plus two per turn.
+
+    The nodes share turn locks and idempotency keys through STATE_BACKEND_URL
+    (e.g. redis://localhost:6379/0) or, if that is unset, a redis-server
+    started for the run. Results then carry the throughput per node relative
+    to one node as 'efficiency', checked against SCALING_BUDGETS. Without a
+    shared backend (memory://) the run is reported but efficiency is not
+    checked, since the nodes would not be doing the work of a real deployment.
+
+    All nodes write one throwaway SQLite file (in WAL mode, see
+    configure_sqlite), and SQLite lets one writer commit at a time, so
+    per-turn commits cap throughput however many nodes are added; a
+    deployment with more than a few nodes should use PostgreSQL. The nodes,
+    clients and state server also share this machine's CPUs, so efficiency
+    is only checked for node counts below os.cpu_count().
+    """
+    import urllib.request
+    import concurrent.futures
+
+    turns = min(rounds, 20)
+    results = {}
+    throughput = {}
+
+    with benchmark_app() as app, shared_state_backend() as state_url:
+        from app.models import Message
+
+        if state_url is None:
+            print("⚠️  No shared state backend (set STATE_BACKEND_URL or install redis-server) - "
+                  "turn locks and idempotency keys are per node and scaling efficiency is not checked")
+        client = app.test_client()
+        env = dict(os.environ, PYTHONPATH=PROJECT_DIR, STATE_BACKEND_URL=state_url or 'memory://')
+
+        for node_count in NODE_COUNTS:
+            ports = [NODE_BASE_PORT + i for i in range(node_count)]
+            prefix = f"node{node_count}"
+            tokens = {f"{prefix}-{i}": seed_participant(app, client, f"{prefix}-{i}", history_length)
+                      for i in range(clients)}
+            with app.app_context():
+                seeded = {participant_id: Message.query.filter_by(participant_id=participant_id).count()
+                          for participant_id in tokens}
+
+            nodes = [subprocess.Popen(
+                [sys.executable, '-c', f"import benchmark; benchmark.serve_node({port})"],
+                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            ) for port in ports]
+            try:
+                for port in ports:
+                    deadline = time.time() + 30
+                    while True:
+                        try:
+                            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+                            break
+                        except OSError:
+                            if time.time() > deadline:
+                                raise RuntimeError(f"Node on port {port} did not start")
+                            time.sleep(0.1)
+
+                def converse(client_index: int) -> typing.List[float]:
+                    participant_id = f"{prefix}-{client_index}"
+                    latencies = []
+                    for turn in range(turns):
+                        port = ports[(client_index + turn) % node_count]
+                        body = json.dumps({
+                            'message': f"Turn {turn}",
+                            'participant_id': participant_id,
+                            'session_token': tokens[participant_id],
+                            'condition_index': 0,
+                        }).encode('utf-8')
+                        request = urllib.request.Request(
+                            f"http://127.0.0.1:{port}/api/send_message", data=body,
+                            headers={'Content-Type': 'application/json',
+                                     'Idempotency-Key': f"{participant_id}-{turn}"}
+                        )
+                        start = time.perf_counter()
+                        with urllib.request.urlopen(request, timeout=30) as response:
+                            assert json.loads(response.read())['success']
+                        latencies.append(time.perf_counter() - start)
+                    return latencies
+
+                start = time.perf_counter()
+                with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+                    latencies = [t for per_client in executor.map(converse, range(clients)) for t in per_client]
+                wall_time = time.perf_counter() - start
+            finally:
+                for node in nodes:
+                    node.terminate()
+                for node in nodes:
+                    node.wait()
+
+            with app.app_context():
+                for participant_id in tokens:
+                    stored = Message.query.filter_by(participant_id=participant_id).count()
+                    expected = seeded[participant_id] + 2 * turns
+                    assert stored == expected, f"{participant_id}: expected {expected} messages, found {stored}"
+
+            throughput[node_count] = clients * turns / wall_time
+            results[f'POST /api/send_message, {node_count} node(s) (per turn)'] = summarize(latencies)
+
+    print(f"\nMulti-node: {clients} clients x {turns} turns, model latency {NODE_MODEL_LATENCY * 1000:.0f}ms, "
+          f"state backend {state_url or 'memory:// (per node)'}, {os.cpu_count()} CPU(s)")
+    for node_count in NODE_COUNTS:
+        efficiency = throughput[node_count] / (node_count * throughput[NODE_COUNTS[0]])
+        # Leave a CPU for the clients and the state server, or the run measures this machine
+        checked = state_url is not None and node_count < (os.cpu_count() or 1)
+        print(f"  {node_count} node(s): {throughput[node_count]:6.1f} turns/s   scaling efficiency {efficiency:.0%}"
+              f"{'' if checked or state_url is None else '   (not checked: more nodes than spare CPUs)'}")
+        if checked:
+            results[f'POST /api/send_message, {node_count} node(s) (per turn)']['efficiency'] = efficiency
+    return results
+
+
+def bench_limiter(rounds: int, participants: int = 1000) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark the per-participant rate limiter (app.limits) on the configured state backend.
+
+    Runs enough calls for a meaningful p99 (checked against P99_BUDGETS),
+    cycling through many participants so counters are created as well as
+    updated. Set STATE_BACKEND_URL to measure a networked backend.
+    """
+    rounds = max(rounds * 20, 1000)
+    results = {}
+
+    with benchmark_environment():
+        from app.state import get_state
+        from app.limits import check_turn, record_tokens, RateLimitExceededError
+
+        # High enough never to refuse, so every call takes the full path
+        limits = {'turns_per_minute': 10 ** 9, 'turns_per_day': 10 ** 9, 'tokens_per_day': 10 ** 12}
+        participant_ids = [f"limit-{i}" for i in range(participants)]
+        calls = iter(range(10 ** 9))
+
+        results['limits.check_turn'] = measure(
+            lambda: check_turn('default', participant_ids[next(calls) % participants], limits), rounds
+        )
+        results['limits.record_tokens'] = measure(
+            lambda: record_tokens('default', participant_ids[next(calls) % participants], limits,
+                                  STUB_RESPONSE_INFO), rounds
+        )
+
+        # A participant over the limit: refused and rolled back
+        check_turn('default', 'limit-refused', {'turns_per_minute': 1})
+
+        def refused():
+            try:
+                check_turn('default', 'limit-refused', {'turns_per_minute': 1})
+            except RateLimitExceededError:
+                return
+            raise AssertionError("turn was not refused")
+
+        results['limits.check_turn (refused)'] = measure(refused, rounds)
+
+        print(f"State backend: {get_state().name}, {participants} participants")
+        for name, stats in results.items():
+            print(f"  {name:<32} p99 {format_seconds(stats['p99'])}")
+
+    return results
+
+
+def bench_search(rounds: int, messages: int = SEARCH_MESSAGES) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark db_utils.py search on a study-sized database.
+
+    Inserts `messages` synthetic chat messages (through the messages table,
+    so the index triggers run) with a realistic spread of common and rare
+    words, then times typical researcher queries: a rare word such as a
+    leaked model name, a phrase, filtered and boolean queries, and a very
+    common word (ranking many matches).
+    """
+    import random
+
+    rounds = min(rounds, 20)
+    results = {}
+    rng = random.Random(42)
+    common = ("the a and to of I you it is that in for this my with have be are can what about not "
+              "do would like think feel how so your more just me we get help task survey answer").split()
+    topics = ("coffee travel budget exam essay project garden weather music health recipe deadline "
+              "interview vacation camera bicycle apartment library museum").split()
+
+    def message_text(i: int) -> str:
+        words = [rng.choice(common) if rng.random() < 0.8 else rng.choice(topics) for _ in range(rng.randint(8, 40))]
+        if i % 10_000 == 0:
+            words.insert(rng.randrange(len(words)), "GPT-4")               # Rare: leaked model name
+        if i % 500 == 0:
+            words[rng.randrange(len(words)):] = ["large", "language", "model"]
+        return ' '.join(words)
+
+    with benchmark_app() as app:
+        from app import db
+        from app.models import Participant, Message
+        from app.search import search_messages
+
+        with app.app_context():
+            participants = max(1, messages // SEARCH_MESSAGES_PER_PARTICIPANT)
+            start_time = datetime.utcnow() - timedelta(days=30)
+            seed_start = time.perf_counter()
+            with db.engine.begin() as connection:
+                connection.execute(db.insert(Participant), [{
+                    'participant_id': f"search-{p}",
+                    'session_token': f"search-token-{p}",
+                    'condition_index': p % 4,
+                    'condition_id': f"condition_{p % 4}",
+                    'condition_name': f"Condition {p % 4}",
+                    'created_at': start_time,
+                } for p in range(participants)])
+                connection.execute(db.insert(Message), [{
+                    'participant_id': f"search-{i // SEARCH_MESSAGES_PER_PARTICIPANT}",
+                    'role': 'user' if i % 2 == 0 else 'assistant',
+                    'content': message_text(i),
+                    'timestamp': start_time + timedelta(seconds=i * 2),
+                } for i in range(messages)])
+            print(f"Seeded {messages:,} messages ({participants:,} participants) "
+                  f"in {time.perf_counter() - seed_start:.1f}s")
+
+            queries = {
+                'search: rare word': dict(query='GPT'),
+                'search: phrase': dict(query='"large language model"'),
+                'search: rare word + filters': dict(
+                    query='GPT', role='user', condition_index=0, since=start_time + timedelta(days=1)),
+                'search: boolean (OR, NOT)': dict(query='"language model" OR GPT NOT survey'),
+                'search: common word (ranking all matches)': dict(query='coffee'),
+                'search: common word, newest first': dict(query='coffee', newest_first=True),
+            }
+            for name, kwargs in queries.items():
+                results[name] = measure(lambda: search_messages(**kwargs), rounds, warmup=1)
+
+    return results
+
+
+def seed_old_study(messages: int, prefix: str = 'old') -> None:
+    """
+    Bulk-insert a finished study: `messages` messages 90 days old,
+    SEARCH_MESSAGES_PER_PARTICIPANT per participant.
+
+    Must be called inside an application context.
+    """
+    from app import db
+    from app.models import Participant, Message
+
+    participants = max(1, messages // SEARCH_MESSAGES_PER_PARTICIPANT)
+    old = datetime.utcnow() - timedelta(days=90)
+    with db.engine.begin() as connection:
+        connection.execute(db.insert(Participant), [{
+            'participant_id': f"{prefix}-{p}",
+            'session_token': f"{prefix}-token-{p}",
+            'condition_index': 0,
+            'condition_id': 'condition_0',
+            'condition_name': 'Condition 0',
+            'created_at': old,
+        } for p in range(participants)])
+        connection.execute(db.insert(Message), [{
+            'participant_id': f"{prefix}-{i // SEARCH_MESSAGES_PER_PARTICIPANT}",
+            'role': 'user' if i % 2 == 0 else 'assistant',
+            'content': STUB_RESPONSE,
+            'timestamp': old,
+        } for i in range(messages)])
+
+
+def while_writing(app, work: typing.Callable[[], typing.Any]) -> typing.Tuple[float, typing.List[float]]:
+    """
+    Run work while a second thread inserts messages the way chat turns do.
+
+    The writer inserts one message per transaction, pausing
+    ARCHIVE_WRITER_INTERVAL between inserts, for participant 'bench-live'
+    (created if missing). Failed inserts count with the time until they failed.
+
+    Returns:
+        (seconds work took, durations of the writer's inserts, number that failed)
+    """
+    import threading
+    from app import db
+    from app.models import Participant, Message
+
+    with app.app_context():
+        if db.session.get(Participant, 'bench-live') is None:
+            db.session.add(Participant(participant_id='bench-live', session_token='bench-live-token',
+                                       condition_index=0, condition_id='condition_0', condition_name='Condition 0'))
+            db.session.commit()
+
+    durations = []
+    failures = []
+    done = threading.Event()
+
+    def writer():
+        with app.app_context():
+            while not done.is_set():
+                start = time.perf_counter()
+                try:
+                    with db.engine.begin() as connection:
+                        connection.execute(db.insert(Message), {
+                            'participant_id': 'bench-live', 'role': 'user', 'content': 'Still here?',
+                        })
+                except Exception:
+                    failures.append(time.perf_counter() - start)   # e.g. 'database is locked' after the busy timeout
+                durations.append(time.perf_counter() - start)
+                time.sleep(ARCHIVE_WRITER_INTERVAL)
+
+    thread = threading.Thread(target=writer)
+    start = time.perf_counter()
+    thread.start()
+    try:
+        work()
+    finally:
+        elapsed = time.perf_counter() - start
+        done.set()
+        thread.join()
+    return elapsed, durations, len(failures)
+
+
+def report_writer(results: typing.Dict[str, typing.Dict[str, float]], name: str,
+                  elapsed: float, durations: typing.List[float], failed: int) -> None:
+    """Add the writer's insert times to results and print a one-line summary."""
+    results[name] = summarize(durations)
+    print(f"  {name:<40} {elapsed:6.1f}s   writer p99 {format_seconds(results[name]['p99'])}, "
+          f"max {format_seconds(max(durations))} ({len(durations)} inserts, {failed} failed)")
+
+
+def bench_archive(rounds: int, messages: int = ARCHIVE_MESSAGES) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark how archiving and bulk deletes affect a running study.
+
+    A writer thread keeps inserting messages the way chat turns do, while
+    the database deletes `messages` old messages in one statement (the
+    former `db_utils.py clear`), in chunks (app.archive.delete_in_chunks),
+    and archives them (db_utils.py archive). Reports how long each of the
+    writer's inserts took, checked against P99_BUDGETS.
+    """
+    results = {}
+
+    with benchmark_app() as app:
+        from app import db
+        from app.models import Participant, Message
+        from app.archive import delete_in_chunks, archive_participants
+
+        with app.app_context():
+            print(f"\nArchive: {messages:,} old messages "
+                  f"({max(1, messages // SEARCH_MESSAGES_PER_PARTICIPANT):,} participants), "
+                  f"writer inserting every {ARCHIVE_WRITER_INTERVAL * 1000:.0f}ms")
+            old_messages = Message.__table__.c.participant_id.like('old-%')
+            old_participants = Participant.__table__.c.participant_id.like('old-%')
+
+            def delete_at_once():
+                with db.engine.begin() as connection:
+                    connection.execute(Message.__table__.delete().where(old_messages))
+                    connection.execute(Participant.__table__.delete().where(old_participants))
+
+            def delete_chunked():
+                delete_in_chunks(Message.__table__, old_messages)
+                delete_in_chunks(Participant.__table__, old_participants)
+
+            for name, work in (('writer insert during single delete', delete_at_once),
+                               ('writer insert during chunked delete', delete_chunked)):
+                seed_old_study(messages)
+                report_writer(results, name, *while_writing(app, work))
+
+            seed_old_study(messages)
+            archive_dir = tempfile.mkdtemp(prefix='chat-archive-')
+            cutoff = datetime.utcnow() - timedelta(days=30)
+            with mock.patch.dict(os.environ, {'ARCHIVE_DIR': archive_dir}):
+                report_writer(results, 'writer insert during archive',
+                              *while_writing(app, lambda: archive_participants('default', before=cutoff)))
+            shutil.rmtree(archive_dir, ignore_errors=True)
+
+    return results
+
+
+def bench_snapshot(rounds: int, messages: int = ARCHIVE_MESSAGES) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark analysis against a snapshot versus the live database.
+
+    With a writer thread inserting messages the way chat turns do, times
+    `db_utils.py export-json` run on the live database (holding a read
+    transaction for the whole export) and taking a snapshot
+    (app.snapshot). Reports the writer's insert times, checked against
+    P99_BUDGETS, and how long the snapshot took.
+    """
+    results = {}
+
+    with benchmark_app() as app:
+        import db_utils
+        from app.snapshot import create_snapshot
+
+        with app.app_context():
+            seed_old_study(messages)
+
+        print(f"\nSnapshot: {messages:,} messages, writer inserting every {ARCHIVE_WRITER_INTERVAL * 1000:.0f}ms")
+        output_dir = tempfile.mkdtemp(prefix='chat-snapshot-')
+        with mock.patch.object(db_utils, 'create_app', lambda: app), mock.patch('builtins.print'):
+            outcome = while_writing(app, lambda: db_utils.export_to_json(os.path.join(output_dir, 'export.json')))
+        report_writer(results, 'writer insert during live export', *outcome)
+
+        with app.app_context():
+            manifest = {}
+
+            def snapshot():
+                manifest.update(create_snapshot(os.path.join(output_dir, 'snapshot.db')))
+
+            report_writer(results, 'writer insert during snapshot', *while_writing(app, snapshot))
+            print(f"  snapshot: {manifest['method']}, {manifest['restarts']} restarts, "
+                  f"{manifest['size_bytes'] / 1e6:.0f}MB")
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    return results
+
+def bench_costs(rounds: int, entries: int = COST_LEDGER_ENTRIES) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark the cost ledger (app.costs).
+
+    Times a spend report on a ledger of 1% of `entries` and of all of them
+    (30 days, 4 conditions, COST_TURNS_PER_PARTICIPANT turns per
+    participant), to show reports depend on the number of conditions and
+    days rather than on ledger size, and the per-turn work with p99 budgets:
+    recording a turn's usage and checking all four budgets.
+    """
+    results = {}
+    config = {
+        'condition_index': 0,
+        'deployment': 'bench',
+        'pricing': {'bench': {'prompt': 0.25, 'completion': 2.0}},
+        'cost_budgets': {name: {'soft': 10 ** 6, 'hard': 10 ** 7}
+                         for name in ('participant', 'condition', 'study', 'study_daily')},
+    }
+
+    with benchmark_app() as app:
+        from app import db
+        from app.models import CostEntry
+        from app.costs import record_usage, check_budget, spend_summary, rebuild_rollups
+
+        with app.app_context():
+            start_time = datetime.utcnow() - timedelta(days=30)
+            seeded = 0
+            for size in (entries // 100, entries):
+                seed_start = time.perf_counter()
+                with db.engine.begin() as connection:
+                    for batch_start in range(seeded, size, 50_000):
+                        connection.execute(db.insert(CostEntry), [{
+                            'timestamp': start_time + timedelta(seconds=i * 30 * 86400 // entries),
+                            'study_id': 'default',
+                            'participant_id': f"cost-{i // COST_TURNS_PER_PARTICIPANT}",
+                            'condition_index': (i // COST_TURNS_PER_PARTICIPANT) % 4,
+                            'deployment': 'bench',
+                            'source': 'turn',
+                            'prompt_tokens': 850,
+                            'completion_tokens': 120,
+                            'cost_micros': 452,
+                            'priced': True,
+                        } for i in range(batch_start, min(batch_start + 50_000, size))])
+                seeded = size
+                rebuild_rollups('default')
+                print(f"Seeded {size:,} ledger entries and rebuilt rollups in {time.perf_counter() - seed_start:.1f}s")
+                results[f'costs.spend_summary ({size:,} ledger entries)'] = measure(
+                    lambda: spend_summary('default'), rounds
+                )
+
+            participants = entries // COST_TURNS_PER_PARTICIPANT
+            calls = iter(range(10 ** 9))
+
+            def record():
+                record_usage(config, 'default', f"cost-{next(calls) % participants}", STUB_RESPONSE_INFO)
+                db.session.commit()
+
+            results['costs.record_usage + commit'] = measure(record, max(rounds * 20, 1000))
+            results['costs.check_budget'] = measure(
+                lambda: check_budget(config, 'default', f"cost-{next(calls) % participants}"), max(rounds * 20, 1000)
+            )
+
+    return results
+
+
+
+def bench_content_filter(rounds: int, participants: int = 1000) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark the content filter fast-fail cache (app.content_filter) on the configured state backend.
+
+    Times what every turn pays before calling the model: fingerprinting a
+    40-turn conversation and one cache lookup, for a message that is not
+    cached (the usual case) and one that is. Set STATE_BACKEND_URL to
+    measure a networked backend.
+    """
+    rounds = max(rounds * 20, 1000)
+    results = {}
+
+    with benchmark_environment():
+        from app.state import get_state
+        from app import content_filter
+
+        settings = {'participant_ttl_seconds': 600, 'global_ttl_seconds': 3600}
+        conversation = [{'role': 'system', 'content': 'You are a helpful assistant. ' * 40}]
+        for turn in range(40):
+            conversation.append({'role': 'user', 'content': f"Question {turn} about the task at hand?"})
+            conversation.append({'role': 'assistant', 'content': STUB_RESPONSE})
+        conversation.append({'role': 'user', 'content': 'One more question, please.'})
+        participant_ids = [f"filter-{i}" for i in range(participants)]
+        calls = iter(range(10 ** 9))
+
+        results['content_filter.fingerprint (40 turns)'] = measure(
+            lambda: content_filter.fingerprint(conversation, 'benchmark'), rounds
+        )
+        fp = content_filter.fingerprint(conversation, 'benchmark')
+        results['content_filter.cached (miss)'] = measure(
+            lambda: content_filter.cached('default', participant_ids[next(calls) % participants], fp, settings),
+            rounds
+        )
+
+        get_state().set(f"content_filter:default:participant:filter-hit:{fp.message}", '1', 600)
+
+        def hit():
+            if content_filter.cached('default', 'filter-hit', fp, settings) != 'participant':
+                raise AssertionError("cached message was not found")
+
+        results['content_filter.cached (hit)'] = measure(hit, rounds)
+
+        print(f"State backend: {get_state().name}")
+        for name, stats in results.items():
+            print(f"  {name:<40} p99 {format_seconds(stats['p99'])}")
+
+    return results
+
+
+
+def bench_gui_history(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark how long a returning participant's chat page takes to show its history.
+
+    Before, the page rendered by /gui fetched /api/get_history on load: two
+    sequential requests. Now /gui embeds the history (up to the inline
+    cutoff; older messages are fetched in pages after the page is usable).
+    Prints time to interactive estimated as server time plus one
+    GUI_ROUND_TRIP per sequential request.
+    """
+    results = {}
+
+    with benchmark_app() as app:
+        from app import routes
+        from app.routes import INLINE_HISTORY_MAX_MESSAGES, HISTORY_PAGE_SIZE
+
+        # /gui as it was: nothing embedded (only /gui passes max_chars)
+        def without_inline_history(participant_id, before_id=None, limit=None, max_chars=None):
+            if max_chars is not None:
+                return [], None
+            return load_history_page(participant_id, before_id, limit)
+        load_history_page = routes.load_history_page
+
+        client = app.test_client()
+        tokens = {
+            length: seed_participant(app, client, f"gui-history-{length}", length)
+            for length in GUI_HISTORY_LENGTHS
+        }
+
+        for length in GUI_HISTORY_LENGTHS:
+            participant_id = f"gui-history-{length}"
+            gui_url = f'/gui?participant_id={participant_id}&condition=0'
+            history_url = f'/api/get_history?participant_id={participant_id}&session_token={tokens[length]}'
+
+            def gui():
+                response = client.get(gui_url)
+                assert response.status_code == 200, response.get_data(as_text=True)[:200]
+
+            def gui_then_history():
+                gui()
+                assert client.get(history_url).get_json()['success']
+
+            with mock.patch('app.routes.load_history_page', without_inline_history):
+                results[f'GET /gui + GET /api/get_history[{length}] (before)'] = measure(gui_then_history, rounds)
+            results[f'GET /gui[{length}] (history inline)'] = measure(gui, rounds)
+
+        page_url = (f'/api/get_history?participant_id=gui-history-2000&session_token={tokens[2000]}'
+                    f'&before=1000000&limit={HISTORY_PAGE_SIZE}')
+        results[f'GET /api/get_history (page of {HISTORY_PAGE_SIZE})'] = measure(
+            lambda: client.get(page_url).get_data(), rounds
+        )
+
+    print(f"\nEstimated time to interactive with a {format_seconds(GUI_ROUND_TRIP)} round trip "
+          f"(histories over {INLINE_HISTORY_MAX_MESSAGES} messages load older pages afterwards):")
+    for length in GUI_HISTORY_LENGTHS:
+        before = results[f'GET /gui + GET /api/get_history[{length}] (before)']['median'] + 2 * GUI_ROUND_TRIP
+        after = results[f'GET /gui[{length}] (history inline)']['median'] + GUI_ROUND_TRIP
+        print(f"  {length:>5} messages: {format_seconds(before):>10} -> {format_seconds(after):>10}")
+
+    return results
+
+
+
+def load_page(client, url: str, cache: typing.Dict[str, typing.Dict[str, typing.Any]]) -> typing.Tuple[int, int]:
+    """
+    Load a page and the static files it references the way a browser would.
+
+    Responses are requested compressed. `cache` plays the browser cache:
+    immutable entries are used without a request, others are revalidated
+    with If-None-Match.
+
+    Returns:
+        (requests made, response body bytes received)
+    """
+    requests = transferred = 0
+    urls = [url]
+    while urls:
+        current = urls.pop(0)
+        entry = cache.get(current)
+        if entry and entry['immutable']:
+            continue
+
+        headers = {'Accept-Encoding': 'gzip, br'}
+        if entry:
+            headers['If-None-Match'] = entry['etag']
+        response = client.get(current, headers=headers)
+        requests += 1
+        transferred += len(response.data)
+        assert response.status_code in (200, 304), f"{current}: {response.status_code}"
+
+        if response.status_code == 200:
+            body = response.data
+            if response.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            cache[current] = {
+                'etag': response.headers.get('ETag'),
+                'immutable': 'immutable' in response.headers.get('Cache-Control', ''),
+                'body': body,
+            }
+        if current == url:
+            # Stylesheets, scripts and icons, including URLs in the page's script settings
+            urls += sorted(set(re.findall(r'"(/static/[^"]+)"', cache[current]['body'].decode('utf-8'))))
+    return requests, transferred
+
+
+def bench_delivery(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark what a participant's browser downloads for the chat page.
+
+    Loads /gui with its stylesheet, script and bot icon (condition 0, with
+    DELIVERY_ICON as its icon) as a fresh browser, then as the next iframe
+    of the same survey: the page itself is requested again, the fingerprinted
+    assets come from the browser cache. Results carry 'requests' and 'bytes'
+    (checked against DELIVERY_BUDGETS) alongside the time to load them.
+    """
+    results = {}
+
+    with benchmark_app() as app:
+        with open('experimental_conditions.json', encoding='utf-8') as f:
+            conditions = json.load(f)
+        conditions['conditions'][0]['bot_icon'] = DELIVERY_ICON
+        conditions['conditions'][0].setdefault('bot_styles', {})['show_header'] = True
+        with open('experimental_conditions.json', 'w', encoding='utf-8') as f:
+            json.dump(conditions, f, indent=2)
+
+        client = app.test_client()
+        seed_participant(app, client, 'delivery-100', 100)
+        first_url = '/gui?participant_id=delivery-new&condition=0'
+
+        def first_visit():
+            return load_page(client, first_url, {})
+
+        cache: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        load_page(client, first_url, cache)
+        scenarios = {
+            'first visit': first_visit,
+            # Another page of the survey: a different URL (task state), so the page is sent again
+            'next survey page': lambda: load_page(client, first_url + '&task_active=false', dict(cache)),
+            'next survey page (page unchanged)': lambda: load_page(client, first_url, cache),
+            'next survey page, 100 messages': lambda: load_page(
+                client, '/gui?participant_id=delivery-100&condition=0&task_active=false', dict(cache)
+            ),
+        }
+        for name, scenario in scenarios.items():
+            requests, transferred = scenario()
+            results[name] = {**measure(scenario, rounds), 'requests': requests, 'bytes': transferred}
+
+        print("\nTransferred per page load (response bodies):")
+        for name, stats in results.items():
+            print(f"  {name:<40} {stats['requests']:>3} requests {stats['bytes']:>10,} bytes")
+
+    return results
+
+
+
+def bench_gui_render(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark the CPU time /gui spends rendering the chat page.
+
+    Compares rendering chat.html in full for every request with the
+    condition's pre-rendered page plus the participant's settings
+    (app.pages), on their own and as part of a whole /gui request from a
+    returning participant. Times are CPU time (time.process_time).
+    """
+    import jinja2
+
+    rounds = max(rounds * 10, 500)
+    results = {}
+
+    with benchmark_app() as app:
+        from flask import render_template
+        from app import pages
+        from app.routes import HISTORY_PAGE_SIZE
+        from app.studies import load_study_config
+
+        client = app.test_client()
+        seed_participant(app, client, 'render-10', 10)
+        gui_url = '/gui?participant_id=render-10&condition=0'
+
+        with app.app_context():
+            config = load_study_config('default', 0)
+            settings = {'sessionToken': 'x' * 43, 'taskActive': True,
+                        'initialHistory': {'messages': [], 'before': None}}
+
+            results['render_template chat.html (CPU)'] = measure(
+                lambda: render_template('chat.html', config=config, history_page_size=HISTORY_PAGE_SIZE,
+                                        participant_settings=jinja2.utils.htmlsafe_json_dumps(settings)),
+                rounds, clock=time.process_time
+            )
+            results['render_chat_page (CPU)'] = measure(
+                lambda: pages.render_chat_page(config, HISTORY_PAGE_SIZE, settings), rounds, clock=time.process_time
+            )
+
+        with mock.patch('app.pages.get_shell', lambda config, history_page_size: None):
+            results['GET /gui, full render (CPU)'] = measure(
+                lambda: client.get(gui_url).get_data(), rounds, clock=time.process_time
+            )
+        results['GET /gui, cached page (CPU)'] = measure(
+            lambda: client.get(gui_url).get_data(), rounds, clock=time.process_time
+        )
+
+    return results
+
+
+def bench_profiling(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark the stage timers of app.profiling and the profiler's stack samples.
+
+    Times a span() and a record() with profiling off (what every chat turn
+    pays) and on, one stack sample of every thread (taken interval_ms apart
+    by a worker's profiler thread during a session), and a whole
+    /api/send_message turn with the stage timers off and on.
+    """
+    import threading
+    import collections
+
+    results = {}
+
+    with benchmark_app() as app, stubbed_model():
+        from app import profiling
+
+        def timed_span():
+            with profiling.span('benchmark'):
+                pass
+
+        started = profiling.now()
+        micro_rounds = max(rounds * 200, 10_000)
+        results['profiling.span (off)'] = measure(timed_span, micro_rounds)
+        results['profiling.record (off)'] = measure(lambda: profiling.record('benchmark', started), micro_rounds)
+        with mock.patch.object(profiling, '_enabled', True):
+            results['profiling.span (on)'] = measure(timed_span, micro_rounds)
+            results['profiling.record (on)'] = measure(lambda: profiling.record('benchmark', started), micro_rounds)
+
+        # A few idle threads, like a threaded worker's request pool
+        stop = threading.Event()
+        threads = [threading.Thread(target=stop.wait, daemon=True) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        stacks, names = collections.Counter(), {}
+        results['stack sample (5 threads)'] = measure(
+            lambda: profiling._sample(stacks, names, threading.get_ident()), rounds * 10
+        )
+        stop.set()
+
+        client = app.test_client()
+        token = seed_participant(app, client, 'profile-10', 10)
+        payload = {
+            'participant_id': 'profile-10',
+            'session_token': token,
+            'condition_index': 0,
+            'message': 'How long does this take without the model?',
+            'task_active': True,
+        }
+        reset = lambda: trim_history(app, 'profile-10', 10)
+
+        def send():
+            response = client.post('/api/send_message', json=payload)
+            assert response.status_code == 200, response.get_data(as_text=True)
+
+        results['POST /api/send_message[10] (timers off)'] = measure(send, rounds, setup=reset)
+        with mock.patch.object(profiling, '_enabled', True):
+            results['POST /api/send_message[10] (timers on)'] = measure(send, rounds, setup=reset)
+
+    return results
+
+
+def bench_tracing(rounds: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Benchmark request tracing (tracing.py).
+
+    Times a span outside and inside a trace, and whole chat turns (both
+    send endpoints, 10 messages of history) with tracing off, exporting to
+    memory (the default) and to a JSON Lines file.
+    """
+    import tracing
+
+    results = {}
+
+    with benchmark_app() as app, stubbed_model():
+        def timed_span():
+            with tracing.span('benchmark', attempt=1):
+                pass
+
+        micro_rounds = max(rounds * 200, 10_000)
+        results['tracing.span (outside a trace)'] = measure(timed_span, micro_rounds)
+        def fresh_trace():
+            # A new trace now and then, so the span list stays the size of a request's
+            trace = tracing._current.get()
+            if trace is None or len(trace.spans) >= 100:
+                tracing.start_trace('benchmark')
+
+        results['tracing.span (in a trace)'] = measure(timed_span, micro_rounds, setup=fresh_trace)
+        tracing._current.set(None)
+
+        client = app.test_client()
+        token = seed_participant(app, client, 'trace-10', 10)
+        payload = {
+            'participant_id': 'trace-10',
+            'session_token': token,
+            'condition_index': 0,
+            'message': 'How long does this take without the model?',
+            'task_active': True,
+        }
+        reset = lambda: trim_history(app, 'trace-10', 10)
+
+        def send():
+            response = client.post('/api/send_message', json=payload)
+            assert response.status_code == 200, response.get_data(as_text=True)
+
+        def send_stream():
+            body = client.post('/api/send_message_stream', json=payload).get_data(as_text=True)
+            assert body.endswith("data: [DONE]\n\n"), body[-200:]
+
+        exporters = {
+            'tracing off': None,
+            'memory': tracing.MemoryExporter(),
+            'file': tracing.FileExporter(os.path.join(os.getcwd(), 'traces.jsonl')),
+        }
+        for label, exporter in exporters.items():
+            with mock.patch('tracing.get_exporter', lambda: exporter):
+                results[f'POST /api/send_message[10] ({label})'] = measure(send, rounds, setup=reset)
+                results[f'POST /api/send_message_stream[10] ({label})'] = measure(send_stream, rounds, setup=reset)
+
+        trace = exporters['memory'].recent(1)[0]
+        print(f"Spans per streamed turn: {len(trace['spans'])}")
+
+    return results
+
+
+SUITES: typing.Dict[str, typing.Callable[[int], typing.Dict[str, typing.Dict[str, float]]]] = {
+    'request-path': bench_request_path,
+    'validation': bench_validation,
+    'startup': bench_startup,
+    'gui-burst': bench_gui_burst,
+    'multi-node': bench_multi_node,
+    'limiter': bench_limiter,
+    'search': bench_search,
+    'archive': bench_archive,
+    'snapshot': bench_snapshot,
+    'costs': bench_costs,
+    'content-filter': bench_content_filter,
+    'gui-history': bench_gui_history,
+    'delivery': bench_delivery,
+    'gui-render': bench_gui_render,
+    'profiling': bench_profiling,
+    'tracing': bench_tracing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for request-path overhead (model stubbed)')
+    parser.add_argument('suite', choices=sorted(SUITES), help='Benchmark suite to run')
+    parser.add_argument('--rounds', type=int, default=50, help='Timed rounds per benchmark')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_FILE, help='Baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='Compare against the stored baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative slowdown before flagging a regression (default: 0.25)')
+    parser.add_argument('--output', help='Also write raw results to this JSON file')
+
+    args = parser.parse_args()
+
+    # Resolve paths before benchmarks change the working directory
+    baseline_file = os.path.abspath(args.baseline)
+
+    results = SUITES[args.suite](args.rounds)
+    print_results(args.suite, results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'suite': args.suite, 'results': results}, f, indent=2)
+
+    if args.save_baseline:
+        save_baseline(baseline_file, args.suite, results)
+
+    failed = check_budgets(args.suite, results)
+
+    if args.compare:
+        regressions = compare_to_baseline(baseline_file, args.suite, results, args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+        else:
+            print("✅ No regressions")
+        failed += regressions
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
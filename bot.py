@@ -1,13 +1,284 @@
 # python -m pip install openai
 
+from __future__ import annotations
+
 import os
-import openai
 import typing
 import time
 import dotenv
 import json
 import random
 import functools
+import hashlib
+import socket
+import argparse
+import threading
+import concurrent.futures
+from datetime import datetime
+
+from response_cache import ResponseCache
+import tracing
+
+if typing.TYPE_CHECKING:
+    # openai is imported inside the functions that call the API: it is the
+    # heaviest import in the project and tools like db_utils never need it
+    import openai
+
+
+# Reasoning effort levels, lowest first. Adaptive retries step down towards
+# 'low' ('minimal' is only used if configured, as not every model accepts it)
+REASONING_EFFORT_LEVELS = ("minimal", "low", "medium", "high")
+
+# Speculative first-turn modes for a condition's "warm_start" block (see app/warm_start.py)
+WARM_START_MODES = ("bot_first", "predicted_user", "prime")
+
+# Per-participant limits (see app/limits.py). Entries in study_metadata "rate_limits"
+# override these defaults, a condition's "rate_limits" overrides both; null removes a limit
+RATE_LIMIT_KEYS = ("turns_per_minute", "turns_per_day", "tokens_per_day")
+DEFAULT_RATE_LIMITS = {"turns_per_minute": 30, "turns_per_day": 500}
+
+# Spending caps (see app/costs.py), each {"soft": amount, "hard": amount}, from
+# study_metadata "cost_budgets", overridable per condition; null removes a budget.
+# Prices per deployment come from study_metadata "pricing"
+COST_BUDGET_KEYS = ("participant", "condition", "study", "study_daily")
+PRICE_KEYS = ("prompt", "completion")
+
+# Fast-fail cache for content-filtered messages (see app/content_filter.py). Entries in
+# study_metadata "content_filter" override these defaults, a condition's overrides both;
+# a TTL of 0 or null turns that cache off
+DEFAULT_CONTENT_FILTER = {
+    "message": "Your message could not be processed. Please rephrase it and try again.",
+    "participant_ttl_seconds": 600,
+    "global_ttl_seconds": 3600,
+}
+
+# Adaptive retries may raise max_completion_tokens up to this multiple of the
+# configured value, and stop once a turn has used this many budgets in total
+MAX_BUDGET_MULTIPLIER = 4
+
+
+class TTFTTimeoutError(Exception):
+    """Raised when no content arrives within the time-to-first-token deadline."""
+
+
+def model_params_from_config(config: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """
+    Extract the keyword arguments for get_chat_response(_stream) from a config.
+    
+    Args:
+        config: Configuration dictionary from load_experiment_config()
+    
+    Returns:
+        Dictionary of model call parameters
+    """
+    return {
+        "deployment": config["deployment"],
+        "temperature": config["temperature"],
+        "max_completion_tokens": config["max_completion_tokens"],
+        "max_retries": config["max_retries"],
+        "retry_delay": config["retry_delay"],
+        "reasoning_effort": config.get("reasoning_effort"),
+        "ttft_timeout": config.get("ttft_timeout"),
+        "request_timeout": config.get("request_timeout"),
+        "fallback_deployment": config.get("fallback_deployment"),
+    }
+
+
+def _api_for_attempt(
+        client: openai.AzureOpenAI,
+        request_timeout: typing.Optional[float],
+        ttft_timeout: typing.Optional[float] = None
+    ) -> openai.AzureOpenAI:
+    """
+    Return the client to use for one attempt.
+    
+    request_timeout is the HTTP timeout: the whole response when not
+    streaming, each read when streaming. The TTFT deadline is not an HTTP
+    timeout (see _FirstContentWatchdog). With either deadline the SDK's own
+    retries are disabled, so a stalled request is abandoned once (not three
+    times) and our retry loop decides what to try next.
+    """
+    options = {}
+    if request_timeout:
+        options["timeout"] = request_timeout
+    if request_timeout or ttft_timeout:
+        options["max_retries"] = 0
+    return client.with_options(**options) if options else client
+
+
+class _FirstContentWatchdog:
+    """
+    Enforces the time-to-first-token deadline of one streamed attempt.
+    
+    A timer runs from the start of the attempt until the first content
+    chunk. If it fires first, the stream's connection is shut down, so a
+    read blocked on a silent stream fails at once (consume() then raises
+    TTFTTimeoutError). After the first content the deadline no longer
+    applies: slow gaps between chunks never end a response.
+    """
+    
+    def __init__(self, timeout: typing.Optional[float]):
+        self.expired = False
+        self._done = False
+        self._stream = None
+        self._lock = threading.Lock()
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def watch(self, stream) -> None:
+        """Watch an attempt's stream (raises TTFTTimeoutError if the deadline passed while opening it)."""
+        with self._lock:
+            self._stream = stream
+            expired = self.expired
+        if expired:
+            raise TTFTTimeoutError()
+    
+    def first_content(self) -> None:
+        """Stop the deadline at the first content (raises TTFTTimeoutError if it already passed)."""
+        with self._lock:
+            self._done = True
+            expired = self.expired
+        self.cancel()
+        if expired:
+            raise TTFTTimeoutError()
+    
+    def cancel(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+    
+    def _expire(self) -> None:
+        with self._lock:
+            if self._done:
+                return
+            self.expired = True
+            stream = self._stream
+        if stream is not None:
+            _interrupt_stream(stream)
+
+
+def _watched(stream, watchdog: _FirstContentWatchdog) -> typing.Iterator:
+    """Iterate a stream, reporting a stream ended by the watchdog as a TTFT timeout."""
+    try:
+        yield from stream
+    except Exception as e:
+        if watchdog.expired:
+            raise TTFTTimeoutError() from e
+        raise
+    # A shut down connection can also look like the end of the stream
+    if watchdog.expired:
+        raise TTFTTimeoutError()
+
+
+def _interrupt_stream(stream) -> None:
+    """Shut down the connection of a stream so a read blocked on it (in another thread) fails."""
+    try:
+        response = getattr(stream, "response", None)
+        network_stream = response.extensions.get("network_stream") if response is not None else None
+        sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except Exception as e:
+        # The chunk loop still checks the deadline whenever a chunk arrives
+        print(f"⚠️  Could not interrupt stalled stream: {type(e).__name__}: {e}")
+
+
+def _completion_params(
+        conversation: typing.List[typing.Dict[str, str]],
+        deployment: str,
+        temperature: float,
+        max_completion_tokens: int,
+        reasoning_effort: typing.Optional[str]
+    ) -> typing.Dict[str, typing.Any]:
+    """Build chat.completions.create() parameters (reasoning_effort only if set; traceparent in a traced request)."""
+    params = {
+        "messages": conversation,
+        "max_completion_tokens": max_completion_tokens,
+        "model": deployment,
+        "temperature": temperature,
+    }
+    if reasoning_effort:
+        params["reasoning_effort"] = reasoning_effort
+    headers = tracing.propagation_headers()
+    if headers:
+        params["extra_headers"] = headers
+    return params
+
+
+def _adapt_budget(
+        reasoning_effort: typing.Optional[str],
+        max_completion_tokens: int,
+        configured_max_tokens: int
+    ) -> typing.Tuple[typing.Optional[str], int]:
+    """
+    Choose the parameters for a retry after the token budget ran out.
+    
+    Repeating an identical request would most likely run out again, so
+    reasoning effort is lowered one step if possible; otherwise the token
+    budget is doubled (up to MAX_BUDGET_MULTIPLIER x the configured value).
+    
+    Returns:
+        (reasoning_effort, max_completion_tokens) for the next attempt
+    """
+    if reasoning_effort in REASONING_EFFORT_LEVELS:
+        level = REASONING_EFFORT_LEVELS.index(reasoning_effort)
+        if level > REASONING_EFFORT_LEVELS.index("low"):
+            lowered = REASONING_EFFORT_LEVELS[level - 1]
+            print(f"🔧 Token budget exhausted - retrying with reasoning_effort={lowered}")
+            return lowered, max_completion_tokens
+    
+    raised = min(max_completion_tokens * 2, configured_max_tokens * MAX_BUDGET_MULTIPLIER)
+    if raised > max_completion_tokens:
+        print(f"🔧 Token budget exhausted - retrying with max_completion_tokens={raised}")
+    return reasoning_effort, raised
+
+
+def _turn_budget_spent(response_info: typing.Dict[str, typing.Any], configured_max_tokens: int) -> bool:
+    """True if this turn's attempts have already used MAX_BUDGET_MULTIPLIER budgets."""
+    spent = response_info.get("completion_tokens", 0)
+    if spent >= configured_max_tokens * MAX_BUDGET_MULTIPLIER:
+        print(f"⚠️  Turn has used {spent} completion tokens across attempts - not retrying")
+        return True
+    return False
+
+
+def _fail_over(
+        deployment: str,
+        fallback_deployment: typing.Optional[str],
+        response_info: typing.Dict[str, typing.Any]
+    ) -> str:
+    """Return the deployment to use after a TTFT timeout (the fallback, if configured)."""
+    response_info["ttft_timeouts"] = response_info.get("ttft_timeouts", 0) + 1
+    if fallback_deployment and deployment != fallback_deployment:
+        print(f"🔧 Failing over from {deployment} to {fallback_deployment}")
+        response_info["fallback"] = True
+        return fallback_deployment
+    return deployment
+
+
+def _content_filter_info(stage: str, error: typing.Optional[Exception] = None) -> typing.Dict[str, typing.Any]:
+    """
+    Describe a content filter result for response_info.
+    
+    Args:
+        stage: 'prompt' (the request was rejected) or 'completion' (the response was stopped)
+        error: The BadRequestError of a rejected request, whose body lists the flagged categories
+    
+    Returns:
+        Dict with stage and categories (flagged categories, e.g. ['jailbreak'], if reported)
+    """
+    body = getattr(error, "body", None)
+    if isinstance(body, dict) and isinstance(body.get("error"), dict):
+        body = body["error"]
+    results = {}
+    if isinstance(body, dict):
+        results = (body.get("innererror") or {}).get("content_filter_result") or {}
+    categories = sorted(
+        name for name, result in results.items() if isinstance(result, dict) and result.get("filtered")
+    )
+    return {"stage": stage, "categories": categories}
 
 
 def get_chat_response(
@@ -17,11 +288,26 @@ def get_chat_response(
         temperature: float = 1.0,
         max_completion_tokens: int = 2500,
         max_retries: int = 5,
-        retry_delay: float = 2.0
+        retry_delay: float = 2.0,
+        cache: typing.Optional[ResponseCache] = None,
+        response_info: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        reasoning_effort: typing.Optional[str] = None,
+        ttft_timeout: typing.Optional[float] = None,
+        fallback_deployment: typing.Optional[str] = None,
+        request_timeout: typing.Optional[float] = None
     ) -> typing.Optional[str]:
     """
     Send conversation to API and get assistant's response with retry logic.
     
+    Retries adapt instead of repeating a doomed request: if the token budget
+    ran out before any text was produced, the next attempt lowers reasoning
+    effort or raises the budget, and after a timeout it fails over to the
+    fallback deployment (if configured).
+    
+    A non-streamed response arrives all at once, so there is no first token
+    to time: each attempt is bounded by request_timeout (the whole response,
+    reasoning included), and ttft_timeout is not applied.
+    
     Args:
         client: Azure OpenAI client instance
         conversation: List of message dicts with 'role' and 'content' (not modified)
@@ -30,21 +316,69 @@ def get_chat_response(
         max_completion_tokens: Maximum tokens in completion
         max_retries: Maximum number of retry attempts
         retry_delay: Seconds to wait between retries
+        cache: Optional response cache (development and pilot runs only)
+        response_info: Optional dict filled with attempts, prompt_tokens,
+            completion_tokens and ttft_ms (time until the response arrived,
+            including retries) for live metrics, and content_filter if
+            Azure's content filter stopped the request
+        reasoning_effort: Reasoning effort for reasoning models (None = model default)
+        ttft_timeout: Accepted for symmetry with get_chat_response_stream (not applied)
+        fallback_deployment: Deployment to fail over to after a timeout
+        request_timeout: Seconds to wait for each attempt's whole response (None = SDK default)
     
     Returns:
         Assistant's response text, or None if all retries fail
     """
+    if response_info is None:
+        response_info = {}
+    start_time = time.time()
+    
+    if cache is not None:
+        request = cache.normalize_request(deployment, temperature, max_completion_tokens, conversation, reasoning_effort)
+        cache_key = cache.make_key(deployment, temperature, max_completion_tokens, conversation, reasoning_effort)
+        cached_message = cache.get(cache_key)
+        if cached_message is not None:
+            response_info['cached'] = True
+            return cached_message
+        
+        if cache.mode == 'replay':
+            print(f"Response cache miss in replay mode (key {cache_key[:12]}) - not calling the API")
+            return None
+        
+        assistant_message = get_chat_response(
+            client, conversation, deployment, temperature,
+            max_completion_tokens, max_retries, retry_delay,
+            response_info=response_info,
+            reasoning_effort=reasoning_effort,
+            ttft_timeout=ttft_timeout,
+            fallback_deployment=fallback_deployment,
+            request_timeout=request_timeout
+        )
+        if assistant_message is not None:
+            cache.put(cache_key, assistant_message, request)
+        return assistant_message
+    
+    import openai
+    
+    configured_max_tokens = max_completion_tokens
+    api = _api_for_attempt(client, request_timeout)
+    
     for attempt in range(max_retries):
+        response_info['attempts'] = attempt + 1
+        response_info['deployment'] = deployment
         try:
-            response = client.chat.completions.create(
-                messages=conversation,
-                max_completion_tokens=max_completion_tokens,
-                model=deployment,
-                temperature=temperature,
-            )
+            with tracing.span('llm.attempt', attempt=attempt + 1, deployment=deployment,
+                              max_completion_tokens=max_completion_tokens) as attempt_span:
+                response = api.chat.completions.create(
+                    **_completion_params(conversation, deployment, temperature, max_completion_tokens, reasoning_effort)
+                )
+                if response.choices:
+                    attempt_span.set('finish_reason', response.choices[0].finish_reason)
 
             # Log token usage
             if hasattr(response, 'usage') and response.usage:
+                response_info['prompt_tokens'] = response_info.get('prompt_tokens', 0) + response.usage.prompt_tokens
+                response_info['completion_tokens'] = response_info.get('completion_tokens', 0) + response.usage.completion_tokens
                 print(f"\n═══ TOKEN USAGE ═══")
                 print(f"Prompt tokens: {response.usage.prompt_tokens}")
                 print(f"Completion tokens: {response.usage.completion_tokens}")
@@ -70,9 +404,22 @@ def get_chat_response(
                 
                 # Check if message is not empty
                 if assistant_message and assistant_message.strip():
+                    response_info['ttft_ms'] = (time.time() - start_time) * 1000
                     return assistant_message
                 else:
                     print(f"Empty response on attempt {attempt + 1}/{max_retries}")
+                    if response.choices[0].finish_reason == "content_filter":
+                        print("Content filter triggered: Azure's content policy blocked the response.")
+                        response_info['content_filter'] = _content_filter_info('completion')
+                        return None
+                    if response.choices[0].finish_reason == "length":
+                        # Budget spent (typically on hidden reasoning) - don't repeat as is
+                        if _turn_budget_spent(response_info, configured_max_tokens):
+                            break
+                        reasoning_effort, max_completion_tokens = _adapt_budget(
+                            reasoning_effort, max_completion_tokens, configured_max_tokens
+                        )
+                        continue
             else:
                 print(f"No response choices on attempt {attempt + 1}/{max_retries}")
             
@@ -86,6 +433,7 @@ def get_chat_response(
             if "content_filter" in error_message or "ResponsibleAIPolicyViolation" in error_message:
                 print(f"\nContent filter triggered: Azure's content policy blocked this request.")
                 print(f"Filter reason: {error_message}")
+                response_info['content_filter'] = _content_filter_info('prompt', e)
                 # Don't retry for content filter errors - they won't succeed
                 return None
             else:
@@ -100,6 +448,11 @@ def get_chat_response(
                 print(f"Waiting {wait_time} seconds before retry...")
                 time.sleep(wait_time)
         
+        except openai.APITimeoutError as e:
+            # Deadline passed: try again right away, on the fallback deployment if configured
+            print(f"⏱️  No response within {request_timeout}s on attempt {attempt + 1}/{max_retries}")
+            deployment = _fail_over(deployment, fallback_deployment, response_info)
+        
         except openai.APIError as e:
             print(f"API error on attempt {attempt + 1}/{max_retries}: {e}")
             if attempt < max_retries - 1:
@@ -127,33 +480,105 @@ def get_chat_response_stream(
         temperature: float = 1.0,
         max_completion_tokens: int = 2500,
         max_retries: int = 5,
-        retry_delay: float = 2.0
+        retry_delay: float = 2.0,
+        cache: typing.Optional[ResponseCache] = None,
+        response_info: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        reasoning_effort: typing.Optional[str] = None,
+        ttft_timeout: typing.Optional[float] = None,
+        fallback_deployment: typing.Optional[str] = None,
+        request_timeout: typing.Optional[float] = None
     ) -> typing.Generator[str, None, None]:
     """
     Stream conversation response from API with retry logic.
+    
+    With a response cache, hits are re-emitted as chunks at the cache's
+    replay speed and complete streamed responses are recorded.
+    
+    If response_info is given, it is filled with attempts, prompt_tokens,
+    completion_tokens and ttft_ms (time until the first content chunk,
+    including retries) for live metrics, and content_filter if Azure's
+    content filter stopped the request or the response.
+    
+    In-stream controls:
+    - If no content arrives within ttft_timeout seconds, the attempt is
+      cancelled and retried (on fallback_deployment, if configured); the
+      deadline ends at the first content chunk
+    - request_timeout bounds opening the stream and each read of it
+    - If the token budget runs out before any content (reasoning models),
+      the retry lowers reasoning effort or raises the budget
+    - Once content has been yielded, failures end the stream instead of
+      retrying, so the participant never sees a second answer appended
+    - Closing this generator (e.g. the participant disconnected) closes the
+      upstream HTTP stream, so Azure stops generating
     """
+    if response_info is None:
+        response_info = {}
+    request_start_time = time.time()
+    
+    if cache is not None:
+        request = cache.normalize_request(deployment, temperature, max_completion_tokens, conversation, reasoning_effort)
+        cache_key = cache.make_key(deployment, temperature, max_completion_tokens, conversation, reasoning_effort)
+        cached_message = cache.get(cache_key)
+        if cached_message is not None:
+            response_info['cached'] = True
+            yield from cache.replay_stream(cached_message)
+            return
+        
+        if cache.mode == 'replay':
+            print(f"Response cache miss in replay mode (key {cache_key[:12]}) - not calling the API")
+            return
+        
+        chunks = []
+        for chunk in get_chat_response_stream(
+            client, conversation, deployment, temperature,
+            max_completion_tokens, max_retries, retry_delay,
+            response_info=response_info,
+            reasoning_effort=reasoning_effort,
+            ttft_timeout=ttft_timeout,
+            fallback_deployment=fallback_deployment,
+            request_timeout=request_timeout
+        ):
+            chunks.append(chunk)
+            yield chunk
+        
+        full_response = "".join(chunks)
+        if full_response.strip():
+            cache.put(cache_key, full_response, request)
+        return
+    
+    import openai
+    
+    configured_max_tokens = max_completion_tokens
+    api = _api_for_attempt(client, request_timeout, ttft_timeout)
+    content_sent = False  # Once True, never retry (the participant already sees text)
+    
     for attempt in range(max_retries):
+        response_info['attempts'] = attempt + 1
+        response_info['deployment'] = deployment
+        stream = None
+        watchdog = _FirstContentWatchdog(ttft_timeout)
+        attempt_span = tracing.span('llm.attempt', attempt=attempt + 1, deployment=deployment,
+                                    max_completion_tokens=max_completion_tokens, stream=True)
         try:
             start_time = time.time()  # Track total time
             print(f"Streaming attempt {attempt + 1}/{max_retries} - Started at {time.strftime('%H:%M:%S')}")
             
-            stream = client.chat.completions.create(
-                messages=conversation,
-                max_completion_tokens=max_completion_tokens,
-                model=deployment,
-                temperature=temperature,
+            stream = api.chat.completions.create(
+                **_completion_params(conversation, deployment, temperature, max_completion_tokens, reasoning_effort),
                 stream=True,
                 stream_options={"include_usage": True}  # Request usage data in stream
             )
+            watchdog.watch(stream)
 
             chunk_count = 0
             full_response = ""
             usage_data = None
             finish_reason = None
+            filtered = False  # Filtered responses still report usage in the final chunk
             first_chunk_time = None  # Track when first content arrives
             
             # Stream chunks as they arrive
-            for chunk in stream:
+            for chunk in _watched(stream, watchdog):
                 # Capture usage data if present (comes in final chunk)
                 if hasattr(chunk, 'usage') and chunk.usage:
                     usage_data = chunk.usage
@@ -166,25 +591,38 @@ def get_chat_response_stream(
                         finish_reason = chunk.choices[0].finish_reason
                         print(f"Stream finished with reason: {finish_reason}")
                         
+                        attempt_span.set('finish_reason', finish_reason)
                         if finish_reason == "content_filter":
                             print("WARNING: Content filter triggered")
-                            return
+                            response_info['content_filter'] = _content_filter_info('completion')
+                            filtered = True
+                            watchdog.cancel()  # Waiting for the usage chunk is not a stalled attempt
                     
-                    if delta.content:
+                    if delta.content and not filtered:
                         if first_chunk_time is None:
+                            watchdog.first_content()
                             first_chunk_time = time.time()
                             time_to_first_chunk = first_chunk_time - start_time
+                            response_info['ttft_ms'] = (first_chunk_time - request_start_time) * 1000
+                            attempt_span.set('ttft_ms', round(time_to_first_chunk * 1000, 1))
                             print(f"⏱️  Time to first chunk: {time_to_first_chunk:.2f}s (reasoning/processing)")
                         
                         chunk_count += 1
                         full_response += delta.content
+                        content_sent = True
                         yield delta.content
+                
+                # Chunks without content (e.g. filter results) don't reset the deadline
+                if first_chunk_time is None and not filtered and ttft_timeout and time.time() - start_time > ttft_timeout:
+                    raise TTFTTimeoutError()
             
             end_time = time.time()
             total_time = end_time - start_time
             
             # Log token usage AFTER stream completes
             if usage_data:
+                response_info['prompt_tokens'] = response_info.get('prompt_tokens', 0) + usage_data.prompt_tokens
+                response_info['completion_tokens'] = response_info.get('completion_tokens', 0) + usage_data.completion_tokens
                 print(f"\n═══ TOKEN USAGE ═══")
                 print(f"Prompt tokens: {usage_data.prompt_tokens}")
                 print(f"Completion tokens: {usage_data.completion_tokens}")
@@ -212,6 +650,9 @@ def get_chat_response_stream(
                 
                 print(f"═══════════════════\n")
             
+            attempt_span.set('chunks', chunk_count)
+            if filtered:
+                return  # Read to the end for the usage chunk; never retried
             print(f"Successfully streamed {chunk_count} chunks")
             print(f"Total response length: {len(full_response)} characters")
             
@@ -225,25 +666,44 @@ def get_chat_response_stream(
             
             if full_response.strip():
                 return  # Successfully completed
-            else:
-                print(f"Stream completed with 0 chunks")
-                print(f"Total response length: 0")
-                print("WARNING: Empty response from model")
-                
-                if attempt < max_retries - 1:
-                    print(f"Retrying after {retry_delay} seconds...")
-                    time.sleep(retry_delay)
+            
+            print(f"Stream completed with 0 chunks")
+            print(f"Total response length: 0")
+            print("WARNING: Empty response from model")
+            
+            if finish_reason == "length":
+                # Budget spent (typically on hidden reasoning) - don't repeat as is
+                if _turn_budget_spent(response_info, configured_max_tokens):
+                    break
+                reasoning_effort, max_completion_tokens = _adapt_budget(
+                    reasoning_effort, max_completion_tokens, configured_max_tokens
+                )
+            elif attempt < max_retries - 1:
+                print(f"Retrying after {retry_delay} seconds...")
+                time.sleep(retry_delay)
+
+        except (TTFTTimeoutError, openai.APITimeoutError) as e:
+            attempt_span.record_error(e)
+            if content_sent:
+                print("Stream stalled after content was sent - ending response")
+                return
+            # Deadline passed: cancel and try again right away, on the fallback deployment if configured
+            print(f"⏱️  No content within {ttft_timeout}s on attempt {attempt + 1}/{max_retries} - cancelling")
+            deployment = _fail_over(deployment, fallback_deployment, response_info)
 
         except openai.BadRequestError as e:
+            attempt_span.record_error(e)
             error_message = str(e)
             print(f"BadRequestError on attempt {attempt + 1}: {error_message}")
             if "content_filter" in error_message or "ResponsibleAIPolicyViolation" in error_message:
                 print(f"Content filter triggered: {error_message}")
+                response_info['content_filter'] = _content_filter_info('prompt', e)
                 return
             if attempt < max_retries - 1:
                 time.sleep(retry_delay)
 
         except openai.RateLimitError as e:
+            attempt_span.record_error(e)
             print(f"Rate limit on attempt {attempt + 1}: {e}")
             if attempt < max_retries - 1:
                 wait_time = retry_delay * (2 ** attempt)
@@ -251,21 +711,38 @@ def get_chat_response_stream(
                 time.sleep(wait_time)
         
         except openai.APIError as e:
+            attempt_span.record_error(e)
             print(f"API error on attempt {attempt + 1}: {e}")
+            if content_sent:
+                return
             if attempt < max_retries - 1:
                 time.sleep(retry_delay)
         
         except openai.APIConnectionError as e:
+            attempt_span.record_error(e)
             print(f"Connection error on attempt {attempt + 1}: {e}")
+            if content_sent:
+                return
             if attempt < max_retries - 1:
                 time.sleep(retry_delay)
         
         except Exception as e:
+            attempt_span.record_error(e)
             print(f"Unexpected error on attempt {attempt + 1}: {type(e).__name__}: {e}")
             import traceback
             traceback.print_exc()
+            if content_sent:
+                return
             if attempt < max_retries - 1:
                 time.sleep(retry_delay)
+        
+        finally:
+            # Runs on success, on errors and when the consumer closes this
+            # generator (GeneratorExit) - releases the upstream request
+            watchdog.cancel()
+            if stream is not None:
+                stream.close()
+            attempt_span.end()
     
     print("ERROR: All retry attempts exhausted with no content")
     
@@ -368,7 +845,19 @@ def load_experiment_config(
         - system_prompt: Merged system prompt string (with identity protection if enabled)
         - temperature: Temperature setting (from override, study defaults, or fallback)
         - max_completion_tokens: Max tokens (from override, study defaults, or fallback)
+        - reasoning_effort: Reasoning effort (from override or study defaults; None = model default)
+        - ttft_timeout: Seconds to wait for the first content of a streamed response
+          (override, study defaults, MODEL_TTFT_TIMEOUT, or None for no deadline)
+        - request_timeout: HTTP timeout of each attempt - the whole response when not
+          streamed (override, study defaults, MODEL_REQUEST_TIMEOUT, or None for the SDK default)
         - deployment: Model deployment name
+        - fallback_deployment: Deployment used after a TTFT timeout (MODEL_FALLBACK_DEPLOYMENT, optional)
+        - warm_start: Speculative first-turn settings, or None (see app/warm_start.py)
+        - rate_limits: Per-participant limits, e.g. {"turns_per_minute": 30} (see app/limits.py)
+        - pricing: Prices per million tokens by deployment, e.g. {"gpt-5-mini": {"prompt": 0.25, "completion": 2.0}}
+        - cost_budgets: Spending caps, e.g. {"participant": {"soft": 0.5, "hard": 1.0}} (see app/costs.py)
+        - content_filter: Failure message and fast-fail cache TTLs for content-filtered
+          messages (see app/content_filter.py)
         - max_retries: Maximum retry attempts
         - retry_delay: Delay between retries
         - endpoint: API endpoint
@@ -376,7 +865,8 @@ def load_experiment_config(
         - api_key: API subscription key
     
     Raises:
-        ValueError: If condition_index is invalid
+        ValueError: If condition_index, the condition's warm_start block, or a rate_limits,
+            pricing, cost_budgets or content_filter block is invalid
         FileNotFoundError: If config file doesn't exist
     """
     # Load environment variables for deployment settings
@@ -391,6 +881,14 @@ def load_experiment_config(
     default_model_params = study_metadata.get("default_model_params", {})
     default_temperature = default_model_params.get("temperature", 0.7)
     default_max_tokens = default_model_params.get("max_completion_tokens", 2000)
+    default_reasoning_effort = default_model_params.get("reasoning_effort")
+    default_ttft_timeout = default_model_params.get(
+        "ttft_timeout", float(os.environ["MODEL_TTFT_TIMEOUT"]) if os.environ.get("MODEL_TTFT_TIMEOUT") else None
+    )
+    default_request_timeout = default_model_params.get(
+        "request_timeout",
+        float(os.environ["MODEL_REQUEST_TIMEOUT"]) if os.environ.get("MODEL_REQUEST_TIMEOUT") else None
+    )
     
     # Build config with deployment settings from .env and defaults from study metadata
     default_config = {
@@ -402,6 +900,10 @@ def load_experiment_config(
         "max_completion_tokens": default_max_tokens,
         "max_retries": int(os.environ["MODEL_MAX_RETRIES"]),
         "retry_delay": float(os.environ["MODEL_RETRY_DELAY"]),
+        "fallback_deployment": os.environ.get("MODEL_FALLBACK_DEPLOYMENT") or None,
+        "reasoning_effort": default_reasoning_effort,
+        "ttft_timeout": default_ttft_timeout,
+        "request_timeout": default_request_timeout,
     }
     
     # Validate condition index
@@ -425,6 +927,70 @@ def load_experiment_config(
     # Apply model overrides from experimental condition
     model_overrides: typing.Dict = experimental_condition.get("model_overrides", {})
     
+    # Validate optional speculative first turn
+    warm_start: typing.Optional[typing.Dict] = experimental_condition.get("warm_start")
+    if warm_start:
+        if warm_start.get("mode") not in WARM_START_MODES:
+            raise ValueError(
+                f"Invalid warm_start mode '{warm_start.get('mode')}' in condition "
+                f"'{experimental_condition.get('name', 'Unknown')}'. Use one of: {', '.join(WARM_START_MODES)}"
+            )
+        if warm_start["mode"] == "predicted_user" and not warm_start.get("opening_message"):
+            raise ValueError(
+                f"warm_start mode 'predicted_user' in condition "
+                f"'{experimental_condition.get('name', 'Unknown')}' needs an opening_message"
+            )
+    
+    # Merge and validate per-participant rate limits
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    rate_limits.update(study_metadata.get("rate_limits", {}))
+    rate_limits.update(experimental_condition.get("rate_limits", {}))
+    for name, limit in rate_limits.items():
+        if name not in RATE_LIMIT_KEYS:
+            raise ValueError(f"Unknown rate limit '{name}'. Use one of: {', '.join(RATE_LIMIT_KEYS)}")
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+            raise ValueError(f"Rate limit '{name}' must be a positive integer or null, got {limit!r}")
+    rate_limits = {name: limit for name, limit in rate_limits.items() if limit is not None}
+    
+    # Prices per million tokens, by deployment
+    pricing = study_metadata.get("pricing", {})
+    for deployment_name, prices in pricing.items():
+        if not isinstance(prices, dict) or set(prices) - set(PRICE_KEYS):
+            raise ValueError(f"Pricing of '{deployment_name}' must be an object with {' and '.join(PRICE_KEYS)}")
+        for name, price in prices.items():
+            if not isinstance(price, (int, float)) or isinstance(price, bool) or price < 0:
+                raise ValueError(f"Price '{name}' of '{deployment_name}' must be a non-negative number, got {price!r}")
+    
+    # Merge and validate spending caps
+    cost_budgets = dict(study_metadata.get("cost_budgets", {}))
+    cost_budgets.update(experimental_condition.get("cost_budgets", {}))
+    for name, budget in cost_budgets.items():
+        if name not in COST_BUDGET_KEYS:
+            raise ValueError(f"Unknown cost budget '{name}'. Use one of: {', '.join(COST_BUDGET_KEYS)}")
+        if budget is None:
+            continue
+        if not isinstance(budget, dict) or not budget or set(budget) - {"soft", "hard"}:
+            raise ValueError(f"Cost budget '{name}' must be an object with 'soft' and/or 'hard', got {budget!r}")
+        for action, amount in budget.items():
+            if not isinstance(amount, (int, float)) or isinstance(amount, bool) or amount <= 0:
+                raise ValueError(f"Cost budget '{name}.{action}' must be a positive number, got {amount!r}")
+        if "soft" in budget and "hard" in budget and budget["soft"] > budget["hard"]:
+            raise ValueError(f"Cost budget '{name}': soft ({budget['soft']}) exceeds hard ({budget['hard']})")
+    cost_budgets = {name: budget for name, budget in cost_budgets.items() if budget is not None}
+    
+    # Merge and validate content filter settings
+    content_filter = dict(DEFAULT_CONTENT_FILTER)
+    content_filter.update(study_metadata.get("content_filter", {}))
+    content_filter.update(experimental_condition.get("content_filter", {}))
+    for name, value in content_filter.items():
+        if name not in DEFAULT_CONTENT_FILTER:
+            raise ValueError(f"Unknown content_filter setting '{name}'. Use one of: {', '.join(DEFAULT_CONTENT_FILTER)}")
+        if name == "message":
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError("content_filter.message must be a non-empty string")
+        elif value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0):
+            raise ValueError(f"content_filter.{name} must be a non-negative number or null, got {value!r}")
+    
     # Build final configuration
     final_config = {
         "condition_index": condition_index,
@@ -437,12 +1003,21 @@ def load_experiment_config(
         "system_prompt": system_prompt,
         "temperature": model_overrides.get("temperature", default_config["temperature"]),
         "max_completion_tokens": model_overrides.get("max_completion_tokens", default_config["max_completion_tokens"]),
+        "reasoning_effort": model_overrides.get("reasoning_effort", default_config["reasoning_effort"]),
+        "ttft_timeout": model_overrides.get("ttft_timeout", default_config["ttft_timeout"]),
+        "request_timeout": model_overrides.get("request_timeout", default_config["request_timeout"]),
         "deployment": default_config["deployment"],
+        "fallback_deployment": default_config["fallback_deployment"],
         "max_retries": default_config["max_retries"],
         "retry_delay": default_config["retry_delay"],
         "endpoint": default_config["endpoint"],
         "api_version": default_config["api_version"],
         "api_key": default_config["api_key"],
+        "warm_start": warm_start,
+        "rate_limits": rate_limits,
+        "pricing": pricing,
+        "cost_budgets": cost_budgets,
+        "content_filter": content_filter,
         "has_temperature_override": "temperature" in model_overrides,
         "has_max_tokens_override": "max_completion_tokens" in model_overrides,
     }
@@ -450,19 +1025,35 @@ def load_experiment_config(
     return final_config
 
 
-def run_conversation(config: typing.Dict[str, typing.Any]) -> None:
+def create_client(config: typing.Dict[str, typing.Any]) -> openai.AzureOpenAI:
     """
-    Run the conversation loop with the given configuration.
+    Create an Azure OpenAI client from a loaded configuration.
     
     Args:
         config: Configuration dictionary from load_experiment_config()
+    
+    Returns:
+        AzureOpenAI client instance
     """
-    # Create Azure OpenAI client
-    client: openai.AzureOpenAI = openai.AzureOpenAI(
+    import openai
+    
+    return openai.AzureOpenAI(
         api_version=config["api_version"],
         azure_endpoint=config["endpoint"],
         api_key=config["api_key"],
     )
+
+
+def run_conversation(config: typing.Dict[str, typing.Any], cache: typing.Optional[ResponseCache] = None) -> None:
+    """
+    Run the conversation loop with the given configuration.
+    
+    Args:
+        config: Configuration dictionary from load_experiment_config()
+        cache: Optional response cache for repeated development runs
+    """
+    # Create Azure OpenAI client
+    client: openai.AzureOpenAI = create_client(config)
     
     # Display condition info (hidden from user in actual experiment)
     print("--------------------------")
@@ -478,6 +1069,8 @@ def run_conversation(config: typing.Dict[str, typing.Any]) -> None:
     print(f"\nSystem Prompt:\n{config['system_prompt']}")
     print("--------------------------")
     print("--------------------------")
+    if cache is not None:
+        print(f"Response cache: {cache.mode} ({cache.directory})")
     print("\nType 'END' to exit the conversation\n")
     
     # Initialize conversation with system prompt
@@ -507,11 +1100,8 @@ def run_conversation(config: typing.Dict[str, typing.Any]) -> None:
         assistant_message: typing.Optional[str] = get_chat_response(
             client,
             conversation,
-            deployment=config["deployment"],
-            temperature=config["temperature"],
-            max_completion_tokens=config["max_completion_tokens"],
-            max_retries=config["max_retries"],
-            retry_delay=config["retry_delay"]
+            cache=cache,
+            **model_params_from_config(config)
         )
         
         # Handle failed response
@@ -529,13 +1119,307 @@ def run_conversation(config: typing.Dict[str, typing.Any]) -> None:
         print("--------------------------")
 
 
-def main(condition_index: typing.Optional[int] = None, random_seed: typing.Optional[int] = None) -> None:
+# ============================================================================
+# Batch simulation (synthetic participants)
+# ============================================================================
+
+def _load_participant_scripts(scripts_file: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    """
+    Load participant scripts from a JSONL file (one script per line).
+    
+    Each script needs a participant_id and either a list of scripted user
+    turns or a simulator definition for an LLM-driven participant:
+    
+        {"participant_id": "sim-001", "condition_index": 0, "turns": ["Hi!", "Can you help me?"]}
+        {"participant_id": "sim-002", "condition_index": 1,
+         "simulator": {"system_prompt": "You are a curious student...", "opening_message": "Hi", "max_turns": 5}}
+    
+    Scripts without condition_index are assigned an enabled condition at random
+    (deterministically per participant_id, so resumed runs assign the same condition).
+    
+    Args:
+        scripts_file: Path to the JSONL file
+    
+    Returns:
+        List of script dictionaries
+    
+    Raises:
+        ValueError: If a line is not valid JSON or is missing required fields
+    """
+    scripts = []
+    seen_ids = set()
+    with open(scripts_file, "r", encoding="utf-8") as file_in:
+        for line_number, line in enumerate(file_in, start=1):
+            if not line.strip():
+                continue
+            try:
+                script = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{scripts_file}:{line_number}: invalid JSON: {e}")
+            
+            if not script.get("participant_id"):
+                raise ValueError(f"{scripts_file}:{line_number}: participant_id is required")
+            if not script.get("turns") and not script.get("simulator"):
+                raise ValueError(f"{scripts_file}:{line_number}: either 'turns' or 'simulator' is required")
+            if script["participant_id"] in seen_ids:
+                raise ValueError(f"{scripts_file}:{line_number}: duplicate participant_id '{script['participant_id']}'")
+            
+            seen_ids.add(script["participant_id"])
+            scripts.append(script)
+    return scripts
+
+
+def _load_checkpoint(checkpoint_file: str) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """
+    Load completed participants from a checkpoint file.
+    
+    The checkpoint is a JSONL file with one completed participant record per
+    line. A partially written last line (from an interrupted run) is ignored.
+    
+    Args:
+        checkpoint_file: Path to the checkpoint file
+    
+    Returns:
+        Dictionary mapping participant_id to its completed record
+    """
+    completed = {}
+    if not os.path.exists(checkpoint_file):
+        return completed
+    
+    with open(checkpoint_file, "r", encoding="utf-8") as file_in:
+        for line in file_in:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            completed[record["participant_id"]] = record
+    return completed
+
+
+def simulate_participant(
+        client: openai.AzureOpenAI,
+        script: typing.Dict[str, typing.Any],
+        config: typing.Dict[str, typing.Any],
+        cache: typing.Optional[ResponseCache] = None
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Run one synthetic participant's conversation against a condition.
+    
+    Scripted participants send their 'turns' in order. LLM-driven participants
+    are played by a second model call using the simulator's own system prompt,
+    with the roles flipped so the simulator sees the bot's replies as user turns.
+    
+    Args:
+        client: Azure OpenAI client instance (shared across workers)
+        script: Participant script (see _load_participant_scripts)
+        config: Configuration dictionary from load_experiment_config()
+        cache: Optional response cache (makes reruns offline and deterministic)
+    
+    Returns:
+        Participant record in the same schema as `db_utils.py export-json`,
+        or None if the bot failed to respond (the participant can be retried)
+    """
+    model_params = dict(model_params_from_config(config), cache=cache)
+    
+    created_at = datetime.utcnow().isoformat()
+    conversation: typing.List[typing.Dict[str, str]] = [
+        {"role": "system", "content": config["system_prompt"]}
+    ]
+    timestamps = [created_at]
+    
+    simulator = script.get("simulator")
+    if simulator:
+        max_turns = simulator.get("max_turns", 5)
+        simulator_conversation = [{"role": "system", "content": simulator["system_prompt"]}]
+    else:
+        max_turns = len(script["turns"])
+    
+    for turn in range(max_turns):
+        # Get the participant's next message
+        if not simulator:
+            user_message = script["turns"][turn]
+        elif turn == 0 and simulator.get("opening_message"):
+            user_message = simulator["opening_message"]
+        else:
+            user_message = get_chat_response(
+                client,
+                simulator_conversation,
+                deployment=simulator.get("deployment", config["deployment"]),
+                temperature=simulator.get("temperature", 1.0),
+                max_completion_tokens=simulator.get("max_completion_tokens", config["max_completion_tokens"]),
+                max_retries=config["max_retries"],
+                retry_delay=config["retry_delay"],
+                cache=cache
+            )
+            if user_message is None:
+                print(f"[{script['participant_id']}] Simulator failed to respond on turn {turn + 1}")
+                return None
+        
+        user_message = user_message.strip()
+        if simulator and user_message.upper() == "END":
+            break
+        
+        conversation.append({"role": "user", "content": user_message})
+        timestamps.append(datetime.utcnow().isoformat())
+        
+        assistant_message = get_chat_response(client, conversation, **model_params)
+        if assistant_message is None:
+            print(f"[{script['participant_id']}] Bot failed to respond on turn {turn + 1}")
+            return None
+        
+        conversation.append({"role": "assistant", "content": assistant_message})
+        timestamps.append(datetime.utcnow().isoformat())
+        
+        if simulator:
+            # From the simulator's point of view, the roles are reversed
+            simulator_conversation.append({"role": "assistant", "content": user_message})
+            simulator_conversation.append({"role": "user", "content": assistant_message})
+    
+    return {
+        "participant_id": script["participant_id"],
+        "condition_index": config["condition_index"],
+        "condition_id": config["condition_id"],
+        "condition_name": config["condition_name"],
+        "system_prompt_hash": hashlib.sha256(config["system_prompt"].encode("utf-8")).hexdigest(),
+        "created_at": created_at,
+        "updated_at": timestamps[-1],
+        "total_messages": len(conversation),
+        "user_messages": sum(1 for m in conversation if m["role"] == "user"),
+        "assistant_messages": sum(1 for m in conversation if m["role"] == "assistant"),
+        "conversation": [
+            {"role": msg["role"], "content": msg["content"], "timestamp": timestamp}
+            for msg, timestamp in zip(conversation, timestamps)
+        ]
+    }
+
+
+def run_batch(
+        scripts_file: str,
+        output_file: str = "data/simulated_conversations.json",
+        workers: int = 4,
+        checkpoint_file: typing.Optional[str] = None,
+        config_file: str = "experimental_conditions.json",
+        random_seed: typing.Optional[int] = None,
+        cache: typing.Optional[ResponseCache] = None
+    ) -> typing.Dict[str, typing.Any]:
+    """
+    Run many synthetic participants concurrently with a bounded worker pool.
+    
+    Completed participants are appended to a checkpoint file as they finish,
+    so an interrupted run picks up where it left off when started again with
+    the same scripts file. Participants whose conversation failed are not
+    checkpointed and are retried on the next run.
+    
+    Args:
+        scripts_file: JSONL file with one participant script per line
+        output_file: JSON file to write (same schema as `db_utils.py export-json`)
+        workers: Maximum number of participants simulated at the same time
+        checkpoint_file: Checkpoint path (defaults to output_file + '.checkpoint.jsonl')
+        config_file: Path to the experimental conditions JSON file
+        random_seed: Seed for assigning conditions to scripts without condition_index
+        cache: Optional response cache shared by all workers
+    
+    Returns:
+        The export data written to output_file
+    """
+    dotenv.load_dotenv()
+    scripts = _load_participant_scripts(scripts_file)
+    checkpoint_file = checkpoint_file or f"{output_file}.checkpoint.jsonl"
+    
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+    
+    completed = _load_checkpoint(checkpoint_file)
+    pending = [s for s in scripts if s["participant_id"] not in completed]
+    print(f"Loaded {len(scripts)} participant scripts "
+          f"({len(completed)} already completed, {len(pending)} to run, {workers} workers)")
+    
+    # Assign conditions and load each condition's config once
+    all_conditions = _load_conditions_file(config_file)["conditions"]
+    enabled_indices = [i for i, cond in enumerate(all_conditions) if cond.get("enabled", True)]
+    configs: typing.Dict[int, typing.Dict[str, typing.Any]] = {}
+    for script in pending:
+        if script.get("condition_index") is None:
+            if not enabled_indices:
+                raise ValueError("No enabled conditions found in configuration file.")
+            rng = random.Random(f"{random_seed}-{script['participant_id']}")
+            script["condition_index"] = rng.choice(enabled_indices)
+        if script["condition_index"] not in configs:
+            configs[script["condition_index"]] = load_experiment_config(script["condition_index"], config_file)
+    
+    checkpoint_lock = threading.Lock()
+    failed = []
+    
+    if pending:
+        # One client shared by all workers (the underlying HTTP client is thread-safe)
+        client = create_client(next(iter(configs.values())))
+        
+        # An interrupted run can leave a partial last line: start on a new one
+        partial_line = False
+        if os.path.exists(checkpoint_file) and os.path.getsize(checkpoint_file):
+            with open(checkpoint_file, "rb") as file_in:
+                file_in.seek(-1, os.SEEK_END)
+                partial_line = file_in.read(1) != b"\n"
+
+        with open(checkpoint_file, "a", encoding="utf-8") as checkpoint_out, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            if partial_line:
+                checkpoint_out.write("\n")
+            futures = {
+                executor.submit(simulate_participant, client, script, configs[script["condition_index"]], cache): script
+                for script in pending
+            }
+            
+            for future in concurrent.futures.as_completed(futures):
+                participant_id = futures[future]["participant_id"]
+                try:
+                    record = future.result()
+                except Exception as e:
+                    print(f"[{participant_id}] Unexpected error: {type(e).__name__}: {e}")
+                    record = None
+                
+                if record is None:
+                    failed.append(participant_id)
+                    continue
+                
+                with checkpoint_lock:
+                    checkpoint_out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    checkpoint_out.flush()
+                    os.fsync(checkpoint_out.fileno())
+                completed[participant_id] = record
+                print(f"[{participant_id}] Completed ({len(completed)}/{len(scripts)})")
+    
+    # Write results in script order, in the same schema as db_utils.py export-json
+    participants = [completed[s["participant_id"]] for s in scripts if s["participant_id"] in completed]
+    export_data = {
+        "export_timestamp": datetime.utcnow().isoformat(),
+        "total_participants": len(participants),
+        "participants": participants
+    }
+    with open(output_file, "w", encoding="utf-8") as file_out:
+        json.dump(export_data, file_out, indent=2, ensure_ascii=False)
+    
+    print(f"✅ Wrote {len(participants)} simulated participants to {output_file}")
+    if cache is not None:
+        print(f"Response cache ({cache.mode}): {cache.hits} hits, {cache.misses} misses")
+    if failed:
+        print(f"⚠️  {len(failed)} participants failed and will be retried on the next run: {', '.join(failed)}")
+    
+    return export_data
+
+
+def main(
+        condition_index: typing.Optional[int] = None,
+        random_seed: typing.Optional[int] = None,
+        cache: typing.Optional[ResponseCache] = None
+    ) -> None:
     """
     Main entry point for the conversation script.
     
     Args:
         condition_index: Specific condition index to use. If None, randomly selects from enabled conditions.
         random_seed: Seed for random selection. If None, uses system time.
+        cache: Optional response cache for repeated development runs
     """
     try:
         # Load all conditions to determine available options
@@ -563,7 +1447,7 @@ def main(condition_index: typing.Optional[int] = None, random_seed: typing.Optio
         config = load_experiment_config(condition_index)
         
         # Run the conversation with the loaded configuration
-        run_conversation(config)
+        run_conversation(config, cache=cache)
         
     except FileNotFoundError as e:
         print(f"Error: Configuration file not found: {e}")
@@ -576,11 +1460,26 @@ def main(condition_index: typing.Optional[int] = None, random_seed: typing.Optio
 
 
 if __name__ == "__main__":
-    # Option 1: Use a specific condition
-    # main(condition_index=0)
+    parser = argparse.ArgumentParser(description="Chat with an experimental condition, or simulate participants in bulk")
+    parser.add_argument("--condition", type=int, help="Condition index (default: random enabled condition)")
+    parser.add_argument("--seed", type=int, help="Random seed for condition selection (for reproducibility)")
+    parser.add_argument("--batch", metavar="SCRIPTS_JSONL", help="Run synthetic participants from a JSONL file")
+    parser.add_argument("--output", default="data/simulated_conversations.json", help="Batch output file")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent participants in batch mode")
+    parser.add_argument("--cache", choices=["off", "record", "replay"],
+                        help="Response cache mode (default: RESPONSE_CACHE_MODE or off)")
+    args = parser.parse_args()
     
-    # Option 2: Randomly select from enabled conditions
-    main()
+    dotenv.load_dotenv()
+    cache = ResponseCache.from_env(args.cache)
     
-    # Option 3: Random selection with seed (for reproducibility)
-    # main(random_seed=42)
\ No newline at end of file
+    if args.batch:
+        # Batch mode: python bot.py --batch scripts.jsonl --workers 8
+        run_batch(args.batch, args.output, workers=args.workers, random_seed=args.seed, cache=cache)
+    else:
+        # Interactive mode:
+        #   python bot.py                  -> randomly select from enabled conditions
+        #   python bot.py --condition 0    -> use a specific condition
+        #   python bot.py --seed 42        -> random selection with seed (for reproducibility)
+        #   python bot.py --cache record   -> reuse responses to identical requests across runs
+        main(condition_index=args.condition, random_seed=args.seed, cache=cache)
@@ -3,23 +3,39 @@ Database utilities for managing experimental chat data.
 Provides tools for exporting, analyzing, and managing the conversation database.
 """
 
+import os
+import sys
 import json
 import csv
 import argparse
 from datetime import datetime
 from collections import defaultdict
 from app import create_app, db
-from app.models import Participant, Message
+from app.models import Participant, Message, Prompt, TaskStateEvent, ContentFilterEvent, WarmStart
+from app.search import search_messages, rebuild_search_index, SearchQueryError
+from app.archive import archive_participants, select_participants, delete_in_chunks, delete_participants, maintain
+from app.snapshot import create_snapshot, list_snapshots, open_snapshot
+from app.costs import spend_summary, rebuild_rollups
+from tracing import read_trace_file
 
 
-def export_to_json(output_file='data/export_data.json'):
-    """Export all data to JSON format."""
+def _participants_query(study_id=None):
+    """Participants query, limited to one study if given."""
+    query = Participant.query
+    if study_id:
+        query = query.filter_by(study_id=study_id)
+    return query
+
+
+def export_to_json(output_file='data/export_data.json', study_id=None):
+    """Export all data (or one study's data) to JSON format."""
     app = create_app()
     with app.app_context():
-        participants = Participant.query.all()
+        participants = _participants_query(study_id).all()
         
         export_data = {
             'export_timestamp': datetime.utcnow().isoformat(),
+            'study_id': study_id,
             'total_participants': len(participants),
             'participants': []
         }
@@ -29,24 +45,43 @@ def export_to_json(output_file='data/export_data.json'):
                 participant_id=participant.participant_id
             ).order_by(Message.timestamp).all()
             
+            conversation = [
+                {
+                    'role': msg.role,
+                    'content': msg.text,
+                    'timestamp': msg.timestamp.isoformat(),
+                    'truncated': msg.truncated,
+                    'trace_id': msg.trace_id
+                }
+                for msg in messages
+            ]
+            
+            # Deduplicated system prompt (legacy participants have it as a message instead)
+            if participant.system_prompt_hash:
+                conversation.insert(0, {
+                    'role': 'system',
+                    'content': participant.system_prompt,
+                    'timestamp': participant.created_at.isoformat(),
+                    'truncated': False,
+                    'trace_id': None
+                })
+            
             participant_data = {
                 'participant_id': participant.participant_id,
+                'study_id': participant.study_id,
                 'condition_index': participant.condition_index,
                 'condition_id': participant.condition_id,
                 'condition_name': participant.condition_name,
+                'system_prompt_hash': participant.system_prompt_hash,
+                'task_active': participant.task_active,
                 'created_at': participant.created_at.isoformat(),
                 'updated_at': participant.updated_at.isoformat(),
-                'total_messages': len(messages),
+                'total_messages': len(conversation),
                 'user_messages': sum(1 for m in messages if m.role == 'user'),
                 'assistant_messages': sum(1 for m in messages if m.role == 'assistant'),
-                'conversation': [
-                    {
-                        'role': msg.role,
-                        'content': msg.content,
-                        'timestamp': msg.timestamp.isoformat()
-                    }
-                    for msg in messages
-                ]
+                'conversation': conversation,
+                'task_state_events': [event.to_dict() for event in participant.task_state_events],
+                'content_filter_events': [event.to_dict() for event in participant.content_filter_events]
             }
             
             export_data['participants'].append(participant_data)
@@ -58,49 +93,76 @@ def export_to_json(output_file='data/export_data.json'):
         return export_data
 
 
-def export_to_csv(output_file='data/export_messages.csv'):
-    """Export all messages to CSV format (one row per message)."""
+def export_to_csv(output_file='data/export_messages.csv', study_id=None):
+    """
+    Export all messages (or one study's messages) to CSV format (one row per message).
+    
+    A participant's deduplicated system prompt is exported as a system row
+    without a message_id, first in their conversation (legacy participants
+    have it as a message instead).
+    """
     app = create_app()
     with app.app_context():
-        messages = Message.query.order_by(Message.participant_id, Message.timestamp).all()
+        query = Message.query
+        if study_id:
+            query = query.join(Participant).filter(Participant.study_id == study_id)
+        messages = query.order_by(Message.participant_id, Message.timestamp).all()
+        participants = {p.participant_id: p for p in _participants_query(study_id)}
+        
+        # (participant_id, sort key, message_id, role, content, timestamp, truncated, trace_id)
+        rows = [
+            (msg.participant_id, (1, msg.timestamp), msg.id, msg.role, msg.text,
+             msg.timestamp, msg.truncated, msg.trace_id)
+            for msg in messages
+        ]
+        rows.extend(
+            (p.participant_id, (0, p.created_at), None, 'system', p.system_prompt,
+             p.created_at, False, None)
+            for p in participants.values() if p.system_prompt_hash
+        )
+        rows.sort(key=lambda row: (row[0], row[1]))
         
         with open(output_file, 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow([
-                'message_id', 'participant_id', 'condition_index', 
+                'message_id', 'participant_id', 'study_id', 'condition_index', 
                 'condition_id', 'condition_name', 'role', 
-                'content', 'timestamp'
+                'content', 'timestamp', 'truncated', 'trace_id'
             ])
             
-            for msg in messages:
-                participant = Participant.query.get(msg.participant_id)
+            for participant_id, _, message_id, role, content, timestamp, truncated, trace_id in rows:
+                participant = participants.get(participant_id)
                 writer.writerow([
-                    msg.id,
-                    msg.participant_id,
+                    message_id,
+                    participant_id,
+                    participant.study_id if participant else None,
                     participant.condition_index if participant else None,
                     participant.condition_id if participant else None,
                     participant.condition_name if participant else None,
-                    msg.role,
-                    msg.content,
-                    msg.timestamp.isoformat()
+                    role,
+                    content,
+                    timestamp.isoformat(),
+                    truncated,
+                    trace_id
                 ])
         
-        print(f"✅ Exported {len(messages)} messages to {output_file}")
+        print(f"✅ Exported {len(rows)} messages to {output_file}")
 
 
-def export_conversations_csv(output_file='data/conversations.csv'):
+def export_conversations_csv(output_file='data/conversations.csv', study_id=None):
     """
     Export conversations to CSV format (one row per participant).
-    Each row contains: participant_id, condition, full_conversation
+    Each row contains: participant_id, study, condition, full_conversation
     """
     app = create_app()
     with app.app_context():
-        participants = Participant.query.order_by(Participant.created_at).all()
+        participants = _participants_query(study_id).order_by(Participant.created_at).all()
         
         with open(output_file, 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow([
                 'participant_id', 
+                'study_id',
                 'condition_index', 
                 'condition_id',
                 'condition_name',
@@ -121,13 +183,15 @@ def export_conversations_csv(output_file='data/conversations.csv'):
                     if msg.role == 'user':
                         conversation_lines.append(f"User: {msg.content}")
                     elif msg.role == 'assistant':
-                        conversation_lines.append(f"Assistant: {msg.content}")
+                        truncated_note = " [truncated]" if msg.truncated else ""
+                        conversation_lines.append(f"Assistant{truncated_note}: {msg.content}")
                 
                 full_conversation = "\n\n".join(conversation_lines)
                 message_count = len([m for m in messages if m.role != 'system'])
                 
                 writer.writerow([
                     participant.participant_id,
+                    participant.study_id,
                     participant.condition_index,
                     participant.condition_id,
                     participant.condition_name,
@@ -141,19 +205,24 @@ def export_conversations_csv(output_file='data/conversations.csv'):
 
 
 
-def get_statistics():
-    """Print statistics about the collected data."""
+def get_statistics(study_id=None):
+    """Print statistics about the collected data (optionally for one study)."""
     app = create_app()
     with app.app_context():
-        participants = Participant.query.all()
-        messages = Message.query.all()
+        participants = _participants_query(study_id).all()
+        messages = Message.query
+        if study_id:
+            messages = messages.join(Participant).filter(Participant.study_id == study_id)
+        messages = messages.all()
+        # Deduplicated system prompts: one per participant, stored once per distinct text
+        prompt_hashes = [p.system_prompt_hash for p in participants if p.system_prompt_hash]
         
         # Basic stats
         print("\n" + "="*60)
-        print("DATABASE STATISTICS")
+        print("DATABASE STATISTICS" + (f" - STUDY {study_id}" if study_id else ""))
         print("="*60)
         print(f"\nTotal Participants: {len(participants)}")
-        print(f"Total Messages: {len(messages)}")
+        print(f"Total Messages: {len(messages) + len(prompt_hashes)}")
         
         # By condition
         by_condition = defaultdict(int)
@@ -167,12 +236,13 @@ def get_statistics():
         # Message counts
         user_msgs = sum(1 for m in messages if m.role == 'user')
         assistant_msgs = sum(1 for m in messages if m.role == 'assistant')
-        system_msgs = sum(1 for m in messages if m.role == 'system')
+        system_msgs = sum(1 for m in messages if m.role == 'system') + len(prompt_hashes)
         
         print(f"\nMessage Breakdown:")
         print(f"  User messages: {user_msgs}")
         print(f"  Assistant messages: {assistant_msgs}")
         print(f"  System messages: {system_msgs}")
+        print(f"  Distinct system prompts (deduplicated): {len(set(prompt_hashes))}")
         
         # Conversation lengths
         if participants:
@@ -198,11 +268,11 @@ def get_statistics():
         print("\n" + "="*60 + "\n")
 
 
-def list_participants():
-    """List all participants with basic info."""
+def list_participants(study_id=None):
+    """List all participants (optionally of one study) with basic info."""
     app = create_app()
     with app.app_context():
-        participants = Participant.query.order_by(Participant.created_at).all()
+        participants = _participants_query(study_id).order_by(Participant.created_at).all()
         
         print("\n" + "="*80)
         print("PARTICIPANTS LIST")
@@ -235,26 +305,116 @@ def view_conversation(participant_id):
             participant_id=participant_id
         ).order_by(Message.timestamp).all()
         
+        # Interleave task state changes and content filter events with the messages
+        timeline = sorted(messages + list(participant.task_state_events) + list(participant.content_filter_events),
+                          key=lambda item: item.timestamp)
+        
         print("\n" + "="*80)
         print(f"CONVERSATION: {participant_id}")
         print(f"Condition: {participant.condition_name}")
         print(f"Started: {participant.created_at.strftime('%Y-%m-%d %H:%M:%S')}")
         print("="*80 + "\n")
         
-        for msg in messages:
-            if msg.role == 'system':
+        if participant.system_prompt_hash:
+            print(f"[SYSTEM PROMPT {participant.system_prompt_hash[:12]}]")
+            print(f"{participant.system_prompt}\n")
+        
+        for msg in timeline:
+            if isinstance(msg, TaskStateEvent):
+                print(f"[TASK STATE: {msg.event_type} ({msg.source}, {msg.timestamp.strftime('%H:%M:%S')})]\n")
+            elif isinstance(msg, ContentFilterEvent):
+                print(f"[CONTENT FILTER: {msg.event_type}{f' ({msg.detail})' if msg.detail else ''}, "
+                      f"{msg.timestamp.strftime('%H:%M:%S')}]\n")
+            elif msg.role == 'system':
                 print(f"[SYSTEM PROMPT]")
-                print(f"{msg.content}\n")
+                print(f"{msg.text}\n")
             elif msg.role == 'user':
                 print(f"USER ({msg.timestamp.strftime('%H:%M:%S')}):")
                 print(f"  {msg.content}\n")
             elif msg.role == 'assistant':
-                print(f"ASSISTANT ({msg.timestamp.strftime('%H:%M:%S')}):")
+                truncated_note = " [TRUNCATED - participant disconnected]" if msg.truncated else ""
+                print(f"ASSISTANT ({msg.timestamp.strftime('%H:%M:%S')}){truncated_note}:")
                 print(f"  {msg.content}\n")
         
         print("="*80 + "\n")
 
 
+def view_trace(trace_id, trace_file=None):
+    """Show the messages stored by a traced request and its spans as a tree (from the trace file)."""
+    app = create_app()
+    with app.app_context():
+        messages = Message.query.filter_by(trace_id=trace_id).order_by(Message.id).all()
+    
+    print("\n" + "="*80)
+    print(f"TRACE: {trace_id}")
+    print("="*80)
+    for msg in messages:
+        print(f"{msg.role.upper()} #{msg.id} of {msg.participant_id} ({msg.timestamp.strftime('%H:%M:%S')}): "
+              f"{msg.text[:60]!r}")
+    
+    trace = read_trace_file(trace_id, trace_file)
+    if trace is None:
+        print(f"\nNo spans found - traces are written to a file with TRACE_EXPORTER=file "
+              f"(searched {trace_file or os.environ.get('TRACE_FILE') or 'data/traces/traces.jsonl'})")
+        print("="*80 + "\n")
+        return
+    
+    print(f"\n{trace['name']} at {trace['start'][:19]} UTC, {trace['duration_ms']:.1f}ms"
+          f"{' - ' + trace['error'] if trace['error'] else ''}\n")
+    children = defaultdict(list)
+    for span in trace['spans'][1:]:
+        children[span['parent_id']].append(span)
+    
+    def show(span, depth):
+        attributes = span.get('attributes', {})
+        detail = attributes.get('statement') or ', '.join(
+            f"{key}={value}" for key, value in attributes.items() if key not in ('statement', 'executemany'))
+        error = f"  ❌ {span['error']}" if span.get('error') else ''
+        print(f"{span['start_ms']:>9.1f}ms {span['duration_ms']:>9.1f}ms  {'  ' * depth}{span['name']}"
+              f"{'  ' + detail[:80] if detail else ''}{error}")
+        for child in sorted(children[span['span_id']], key=lambda child: child['start_ms']):
+            show(child, depth + 1)
+    
+    print(f"{'start':>11} {'duration':>11}  span")
+    show(trace['spans'][0], 0)
+    if trace.get('dropped_spans'):
+        print(f"... and {trace['dropped_spans']} more spans not recorded")
+    print("="*80 + "\n")
+
+
+def search(query, role=None, condition_index=None, study_id=None, participant_id=None,
+           since=None, until=None, limit=20, newest_first=False):
+    """Search all conversations and print matching messages with highlighted snippets."""
+    app = create_app()
+    with app.app_context():
+        # Bold matches on a terminal, bracket them when the output is piped
+        highlight = ('\033[1;33m', '\033[0m') if sys.stdout.isatty() else ('[', ']')
+        try:
+            results, elapsed_ms = search_messages(
+                query, role=role, condition_index=condition_index, study_id=study_id,
+                participant_id=participant_id, since=since, until=until, limit=limit,
+                newest_first=newest_first, highlight=highlight
+            )
+        except (SearchQueryError, RuntimeError) as e:
+            print(f"❌ {e}")
+            return
+        
+        more = " (limit reached, use --limit for more)" if len(results) == limit else ""
+        print(f"\n🔍 {len(results)} message(s) matching {query!r} in {elapsed_ms:.1f}ms{more}\n")
+        for result in results:
+            print(f"{result['participant_id']}  study {result['study_id']}  condition {result['condition_index']}  "
+                  f"{result['role']}  {result['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}  (message {result['message_id']})")
+            print(f"  {' '.join(result['snippet'].split())}\n")
+
+
+def rebuild_search():
+    """Rebuild the full-text search index from the messages table."""
+    app = create_app()
+    with app.app_context():
+        indexed = rebuild_search_index()
+        print(f"✅ Search index rebuilt ({indexed} messages).")
+
+
 def delete_participant(participant_id, confirm=False):
     """Delete a participant and all their messages."""
     app = create_app()
@@ -272,14 +432,19 @@ def delete_participant(participant_id, confirm=False):
             print("   Run with --confirm flag to proceed.")
             return
         
-        db.session.delete(participant)
         db.session.commit()
+        msg_count = delete_participants([participant_id])
         
         print(f"✅ Deleted participant '{participant_id}' and {msg_count} messages.")
 
 
 def clear_all_data(confirm=False):
-    """Clear all data from the database."""
+    """
+    Clear all data from the database.
+    
+    Rows are deleted in short transactions, so a running study can keep
+    saving messages meanwhile.
+    """
     app = create_app()
     with app.app_context():
         participant_count = Participant.query.count()
@@ -292,13 +457,381 @@ def clear_all_data(confirm=False):
             print("   Run with --confirm flag to proceed.")
             return
         
-        Message.query.delete()
-        Participant.query.delete()
         db.session.commit()
+        for model in (TaskStateEvent, ContentFilterEvent, WarmStart, Message, Participant):
+            delete_in_chunks(model.__table__, db.true())
         
         print(f"✅ Cleared all data: {participant_count} participants, {message_count} messages.")
 
 
+def archive_study(study_id='default', before=None, condition_index=None, confirm=False):
+    """
+    Move finished participants of a study into its compressed archive (see app.archive).
+    
+    Args:
+        study_id: Study to archive from
+        before: Only participants inactive since before this time (UTC)
+        condition_index: Only participants in this condition
+        confirm: Without it, only report what would be archived
+    """
+    if before is None and condition_index is None:
+        print("❌ Give --before, --condition, or both.")
+        return
+    
+    app = create_app()
+    with app.app_context():
+        participant_ids = select_participants(study_id, before, condition_index)
+        message_count = sum(
+            Message.query.filter(Message.participant_id.in_(participant_ids[i:i + 500])).count()
+            for i in range(0, len(participant_ids), 500)
+        )
+        
+        if not confirm:
+            print(f"⚠️  This will move {len(participant_ids)} participants and {message_count} messages "
+                  f"of study '{study_id}' into its archive.")
+            print("   Run with --confirm flag to proceed.")
+            return
+        
+        try:
+            summary = archive_participants(study_id, before, condition_index)
+        except RuntimeError as e:
+            print(f"❌ {e}. Nothing was deleted.")
+            return
+        
+        print(f"💾 Archived {summary['participants']} participants, {summary['messages']} messages, "
+              f"{summary['task_state_events']} task state events and "
+              f"{summary['content_filter_events']} content filter events to {summary['archive']}")
+        print(f"✅ Removed {summary['deleted_messages']} messages from the live database. "
+              f"Run 'python db_utils.py maintain --vacuum' to shrink the file.")
+
+
+def maintain_database(vacuum=None):
+    """Run routine maintenance (ANALYZE, search index merge, VACUUM) and show the size change."""
+    app = create_app()
+    with app.app_context():
+        before = collect_size_stats()
+        db.session.commit()
+        for step in maintain(vacuum):
+            print(f"🔧 {step}")
+        print_size_report(collect_size_stats(), before=before)
+
+
+def take_snapshot(output=None, pages_per_step=256, pause_ms=5.0):
+    """Take a consistent read-only snapshot of the live database for analysis (see app.snapshot)."""
+    app = create_app()
+    with app.app_context():
+        try:
+            manifest = create_snapshot(output, pages_per_step, pause_ms / 1000)
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            return
+        
+        rows = manifest['rows']
+        print(f"💾 Snapshot {manifest['snapshot']}: {_format_bytes(manifest['size_bytes'])}, "
+              f"{rows.get('participants', 0)} participants, {rows.get('messages', 0)} messages")
+        print(f"   {manifest['method']}, {manifest['restarts']} restarts, {manifest['duration_seconds']}s")
+        print(f"   sha256 {manifest['sha256']}")
+        print(f"✅ Use it with --from-snapshot {manifest['snapshot']} (or --from-snapshot latest)")
+
+
+def print_snapshots():
+    """List complete snapshots, newest first."""
+    snapshots = list_snapshots()
+    if not snapshots:
+        print("No snapshots yet. Take one with 'python db_utils.py snapshot'.")
+        return
+    
+    print("\n" + "="*80)
+    print("SNAPSHOTS")
+    print("="*80)
+    print(f"{'Snapshot':<32} {'Created (UTC)':<21} {'Size':>10} {'Participants':>13} {'Messages':>10}")
+    print("-"*80)
+    for manifest in snapshots:
+        print(f"{manifest['snapshot']:<32} {manifest['created_at'][:19]:<21} "
+              f"{_format_bytes(manifest['size_bytes']):>10} {manifest['rows'].get('participants', 0):>13} "
+              f"{manifest['rows'].get('messages', 0):>10}")
+    print("="*80 + "\n")
+
+
+def list_studies_report():
+    """List configured studies with their conditions file, quotas and participant counts."""
+    from app.studies import list_studies, get_quotas
+    
+    app = create_app()
+    with app.app_context():
+        counts = dict(
+            db.session.query(Participant.study_id, db.func.count(Participant.participant_id))
+            .group_by(Participant.study_id).all()
+        )
+        configured = list_studies()
+        
+        print("\n" + "="*80)
+        print("STUDIES")
+        print("="*80)
+        print(f"{'Study':<20} {'Participants':<14} {'Quotas':<25} {'Conditions file'}")
+        print("-"*80)
+        for study_id in list(configured) + sorted(set(counts) - set(configured)):
+            config_file = configured.get(study_id)
+            if config_file:
+                quotas = ', '.join(f"{name}={value}" for name, value in get_quotas(study_id).items()) or '-'
+            else:
+                quotas, config_file = '-', '(no conditions file)'
+            print(f"{study_id:<20} {counts.get(study_id, 0):<14} {quotas:<25} {config_file}")
+        print("="*80 + "\n")
+
+
+def costs_report(study_id='default', days=14, top=10, rebuild=False):
+    """Print a study's model spend by condition, by day and for its costliest participants."""
+    app = create_app()
+    with app.app_context():
+        if rebuild:
+            entries = rebuild_rollups(study_id)
+            print(f"🔧 Rebuilt cost rollups of study {study_id} from {entries} ledger entries")
+        summary = spend_summary(study_id, days, top)
+        
+        def line(label, entry):
+            return (f"{label:<24} {entry['turns']:>8} {entry['prompt_tokens']:>14,} "
+                    f"{entry['completion_tokens']:>14,} {entry['cost']:>12.4f}")
+        header = f"{'':<24} {'Turns':>8} {'Prompt tokens':>14} {'Compl. tokens':>14} {'Cost':>12}"
+        
+        print("\n" + "="*76)
+        print(f"MODEL SPEND - STUDY {study_id}")
+        print("="*76)
+        print(header)
+        print("-"*76)
+        print(line('Total', summary['total']))
+        
+        print("\nBy condition:")
+        for condition_index, entry in summary['conditions'].items():
+            print(line(f"  Condition {condition_index}", entry))
+        
+        print(f"\nLast {days} days (UTC):")
+        for day, entry in summary['daily'].items():
+            print(line(f"  {day}", entry))
+        
+        print(f"\nTop {top} participants:")
+        for entry in summary['top_participants']:
+            print(line(f"  {entry['participant_id'][:22]}", entry))
+        print("="*76 + "\n")
+
+
+def collect_size_stats():
+    """
+    Measure how much space conversation and prompt text takes.
+    
+    Must be called inside an application context.
+    
+    Returns:
+        Dictionary of sizes in bytes and row counts
+    """
+    stats = {
+        'participants': Participant.query.count(),
+        'messages': Message.query.count(),
+        'message_bytes': db.session.query(db.func.coalesce(db.func.sum(db.func.length(Message.content)), 0)).scalar(),
+        'system_messages': Message.query.filter_by(role='system').count(),
+        'system_message_bytes': db.session.query(
+            db.func.coalesce(db.func.sum(db.func.length(Message.content)), 0)
+        ).filter(Message.role == 'system').scalar(),
+        'prompts': Prompt.query.count(),
+        'prompt_bytes_stored': db.session.query(
+            db.func.coalesce(db.func.sum(
+                db.func.length(Prompt.content) + db.func.coalesce(db.func.length(Prompt.content_blob), 0)
+            ), 0)
+        ).scalar(),
+        'prompt_bytes_uncompressed': db.session.query(
+            db.func.coalesce(db.func.sum(Prompt.size_bytes), 0)
+        ).scalar(),
+        'database_bytes': None,
+        'free_bytes': None,
+    }
+    
+    if db.engine.dialect.name == 'sqlite':
+        page_size = db.session.execute(db.text('PRAGMA page_size')).scalar()
+        stats['database_bytes'] = db.session.execute(db.text('PRAGMA page_count')).scalar() * page_size
+        stats['free_bytes'] = db.session.execute(db.text('PRAGMA freelist_count')).scalar() * page_size
+    
+    return stats
+
+
+def _format_bytes(value):
+    """Format a byte count for display."""
+    if value is None:
+        return 'n/a'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if value < 1024 or unit == 'GB':
+            return f"{value:.1f} {unit}" if unit != 'B' else f"{value} B"
+        value /= 1024
+
+
+def print_size_report(stats, before=None):
+    """Print size statistics, optionally next to an earlier snapshot."""
+    rows = [
+        ('Database file', 'database_bytes', True),
+        ('  of which free pages', 'free_bytes', True),
+        ('Participants', 'participants', False),
+        ('Messages', 'messages', False),
+        ('Message text', 'message_bytes', True),
+        ('System messages', 'system_messages', False),
+        ('System message text', 'system_message_bytes', True),
+        ('Distinct prompts', 'prompts', False),
+        ('Prompt text (stored)', 'prompt_bytes_stored', True),
+        ('Prompt text (uncompressed)', 'prompt_bytes_uncompressed', True),
+    ]
+    
+    print("\n" + "="*70)
+    print("DATABASE SIZE REPORT")
+    print("="*70)
+    if before:
+        print(f"{'':<30} {'Before':>18} {'After':>18}")
+    for label, key, is_bytes in rows:
+        fmt = _format_bytes if is_bytes else str
+        if before:
+            print(f"{label:<30} {fmt(before[key]):>18} {fmt(stats[key]):>18}")
+        else:
+            print(f"{label:<30} {fmt(stats[key]):>18}")
+    print("="*70 + "\n")
+
+
+def size_report():
+    """Print how much space messages and prompts take in the database."""
+    app = create_app()
+    with app.app_context():
+        print_size_report(collect_size_stats())
+
+
+def migrate_prompts(batch_size=500, vacuum=False):
+    """
+    Move system text from per-participant message rows into the prompts table.
+    
+    Databases created before prompts were deduplicated store each participant's
+    full system prompt as their first message. This converts them in small
+    batches (each its own short transaction, so a live study keeps running):
+    
+    - A legacy participant's first system message becomes a reference from
+      participants.system_prompt_hash, and the message row is removed
+    - Any other system messages (e.g. task state markers) are stored once in
+      the prompts table and referenced from messages.prompt_hash
+    
+    Safe to run more than once; already converted rows are skipped.
+    
+    Args:
+        batch_size: Rows converted per transaction
+        vacuum: Run VACUUM afterwards to return freed pages to the filesystem (SQLite)
+    """
+    from app.prompts import store_prompt
+    
+    app = create_app()
+    with app.app_context():
+        before = collect_size_stats()
+        converted_participants = 0
+        converted_messages = 0
+        
+        # 1. Legacy participants: first system message -> participant reference
+        last_id = ''
+        while True:
+            participants = Participant.query.filter(
+                Participant.system_prompt_hash.is_(None),
+                Participant.participant_id > last_id
+            ).order_by(Participant.participant_id).limit(batch_size).all()
+            if not participants:
+                break
+            last_id = participants[-1].participant_id
+            
+            for participant in participants:
+                first_message = Message.query.filter_by(
+                    participant_id=participant.participant_id
+                ).order_by(Message.timestamp, Message.id).first()
+                
+                if first_message is None or first_message.role != 'system' or first_message.prompt_hash:
+                    continue
+                
+                participant.system_prompt_hash = store_prompt(first_message.content)
+                db.session.delete(first_message)
+                converted_participants += 1
+            
+            db.session.commit()
+        
+        # 2. Remaining system messages -> deduplicated references
+        last_message_id = 0
+        while True:
+            messages = Message.query.filter(
+                Message.role == 'system',
+                Message.prompt_hash.is_(None),
+                Message.id > last_message_id
+            ).order_by(Message.id).limit(batch_size).all()
+            if not messages:
+                break
+            last_message_id = messages[-1].id
+            
+            for message in messages:
+                message.prompt_hash = store_prompt(message.content)
+                message.content = ''
+                converted_messages += 1
+            
+            db.session.commit()
+        
+        print(f"✅ Converted {converted_participants} participant system prompts "
+              f"and {converted_messages} other system messages.")
+        
+        if vacuum and db.engine.dialect.name == 'sqlite':
+            print("Running VACUUM...")
+            db.session.commit()
+            with db.engine.connect() as connection:
+                connection.execution_options(isolation_level='AUTOCOMMIT').execute(db.text('VACUUM'))
+        
+        print_size_report(collect_size_stats(), before=before)
+
+
+def migrate_task_state(batch_size=500):
+    """
+    Convert legacy 'TASK_STATE: ...' system messages into task state events.
+    
+    Older versions logged task state changes as system messages, which were
+    then part of every conversation sent to the model. Each marker becomes a
+    TaskStateEvent with the marker's timestamp, the participant's task_active
+    column is set from their latest marker, and the message row is removed.
+    
+    Safe to run more than once.
+    
+    Args:
+        batch_size: Messages examined per transaction
+    """
+    app = create_app()
+    with app.app_context():
+        converted = 0
+        last_message_id = 0
+        
+        while True:
+            messages = Message.query.filter(
+                Message.role == 'system',
+                Message.id > last_message_id
+            ).order_by(Message.id).limit(batch_size).all()
+            if not messages:
+                break
+            last_message_id = messages[-1].id
+            
+            for message in messages:
+                text = message.text
+                if not text.startswith('TASK_STATE:'):
+                    continue
+                
+                task_active = not text.startswith('TASK_STATE: inactive')
+                event = TaskStateEvent.for_state(message.participant_id, task_active, source='legacy_marker')
+                event.timestamp = message.timestamp
+                db.session.add(event)
+                
+                participant = Participant.query.get(message.participant_id)
+                if participant is not None:
+                    participant.task_active = task_active
+                
+                db.session.delete(message)
+                converted += 1
+            
+            db.session.commit()
+        
+        print(f"✅ Converted {converted} task state markers into task state events.")
+
+
 def main():
     parser = argparse.ArgumentParser(description='Database utilities for experimental chat')
     subparsers = parser.add_subparsers(dest='command', help='Command to run')
@@ -306,20 +839,59 @@ def main():
     # Export commands
     export_json = subparsers.add_parser('export-json', help='Export data to JSON')
     export_json.add_argument('--output', default='data/export_data.json', help='Output filename')
+    export_json.add_argument('--study', help='Only export this study')
     
     export_csv = subparsers.add_parser('export-csv', help='Export messages to CSV (one row per message)')
     export_csv.add_argument('--output', default='data/export_messages.csv', help='Output filename')
+    export_csv.add_argument('--study', help='Only export this study')
     
     export_convos = subparsers.add_parser('export-conversations', help='Export conversations to CSV (one row per participant)')
     export_convos.add_argument('--output', default='data/conversations.csv', help='Output filename')
+    export_convos.add_argument('--study', help='Only export this study')
     
     # View commands
-    subparsers.add_parser('stats', help='Show database statistics')
-    subparsers.add_parser('list', help='List all participants')
+    stats = subparsers.add_parser('stats', help='Show database statistics')
+    stats.add_argument('--study', help='Only count this study')
+    list_cmd = subparsers.add_parser('list', help='List all participants')
+    list_cmd.add_argument('--study', help='Only list this study')
+    studies = subparsers.add_parser('studies', help='List studies with quotas and participant counts')
+    costs = subparsers.add_parser('costs', help='Show model spend by condition, day and participant')
+    costs.add_argument('--study', default='default', help='Study to report (default: default)')
+    costs.add_argument('--days', type=int, default=14, help='Days shown in the daily breakdown (default: 14)')
+    costs.add_argument('--top', type=int, default=10, help='Costliest participants shown (default: 10)')
+    costs.add_argument('--rebuild', action='store_true', help='Recompute the totals from the cost ledger first')
     
     view = subparsers.add_parser('view', help='View a conversation')
     view.add_argument('participant_id', help='Participant ID to view')
     
+    trace = subparsers.add_parser('trace', help="Show a request's trace (the trace_id of its messages)")
+    trace.add_argument('trace_id', help='Trace ID (messages.trace_id or the X-Trace-Id response header)')
+    trace.add_argument('--file', help='Trace file (default: TRACE_FILE or data/traces/traces.jsonl)')
+    
+    # Search commands
+    search_cmd = subparsers.add_parser(
+        'search', help='Full-text search across all conversations',
+        description='Query syntax: words (all must appear), "exact phrase", OR, NOT, prefix*. '
+                    'Example: \'"language model" OR GPT NOT GPT-4\''
+    )
+    search_cmd.add_argument('query', help='Search query')
+    search_cmd.add_argument('--role', choices=['user', 'assistant', 'system'], help='Only messages with this role')
+    search_cmd.add_argument('--condition', type=int, help='Only participants in this condition')
+    search_cmd.add_argument('--study', help='Only this study')
+    search_cmd.add_argument('--participant', help='Only this participant')
+    search_cmd.add_argument('--since', type=datetime.fromisoformat, help='Only messages from this time on (UTC, e.g. 2025-03-01)')
+    search_cmd.add_argument('--until', type=datetime.fromisoformat, help='Only messages before this time (UTC)')
+    search_cmd.add_argument('--limit', type=int, default=20, help='Maximum number of results (default: 20)')
+    search_cmd.add_argument('--newest', action='store_true', help='Newest first instead of best match (faster for common words)')
+    subparsers.add_parser('search-rebuild', help='Rebuild the full-text search index (e.g. after a bulk import)')
+    
+    # Snapshot commands
+    snapshot = subparsers.add_parser('snapshot', help='Take a consistent read-only copy of the live database for analysis')
+    snapshot.add_argument('--output', help='Snapshot file (default: data/snapshots/snapshot-<time>.db)')
+    snapshot.add_argument('--pages', type=int, default=256, help='Pages copied per step (default: 256)')
+    snapshot.add_argument('--pause-ms', type=float, default=5.0, help='Pause between steps in ms (default: 5)')
+    snapshot.add_argument('--list', action='store_true', help='List existing snapshots instead')
+    
     # Delete commands
     delete = subparsers.add_parser('delete', help='Delete a participant')
     delete.add_argument('participant_id', help='Participant ID to delete')
@@ -328,24 +900,91 @@ def main():
     clear = subparsers.add_parser('clear', help='Clear all data')
     clear.add_argument('--confirm', action='store_true', help='Confirm deletion')
     
+    # Retention commands
+    archive = subparsers.add_parser('archive', help='Move finished participants into a compressed per-study archive')
+    archive.add_argument('--study', default='default', help='Study to archive from (default: default)')
+    archive.add_argument('--before', type=datetime.fromisoformat,
+                         help='Only participants inactive since before this time (UTC, e.g. 2025-03-01)')
+    archive.add_argument('--condition', type=int, help='Only participants in this condition')
+    archive.add_argument('--archive-dir', help='Directory for archives (default: ARCHIVE_DIR or data/archive)')
+    archive.add_argument('--confirm', action='store_true', help='Confirm archiving')
+    
+    maintain_cmd = subparsers.add_parser('maintain', help='Refresh statistics, merge the search index, reclaim free space')
+    vacuum_choice = maintain_cmd.add_mutually_exclusive_group()
+    vacuum_choice.add_argument('--vacuum', dest='vacuum', action='store_true',
+                               help='Always VACUUM (default: only when much of the file is free)')
+    vacuum_choice.add_argument('--no-vacuum', dest='vacuum', action='store_false', help='Never VACUUM')
+    maintain_cmd.set_defaults(vacuum=None)
+    
+    # Storage commands
+    size = subparsers.add_parser('size-report', help='Show how much space messages and prompts take')
+    
+    migrate = subparsers.add_parser('migrate-prompts', help='Deduplicate stored system prompts (older databases)')
+    migrate.add_argument('--batch-size', type=int, default=500, help='Rows converted per transaction')
+    migrate.add_argument('--vacuum', action='store_true', help='Reclaim freed space afterwards (SQLite)')
+    
+    migrate_state = subparsers.add_parser('migrate-task-state', help='Convert TASK_STATE messages into events (older databases)')
+    migrate_state.add_argument('--batch-size', type=int, default=500, help='Messages examined per transaction')
+    
+    # Read-only commands can run against a snapshot instead of the live database
+    for command in (export_json, export_csv, export_convos, stats, list_cmd, studies, costs, view, search_cmd, size):
+        command.add_argument('--from-snapshot', metavar='SNAPSHOT',
+                             help="Read from a snapshot ('latest', a name in data/snapshots, or a path)")
+    
     args = parser.parse_args()
     
+    if getattr(args, 'from_snapshot', None):
+        try:
+            os.environ['DATABASE_URL'], manifest = open_snapshot(args.from_snapshot)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        print(f"💾 Reading snapshot {manifest['snapshot']} taken {manifest['created_at'][:19]} UTC (checksum verified)")
+    
     if args.command == 'export-json':
-        export_to_json(args.output)
+        export_to_json(args.output, args.study)
     elif args.command == 'export-csv':
-        export_to_csv(args.output)
+        export_to_csv(args.output, args.study)
     elif args.command == 'export-conversations':
-        export_conversations_csv(args.output)
+        export_conversations_csv(args.output, args.study)
     elif args.command == 'stats':
-        get_statistics()
+        get_statistics(args.study)
     elif args.command == 'list':
-        list_participants()
+        list_participants(args.study)
+    elif args.command == 'studies':
+        list_studies_report()
+    elif args.command == 'costs':
+        costs_report(args.study, args.days, args.top, args.rebuild)
     elif args.command == 'view':
         view_conversation(args.participant_id)
+    elif args.command == 'trace':
+        view_trace(args.trace_id, args.file)
+    elif args.command == 'search':
+        search(args.query, args.role, args.condition, args.study, args.participant,
+               args.since, args.until, args.limit, args.newest)
+    elif args.command == 'search-rebuild':
+        rebuild_search()
+    elif args.command == 'snapshot':
+        if args.list:
+            print_snapshots()
+        else:
+            take_snapshot(args.output, args.pages, args.pause_ms)
     elif args.command == 'delete':
         delete_participant(args.participant_id, args.confirm)
     elif args.command == 'clear':
         clear_all_data(args.confirm)
+    elif args.command == 'archive':
+        if args.archive_dir:
+            os.environ['ARCHIVE_DIR'] = args.archive_dir
+        archive_study(args.study, args.before, args.condition, args.confirm)
+    elif args.command == 'maintain':
+        maintain_database(args.vacuum)
+    elif args.command == 'size-report':
+        size_report()
+    elif args.command == 'migrate-prompts':
+        migrate_prompts(args.batch_size, args.vacuum)
+    elif args.command == 'migrate-task-state':
+        migrate_task_state(args.batch_size)
     else:
         parser.print_help()
 
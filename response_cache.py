@@ -0,0 +1,272 @@
+"""
+Content-addressed on-disk cache of model responses for development and pilot runs.
+
+When iterating on experimental_conditions.json with bot.py, identical
+requests (same deployment, temperature, token limit and messages) can be
+answered from disk instead of paying for another API call:
+
+    record  - serve cached responses, call the API on a miss and store the result
+    replay  - serve cached responses only; a miss fails instead of calling the API
+              (fully offline and deterministic)
+
+The cache is strictly a development tool. The Flask app refuses to start
+while RESPONSE_CACHE_MODE is set, and no cache can be created in a process
+that has created the app, so live participants always get fresh responses.
+
+Configuration (environment variables, or the equivalent bot.py flags):
+    RESPONSE_CACHE_MODE         off | record | replay (default: off)
+    RESPONSE_CACHE_DIR          Cache directory (default: data/response_cache)
+    RESPONSE_CACHE_MAX_MB       Size cap; least recently used entries are evicted (default: 500)
+    RESPONSE_CACHE_REPLAY_CPS   Streaming replay speed in characters/second (default: 0 = instant)
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import typing
+from datetime import datetime
+
+CACHE_MODES = ('off', 'record', 'replay')
+DEFAULT_CACHE_DIR = 'data/response_cache'
+DEFAULT_MAX_MB = 500
+REPLAY_CHUNK_SIZE = 12           # Characters per replayed streaming chunk
+
+# Set by create_app() - once the participant-facing app exists in this
+# process, no response cache may be created
+_live_server = False
+
+
+def forbid_in_live_server() -> None:
+    """
+    Permanently disable response caching in this process.
+
+    Called by the Flask application factory so that cached (and possibly
+    stale or shared) responses can never be served to live participants.
+
+    Raises:
+        RuntimeError: If RESPONSE_CACHE_MODE enables the cache
+    """
+    global _live_server
+    _live_server = True
+
+    mode = os.environ.get('RESPONSE_CACHE_MODE', 'off').strip().lower() or 'off'
+    if mode != 'off':
+        raise RuntimeError(
+            f"RESPONSE_CACHE_MODE={mode} is set, but the response cache is only for bot.py development "
+            f"and pilot runs. Unset it (or set it to 'off') before starting the web app."
+        )
+
+
+class ResponseCache:
+    """
+    Content-addressed response store with an LRU size cap.
+
+    Entries are JSON files named by the SHA-256 of the normalized request.
+    Reads refresh the file's modification time, which is used as the LRU
+    order when the cache grows beyond max_bytes. Safe to share between
+    threads (e.g. bot.run_batch workers).
+    """
+
+    def __init__(
+            self,
+            directory: str = DEFAULT_CACHE_DIR,
+            mode: str = 'record',
+            max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024,
+            replay_chars_per_second: float = 0.0
+        ):
+        """
+        Args:
+            directory: Directory holding cache entries (created if missing)
+            mode: 'record' or 'replay'
+            max_bytes: Total size cap before least recently used entries are evicted
+            replay_chars_per_second: Streaming replay speed (0 = as fast as possible)
+
+        Raises:
+            RuntimeError: If called in a process running the participant-facing app
+            ValueError: If mode is not 'record' or 'replay'
+        """
+        if _live_server:
+            raise RuntimeError("Response caching cannot be used in the participant-facing web app.")
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Invalid response cache mode '{mode}'. Use 'record' or 'replay'.")
+
+        self.directory = directory
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.replay_chars_per_second = replay_chars_per_second
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Index of entry sizes, used to enforce the size cap without rescanning
+        self._sizes: typing.Dict[str, int] = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    self._sizes[path] = os.path.getsize(path)
+
+    @classmethod
+    def from_env(cls, mode: typing.Optional[str] = None) -> typing.Optional['ResponseCache']:
+        """
+        Create a cache from RESPONSE_CACHE_* environment variables.
+
+        Args:
+            mode: Overrides RESPONSE_CACHE_MODE if given
+
+        Returns:
+            ResponseCache instance, or None if caching is off
+        """
+        mode = (mode or os.environ.get('RESPONSE_CACHE_MODE', 'off')).strip().lower() or 'off'
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Invalid RESPONSE_CACHE_MODE '{mode}'. Use one of: {', '.join(CACHE_MODES)}")
+        if mode == 'off':
+            return None
+
+        return cls(
+            directory=os.environ.get('RESPONSE_CACHE_DIR', DEFAULT_CACHE_DIR),
+            mode=mode,
+            max_bytes=int(float(os.environ.get('RESPONSE_CACHE_MAX_MB', DEFAULT_MAX_MB)) * 1024 * 1024),
+            replay_chars_per_second=float(os.environ.get('RESPONSE_CACHE_REPLAY_CPS', 0)),
+        )
+
+    @staticmethod
+    def normalize_request(
+            deployment: str,
+            temperature: float,
+            max_completion_tokens: int,
+            conversation: typing.List[typing.Dict[str, str]],
+            reasoning_effort: typing.Optional[str] = None
+        ) -> typing.Dict[str, typing.Any]:
+        """
+        Build the canonical form of a request used for hashing.
+
+        Only role and content of each message are kept, and numbers are
+        normalized so that e.g. temperature 1 and 1.0 hash identically.
+        reasoning_effort is only included when set, so existing entries
+        keep their keys.
+        """
+        request = {
+            'deployment': deployment,
+            'temperature': float(temperature),
+            'max_completion_tokens': int(max_completion_tokens),
+            'messages': [{'role': m['role'], 'content': m['content']} for m in conversation],
+        }
+        if reasoning_effort:
+            request['reasoning_effort'] = reasoning_effort
+        return request
+
+    def make_key(
+            self,
+            deployment: str,
+            temperature: float,
+            max_completion_tokens: int,
+            conversation: typing.List[typing.Dict[str, str]],
+            reasoning_effort: typing.Optional[str] = None
+        ) -> str:
+        """Return the content address (SHA-256 hex digest) of a request."""
+        canonical = json.dumps(
+            self.normalize_request(deployment, temperature, max_completion_tokens, conversation, reasoning_effort),
+            sort_keys=True, separators=(',', ':'), ensure_ascii=False
+        )
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> typing.Optional[str]:
+        """
+        Look up a cached response.
+
+        Args:
+            key: Key from make_key()
+
+        Returns:
+            Cached response text, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return entry['response']
+
+    def put(self, key: str, response: str, request: typing.Optional[typing.Dict[str, typing.Any]] = None) -> None:
+        """
+        Store a response, evicting least recently used entries if over the size cap.
+
+        Args:
+            key: Key from make_key()
+            response: Response text to store
+            request: Normalized request, stored alongside for inspection
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        entry = {
+            'key': key,
+            'created_at': datetime.utcnow().isoformat(),
+            'request': request,
+            'response': response,
+        }
+
+        # Write atomically so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._sizes[path] = os.path.getsize(path)
+            self._evict()
+
+    def _evict(self) -> None:
+        """Remove least recently used entries until under the size cap (lock held)."""
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        by_last_use = sorted(
+            self._sizes,
+            key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0
+        )
+        for path in by_last_use:
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes.pop(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def replay_stream(self, text: str) -> typing.Generator[str, None, None]:
+        """
+        Re-emit cached text as streaming chunks.
+
+        Args:
+            text: Cached response text
+
+        Yields:
+            Chunks of REPLAY_CHUNK_SIZE characters, paced at replay_chars_per_second
+        """
+        delay = REPLAY_CHUNK_SIZE / self.replay_chars_per_second if self.replay_chars_per_second > 0 else 0
+        for i in range(0, len(text), REPLAY_CHUNK_SIZE):
+            if delay and i:
+                time.sleep(delay)
+            yield text[i:i + REPLAY_CHUNK_SIZE]
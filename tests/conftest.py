@@ -0,0 +1,78 @@
+"""
+Shared fixtures: each test gets a fresh app in a throwaway working directory.
+
+The environment is the one benchmark.py uses (temporary SQLite database,
+dummy model credentials, the example conditions file with raised rate
+limits); the model itself is replaced with benchmark.stubbed_model().
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_DIR not in sys.path:
+    sys.path.insert(0, PROJECT_DIR)
+
+from benchmark import benchmark_environment, stubbed_model  # noqa: E402
+
+
+def _reset_worker_state():
+    """Forget what a previous test's app left in module-level caches."""
+    import bot
+    import tracing
+    from app import costs, pages, prompts, state, warm_start
+
+    bot._load_conditions_file.cache_clear()
+    state.get_state.cache_clear()
+    prompts._stored_prompt_hashes.clear()
+    prompts._load_prompt_content.cache_clear()
+    pages._shells.clear()
+    costs._warned.clear()
+    warm_start._last_primed.clear()
+    tracing.get_exporter.cache_clear()
+
+
+@pytest.fixture
+def workdir():
+    """Fresh working directory holding the example conditions file (also the current directory)."""
+    with benchmark_environment() as path:
+        _reset_worker_state()
+        yield path
+        _reset_worker_state()
+
+
+@pytest.fixture
+def make_app(workdir):
+    """
+    Factory for an app in a fresh working directory.
+
+    Call it with a function taking the parsed conditions file to change the
+    conditions before the app starts.
+    """
+    def make(edit_conditions=None):
+        if edit_conditions is not None:
+            path = os.path.join(workdir, 'experimental_conditions.json')
+            with open(path, encoding='utf-8') as f:
+                conditions = json.load(f)
+            edit_conditions(conditions)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(conditions, f)
+            _reset_worker_state()
+        from app import create_app
+        return create_app()
+
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    with stubbed_model():
+        yield app.test_client()
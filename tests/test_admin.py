@@ -0,0 +1,55 @@
+"""Admin dashboard authentication (app.admin)."""
+
+import pytest
+
+from app.admin import STREAM_TOKEN_TTL_SECONDS, check_stream_token, issue_stream_token
+
+ADMIN_TOKEN = 'admin-secret'
+BEARER = {'Authorization': f'Bearer {ADMIN_TOKEN}'}
+
+
+@pytest.fixture
+def admin(monkeypatch, app):
+    monkeypatch.setenv('ADMIN_TOKEN', ADMIN_TOKEN)
+    return app.test_client()
+
+
+def test_dashboard_disabled_without_admin_token(monkeypatch, app):
+    monkeypatch.delenv('ADMIN_TOKEN', raising=False)
+    client = app.test_client()
+    assert client.get('/admin').status_code == 404
+    assert client.get('/admin/api/metrics', headers=BEARER).status_code == 404
+
+
+def test_api_takes_the_token_as_bearer_header_only(admin):
+    assert admin.get('/admin/api/metrics', headers=BEARER).status_code == 200
+    assert admin.get(f'/admin/api/metrics?token={ADMIN_TOKEN}').status_code == 403
+    assert admin.get('/admin/api/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+
+def test_dashboard_page_holds_no_token(admin):
+    page = admin.get('/admin').get_data(as_text=True)
+    assert ADMIN_TOKEN not in page
+
+
+def test_stream_takes_a_stream_token_not_the_admin_token(admin):
+    assert admin.post('/admin/api/stream-token').status_code == 403
+    grant = admin.post('/admin/api/stream-token', headers=BEARER).get_json()
+    assert grant['expires_in'] == STREAM_TOKEN_TTL_SECONDS
+    assert 'default' in grant['studies']
+
+    stream = admin.get(f"/admin/api/metrics/stream?stream_token={grant['stream_token']}")
+    assert stream.status_code == 200
+    stream.close()
+    assert admin.get(f'/admin/api/metrics/stream?stream_token={ADMIN_TOKEN}').status_code == 403
+    assert admin.get(f'/admin/api/metrics/stream?token={ADMIN_TOKEN}').status_code == 403
+
+
+def test_stream_tokens_expire_and_are_bound_to_the_admin_token():
+    token = issue_stream_token(ADMIN_TOKEN, now=1000)
+    assert check_stream_token(ADMIN_TOKEN, token, now=1000 + STREAM_TOKEN_TTL_SECONDS)
+    assert not check_stream_token(ADMIN_TOKEN, token, now=1001 + STREAM_TOKEN_TTL_SECONDS)
+    assert not check_stream_token('rotated-secret', token, now=1000)
+    expires, _, signature = token.partition('.')
+    assert not check_stream_token(ADMIN_TOKEN, f"{int(expires) + 3600}.{signature}", now=1000)
+    assert not check_stream_token(ADMIN_TOKEN, 'garbage', now=1000)
@@ -0,0 +1,73 @@
+"""Archiving finished participants (app.archive)."""
+
+import gzip
+import os
+import shutil
+import sqlite3
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app import archive, db
+from app.models import Message, Participant
+from benchmark import seed_participant
+
+LONG_AGO = datetime.utcnow() - timedelta(days=30)
+
+
+def seed_finished(app, client, count=3, history_length=3):
+    """Participants P0..Pn, with history_length - 1 messages each, last active a month ago."""
+    for i in range(count):
+        seed_participant(app, client, f'P{i}', history_length)
+    with app.app_context():
+        Participant.query.update({'created_at': LONG_AGO})
+        Message.query.update({'timestamp': LONG_AGO})
+        db.session.commit()
+
+
+def archived_messages(study_id='default'):
+    """Participant IDs and contents of the messages in a study's archive."""
+    unpacked = archive.archive_path(study_id) + '.test'
+    with gzip.open(archive.archive_path(study_id), 'rb') as source, open(unpacked, 'wb') as target:
+        shutil.copyfileobj(source, target)
+    try:
+        with sqlite3.connect(unpacked) as connection:
+            return connection.execute('SELECT participant_id, content FROM messages').fetchall()
+    finally:
+        os.remove(unpacked)
+
+
+def test_archive_moves_finished_participants(app, client):
+    seed_finished(app, client)
+    seed_participant(app, client, 'active', 3)
+
+    with app.app_context():
+        summary = archive.archive_participants('default', before=datetime.utcnow() - timedelta(days=1))
+        assert summary['participants'] == 3
+        assert summary['deleted_messages'] == summary['messages'] == 6
+        assert [p.participant_id for p in Participant.query] == ['active']
+        assert Message.query.filter(Message.participant_id != 'active').count() == 0
+    assert len(archived_messages()) == 6
+
+
+def test_rows_written_after_the_copy_are_kept(app, client):
+    seed_finished(app, client)
+    copy_to_archive = archive.copy_to_archive
+
+    def copy_then_write(study_id, participant_ids):
+        copied = copy_to_archive(study_id, participant_ids)
+        # P1 comes back between the copy and the delete
+        with db.engine.begin() as connection:
+            connection.execute(db.insert(Message.__table__).values(
+                participant_id='P1', role='user', content='Back again', timestamp=datetime.utcnow()))
+        return copied
+
+    with app.app_context(), mock.patch('app.archive.copy_to_archive', copy_then_write):
+        summary = archive.archive_participants('default', before=datetime.utcnow() - timedelta(days=1))
+        assert summary['deleted_messages'] == 4
+        assert [p.participant_id for p in Participant.query] == ['P1']
+        assert [m.content for m in Message.query.order_by(Message.id)][-1] == 'Back again'
+        assert Message.query.count() == 3
+
+    # Everything deleted is in the archive; the new message is not (yet)
+    assert len(archived_messages()) == 6
+    assert ('P1', 'Back again') not in archived_messages()
@@ -0,0 +1,65 @@
+"""Fingerprinted, pre-compressed static assets and compressed pages (app.assets)."""
+
+import gzip
+import os
+import re
+
+from app.assets import IMMUTABLE_CACHE_CONTROL, STATIC_DIR, asset_url, fingerprinted_path
+from benchmark import seed_participant
+
+
+def test_asset_urls(app):
+    assert fingerprinted_path('css/chat.css', 'abcdef0123456789') == 'css/chat.abcdef012345.css'
+    url = asset_url('js/chat.js')
+    assert re.fullmatch(r'/static/js/chat\.[0-9a-f]{12}\.js', url)
+    assert asset_url('/static/js/chat.js') == url
+    assert asset_url('images/missing.png') == '/static/images/missing.png'
+    assert asset_url('https://example.org/icon.png') == 'https://example.org/icon.png'
+
+
+def test_fingerprinted_assets_are_compressed_and_immutable(app):
+    client = app.test_client()
+    url = asset_url('js/chat.js')
+    with open(os.path.join(STATIC_DIR, 'js', 'chat.js'), 'rb') as f:
+        content = f.read()
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == content
+
+    plain = client.get(url)
+    assert 'Content-Encoding' not in plain.headers and plain.data == content
+
+
+def test_plain_static_urls_are_revalidated(app):
+    client = app.test_client()
+    response = client.get('/static/images/heart.png')
+    assert response.status_code == 200 and response.headers['Cache-Control'] == 'no-cache'
+    assert 'Content-Encoding' not in response.headers
+    etag = response.headers['ETag']
+    assert client.get('/static/images/heart.png', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/static/images/missing.png').status_code == 404
+
+
+def test_pages_are_gzipped_and_validated(app):
+    client = app.test_client()
+    page = client.get('/gui?participant_id=P001&condition=0', headers={'Accept-Encoding': 'gzip'})
+    assert page.headers['Content-Encoding'] == 'gzip'
+    assert page.headers['Cache-Control'] == 'private, no-cache'
+    assert asset_url('js/chat.js') in gzip.decompress(page.data).decode('utf-8')
+
+    again = client.get('/gui?participant_id=P001&condition=0',
+                       headers={'Accept-Encoding': 'gzip', 'If-None-Match': page.headers['ETag']})
+    assert again.status_code == 304 and again.data == b''
+
+
+def test_small_and_streamed_responses_are_not_compressed(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    body = {'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hello'}
+    small = client.post('/api/send_message', json=body, headers={'Accept-Encoding': 'gzip'})
+    assert small.status_code == 200 and 'Content-Encoding' not in small.headers
+    streamed = client.post('/api/send_message_stream', json=body, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in streamed.headers
+    assert streamed.get_data(as_text=True).endswith('data: [DONE]\n\n')
@@ -0,0 +1,99 @@
+"""Batch simulation of synthetic participants (bot.run_batch)."""
+
+import json
+from unittest import mock
+
+import pytest
+
+import bot
+
+SCRIPTS = [
+    {'participant_id': 'sim-1', 'condition_index': 0, 'turns': ['Hi', 'Thanks']},
+    {'participant_id': 'sim-2', 'condition_index': 1, 'turns': ['Hello']},
+    {'participant_id': 'sim-3', 'turns': ['Hey']},
+]
+
+
+@pytest.fixture
+def scripts_file(workdir):
+    path = f"{workdir}/scripts.jsonl"
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(script) + '\n' for script in SCRIPTS))
+    return path
+
+
+def fake_model(fail_for=()):
+    """Stand-in for bot.get_chat_response that fails for some participants' conversations."""
+    def get_chat_response(client, conversation, **kwargs):
+        last = conversation[-1]['content']
+        return None if last in fail_for else f"Reply to {last}"
+    return mock.patch('bot.get_chat_response', side_effect=get_chat_response)
+
+
+@pytest.fixture(autouse=True)
+def no_client():
+    with mock.patch('bot.create_client', return_value=object()):
+        yield
+
+
+def test_batch_writes_the_export_schema(workdir, scripts_file):
+    with fake_model() as model:
+        export = bot.run_batch(scripts_file, output_file=f"{workdir}/out.json", workers=2, random_seed=1)
+
+    assert model.call_count == 4
+    with open(f"{workdir}/out.json", encoding='utf-8') as f:
+        assert json.load(f)['participants'] == export['participants']
+    first = export['participants'][0]
+    assert [p['participant_id'] for p in export['participants']] == ['sim-1', 'sim-2', 'sim-3']
+    assert [(m['role'], m['content']) for m in first['conversation']][1:] == [
+        ('user', 'Hi'), ('assistant', 'Reply to Hi'), ('user', 'Thanks'), ('assistant', 'Reply to Thanks')
+    ]
+    assert first['total_messages'] == 5 and first['user_messages'] == 2
+    assert export['participants'][1]['condition_index'] == 1
+
+
+def test_resumed_batch_only_runs_unfinished_participants(workdir, scripts_file):
+    output = f"{workdir}/out.json"
+    with fake_model(fail_for={'Hello'}):
+        export = bot.run_batch(scripts_file, output_file=output, random_seed=1)
+    assert [p['participant_id'] for p in export['participants']] == ['sim-1', 'sim-3']
+
+    # An interrupted write leaves a partial last line, which is ignored
+    with open(f"{output}.checkpoint.jsonl", 'a', encoding='utf-8') as f:
+        f.write('{"participant_id": "sim-2", "conv')
+
+    with fake_model() as model:
+        export = bot.run_batch(scripts_file, output_file=output, random_seed=1)
+    assert model.call_count == 1   # sim-2's only turn
+    assert [p['participant_id'] for p in export['participants']] == ['sim-1', 'sim-2', 'sim-3']
+    assert export['participants'][1]['conversation'][-1]['content'] == 'Reply to Hello'
+
+    # The record written after the partial line is read back
+    with fake_model() as model:
+        export = bot.run_batch(scripts_file, output_file=output, random_seed=1)
+    assert model.call_count == 0
+    assert len(export['participants']) == 3
+
+
+def test_unassigned_conditions_are_stable_for_a_seed(workdir, scripts_file):
+    def assigned(run):
+        with fake_model():
+            export = bot.run_batch(scripts_file, output_file=f"{workdir}/{run}.json", random_seed=7)
+        return export['participants'][2]['condition_index']
+
+    first = assigned('a')
+    assert first == assigned('b')
+    assert bot._load_conditions_file('experimental_conditions.json')['conditions'][first].get('enabled', True)
+
+
+@pytest.mark.parametrize('line, error', [
+    ('{"turns": ["Hi"]}', 'participant_id is required'),
+    ('{"participant_id": "sim-1"}', "either 'turns' or 'simulator' is required"),
+    ('not json', 'invalid JSON'),
+])
+def test_invalid_scripts_are_rejected(workdir, line, error):
+    path = f"{workdir}/bad.jsonl"
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(line + '\n')
+    with pytest.raises(ValueError, match=error):
+        bot._load_participant_scripts(path)
@@ -0,0 +1,89 @@
+"""Fast-fail cache for content-filtered messages (app.content_filter)."""
+
+from unittest import mock
+
+from app import metrics
+from app.content_filter import fingerprint, normalize_message
+from app.models import ContentFilterEvent
+from benchmark import seed_participant, stub_get_chat_response
+
+SYSTEM = {'role': 'system', 'content': 'You are a helpful assistant.'}
+
+
+def test_normalize_message():
+    assert normalize_message('  How do I   pick a LOCK?!  ') == 'how do i pick a lock'
+    assert normalize_message('"quoted"') == 'quoted'
+    assert normalize_message("don't") == "don't"
+
+
+def test_fingerprint_ignores_resends_but_not_context_or_deployment():
+    first = fingerprint([SYSTEM, {'role': 'user', 'content': 'Pick a lock'}], 'gpt')
+    resend = fingerprint([SYSTEM, {'role': 'user', 'content': 'Pick a lock'},
+                          {'role': 'user', 'content': 'pick a LOCK!'}], 'gpt')
+    assert resend == first
+
+    later = fingerprint([SYSTEM, {'role': 'user', 'content': 'Hi'}, {'role': 'assistant', 'content': 'Hello'},
+                         {'role': 'user', 'content': 'Pick a lock'}], 'gpt')
+    assert later.message == first.message and later.context != first.context
+    assert fingerprint([SYSTEM, {'role': 'user', 'content': 'Pick a lock'}], 'other').context != first.context
+    assert fingerprint([SYSTEM, {'role': 'user', 'content': 'Pick a door'}], 'gpt').message != first.message
+
+
+def filtered(stage):
+    def get_chat_response(client, conversation, response_info=None, **kwargs):
+        response_info['content_filter'] = {'stage': stage, 'categories': ['violence']}
+        return None
+    return mock.Mock(side_effect=get_chat_response)
+
+
+def send(client, participant_id, token, message):
+    return client.post('/api/send_message', json={
+        'participant_id': participant_id, 'session_token': token, 'condition_index': 0, 'message': message})
+
+
+def test_rejected_message_fails_fast_for_the_participant_and_identical_requests(app, client):
+    first_token = seed_participant(app, client, 'P001', 1)
+    second_token = seed_participant(app, client, 'P002', 1)
+    model = filtered('prompt')
+    with mock.patch('app.routes.get_chat_response', model):
+        refused = send(client, 'P001', first_token, 'Pick a lock')
+        assert refused.status_code == 422 and refused.get_json()['code'] == 'content_filtered'
+        assert send(client, 'P001', first_token, 'pick a LOCK!').status_code == 422   # Participant cache
+        assert send(client, 'P002', second_token, 'Pick a lock').status_code == 422   # Global cache
+    assert model.call_count == 1
+
+    with mock.patch('app.routes.get_chat_response', stub_get_chat_response):
+        assert send(client, 'P002', second_token, 'Something else').status_code == 200
+
+    with app.app_context():
+        assert [(e.participant_id, e.event_type, e.detail) for e in ContentFilterEvent.query.order_by('id')] == [
+            ('P001', ContentFilterEvent.PROMPT_FILTERED, 'violence'),
+            ('P001', ContentFilterEvent.FAST_FAILED, 'participant'),
+            ('P002', ContentFilterEvent.FAST_FAILED, 'global'),
+        ]
+        totals = metrics.summarize()['totals']
+        assert (totals['content_filtered'], totals['content_filter_hits']) == (1, 2)
+
+
+def test_stopped_completions_are_logged_but_not_cached(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    model = filtered('completion')
+    with mock.patch('app.routes.get_chat_response', model):
+        for _ in range(2):
+            assert send(client, 'P001', token, 'Tell me a story').status_code == 422
+    assert model.call_count == 2
+    with app.app_context():
+        assert ContentFilterEvent.query.filter_by(event_type=ContentFilterEvent.COMPLETION_FILTERED).count() == 2
+
+
+def test_cache_can_be_disabled(make_app):
+    def no_cache(conditions):
+        conditions['study_metadata']['content_filter'] = {'participant_ttl_seconds': 0, 'global_ttl_seconds': 0}
+    app = make_app(no_cache)
+    client = app.test_client()
+    token = seed_participant(app, client, 'P001', 1)
+    model = filtered('prompt')
+    with mock.patch('app.routes.get_chat_response', model):
+        for _ in range(2):
+            assert send(client, 'P001', token, 'Pick a lock').status_code == 422
+    assert model.call_count == 2
@@ -0,0 +1,149 @@
+"""Cost ledger, rollups and budgets (app.costs)."""
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from app import db
+from app.costs import (ESTIMATED_SOURCE, BudgetExceededError, check_budget, rebuild_rollups, record_usage,
+                       spend_summary)
+from app.models import CostEntry, CostRollup
+from benchmark import seed_participant
+
+NOW = datetime(2026, 3, 10, 12, 0)
+YESTERDAY = NOW - timedelta(days=1)
+USAGE = {'prompt_tokens': 100, 'completion_tokens': 10, 'deployment': 'gpt'}
+
+
+def condition(index=0, budgets=None):
+    return {
+        'condition_index': index,
+        'deployment': 'gpt',
+        'pricing': {'gpt': {'prompt': 1000, 'completion': 10000}},   # 0.2 per USAGE
+        'cost_budgets': budgets or {},
+    }
+
+
+def rollups():
+    return {(row.scope, row.subject, row.period): row.turns for row in CostRollup.query}
+
+
+def test_record_usage_writes_ledger_and_rollups(app):
+    with app.app_context():
+        assert record_usage(condition(1), 'default', 'P001', USAGE, now=YESTERDAY) == 200_000
+        record_usage(condition(1), 'default', 'P001', USAGE, now=NOW)
+        record_usage(condition(2), 'default', 'P002', USAGE, now=NOW)
+        db.session.commit()
+
+        assert CostEntry.query.count() == 3
+        assert rollups() == {
+            ('study', '', '2026-03-09'): 1, ('study', '', '2026-03-10'): 2,
+            ('condition', '1', '2026-03-09'): 1, ('condition', '1', '2026-03-10'): 1,
+            ('condition', '2', '2026-03-10'): 1,
+            ('participant', 'P001', 'total'): 2, ('participant', 'P002', 'total'): 1,
+        }
+
+        summary = spend_summary('default', now=NOW)
+        assert summary['total']['turns'] == 3
+        assert summary['total']['cost'] == pytest.approx(0.6)
+        assert {index: entry['turns'] for index, entry in summary['conditions'].items()} == {1: 2, 2: 1}
+
+
+def test_usage_already_recorded_is_skipped(app):
+    with app.app_context():
+        assert record_usage(condition(), 'default', 'P001', dict(USAGE, usage_recorded=True), now=NOW) == 0
+        assert record_usage(condition(), 'default', 'P001', {}, now=NOW) == 0
+        db.session.commit()
+        assert CostEntry.query.count() == 0
+
+
+def test_warm_start_usage_is_not_a_turn(app):
+    with app.app_context():
+        record_usage(condition(), 'default', 'P001', USAGE, source='warm_start', now=NOW)
+        db.session.commit()
+        assert rollups()[('participant', 'P001', 'total')] == 0
+        assert spend_summary('default', now=NOW)['total']['cost'] == pytest.approx(0.2)
+
+
+def test_hard_budgets_refuse_and_daily_budget_resets(app):
+    with app.app_context():
+        for _ in range(3):
+            record_usage(condition(), 'default', 'P001', USAGE, now=YESTERDAY)
+        db.session.commit()
+
+        check_budget(condition(budgets={'study_daily': {'hard': 0.5}}), 'default', 'P002', now=NOW)
+        with pytest.raises(BudgetExceededError) as refused:
+            check_budget(condition(budgets={'study_daily': {'hard': 0.5}}), 'default', 'P002', now=YESTERDAY)
+        assert refused.value.retry_after
+
+        with pytest.raises(BudgetExceededError):
+            check_budget(condition(budgets={'study': {'hard': 0.5}}), 'default', 'P002', now=NOW)
+        with pytest.raises(BudgetExceededError):
+            check_budget(condition(budgets={'condition': {'hard': 0.5}}), 'default', 'P002', now=NOW)
+        check_budget(condition(1, budgets={'condition': {'hard': 0.5}}), 'default', 'P002', now=NOW)
+        with pytest.raises(BudgetExceededError):
+            check_budget(condition(budgets={'participant': {'hard': 0.5}}), 'default', 'P001', now=NOW)
+        check_budget(condition(budgets={'participant': {'hard': 0.5}}), 'default', 'P002', now=NOW)
+
+
+def test_rebuild_matches_recorded_rollups(app):
+    with app.app_context():
+        record_usage(condition(0), 'default', 'P001', USAGE, now=YESTERDAY)
+        record_usage(condition(1), 'default', 'P002', USAGE, now=NOW)
+        record_usage(condition(1), 'default', 'P002', USAGE, source='warm_start', now=NOW)
+        db.session.commit()
+        recorded = rollups()
+
+        # Study and condition 'total' rows of older versions are ignored, then dropped
+        db.session.add(CostRollup(study_id='default', scope='study', subject='', period='total',
+                                  turns=99, prompt_tokens=0, completion_tokens=0, cost_micros=10 ** 9))
+        db.session.commit()
+        assert spend_summary('default', now=NOW)['total']['turns'] == 2
+
+        assert rebuild_rollups('default') == 3
+        assert rollups() == recorded
+
+
+def chunk(content=None, finish_reason=None, usage=None):
+    """A streamed chat completion chunk as the openai client returns it."""
+    choices = [] if content is None and finish_reason is None else [
+        SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish_reason)]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def test_filtered_stream_still_reports_usage():
+    import bot
+
+    usage = SimpleNamespace(prompt_tokens=120, completion_tokens=7, total_tokens=127)
+    chunks = [chunk('Some'), chunk(' text'), chunk(finish_reason='content_filter'), chunk(' more'), chunk(usage=usage)]
+    create = mock.Mock(return_value=(c for c in chunks))   # A generator can be closed, like the real stream
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    response_info = {}
+    text = ''.join(bot.get_chat_response_stream(client, [{'role': 'user', 'content': 'Hi'}], 'gpt',
+                                                max_retries=3, response_info=response_info))
+    assert text == 'Some text'
+    assert create.call_count == 1
+    assert response_info['content_filter']['stage'] == 'completion'
+    assert (response_info['prompt_tokens'], response_info['completion_tokens']) == (120, 7)
+
+
+def test_abandoned_stream_books_an_estimate(app, client):
+    def stream(client, conversation, response_info=None, **kwargs):
+        yield from ('Chunk one', 'chunk two', 'chunk three')   # Usage would only come at the end
+
+    token = seed_participant(app, client, 'P001', 1)
+    with mock.patch('bot.get_chat_response_stream', stream):
+        response = client.post('/api/send_message_stream', buffered=False, json={
+            'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hello'})
+        stream = iter(response.response)
+        next(stream), next(stream)   # The participant leaves after two chunks
+        response.close()
+
+    with app.app_context():
+        entry = CostEntry.query.one()
+        assert entry.source == ESTIMATED_SOURCE
+        assert entry.completion_tokens == 2
+        assert entry.prompt_tokens > 0
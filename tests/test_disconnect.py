@@ -0,0 +1,49 @@
+"""Streams abandoned by a participant who disconnects (user-036)."""
+
+from unittest import mock
+
+from app import metrics
+from app.models import Message
+from benchmark import seed_participant
+
+
+def test_disconnect_cancels_the_model_and_keeps_the_partial_response(app, client):
+    model_stream = {'closed': False, 'chunks': 0}
+
+    def stream(client, conversation, response_info=None, **kwargs):
+        try:
+            for text in ('First part.', ' Second part.', ' Never sent.'):
+                model_stream['chunks'] += 1
+                yield text
+        finally:
+            model_stream['closed'] = True   # Closing the generator closes the upstream request
+
+    token = seed_participant(app, client, 'P001', 1)
+    body = {'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hello'}
+    with mock.patch('bot.get_chat_response_stream', stream):
+        response = client.post('/api/send_message_stream', buffered=False, json=body)
+        events = iter(response.response)
+        assert next(events) == b'data: First part.\n\n'
+        next(events)
+        response.close()   # The participant closed the tab
+
+        assert model_stream == {'closed': True, 'chunks': 2}
+        with app.app_context():
+            reply = Message.query.filter_by(participant_id='P001', role='assistant').one()
+            assert (reply.content, reply.truncated) == ('First part. Second part.', True)
+            totals = metrics.summarize()['totals']
+            assert totals['abandoned_streams'] == 1 and totals['turns'] == 0
+
+        # The turn lock was released: the participant can send again
+        assert client.post('/api/send_message', json=body).status_code == 200
+
+
+def test_completed_stream_is_not_truncated(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    response = client.post('/api/send_message_stream', json={
+        'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hello'})
+    assert response.get_data(as_text=True).endswith('data: [DONE]\n\n')
+    with app.app_context():
+        reply = Message.query.filter_by(participant_id='P001', role='assistant').one()
+        assert not reply.truncated
+        assert metrics.summarize()['totals']['abandoned_streams'] == 0
@@ -0,0 +1,46 @@
+"""Data exports and statistics of db_utils.py with deduplicated system prompts."""
+
+import csv
+import json
+
+import db_utils
+from benchmark import seed_participant
+
+
+def test_json_export_entries_share_keys(app, client):
+    seed_participant(app, client, 'P001', 3)
+    data = db_utils.export_to_json('export.json')
+    conversation = data['participants'][0]['conversation']
+
+    assert conversation[0]['role'] == 'system' and conversation[0]['content']
+    assert {frozenset(entry) for entry in conversation} == {
+        frozenset({'role', 'content', 'timestamp', 'truncated', 'trace_id'})}
+    with open('export.json', encoding='utf-8') as f:
+        assert json.load(f)['participants'][0]['total_messages'] == 3
+
+
+def test_csv_export_has_the_system_prompt_first(app, client):
+    seed_participant(app, client, 'P001', 3)
+    seed_participant(app, client, 'P002', 2)
+    db_utils.export_to_csv('export.csv')
+
+    with open('export.csv', newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert [(row['participant_id'], row['role']) for row in rows] == [
+        ('P001', 'system'), ('P001', 'user'), ('P001', 'assistant'),
+        ('P002', 'system'), ('P002', 'user'),
+    ]
+    assert rows[0]['message_id'] == '' and rows[0]['content']
+    assert rows[0]['truncated'] == 'False'
+
+
+def test_stats_count_system_prompts(app, client, capsys):
+    seed_participant(app, client, 'P001', 3)
+    seed_participant(app, client, 'P002', 3)
+    capsys.readouterr()
+    db_utils.get_statistics()
+
+    output = capsys.readouterr().out
+    assert 'Total Messages: 6' in output
+    assert 'System messages: 2' in output
+    assert 'Distinct system prompts (deduplicated): 1' in output
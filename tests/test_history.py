@@ -0,0 +1,74 @@
+"""Conversation history embedded in /gui and paged through /api/get_history (user-046)."""
+
+import json
+import re
+from unittest import mock
+
+from app import db
+from app.models import Message
+from benchmark import seed_participant
+
+
+def embedded_history(client, participant_id='P001', condition=0):
+    page = client.get(f'/gui?participant_id={participant_id}&condition={condition}').get_data(as_text=True)
+    settings = json.loads(re.search(r'\.\.\.(\{.*\})\n', page).group(1))
+    return page, settings['initialHistory']
+
+
+def get_history(client, token, **page):
+    query = ''.join(f'&{name}={value}' for name, value in page.items())
+    return client.get(f'/api/get_history?participant_id=P001&session_token={token}{query}')
+
+
+def test_gui_embeds_the_history_safely(app, client):
+    seed_participant(app, client, 'P001', 3)
+    with app.app_context():
+        db.session.add(Message(participant_id='P001', role='system', content='TASK_STATE: hidden'))
+        db.session.add(Message(participant_id='P001', role='user', content='</script><script>alert(1)</script>'))
+        db.session.commit()
+
+    page, history = embedded_history(client)
+    assert [m['role'] for m in history['messages']] == ['user', 'assistant', 'user']
+    assert history['messages'][-1]['content'] == '</script><script>alert(1)</script>'
+    assert history['before'] is None
+    assert '<script>alert(1)' not in page
+
+
+def test_long_histories_embed_the_newest_messages_and_page_the_rest(app, client):
+    token = seed_participant(app, client, 'P001', 8)   # 7 messages
+    with mock.patch('app.routes.INLINE_HISTORY_MAX_MESSAGES', 3):
+        _, history = embedded_history(client)
+    newest = [m['content'] for m in history['messages']]
+    assert [c.split(':')[0] for c in newest] == ['Seeded message 4', 'Seeded message 5', 'Seeded message 6']
+
+    older = []
+    before = history['before']
+    while before:
+        data = get_history(client, token, before=before, limit=2).get_json()
+        older[:0] = [m['content'] for m in data['messages']]
+        before = data['before']
+    whole = [m['content'] for m in get_history(client, token).get_json()['messages']]
+    assert older + newest == whole and len(whole) == 7
+
+
+def test_embedded_history_is_capped_by_size(app, client):
+    seed_participant(app, client, 'P001', 4)
+    with mock.patch('app.routes.INLINE_HISTORY_MAX_CHARS', 1):
+        _, history = embedded_history(client)
+    assert len(history['messages']) == 1 and history['before'] is not None   # The newest is always shown
+
+
+def test_invalid_pages_are_refused(app, client):
+    token = seed_participant(app, client, 'P001', 2)
+    for page in ({'limit': 0}, {'before': 'x'}, {'limit': 10_000}):
+        response = get_history(client, token, **page)
+        assert response.status_code == 400 and response.get_json()['code'] == 'invalid_page'
+
+
+def test_bot_first_participants_fetch_their_opening_turn(make_app):
+    def bot_first(conditions):
+        conditions['conditions'][0]['warm_start'] = {'mode': 'bot_first', 'opening_message': 'Greet them.'}
+    app = make_app(bot_first)
+    with mock.patch('app.warm_start.maybe_start'):
+        _, history = embedded_history(app.test_client())
+    assert history is None
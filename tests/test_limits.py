@@ -0,0 +1,112 @@
+"""Per-participant rate limits (app.limits) and their use by the chat API."""
+
+import pytest
+
+from app.limits import RateLimitExceededError, _exceeded, check_turn, record_tokens, refund_turn
+from benchmark import seed_participant, stubbed_model
+
+NOW = 1_000_000.0
+
+
+def test_turns_over_the_limit_are_refused(app):
+    limits = {'turns_per_minute': 2}
+    check_turn('default', 'P001', limits, now=NOW)
+    check_turn('default', 'P001', limits, now=NOW)
+    with pytest.raises(RateLimitExceededError):
+        check_turn('default', 'P001', limits, now=NOW)
+    # Other participants have their own counters
+    check_turn('default', 'P002', limits, now=NOW)
+
+
+def test_refused_turn_is_not_counted(app):
+    limits = {'turns_per_minute': 1}
+    check_turn('default', 'P001', limits, now=NOW)
+    for _ in range(3):
+        with pytest.raises(RateLimitExceededError):
+            check_turn('default', 'P001', limits, now=NOW)
+    refund_turn(check_turn('default', 'P002', limits, now=NOW))
+    check_turn('default', 'P002', limits, now=NOW)
+
+
+def test_refunded_turn_frees_its_slot(app):
+    limits = {'turns_per_minute': 2}
+    for _ in range(5):
+        refund_turn(check_turn('default', 'P001', limits, now=NOW))
+    check_turn('default', 'P001', limits, now=NOW)
+    check_turn('default', 'P001', limits, now=NOW)
+    with pytest.raises(RateLimitExceededError):
+        check_turn('default', 'P001', limits, now=NOW)
+
+
+@pytest.mark.parametrize('previous, room, offset, retry_after', [
+    (0, -1, 15, 45),        # Nothing to decay: wait for the window to end
+    (4, 0, 10.5, 50),       # Current window alone is at the limit
+    (4, 1, 30, 15),         # Previous window's share drops below the limit sooner
+    (4, 1, 59.9, 1),        # Never less than a second
+])
+def test_exceeded_retry_after(previous, room, offset, retry_after):
+    error = _exceeded('turns_per_minute', previous, room, offset)
+    assert error.retry_after == retry_after
+    assert 'too quickly' in str(error)
+
+
+def test_previous_window_counts_while_it_decays(app):
+    limits = {'turns_per_minute': 4}
+    next_window = (NOW // 60 + 1) * 60
+    for _ in range(4):
+        check_turn('default', 'P001', limits, now=NOW)
+    # Halfway through the next window, half of the previous window's turns still count
+    check_turn('default', 'P001', limits, now=next_window + 30)
+    check_turn('default', 'P001', limits, now=next_window + 30)
+    with pytest.raises(RateLimitExceededError) as refused:
+        check_turn('default', 'P001', limits, now=next_window + 30)
+    assert refused.value.retry_after == 15
+    check_turn('default', 'P001', limits, now=next_window + 45)
+
+
+def test_token_cap_refuses_turns_once_reached(app):
+    limits = {'tokens_per_day': 1000}
+    check_turn('default', 'P001', limits)
+    record_tokens('default', 'P001', limits, {'prompt_tokens': 600, 'completion_tokens': 400})
+    record_tokens('default', 'P002', limits, {'prompt_tokens': 600, 'completion_tokens': 400, 'usage_recorded': True})
+    with pytest.raises(RateLimitExceededError, match='daily usage'):
+        check_turn('default', 'P001', limits)
+    check_turn('default', 'P002', limits)
+
+
+def test_refund_after_expiry_does_not_leave_a_permanent_counter(app):
+    from app.state import get_state
+
+    counted = check_turn('default', 'P001', {'turns_per_minute': 2}, now=NOW)
+    assert [ttl for _, ttl in counted] == [120]
+    state = get_state()
+    for key, _ in counted:
+        state.delete(key)   # Expired or evicted before the refund
+    refund_turn(counted)
+    for key, _ in counted:
+        assert state._data[state.prefix + key][1] is not None
+
+
+def test_no_limits_count_nothing(app):
+    assert check_turn('default', 'P001', {}, now=NOW) == []
+
+
+def test_turn_refused_by_budget_keeps_its_rate_limit_slot(make_app):
+    def edit(conditions):
+        conditions['study_metadata']['rate_limits'] = {'turns_per_minute': 2}
+        conditions['study_metadata']['pricing'] = {'benchmark-deployment': {'prompt': 1000, 'completion': 1000}}
+        conditions['study_metadata']['cost_budgets'] = {'condition': {'hard': 0.5}}
+
+    app = make_app(edit)
+    with stubbed_model():
+        client = app.test_client()
+        token = seed_participant(app, client, 'P001', 1)
+        for status in (200, 503, 503, 503):   # The first turn spends 0.97 of the condition's 0.5
+            assert client.post('/api/send_message', json={
+                'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hello'
+            }).status_code == status
+
+    # Only the answered turn used a slot
+    check_turn('default', 'P001', {'turns_per_minute': 2})
+    with pytest.raises(RateLimitExceededError):
+        check_turn('default', 'P001', {'turns_per_minute': 2})
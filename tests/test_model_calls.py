@@ -0,0 +1,134 @@
+"""Response deadlines, fail-over and adaptive retries of model calls (bot.py)."""
+
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import openai
+import pytest
+
+import bot
+
+CONVERSATION = [{'role': 'user', 'content': 'Hi'}]
+
+
+def chunk(content=None, finish_reason=None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish_reason)], usage=None)
+
+
+class FakeStream:
+    """
+    A streamed response: yields its chunks (after an optional delay each),
+    then raises error if given, or blocks like a silent connection if stall
+    is set, until its socket is shut down.
+    """
+
+    def __init__(self, chunks=(), delay=0.0, stall=False, error=None):
+        self.chunks, self.delay, self.stall, self.error = list(chunks), delay, stall, error
+        self.closed = False
+        self._shutdown = threading.Event()
+        sock = SimpleNamespace(shutdown=lambda how: self._shutdown.set())
+        network_stream = SimpleNamespace(get_extra_info=lambda name: sock)
+        self.response = SimpleNamespace(extensions={'network_stream': network_stream})
+
+    def __iter__(self):
+        for item in self.chunks:
+            time.sleep(self.delay)
+            yield item
+        if self.error is not None:
+            raise self.error
+        if self.stall:
+            if not self._shutdown.wait(10):
+                raise AssertionError('stalled stream was never interrupted')
+            raise httpx.ReadError('connection shut down')
+
+    def close(self):
+        self.closed = True
+
+
+def fake_client(*responses):
+    create = mock.Mock(side_effect=list(responses))
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+                             with_options=lambda **options: client)
+    return client, create
+
+
+@pytest.mark.parametrize('effort, tokens, expected', [
+    ('high', 1000, ('medium', 1000)),
+    ('medium', 1000, ('low', 1000)),
+    ('low', 1000, ('low', 2000)),       # Lowest useful effort: raise the budget instead
+    ('minimal', 1000, ('minimal', 2000)),
+    (None, 1000, (None, 2000)),
+    (None, 3000, (None, 4000)),         # Capped at MAX_BUDGET_MULTIPLIER x the configured budget
+    (None, 4000, (None, 4000)),
+])
+def test_adapt_budget(effort, tokens, expected):
+    assert bot._adapt_budget(effort, tokens, configured_max_tokens=1000) == expected
+
+
+def test_turn_budget_spent():
+    assert not bot._turn_budget_spent({'completion_tokens': 3999}, 1000)
+    assert bot._turn_budget_spent({'completion_tokens': 4000}, 1000)
+    assert not bot._turn_budget_spent({}, 1000)
+
+
+def test_fail_over():
+    info = {}
+    assert bot._fail_over('primary', 'fallback', info) == 'fallback'
+    assert info == {'ttft_timeouts': 1, 'fallback': True}
+    assert bot._fail_over('fallback', 'fallback', info) == 'fallback'
+    assert bot._fail_over('primary', None, info) == 'primary'
+    assert info['ttft_timeouts'] == 3
+
+
+def test_silent_stream_fails_over_at_the_ttft_deadline():
+    client, create = fake_client(FakeStream(stall=True), FakeStream([chunk('Hello'), chunk(' there', 'stop')]))
+    info = {}
+    start = time.monotonic()
+    text = ''.join(bot.get_chat_response_stream(client, CONVERSATION, 'primary', max_retries=3, retry_delay=0,
+                                                response_info=info, ttft_timeout=0.2, fallback_deployment='fallback'))
+    assert text == 'Hello there'
+    assert time.monotonic() - start < 2
+    assert [call.kwargs['model'] for call in create.call_args_list] == ['primary', 'fallback']
+    assert info['fallback'] and info['ttft_timeouts'] == 1 and info['attempts'] == 2
+
+
+def test_slow_chunks_after_the_first_content_do_not_end_the_response():
+    stream = FakeStream([chunk('One'), chunk(' two'), chunk(' three', 'stop')], delay=0.15)
+    client, create = fake_client(stream)
+    text = ''.join(bot.get_chat_response_stream(client, CONVERSATION, 'primary', max_retries=3, retry_delay=0,
+                                                ttft_timeout=0.2))
+    assert text == 'One two three'
+    assert create.call_count == 1 and stream.closed
+
+
+def test_read_timeout_after_content_ends_the_stream_without_retrying():
+    timeout = openai.APITimeoutError(request=httpx.Request('POST', 'https://example.invalid'))
+    client, create = fake_client(FakeStream([chunk('Partial')], error=timeout), FakeStream([chunk('Second answer')]))
+    text = ''.join(bot.get_chat_response_stream(client, CONVERSATION, 'primary', max_retries=3, retry_delay=0,
+                                                request_timeout=0.2))
+    assert text == 'Partial'
+    assert create.call_count == 1
+
+
+def test_exhausted_budget_without_content_retries_with_lower_effort():
+    client, create = fake_client(FakeStream([chunk(finish_reason='length')]), FakeStream([chunk('Answer', 'stop')]))
+    text = ''.join(bot.get_chat_response_stream(client, CONVERSATION, 'primary', max_completion_tokens=1000,
+                                                max_retries=3, retry_delay=0, reasoning_effort='high'))
+    assert text == 'Answer'
+    assert [call.kwargs.get('reasoning_effort') for call in create.call_args_list] == ['high', 'medium']
+
+
+def test_request_timeout_fails_over_without_streaming():
+    timeout = openai.APITimeoutError(request=httpx.Request('POST', 'https://example.invalid'))
+    answer = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='Answer'), finish_reason='stop')],
+                             usage=None)
+    client, create = fake_client(timeout, answer)
+    info = {}
+    assert bot.get_chat_response(client, CONVERSATION, 'primary', max_retries=3, retry_delay=0, response_info=info,
+                                 request_timeout=5, fallback_deployment='fallback') == 'Answer'
+    assert [call.kwargs['model'] for call in create.call_args_list] == ['primary', 'fallback']
+    assert info['fallback']
@@ -0,0 +1,51 @@
+"""Chat pages pre-rendered once per condition (app.pages)."""
+
+import json
+from unittest import mock
+
+from app import pages, warm_up
+from app.studies import load_study_config
+
+
+def gui(client, participant_id, condition=0):
+    response = client.get(f'/gui?participant_id={participant_id}&condition={condition}')
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_each_condition_is_rendered_once(app):
+    client = app.test_client()
+    with mock.patch('app.pages.render_template', wraps=pages.render_template) as render:
+        first = gui(client, 'P001')
+        second = gui(client, 'P002')
+        gui(client, 'P003', condition=1)
+    assert render.call_count == 2
+    assert set(pages._shells) == {('default', 0), ('default', 1)}
+    # Only the participant's settings differ
+    assert first != second
+    assert first.split('...{')[0] == second.split('...{')[0]
+
+
+def test_participant_settings_are_escaped(app):
+    with app.test_request_context(), mock.patch.object(pages, '_shells', {}):
+        config = load_study_config('default', 0)
+        page = pages.render_chat_page(config, 100, {'sessionToken': '</script><script>alert(1)</script>'})
+    assert '<script>alert(1)' not in page
+    assert '\\u003c/script\\u003e' in page
+
+
+def test_page_without_the_marker_falls_back_to_a_full_render(app):
+    client = app.test_client()
+    with mock.patch('app.pages._render_shell', return_value=None):
+        fallback = gui(client, 'P001')
+    assert pages._shells == {}
+    pages._shells.clear()
+    shelled = gui(client, 'P001')
+    assert fallback == shelled
+
+
+def test_warm_up_renders_every_condition(app):
+    with open('experimental_conditions.json', encoding='utf-8') as f:
+        conditions = json.load(f)['conditions']
+    status = warm_up(app)
+    assert status['pages'] == len(conditions) == len(pages._shells)
@@ -0,0 +1,76 @@
+"""On-demand profiling sessions (app.profiling)."""
+
+import threading
+
+import pytest
+
+from app import profiling
+from benchmark import seed_participant
+
+ADMIN_TOKEN = 'admin-secret'
+BEARER = {'Authorization': f'Bearer {ADMIN_TOKEN}'}
+
+
+@pytest.fixture
+def admin(monkeypatch, app):
+    monkeypatch.setenv('ADMIN_TOKEN', ADMIN_TOKEN)
+    monkeypatch.setattr(profiling, '_next_poll', 0.0)
+    return app.test_client()
+
+
+def wait_for_profiler():
+    for thread in threading.enumerate():
+        if thread.name == 'profiler':
+            thread.join(5)
+            assert not thread.is_alive()
+
+
+@pytest.mark.parametrize('buckets, fraction, expected', [
+    ([0] * 15, 0.5, None),
+    ([1, 1, 0, 0, 2] + [0] * 10, 0.5, 2),
+    ([1, 1, 0, 0, 2] + [0] * 10, 0.95, 25),
+    ([0] * 14 + [3], 0.5, None),             # Above the largest bucket
+])
+def test_percentile(buckets, fraction, expected):
+    assert profiling._percentile(buckets, fraction) == expected
+
+
+def test_spans_record_nothing_outside_a_session(monkeypatch, app):
+    monkeypatch.setattr(profiling, '_stages', {})
+    with profiling.span('load_history'):
+        pass
+    profiling.record('stream', profiling.now())
+    assert not profiling.enabled() and profiling._stages == {}
+
+
+def test_session_times_the_stages_of_chat_turns(admin, client, app):
+    token = seed_participant(app, client, 'P001', 1)
+    started = admin.post('/admin/api/profile?seconds=1&interval_ms=5', headers=BEARER)
+    assert started.status_code == 202
+    session = started.get_json()['session']
+    assert admin.post('/admin/api/profile', headers=BEARER).status_code == 409
+
+    assert client.post('/api/send_message', json={
+        'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hello'}).status_code == 200
+    wait_for_profiler()
+
+    results = admin.get('/admin/api/profile', headers=BEARER).get_json()
+    assert results['session'] == session and not results['active']
+    assert len(results['workers']) == 1 and results['workers'][0]['samples'] > 0
+    stages = results['stages']
+    assert {'validate', 'auth', 'load_history', 'llm_response', 'persist_assistant_message'} <= set(stages)
+    assert stages['llm_response']['count'] == 1 and stages['llm_response']['p50_ms'] is not None
+
+    stacks = admin.get(f'/admin/api/profile/stacks?session={session}', headers=BEARER)
+    assert stacks.mimetype == 'text/plain'
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in stacks.get_data(as_text=True).splitlines())
+
+    # A new session can start once the last one ended
+    assert admin.post('/admin/api/profile?seconds=1&sample=0', headers=BEARER).status_code == 202
+    wait_for_profiler()
+
+
+def test_no_results_without_a_session(admin):
+    assert admin.get('/admin/api/profile', headers=BEARER).status_code == 404
+    assert admin.get('/admin/api/profile/stacks', headers=BEARER).status_code == 404
+    assert admin.get('/admin/api/profile?session=../x', headers=BEARER).status_code == 404
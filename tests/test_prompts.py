@@ -0,0 +1,26 @@
+"""Deduplicated prompt storage (app.prompts)."""
+
+from app import db
+from app.models import hash_prompt
+from app.prompts import get_prompt_content, store_prompt
+
+PROMPT = 'You are a helpful assistant. ' * 200
+
+
+def test_rolled_back_prompt_is_stored_again(app):
+    with app.app_context():
+        store_prompt(PROMPT)
+        db.session.rollback()
+
+        prompt_hash = store_prompt(PROMPT)
+        db.session.commit()
+        assert get_prompt_content(prompt_hash) == PROMPT
+
+
+def test_missing_prompt_is_looked_up_again(app):
+    prompt_hash = hash_prompt(PROMPT)
+    with app.app_context():
+        assert get_prompt_content(prompt_hash) is None
+        store_prompt(PROMPT)
+        db.session.commit()
+        assert get_prompt_content(prompt_hash) == PROMPT
@@ -0,0 +1,96 @@
+"""On-disk response cache for bot.py development runs (response_cache)."""
+
+import os
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+import bot
+import response_cache
+from response_cache import ResponseCache
+
+CONVERSATION = [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': 'Hi'}]
+
+
+@pytest.fixture(autouse=True)
+def outside_live_server(monkeypatch):
+    # Other tests create the app in this process, which disables caching for good
+    monkeypatch.setattr(response_cache, '_live_server', False)
+
+
+def fake_client(text='Hello there'):
+    """A client whose chat.completions.create returns one non-streamed response."""
+    response = SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text), finish_reason='stop')], usage=None)
+    create = mock.Mock(return_value=response)
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))), create
+
+
+def test_record_then_replay_offline(tmp_path):
+    client, create = fake_client()
+    recorder = ResponseCache(str(tmp_path), mode='record')
+    assert bot.get_chat_response(client, CONVERSATION, 'gpt', cache=recorder) == 'Hello there'
+    info = {}
+    assert bot.get_chat_response(client, CONVERSATION, 'gpt', cache=recorder, response_info=info) == 'Hello there'
+    assert info['cached'] and create.call_count == 1
+    assert (recorder.hits, recorder.misses) == (1, 1)
+
+    offline, never_called = fake_client()
+    replayer = ResponseCache(str(tmp_path), mode='replay')
+    assert bot.get_chat_response(offline, CONVERSATION, 'gpt', cache=replayer) == 'Hello there'
+    # A miss in replay mode fails instead of calling the API
+    assert bot.get_chat_response(offline, CONVERSATION, 'gpt', temperature=0.5, cache=replayer) is None
+    assert never_called.call_count == 0
+
+
+def test_streamed_replay_yields_the_cached_text(tmp_path):
+    cache = ResponseCache(str(tmp_path), mode='replay')
+    key = cache.make_key('gpt', 1.0, 2500, CONVERSATION)
+    cache.put(key, 'x' * 30)
+    client, create = fake_client()
+    chunks = list(bot.get_chat_response_stream(client, CONVERSATION, 'gpt', cache=cache))
+    assert ''.join(chunks) == 'x' * 30 and len(chunks) == 3
+    assert create.call_count == 0
+
+
+def test_key_ignores_number_formatting_and_extra_message_fields(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    with_extras = [dict(m, timestamp='2025-01-01') for m in CONVERSATION]
+    assert cache.make_key('gpt', 1, 100, CONVERSATION) == cache.make_key('gpt', 1.0, 100.0, with_extras)
+    assert cache.make_key('gpt', 1, 100, CONVERSATION) != cache.make_key('gpt', 1, 100, CONVERSATION, 'low')
+    assert cache.make_key('gpt', 1, 100, CONVERSATION) != cache.make_key('gpt', 1, 100, CONVERSATION[1:])
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=10**6)
+    for age, key in enumerate(('c3', 'b2', 'a1'), start=1):
+        cache.put(key, 'x' * 100)
+        os.utime(cache._path(key), (time.time() - 60 * age,) * 2)
+    entry_size = max(cache._sizes.values())
+    cache.max_bytes = entry_size * 2
+    cache.get('a1')               # Used more recently than b2
+    cache.put('d4', 'x' * 100)
+    assert cache.get('b2') is None and cache.get('c3') is None
+    assert cache.get('a1') and cache.get('d4')
+
+
+def test_from_env(monkeypatch, tmp_path):
+    monkeypatch.setenv('RESPONSE_CACHE_DIR', str(tmp_path))
+    monkeypatch.delenv('RESPONSE_CACHE_MODE', raising=False)
+    assert ResponseCache.from_env() is None
+    assert ResponseCache.from_env('replay').mode == 'replay'
+    with pytest.raises(ValueError):
+        ResponseCache.from_env('sometimes')
+
+
+def test_live_server_refuses_the_cache(monkeypatch, tmp_path, make_app):
+    monkeypatch.setenv('RESPONSE_CACHE_MODE', 'record')
+    with pytest.raises(RuntimeError, match='RESPONSE_CACHE_MODE'):
+        make_app()
+
+    monkeypatch.setenv('RESPONSE_CACHE_MODE', 'off')
+    make_app()
+    with pytest.raises(RuntimeError):
+        ResponseCache(str(tmp_path))
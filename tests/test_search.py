@@ -0,0 +1,86 @@
+"""Full-text search over messages (app.search)."""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.models import Message
+from app.search import SearchQueryError, Term, _fts5_query, _postgres_query, parse_query, search_messages
+from benchmark import seed_participant
+
+
+@pytest.mark.parametrize('query, groups', [
+    ('GPT', [[(Term('GPT'), False)]]),
+    ('language model', [[(Term('language'), False), (Term('model'), False)]]),
+    ('"language model"', [[(Term('language model'), False)]]),
+    ('chat*', [[(Term('chat', prefix=True), False)]]),
+    ('GPT OR Claude', [[(Term('GPT'), False)], [(Term('Claude'), False)]]),
+    ('model NOT GPT', [[(Term('model'), False), (Term('GPT'), True)]]),
+    ('a AND b OR c NOT d', [[(Term('a'), False), (Term('b'), False)], [(Term('c'), False), (Term('d'), True)]]),
+    ('GPT-4 - ""', [[(Term('GPT-4'), False)]]),    # Stray punctuation and empty phrases are skipped
+    ('or not', [[(Term('or'), False), (Term('not'), False)]]),   # Operators are upper case
+])
+def test_parse_query(query, groups):
+    assert parse_query(query) == groups
+
+
+@pytest.mark.parametrize('query', ['', '   ', '""', 'OR GPT', 'GPT OR', 'GPT NOT', 'NOT GPT', 'GPT OR NOT x',
+                                   'GPT AND -'])
+def test_parse_query_rejects_misplaced_operators(query):
+    with pytest.raises(SearchQueryError):
+        parse_query(query)
+
+
+def test_queries_are_quoted_for_each_database():
+    groups = parse_query('GPT-4 chat* OR model NOT it"s')
+    assert _fts5_query(groups) == '("GPT-4" AND "chat" *) OR ("model" NOT "it""s")'
+    params = {}
+    assert _postgres_query(parse_query('chat* OR model'), params) == (
+        "((to_tsquery('english', :term0)) || (phraseto_tsquery('english', :term1)))")
+    assert params == {'term0': 'chat:*', 'term1': 'model'}
+
+
+def test_search_finds_stemmed_words_phrases_and_filters(app, client):
+    seed_participant(app, client, 'P001', 1)
+    seed_participant(app, client, 'P002', 1, condition_index=1)
+    now = datetime.utcnow()
+    with app.app_context():
+        for participant_id, role, content, age in (
+            ('P001', 'user', 'I mentioned the language model yesterday', 3),
+            ('P001', 'assistant', 'Mentions of GPT-4 are common', 2),
+            ('P002', 'user', 'The model of a language', 1),
+        ):
+            db.session.add(Message(participant_id=participant_id, role=role, content=content,
+                                   timestamp=now - timedelta(hours=age)))
+        db.session.commit()
+
+        def found(query, **filters):
+            results, _ = search_messages(query, **filters)
+            return sorted(r['participant_id'] + ':' + r['role'] for r in results)
+
+        assert found('mention') == ['P001:assistant', 'P001:user']
+        assert found('"language model"') == ['P001:user']
+        assert found('language model') == ['P001:user', 'P002:user']
+        assert found('GPT-4') == ['P001:assistant']
+        assert found('model NOT yesterday') == ['P002:user']
+        assert found('lang*', role='user', condition_index=1) == ['P002:user']
+        assert found('mention', since=now - timedelta(hours=2, minutes=30)) == ['P001:assistant']
+
+        results, _ = search_messages('mention', newest_first=True, highlight=('<b>', '</b>'))
+        assert '<b>Mentions</b>' in results[0]['snippet']
+
+
+def test_deleted_messages_leave_the_index(app, client):
+    seed_participant(app, client, 'P001', 1)
+    with app.app_context():
+        message = Message(participant_id='P001', role='user', content='unforgettable')
+        db.session.add(message)
+        db.session.commit()
+        assert len(search_messages('unforgettable')[0]) == 1
+        message.content = 'forgotten'
+        db.session.commit()
+        assert search_messages('unforgettable')[0] == []
+        db.session.delete(message)
+        db.session.commit()
+        assert search_messages('forgotten')[0] == []
@@ -0,0 +1,58 @@
+"""Read-only snapshots of the live database (app.snapshot)."""
+
+import os
+import stat
+from unittest import mock
+
+import pytest
+
+from app import db
+from app.snapshot import create_snapshot, file_checksum, list_snapshots, open_snapshot
+from benchmark import seed_participant
+
+
+def test_snapshot_is_a_verified_read_only_copy(app, client):
+    seed_participant(app, client, 'P001', 3)
+    seed_participant(app, client, 'P002', 1, condition_index=1)
+    with app.app_context():
+        manifest = create_snapshot(os.path.join('data', 'snapshots', 'first.db'), pages_per_step=1, pause=0)
+
+    path = os.path.abspath(os.path.join('data', 'snapshots', 'first.db'))
+    assert manifest['sha256'] == file_checksum(path)
+    assert manifest['integrity'] == 'ok'
+    assert manifest['rows']['participants'] == 2 and manifest['rows']['messages'] == 2
+    assert manifest['participants_per_study'] == {'default': 2}
+    assert not os.stat(path).st_mode & stat.S_IWUSR
+    assert not os.path.exists(path + '.part')
+
+    url, opened = open_snapshot('latest')
+    assert url == f"sqlite:///file:{path}?mode=ro&uri=true"
+    assert opened['sha256'] == manifest['sha256']
+    assert [os.path.abspath(m['path']) for m in list_snapshots()] == [path]
+
+
+def test_modified_or_incomplete_snapshots_are_refused(app, client):
+    seed_participant(app, client, 'P001', 1)
+    with pytest.raises(ValueError):
+        open_snapshot('latest')
+    with app.app_context():
+        create_snapshot(os.path.join('data', 'snapshots', 'first.db'))
+
+    path = os.path.join('data', 'snapshots', 'first.db')
+    os.chmod(path, 0o644)
+    with open(path, 'ab') as f:
+        f.write(b'\0')
+    with pytest.raises(ValueError, match='checksum'):
+        open_snapshot('first.db')
+
+    os.remove(os.path.join('data', 'snapshots', 'first.json'))
+    with pytest.raises(ValueError, match='incomplete'):
+        open_snapshot('first.db')
+    assert list_snapshots() == []
+
+
+def test_snapshots_need_a_sqlite_file(app):
+    with app.app_context():
+        postgres = db.engine.url.set(drivername='postgresql', database='research')
+        with mock.patch.object(db.engine, 'url', postgres), pytest.raises(RuntimeError, match='pg_dump'):
+            create_snapshot()
@@ -0,0 +1,161 @@
+"""
+Shared state backends (app.state): memory:// and Redis.
+
+The Redis tests use a local server when TEST_REDIS_URL is set (for example
+redis://localhost:6379/15 - its keys are flushed), otherwise fakeredis, and
+are skipped if neither the redis nor the fakeredis package is installed.
+"""
+
+import os
+import time
+import uuid
+from unittest import mock
+
+import pytest
+
+from app.state import MemoryBackend, RedisBackend, create_backend
+from benchmark import seed_participant, stub_get_chat_response, stubbed_model
+
+TTL = 0.3
+
+
+@pytest.fixture
+def redis_url(monkeypatch):
+    """URL of a Redis server every RedisBackend in the test connects to."""
+    redis = pytest.importorskip('redis')
+    url = os.environ.get('TEST_REDIS_URL')
+    if url:
+        client = redis.Redis.from_url(url)
+        try:
+            client.ping()
+        except redis.ConnectionError:
+            pytest.skip(f"No Redis server at {url}")
+        client.flushdb()
+        yield url
+        client.flushdb()
+        return
+
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url',
+                        lambda url, **kwargs: fakeredis.FakeRedis(server=server, decode_responses=True))
+    yield 'redis://localhost:6379/15'
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def connect(request):
+    """
+    Factory of backends sharing one store, like the workers of a deployment
+    (memory:// is only shared within a process, so it returns one instance).
+    """
+    prefix = f"test-{uuid.uuid4().hex[:8]}:"
+    if request.param == 'memory':
+        backend = MemoryBackend(prefix)
+        return lambda: backend
+    url = request.getfixturevalue('redis_url')
+    return lambda: create_backend(url, prefix)
+
+
+def test_create_backend_picks_the_backend_by_url(redis_url):
+    assert isinstance(create_backend('memory://'), MemoryBackend)
+    assert isinstance(create_backend(redis_url), RedisBackend)
+    with pytest.raises(ValueError):
+        create_backend('memcached://localhost')
+
+
+def test_lock_excludes_other_holders(connect):
+    first, second = connect().lock('turn:P001', ttl=10), connect().lock('turn:P001', ttl=10)
+    assert first.acquire()
+    assert not second.acquire()
+    assert connect().lock('turn:P002', ttl=10).acquire()
+
+    first.release()
+    assert second.acquire()
+    second.release()
+
+
+def test_lock_is_only_released_by_its_holder(connect):
+    stale = connect().lock('turn:P001', ttl=TTL)
+    assert stale.acquire()
+    time.sleep(TTL + 0.1)   # The holder took too long: the lock expired
+
+    current = connect().lock('turn:P001', ttl=10)
+    assert current.acquire()
+    stale.release()         # Must not release the lock it no longer holds
+    assert not connect().lock('turn:P001', ttl=10).acquire()
+    current.release()
+    assert connect().lock('turn:P001', ttl=10).acquire()
+
+
+def test_lock_acquire_waits_for_release(connect):
+    first, second = connect().lock('turn:P001', ttl=TTL), connect().lock('turn:P001', ttl=10)
+    assert first.acquire()
+    assert second.acquire(wait=TTL + 0.5)   # Acquired once the first lock expires
+    assert not first.acquire()
+
+
+def test_incr_sets_the_ttl_when_creating_the_counter(connect):
+    backend = connect()
+    assert backend.incr('rate:P001', ttl=TTL) == 1
+    time.sleep(TTL * 2 / 3)
+    assert connect().incr('rate:P001', ttl=TTL) == 2   # Does not extend the window
+    time.sleep(TTL * 2 / 3)
+    assert backend.get('rate:P001') is None
+    assert backend.incr('rate:P001', ttl=TTL) == 1
+
+
+def test_incr_without_ttl_and_negative_amounts(connect):
+    backend = connect()
+    assert backend.incr('count') == 1
+    assert backend.incr('count', 5) == 6
+    assert backend.incr('count', -2) == 4
+    # A refund after the counter expired creates it with an expiry, not a permanent key
+    assert backend.incr('refunded', -1, ttl=TTL) == -1
+    time.sleep(TTL + 0.1)
+    assert backend.get('refunded') is None
+
+
+def test_get_many_returns_values_in_order(connect):
+    backend = connect()
+    backend.set('a', '1')
+    backend.set('c', '3', ttl=10)
+    assert connect().get_many(['a', 'b', 'c']) == ['1', None, '3']
+    assert backend.get_many([]) == []
+
+
+def test_add_and_delete_if_equals(connect):
+    backend = connect()
+    assert backend.add('key', 'first', ttl=10)
+    assert not connect().add('key', 'second', ttl=10)
+    assert not backend.delete_if_equals('key', 'second')
+    assert backend.delete_if_equals('key', 'first')
+    assert backend.get('key') is None
+
+
+def test_json_values_expire(connect):
+    backend = connect()
+    backend.set_json('idempotency:P001:key', {'success': True, 'response': 'Grüße'}, ttl=TTL)
+    assert connect().get_json('idempotency:P001:key') == {'success': True, 'response': 'Grüße'}
+    time.sleep(TTL + 0.1)
+    assert backend.get_json('idempotency:P001:key') is None
+
+
+def test_retried_turn_is_answered_once_across_workers(monkeypatch, redis_url, make_app):
+    monkeypatch.setenv('STATE_BACKEND_URL', redis_url)
+    monkeypatch.setenv('STATE_KEY_PREFIX', f"test-{uuid.uuid4().hex[:8]}:")
+    app = make_app()
+    with stubbed_model(), mock.patch('app.routes.get_chat_response', wraps=stub_get_chat_response) as model:
+        client = app.test_client()
+        token = seed_participant(app, client, 'P001', 1)
+        body = {'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hello'}
+        headers = {'Idempotency-Key': 'turn-1'}
+
+        first = client.post('/api/send_message', json=body, headers=headers)
+        # Another worker has its own RedisBackend on the same server
+        from app import state
+        state.get_state.cache_clear()
+        retry = client.post('/api/send_message', json=body, headers=headers)
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.get_json() == first.get_json()
+    assert model.call_count == 1
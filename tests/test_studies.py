@@ -0,0 +1,99 @@
+"""Several studies served by one deployment, and their quotas (app.studies)."""
+
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from app.models import Participant
+from app.studies import list_studies
+from benchmark import stub_get_chat_response
+
+PILOT_PROMPT = 'You only talk about the pilot study.'
+
+
+@pytest.fixture
+def add_study(workdir):
+    """Write studies/<study_id>.json from the example conditions, edited by a function."""
+    def add(study_id, edit=None):
+        with open(os.path.join(workdir, 'experimental_conditions.json'), encoding='utf-8') as f:
+            conditions = json.load(f)
+        conditions['conditions'][0]['system_prompt'] = {'behavior': PILOT_PROMPT}
+        if edit is not None:
+            edit(conditions)
+        os.makedirs(os.path.join(workdir, 'studies'), exist_ok=True)
+        with open(os.path.join(workdir, 'studies', f'{study_id}.json'), 'w', encoding='utf-8') as f:
+            json.dump(conditions, f)
+    return add
+
+
+def send(client, participant_id, token, message='Hello'):
+    return client.post('/api/send_message', json={
+        'participant_id': participant_id, 'session_token': token, 'condition_index': 0, 'message': message})
+
+
+def enrol(client, participant_id, study=None):
+    query = f'/gui?participant_id={participant_id}&condition=0' + (f'&study={study}' if study else '')
+    return client.get(query)
+
+
+def token_of(app, participant_id):
+    with app.app_context():
+        return Participant.query.get(participant_id).session_token
+
+
+def test_chat_api_uses_the_participants_study(add_study, make_app):
+    add_study('pilot-b')
+    app = make_app()
+    client = app.test_client()
+    assert list(list_studies()) == ['default', 'pilot-b']
+    assert enrol(client, 'B001', 'pilot-b').status_code == 200
+    assert enrol(client, 'A001').status_code == 200
+
+    with mock.patch('app.routes.get_chat_response', wraps=stub_get_chat_response) as model:
+        assert send(client, 'B001', token_of(app, 'B001')).status_code == 200
+        assert send(client, 'A001', token_of(app, 'A001')).status_code == 200
+
+    pilot, default = (call.args[1][0]['content'] for call in model.call_args_list)
+    assert PILOT_PROMPT in pilot and PILOT_PROMPT not in default
+    with app.app_context():
+        assert Participant.query.get('B001').study_id == 'pilot-b'
+
+
+def test_unknown_study_and_study_mismatch(app, client):
+    assert enrol(client, 'P001', 'nope').status_code == 404
+    assert enrol(client, 'P001', '../secrets').status_code == 400
+    assert enrol(client, 'P001').status_code == 200
+    os.makedirs('studies')
+    with open('experimental_conditions.json', encoding='utf-8') as f, \
+            open('studies/pilot-b.json', 'w', encoding='utf-8') as out:
+        out.write(f.read())
+    # Participant IDs are unique across studies
+    assert enrol(client, 'P001', 'pilot-b').status_code == 409
+
+
+def test_participant_quota_only_stops_new_participants(add_study, make_app):
+    add_study('pilot-b', lambda conditions: conditions['study_metadata'].update(quotas={'max_participants': 1}))
+    client = make_app().test_client()
+    assert enrol(client, 'B001', 'pilot-b').status_code == 200
+    assert enrol(client, 'B002', 'pilot-b').status_code == 429
+    assert enrol(client, 'B001', 'pilot-b').status_code == 200   # Returning participant
+    assert enrol(client, 'A001').status_code == 200               # Other studies are not affected
+
+
+def test_turn_quota_counts_the_studys_turns_this_minute(add_study, make_app):
+    add_study('pilot-b', lambda conditions: conditions['study_metadata'].update(quotas={'max_turns_per_minute': 2}))
+    app = make_app()
+    client = app.test_client()
+    for participant_id in ('B001', 'B002'):
+        enrol(client, participant_id, 'pilot-b')
+    enrol(client, 'A001')
+
+    with mock.patch('app.routes.get_chat_response', stub_get_chat_response):
+        assert send(client, 'B001', token_of(app, 'B001')).status_code == 200
+        assert send(client, 'B002', token_of(app, 'B002')).status_code == 200
+        refused = send(client, 'B001', token_of(app, 'B001'))
+        assert send(client, 'A001', token_of(app, 'A001')).status_code == 200
+    assert refused.status_code == 429
+    assert refused.get_json()['code'] == 'quota_exceeded'
@@ -0,0 +1,63 @@
+"""Task state stored on the participant and logged as events (user-033)."""
+
+from unittest import mock
+
+import db_utils
+from app import db
+from app.models import Message, Participant, TaskStateEvent
+from app.routes import TASK_COMPLETE_OVERRIDE
+from benchmark import seed_participant, stub_get_chat_response
+
+
+def events(app, participant_id='P001'):
+    with app.app_context():
+        return [(e.event_type, e.source) for e in
+                TaskStateEvent.query.filter_by(participant_id=participant_id).order_by(TaskStateEvent.id)]
+
+
+def test_only_changes_are_logged(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    for _ in range(2):
+        assert client.get('/gui?participant_id=P001&condition=0&task_active=false').status_code == 200
+    client.post('/api/send_message', json={
+        'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'Hi', 'task_active': True})
+
+    assert events(app) == [('task_inactive', 'gui'), ('task_active', 'send_message')]
+    with app.app_context():
+        assert Participant.query.get('P001').task_active is True
+
+
+def test_override_is_sent_to_the_model_but_not_stored(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    sent = []
+
+    def get_chat_response(client, conversation, **kwargs):
+        sent.append([dict(m) for m in conversation])
+        return stub_get_chat_response(client, conversation, **kwargs)
+
+    with mock.patch('app.routes.get_chat_response', get_chat_response):
+        for task_active in (False, True):
+            assert client.post('/api/send_message', json={
+                'participant_id': 'P001', 'session_token': token, 'condition_index': 0,
+                'message': 'Hi', 'task_active': task_active}).status_code == 200
+
+    assert sent[0][1] == TASK_COMPLETE_OVERRIDE
+    assert TASK_COMPLETE_OVERRIDE not in sent[1]
+    with app.app_context():
+        assert Message.query.filter_by(participant_id='P001', role='system').count() == 0
+
+
+def test_legacy_markers_become_events(app, client):
+    seed_participant(app, client, 'P001', 1)
+    with app.app_context():
+        db.session.add(Message(participant_id='P001', role='system',
+                               content='TASK_STATE: inactive - Task completion mode enabled'))
+        db.session.commit()
+
+    db_utils.migrate_task_state()
+    db_utils.migrate_task_state()   # Safe to run again
+
+    assert events(app) == [('task_inactive', 'legacy_marker')]
+    with app.app_context():
+        assert Participant.query.get('P001').task_active is False
+        assert Message.query.filter_by(participant_id='P001').count() == 0
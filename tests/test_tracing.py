@@ -0,0 +1,109 @@
+"""Request traces across routes, SQL statements and model attempts (tracing)."""
+
+import json
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+import bot
+import tracing
+from app.models import Message
+from benchmark import seed_participant
+
+ADMIN_TOKEN = 'admin-secret'
+BEARER = {'Authorization': f'Bearer {ADMIN_TOKEN}'}
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+TRACEPARENT = f'00-{TRACE_ID}-00f067aa0ba902b7-01'
+
+
+def names(trace):
+    return [span['name'] for span in trace['spans']]
+
+
+def test_spans_nest_and_unfinished_spans_are_marked():
+    trace = tracing.Trace('GET /gui')
+    with trace.start_span('outer', {}) as outer:
+        started = time.perf_counter()
+        inner = trace.start_span('inner', {})
+        inner.end()
+        trace.start_span('after the fact', {}, started).end()
+        left_open = trace.start_span('left open', {})
+    trace.finish()
+
+    spans = {span['name']: span for span in trace.to_dict()['spans']}
+    assert spans['outer']['parent_id'] == trace.root.span_id
+    assert spans['inner']['parent_id'] == spans['after the fact']['parent_id'] == outer.span_id
+    assert left_open.attributes == {'unfinished': True}
+
+
+def test_spans_beyond_the_limit_are_counted_not_kept(monkeypatch):
+    monkeypatch.setattr(tracing, 'MAX_SPANS_PER_TRACE', 2)
+    trace = tracing.Trace('GET /gui')
+    for _ in range(5):
+        trace.start_span('db.query', {}).end()
+    assert len(trace.spans) == 2 and trace.dropped_spans == 3
+
+
+@pytest.mark.parametrize('traceparent, continued', [
+    (TRACEPARENT, True),
+    (f'00-{"0" * 32}-00f067aa0ba902b7-01', False),
+    ('00-not-a-trace', False),
+    (None, False),
+])
+def test_incoming_traceparent(traceparent, continued):
+    trace = tracing.start_trace('GET /gui', traceparent)
+    tracing.finish_trace()
+    assert (trace.trace_id == TRACE_ID) is continued
+    assert (trace.root.parent_id == '00f067aa0ba902b7') is continued
+
+
+def test_chat_turn_is_traced_without_message_content(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    response = client.post('/api/send_message', headers={'traceparent': TRACEPARENT}, json={
+        'participant_id': 'P001', 'session_token': token, 'condition_index': 0, 'message': 'my private answer'})
+    assert response.headers['X-Trace-Id'] == TRACE_ID
+
+    trace = tracing.get_exporter().find(TRACE_ID)
+    assert trace['attributes']['status'] == 200
+    assert {'validate', 'auth', 'load_history', 'llm_response', 'db.query', 'db.commit'} <= set(names(trace))
+    assert 'my private answer' not in json.dumps(trace)
+    with app.app_context():
+        assert {m.trace_id for m in Message.query.filter_by(participant_id='P001')} == {TRACE_ID}
+
+
+def test_model_attempts_are_traced_and_propagated():
+    answer = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='Hi'), finish_reason='stop')],
+                             usage=None)
+    create = mock.Mock(return_value=answer)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+                             with_options=lambda **options: client)
+    trace = tracing.start_trace('POST /api/send_message')
+    assert bot.get_chat_response(client, [{'role': 'user', 'content': 'Hi'}], 'primary', max_retries=1) == 'Hi'
+    tracing.finish_trace()
+
+    attempt = next(span for span in trace.spans if span.name == 'llm.attempt')
+    assert attempt.attributes['deployment'] == 'primary' and attempt.attributes['finish_reason'] == 'stop'
+    traceparent = create.call_args.kwargs['extra_headers']['traceparent']
+    assert traceparent == f'00-{trace.trace_id}-{attempt.span_id}-01'
+
+
+def test_file_exporter_and_admin_views(monkeypatch, workdir, make_app):
+    monkeypatch.setenv('TRACE_EXPORTER', 'file')
+    monkeypatch.setenv('ADMIN_TOKEN', ADMIN_TOKEN)
+    client = make_app().test_client()
+    trace_id = client.get('/gui?participant_id=P001&condition=0').headers['X-Trace-Id']
+
+    assert tracing.read_trace_file(trace_id)['name'] == 'GET /gui'
+    listed = client.get('/admin/api/traces', headers=BEARER).get_json()['traces']
+    assert listed[0]['trace_id'] == trace_id and listed[0]['db_queries'] > 0
+    tracing.get_exporter()._traces.clear()   # e.g. after a restart: found in the file
+    assert client.get(f'/admin/api/traces/{trace_id}', headers=BEARER).get_json()['trace_id'] == trace_id
+    assert client.get('/admin/api/traces/unknown', headers=BEARER).status_code == 404
+
+
+def test_tracing_off(monkeypatch, make_app):
+    monkeypatch.setenv('TRACE_EXPORTER', 'off')
+    client = make_app().test_client()
+    assert 'X-Trace-Id' not in client.get('/gui?participant_id=P001&condition=0').headers
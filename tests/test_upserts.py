@@ -0,0 +1,42 @@
+"""Atomic insert helpers (app.upserts)."""
+
+from datetime import datetime
+
+from app import db
+from app.models import MetricCounter, Prompt
+from app.upserts import increment_counters, insert_or_ignore
+
+KEY = ['minute', 'study_id', 'condition_index', 'name']
+
+
+def counters():
+    return {(row.condition_index, row.name): row.value for row in MetricCounter.query}
+
+
+def test_insert_or_ignore_inserts_once(app):
+    with app.app_context():
+        assert insert_or_ignore(Prompt, {'prompt_hash': 'h1', 'content': 'first'}, ['prompt_hash']) is True
+        assert insert_or_ignore(Prompt, {'prompt_hash': 'h1', 'content': 'second'}, ['prompt_hash']) is False
+        db.session.commit()
+        assert Prompt.query.one().content == 'first'
+
+
+def test_increment_counters_creates_and_adds(app):
+    minute = datetime(2026, 1, 1, 12, 0)
+    rows = [{'minute': minute, 'study_id': 'default', 'condition_index': c, 'name': 'turns', 'value': 1}
+            for c in (0, 1)]
+    with app.app_context():
+        increment_counters(MetricCounter, rows, index_elements=KEY)
+        increment_counters(MetricCounter, rows[:1], index_elements=KEY)
+        db.session.commit()
+        assert counters() == {(0, 'turns'): 2, (1, 'turns'): 1}
+
+
+def test_increment_counters_adds_repeated_keys_of_one_call(app):
+    row = {'minute': datetime(2026, 1, 1, 12, 0), 'study_id': 'default', 'condition_index': 0,
+           'name': 'turns', 'value': 2}
+    with app.app_context():
+        increment_counters(MetricCounter, [row, row], index_elements=KEY)
+        increment_counters(MetricCounter, [], index_elements=KEY)
+        db.session.commit()
+        assert counters() == {(0, 'turns'): 4}
@@ -0,0 +1,56 @@
+"""Request validation of the chat API and /gui (app.validation)."""
+
+import json
+import os
+
+from benchmark import seed_participant
+
+
+def send(client, participant_id, session_token, condition_index=0, message='Hello'):
+    return client.post('/api/send_message', json={
+        'participant_id': participant_id,
+        'session_token': session_token,
+        'condition_index': condition_index,
+        'message': message,
+    })
+
+
+def test_valid_turn_is_answered(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    response = send(client, 'P001', token)
+    assert response.status_code == 200
+    assert response.get_json()['success'] is True
+
+
+def test_wrong_session_token_is_refused(app, client):
+    seed_participant(app, client, 'P001', 1)
+    assert send(client, 'P001', 'not-the-token').status_code == 403
+
+
+def test_non_ascii_session_token_is_refused_not_an_error(app, client):
+    seed_participant(app, client, 'P001', 1)
+    response = send(client, 'P001', 'tökén')
+    assert response.status_code == 403
+    assert 'error' in response.get_json()
+
+
+def test_condition_outside_the_study_is_refused(app, client):
+    token = seed_participant(app, client, 'P001', 1)
+    response = send(client, 'P001', token, condition_index=7)   # The example study has 7 conditions
+    assert response.status_code == 400
+    assert 'between 0 and 6' in json.dumps(response.get_json())
+    assert send(client, 'P001', token, condition_index=-1).status_code == 400
+
+
+def test_condition_range_follows_the_study(app, client):
+    os.makedirs('studies')
+    with open('experimental_conditions.json', encoding='utf-8') as f:
+        conditions = json.load(f)
+    conditions['conditions'] = conditions['conditions'][:2]
+    with open(os.path.join('studies', 'pilot.json'), 'w', encoding='utf-8') as f:
+        json.dump(conditions, f)
+
+    assert client.get('/gui?study=pilot&participant_id=P002&condition=1').status_code == 200
+    assert client.get('/gui?study=pilot&participant_id=P003&condition=2').status_code == 400
+    assert client.get('/gui?participant_id=P004&condition=2').status_code == 200
+    assert client.get('/gui?study=missing&participant_id=P005&condition=0').status_code == 404
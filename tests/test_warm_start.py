@@ -0,0 +1,85 @@
+"""Speculative first turns (app.warm_start): what they cost and when they start."""
+
+from unittest import mock
+
+import pytest
+
+import benchmark
+from app import db
+from app.costs import record_usage
+from app.models import CostEntry, Participant, WarmStart
+from app.studies import load_study_config
+from benchmark import STUB_RESPONSE
+
+OPENING = 'Hi!'
+
+
+class InlineThread:
+    """Runs a warm start's background work when started, so tests need not wait for it."""
+
+    def __init__(self, target, args=(), daemon=None):
+        self.target, self.args = target, args
+
+    def start(self):
+        self.target(*self.args)
+
+
+@pytest.fixture
+def warm_client(make_app):
+    def edit(conditions):
+        conditions['conditions'][1]['warm_start'] = {'mode': 'predicted_user', 'opening_message': OPENING}
+        conditions['study_metadata']['pricing'] = {'benchmark-deployment': {'prompt': 1000, 'completion': 1000}}
+        conditions['study_metadata']['cost_budgets'] = {'participant': {'hard': 1.5}}
+
+    app = make_app(edit)
+    model = mock.Mock(side_effect=benchmark.stub_get_chat_response)
+    with benchmark.stubbed_model(), mock.patch('bot.get_chat_response', model), \
+         mock.patch('app.warm_start.threading.Thread', InlineThread):
+        yield app, app.test_client(), model
+
+
+def first_turn(app, client, participant_id, message):
+    with app.app_context():
+        token = db.session.get(Participant, participant_id).session_token
+    return client.post('/api/send_message', json={
+        'participant_id': participant_id, 'session_token': token, 'condition_index': 1, 'message': message,
+    }).get_json()
+
+
+def ledger(app):
+    with app.app_context():
+        return [(entry.participant_id, entry.source) for entry in CostEntry.query.order_by(CostEntry.id)]
+
+
+def test_served_warm_start_is_booked_once(warm_client):
+    app, client, model = warm_client
+    client.get('/gui?participant_id=P001&condition=1')
+    client.get('/gui?participant_id=P001&condition=1')   # A reload while it is live starts nothing
+
+    assert first_turn(app, client, 'P001', 'hi')['message'] == STUB_RESPONSE
+    assert model.call_count == 1
+    assert ledger(app) == [('P001', 'warm_start')]
+
+
+def test_discarded_warm_start_keeps_its_cost(warm_client):
+    app, client, model = warm_client
+    client.get('/gui?participant_id=P001&condition=1')
+    first_turn(app, client, 'P001', 'Something else')
+
+    assert ledger(app) == [('P001', 'warm_start'), ('P001', 'turn')]
+    with app.app_context():
+        assert db.session.get(WarmStart, 'P001').status == 'discarded'
+
+
+def test_no_warm_start_over_budget(warm_client):
+    app, client, model = warm_client
+    with app.app_context():
+        config = load_study_config('default', 1)
+        record_usage(config, 'default', 'P001', benchmark.STUB_RESPONSE_INFO)   # 0.97 of the 1.5 budget
+        record_usage(config, 'default', 'P001', benchmark.STUB_RESPONSE_INFO)
+        db.session.commit()
+
+    assert client.get('/gui?participant_id=P001&condition=1').status_code == 200
+    assert model.call_count == 0
+    with app.app_context():
+        assert db.session.get(WarmStart, 'P001') is None
@@ -0,0 +1,469 @@
+"""
+Request tracing: one trace per participant request, from the route down to each database statement and model attempt.
+
+Each request to the chat endpoints (/gui, /api/send_message(_stream),
+/api/get_history) produces one trace: a tree of timed spans with
+
+    request stages      validate, auth, config, turn_lock, persist_user_message,
+                        load_history, llm_ttft, stream / llm_response,
+                        persist_assistant_message (see app.profiling)
+    db.query            every SQL statement (text only - parameters, and so
+                        participant content, are never recorded)
+    db.commit           each session commit, with the statements it flushed
+    llm.attempt         each attempt of bot.get_chat_response(_stream)'s retry
+                        loop (deployment, outcome, time to first token)
+
+so a slow turn shows whether the time went to SQLite lock waits, history
+loading, retries or the model itself. The trace ID is returned in the
+X-Trace-Id response header and stored with the turn's messages
+(messages.trace_id). An incoming W3C traceparent header (e.g. from a
+tracing proxy) continues that trace, and model requests carry a traceparent
+header of their own.
+
+Finished traces are exported locally, so tracing works offline:
+
+    memory      the last TRACE_BUFFER_SIZE traces of each worker, served by
+                /admin/api/traces (default)
+    file        also appended to TRACE_FILE, one JSON object per line (every
+                worker appends to the same file)
+    off         no tracing
+
+Configuration (environment variables):
+    TRACE_EXPORTER          memory | file | off (default: memory)
+    TRACE_FILE              JSON Lines file of the file exporter (default: data/traces/traces.jsonl)
+    TRACE_BUFFER_SIZE       Traces kept in memory per worker (default: 200)
+    TRACE_MIN_DURATION_MS   Only export traces at least this slow (default: 0 = all)
+"""
+
+import os
+import re
+import json
+import time
+import typing
+import secrets
+import threading
+import contextvars
+import collections
+from datetime import datetime, timezone
+from functools import lru_cache
+
+EXPORTERS = ('memory', 'file', 'off')
+DEFAULT_TRACE_FILE = 'data/traces/traces.jsonl'
+DEFAULT_BUFFER_SIZE = 200
+MAX_STATEMENT_LENGTH = 200       # Characters of SQL kept per db.query span
+MAX_SPANS_PER_TRACE = 2000       # Later spans are counted but not kept
+
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+_SPACES = re.compile(r'\s+')
+
+
+class Span:
+    """A timed operation within a trace; ends when its with block exits or end() is called."""
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'start', 'end_time', 'attributes', 'error')
+
+    def __init__(self, trace: 'Trace', name: str, parent_id: typing.Optional[str],
+                 attributes: typing.Dict[str, typing.Any], start: typing.Optional[float] = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter() if start is None else start
+        self.end_time: typing.Optional[float] = None
+        self.attributes = attributes
+        self.error: typing.Optional[str] = None
+
+    def set(self, key: str, value: typing.Any) -> None:
+        """Add an attribute (JSON-serializable) to the span."""
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        """Mark the span as failed with an exception."""
+        self.error = f"{type(error).__name__}: {error}"[:500]
+
+    def end(self) -> None:
+        """End the span (later calls are ignored)."""
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+            self.trace._close(self)
+
+    def __enter__(self) -> 'Span':
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        if exc is not None and not isinstance(exc, GeneratorExit):
+            self.record_error(exc)
+        self.end()
+        return False
+
+
+class _NullSpan:
+    """Stands in for a span outside a trace: every method does nothing."""
+    __slots__ = ()
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+    def record_error(self, error):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """The spans of one request; spans started while another is open become its children."""
+
+    def __init__(self, name: str, trace_id: typing.Optional[str] = None,
+                 parent_id: typing.Optional[str] = None, attributes: typing.Optional[typing.Dict[str, typing.Any]] = None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.started_at = datetime.now(timezone.utc)
+        self.spans: typing.List[Span] = []
+        self.dropped_spans = 0
+        self._open: typing.List[Span] = []
+        self.root = Span(self, name, parent_id, dict(attributes or {}))
+        self._open.append(self.root)
+
+    def start_span(self, name: str, attributes: typing.Dict[str, typing.Any],
+                   start: typing.Optional[float] = None) -> Span:
+        parent = self.root
+        for candidate in reversed(self._open):
+            # A span recorded after the fact belongs to the innermost span open since its start
+            if start is None or candidate.start <= start:
+                parent = candidate
+                break
+        span = Span(self, name, parent.span_id, attributes, start)
+        if len(self.spans) < MAX_SPANS_PER_TRACE:
+            self.spans.append(span)
+        else:
+            self.dropped_spans += 1
+        self._open.append(span)
+        return span
+
+    def _close(self, span: Span) -> None:
+        # Usually the innermost span; spans left open in a generator can end out of order
+        if self._open and self._open[-1] is span:
+            self._open.pop()
+        elif span in self._open:
+            self._open.remove(span)
+
+    def current_span(self) -> Span:
+        return self._open[-1] if self._open else self.root
+
+    def finish(self) -> None:
+        """End the trace, ending spans left open (marked unfinished)."""
+        for span in self.spans:
+            if span.end_time is None:
+                span.set('unfinished', True)
+                span.end()
+        self.root.end()
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.root.end_time if self.root.end_time is not None else time.perf_counter()
+        return (end - self.root.start) * 1000
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """The trace as exported: span times are milliseconds from the start of the request."""
+        origin = self.root.start
+
+        def span_dict(span: Span) -> typing.Dict[str, typing.Any]:
+            end = span.end_time if span.end_time is not None else time.perf_counter()
+            entry = {
+                'span_id': span.span_id,
+                'parent_id': span.parent_id,
+                'name': span.name,
+                'start_ms': round((span.start - origin) * 1000, 3),
+                'duration_ms': round((end - span.start) * 1000, 3),
+            }
+            if span.attributes:
+                entry['attributes'] = span.attributes
+            if span.error:
+                entry['error'] = span.error
+            return entry
+
+        return {
+            'trace_id': self.trace_id,
+            'name': self.root.name,
+            'start': self.started_at.isoformat(),
+            'duration_ms': round(self.duration_ms, 3),
+            'attributes': self.root.attributes,
+            'error': self.root.error,
+            'dropped_spans': self.dropped_spans,
+            'spans': [span_dict(self.root)] + [span_dict(span) for span in self.spans],
+        }
+
+
+# The trace of the request being handled (per thread and per asyncio task)
+_current: contextvars.ContextVar[typing.Optional[Trace]] = contextvars.ContextVar('trace', default=None)
+
+
+# ============================================================================
+# Exporters
+# ============================================================================
+
+class MemoryExporter:
+    """Keeps the most recent traces of this process."""
+
+    def __init__(self, size: int = DEFAULT_BUFFER_SIZE):
+        self._traces: typing.Deque[typing.Dict[str, typing.Any]] = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def export(self, trace: typing.Dict[str, typing.Any]) -> None:
+        with self._lock:
+            self._traces.append(trace)
+
+    def recent(self, limit: int, min_duration_ms: float = 0) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Most recent traces first."""
+        with self._lock:
+            traces = list(self._traces)
+        return [trace for trace in reversed(traces) if trace['duration_ms'] >= min_duration_ms][:limit]
+
+    def find(self, trace_id: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        with self._lock:
+            return next((trace for trace in self._traces if trace['trace_id'] == trace_id), None)
+
+
+class FileExporter(MemoryExporter):
+    """Keeps recent traces in memory and appends every trace to a JSON Lines file."""
+
+    def __init__(self, path: str, size: int = DEFAULT_BUFFER_SIZE):
+        super().__init__(size)
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, trace):
+        super().export(trace)
+        line = json.dumps(trace, ensure_ascii=False, default=str) + '\n'
+        # One write per trace in append mode, so lines of several workers don't interleave
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+@lru_cache(maxsize=1)
+def get_exporter() -> typing.Optional[MemoryExporter]:
+    """The configured exporter (TRACE_EXPORTER), or None if tracing is off."""
+    name = os.environ.get('TRACE_EXPORTER', 'memory').strip().lower() or 'memory'
+    if name not in EXPORTERS:
+        raise ValueError(f"Unknown TRACE_EXPORTER '{name}'. Use one of: {', '.join(EXPORTERS)}")
+    if name == 'off':
+        return None
+    size = int(os.environ.get('TRACE_BUFFER_SIZE', DEFAULT_BUFFER_SIZE))
+    if name == 'file':
+        return FileExporter(os.environ.get('TRACE_FILE') or DEFAULT_TRACE_FILE, size)
+    return MemoryExporter(size)
+
+
+def read_trace_file(trace_id: str, path: typing.Optional[str] = None) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Find a trace in a trace file (e.g. for a message's trace_id, after the worker has restarted).
+
+    Args:
+        trace_id: Trace to find
+        path: JSON Lines file (default: TRACE_FILE)
+
+    Returns:
+        The trace, or None if the file does not contain it
+    """
+    path = path or os.environ.get('TRACE_FILE') or DEFAULT_TRACE_FILE
+    if not os.path.exists(path):
+        return None
+    marker = f'"trace_id": "{trace_id}"'
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if marker in line:
+                return json.loads(line)
+    return None
+
+
+# ============================================================================
+# Tracing API
+# ============================================================================
+
+def start_trace(name: str, traceparent: typing.Optional[str] = None, **attributes) -> typing.Optional[Trace]:
+    """
+    Start the trace of a request in the current context (None if tracing is off).
+
+    Args:
+        name: Trace name, e.g. 'POST /api/send_message'
+        traceparent: Incoming W3C traceparent header; a valid one is continued
+        **attributes: Attributes of the request span
+    """
+    if get_exporter() is None:
+        return None
+    trace_id = parent_id = None
+    match = _TRACEPARENT.match(traceparent or '')
+    if match and match.group(1) != '0' * 32:
+        trace_id, parent_id = match.groups()
+    trace = Trace(name, trace_id, parent_id, attributes)
+    _current.set(trace)
+    return trace
+
+
+def finish_trace(error: typing.Optional[BaseException] = None) -> typing.Optional[Trace]:
+    """End the current trace and export it. Never raises."""
+    trace = _current.get()
+    if trace is None:
+        return None
+    _current.set(None)
+    try:
+        if error is not None:
+            trace.root.record_error(error)
+        trace.finish()
+        if trace.duration_ms >= float(os.environ.get('TRACE_MIN_DURATION_MS', 0) or 0):
+            get_exporter().export(trace.to_dict())
+    except Exception as e:
+        print(f"⚠️  Could not export trace {trace.trace_id}: {type(e).__name__}: {e}")
+    return trace
+
+
+def current_trace_id() -> typing.Optional[str]:
+    """ID of the current trace (None outside a traced request)."""
+    trace = _current.get()
+    return trace.trace_id if trace is not None else None
+
+
+def span(name: str, **attributes) -> typing.Union[Span, _NullSpan]:
+    """
+    Start a span in the current trace (a no-op outside a traced request).
+
+    Usage:
+        with tracing.span('llm.attempt', attempt=1) as attempt_span:
+            ...
+            attempt_span.set('finish_reason', 'stop')
+
+    or, where a with block does not fit, keep the span and call end().
+    """
+    trace = _current.get()
+    if trace is None:
+        return _NULL_SPAN
+    return trace.start_span(name, attributes)
+
+
+def record(name: str, started: float, **attributes) -> None:
+    """Add a span that started at `started` (time.perf_counter()) and ends now."""
+    trace = _current.get()
+    if trace is not None:
+        trace.start_span(name, attributes, started).end()
+
+
+def annotate(**attributes) -> None:
+    """Add attributes to the current request's span (e.g. the participant, once authenticated)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.root.attributes.update(attributes)
+
+
+def propagation_headers() -> typing.Dict[str, str]:
+    """W3C traceparent header for an outgoing request, made from the current span (empty outside a trace)."""
+    trace = _current.get()
+    if trace is None:
+        return {}
+    return {'traceparent': f"00-{trace.trace_id}-{trace.current_span().span_id}-01"}
+
+
+# ============================================================================
+# Flask and SQLAlchemy integration
+# ============================================================================
+
+def _statement_summary(statement: str) -> str:
+    statement = _SPACES.sub(' ', statement).strip()
+    if len(statement) > MAX_STATEMENT_LENGTH:
+        return statement[:MAX_STATEMENT_LENGTH] + '...'
+    return statement
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _current.get() is not None:
+        context._trace_span = span('db.query', statement=_statement_summary(statement), executemany=executemany)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    query_span = getattr(context, '_trace_span', None)
+    if query_span is not None:
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            query_span.set('rows', cursor.rowcount)
+        query_span.end()
+        context._trace_span = None
+
+
+def _handle_error(exception_context):
+    query_span = getattr(exception_context.execution_context, '_trace_span', None)
+    if query_span is not None:
+        query_span.record_error(exception_context.original_exception)
+        query_span.end()
+        exception_context.execution_context._trace_span = None
+
+
+def _before_commit(session):
+    if _current.get() is not None and 'trace_commit_span' not in session.info:
+        session.info['trace_commit_span'] = span('db.commit')
+
+
+def _end_commit(session, error: typing.Optional[str] = None):
+    commit_span = session.info.pop('trace_commit_span', None)
+    if commit_span is not None:
+        if error:
+            commit_span.set('outcome', error)
+        commit_span.end()
+
+
+def instrument_sqlalchemy() -> None:
+    """Trace SQL statements and session commits of every engine and session (once per process)."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import Session
+
+    if event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    event.listen(Session, 'before_commit', _before_commit)
+    event.listen(Session, 'after_commit', _end_commit)
+    event.listen(Session, 'after_soft_rollback', lambda session, previous: _end_commit(session, 'rolled back'))
+
+
+def init_app(app, endpoints: typing.Iterable[str]) -> None:
+    """
+    Trace requests to the given endpoints of a Flask app, and its database work.
+
+    The trace ends when the request context is torn down: for a streamed
+    response (stream_with_context), once the stream has been sent.
+    """
+    from flask import request
+
+    if get_exporter() is None:
+        return
+    traced = frozenset(endpoints)
+    instrument_sqlalchemy()
+
+    @app.before_request
+    def start_request_trace():
+        if request.endpoint in traced:
+            start_trace(f"{request.method} {request.path}",
+                        traceparent=request.headers.get('traceparent'),
+                        endpoint=request.endpoint)
+
+    @app.after_request
+    def add_trace_header(response):
+        trace = _current.get()
+        if trace is not None:
+            trace.root.set('status', response.status_code)
+            response.headers['X-Trace-Id'] = trace.trace_id
+        return response
+
+    @app.teardown_request
+    def finish_request_trace(error=None):
+        finish_trace(error)
@@ -2,9 +2,13 @@
 WSGI entry point for production deployment with Gunicorn or uWSGI.
 """
 
-from app import create_app
+from app import create_app, warm_up
 
 app = create_app()
 
+# Preload conditions and the model client. With gunicorn --preload this runs
+# once before workers fork, so workers take traffic without a cold first request.
+warm_up(app)
+
 if __name__ == "__main__":
     app.run()
\ No newline at end of file